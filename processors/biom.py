@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+BIOM Table Reader
+读取 BIOM 1.0 (JSON) 与 2.1 (HDF5) 表, 直接由存储的数组构建 samples x observations 的 CSR 矩阵
+
+- JSON: 顶层成员逐个解析, 数值部分 ('data') 不经过 json 模块, 整段交给 numpy 的文本解析器
+- HDF5: sample/matrix 本身就是按样本压缩的 CSR, 三个数组原样读出 (需要 h5py)
+"""
+
+import json
+import re
+import numpy as np
+from scipy import sparse
+from typing import Dict, List, Optional, Tuple
+
+
+# 分类等级 (BIOM taxonomy 元数据按此顺序)
+RANKS = ['kingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species']
+
+_HDF5_MAGIC = b'\x89HDF\r\n\x1a\n'
+_WS = re.compile(r'\s*')
+_ROWS_END = re.compile(r'\]\s*\]')
+
+
+def is_hdf5(path: str) -> bool:
+    with open(path, 'rb') as f:
+        return f.read(8) == _HDF5_MAGIC
+
+
+def _array_end(text: str, start: int) -> int:
+    """text[start] 为 data 数组的 '[': 返回数组结束后的位置 (data 只含数字与方括号, 以第一个 ']]' 结束)"""
+    pos = _WS.match(text, start + 1).end()
+    if text[pos:pos + 1] == ']':
+        return pos + 1
+    m = _ROWS_END.search(text, pos)
+    if m is None:
+        raise ValueError("unterminated BIOM 'data' array")
+    return m.end()
+
+
+def _split_data(text: str) -> Tuple[Dict, str]:
+    """
+    逐个解析顶层对象的成员 (json.JSONDecoder.raw_decode), 返回 (其余字段, 顶层 data 数组文本);
+    只有顶层 'data' 的值不经过 json 模块, 元数据中同名的 "data" 字段照常解析
+    """
+    decoder = json.JSONDecoder()
+    pos = _WS.match(text, 0).end()
+    if text[pos:pos + 1] != '{':
+        raise ValueError("BIOM JSON must be an object")
+    pos = _WS.match(text, pos + 1).end()
+    table, data = {}, None
+    while text[pos:pos + 1] != '}':
+        key, pos = decoder.raw_decode(text, pos)
+        pos = _WS.match(text, pos).end()
+        if not isinstance(key, str) or text[pos:pos + 1] != ':':
+            raise ValueError(f"malformed BIOM JSON at offset {pos}")
+        pos = _WS.match(text, pos + 1).end()
+        if key == 'data' and text[pos:pos + 1] == '[':
+            stop = _array_end(text, pos)
+            data = text[pos:stop]
+        else:
+            table[key], stop = decoder.raw_decode(text, pos)
+        pos = _WS.match(text, stop).end()
+        if text[pos:pos + 1] == ',':
+            pos = _WS.match(text, pos + 1).end()
+        elif text[pos:pos + 1] != '}':
+            raise ValueError(f"malformed BIOM JSON at offset {pos}")
+    if data is None:
+        raise ValueError("BIOM JSON has no 'data' field")
+    return table, data
+
+
+def _parse_numbers(text: str) -> np.ndarray:
+    """'[[0, 1, 2.0], ...]' -> 一维 float64 数组"""
+    flat = text.translate(str.maketrans('[],', '   '))
+    if not flat.strip():
+        return np.empty(0)
+    return np.fromstring(flat, dtype=np.float64, sep=' ')
+
+
+def _taxonomy(values: List) -> List[List[str]]:
+    """每个特征的分类路径, 补齐到 len(RANKS); 字符串形式按 ';' 分割"""
+    out = []
+    for v in values:
+        if v is None:
+            v = []
+        elif isinstance(v, (str, bytes)):
+            v = v.decode() if isinstance(v, bytes) else v
+            v = v.split(';')
+        v = [(s.decode() if isinstance(s, bytes) else str(s)).strip() for s in v][:len(RANKS)]
+        out.append(v + [''] * (len(RANKS) - len(v)))
+    return out
+
+
+def _columns(records: List[Optional[Dict]]) -> Dict[str, List]:
+    """逐样本的元数据字典 -> 按列的表, 缺失值为 None"""
+    keys: List[str] = []
+    for r in records:
+        for k in (r or {}):
+            if k not in keys:
+                keys.append(k)
+    return {k: [(r or {}).get(k) for r in records] for k in keys}
+
+
+def _read_json(path: str) -> Dict:
+    with open(path) as f:
+        table, data = _split_data(f.read())
+    n_obs, n_samples = table['shape']
+    values = _parse_numbers(data)
+    if table.get('matrix_type', 'sparse') == 'sparse':
+        entries = values.reshape(-1, 3)
+        X = sparse.csr_matrix(
+            (entries[:, 2], (entries[:, 1].astype(np.int64), entries[:, 0].astype(np.int64))),
+            shape=(n_samples, n_obs)
+        )
+    else:
+        X = sparse.csr_matrix(values.reshape(n_obs, n_samples).T)
+    rows, columns = table['rows'], table['columns']
+    obs_meta = [r.get('metadata') or {} for r in rows]
+    return {
+        "counts": X,
+        "sample_ids": [str(c['id']) for c in columns],
+        "feature_ids": [str(r['id']) for r in rows],
+        "taxonomy": _taxonomy([m.get('taxonomy') for m in obs_meta])
+        if any('taxonomy' in m for m in obs_meta) else None,
+        "sample_metadata": _columns([c.get('metadata') for c in columns]),
+        "format": "biom1"
+    }
+
+
+def _decode(values: np.ndarray) -> List:
+    return [v.decode() if isinstance(v, bytes) else v for v in values.tolist()]
+
+
+def _read_hdf5(path: str) -> Dict:
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError("reading BIOM 2.x (HDF5) tables requires h5py")
+    with h5py.File(path, 'r') as f:
+        n_obs, n_samples = (int(v) for v in f.attrs['shape'])
+        grp = f['sample/matrix']
+        # 按样本压缩: indptr 长度 n_samples+1, indices 为观测下标
+        X = sparse.csr_matrix(
+            (grp['data'][:], grp['indices'][:], grp['indptr'][:]), shape=(n_samples, n_obs)
+        )
+        taxonomy = None
+        if 'observation/metadata/taxonomy' in f:
+            taxonomy = _taxonomy(list(f['observation/metadata/taxonomy'][:]))
+        sample_metadata = {}
+        if 'sample/metadata' in f:
+            for key, ds in f['sample/metadata'].items():
+                if isinstance(ds, h5py.Dataset) and ds.ndim == 1:
+                    sample_metadata[key] = _decode(ds[:])
+        return {
+            "counts": X,
+            "sample_ids": [str(v) for v in _decode(f['sample/ids'][:])],
+            "feature_ids": [str(v) for v in _decode(f['observation/ids'][:])],
+            "taxonomy": taxonomy,
+            "sample_metadata": sample_metadata,
+            "format": "biom2"
+        }
+
+
+def read_biom(path: str) -> Dict:
+    """
+    读取 BIOM 表 (按文件头自动区分 JSON / HDF5)
+    返回 counts (samples x observations CSR), sample_ids, feature_ids,
+    taxonomy (每个特征一条补齐到 RANKS 的路径, 没有时为 None), sample_metadata (按列), format
+    """
+    table = _read_hdf5(path) if is_hdf5(path) else _read_json(path)
+    X = table["counts"]
+    X.sum_duplicates()
+    X.eliminate_zeros()
+    return table
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+Clustered Heatmap Engine
+大矩阵 (如 2万 x 500) 聚类热图: 行列聚类, 按像素聚合, 可缩放的瓦片金字塔
+
+- 距离: euclidean / correlation 由一次矩阵乘法得到, manhattan 用 scipy 的 pdist, bray = manhattan / 两行总和之和
+- 行数不超过 max_exact 时精确层次聚类; 更多时先在随机化PCA空间中用 k-means 聚成微簇,
+  对微簇中心做层次聚类, 微簇内部按第一主成分排序 (输出分辨率下同一微簇本来就落在相邻的像素行)
+- 出图只用按输出像素聚合后的矩阵, 绘制开销与矩阵大小无关
+- 瓦片金字塔: 第 z 级的每个轴按 2 的幂聚合, 0 级整体放进一个瓦片, 最高级为原始分辨率;
+  每一级由上一级 2x 合并得到 (带计数的加权平均), 读取一个瓦片只触及该级的 tile x tile 个值
+"""
+
+import io
+import numpy as np
+from matplotlib import colormaps
+from matplotlib.image import imsave
+from scipy import sparse
+from scipy.cluster.hierarchy import leaves_list, linkage
+from scipy.spatial.distance import pdist, squareform
+from typing import Dict, List, Optional, Tuple
+
+try:
+    from .ordination import sparse_pca
+except ImportError:  # 作为脚本直接运行
+    from ordination import sparse_pca
+
+LINKAGE_METHODS = {'ward.d2': 'ward', 'ward': 'ward', 'average': 'average', 'complete': 'complete', 'single': 'single'}
+DISTANCES = ['bray', 'euclidean', 'correlation', 'manhattan']
+TILE_SIZE = 256
+# 精确层次聚类的行数上限: 8000 行的压缩距离约 256 MB (float64), scipy linkage 另需一份副本
+MAX_EXACT_LINKAGE = 8000
+
+
+def scale_matrix(M: np.ndarray, scale: str) -> np.ndarray:
+    """按行/列 z-score (float32, 常数行/列为0); scale='none' 时原样返回 float32 副本"""
+    Z = np.array(M, dtype=np.float32)
+    if scale == 'none':
+        return Z
+    axis = 1 if scale == 'row' else 0
+    Z -= Z.mean(axis=axis, keepdims=True)
+    sd = np.sqrt((Z * Z).sum(axis=axis, keepdims=True) / max(Z.shape[axis] - 1, 1))
+    Z /= np.where(sd > 0, sd, np.inf)
+    return Z
+
+
+def condensed_distances(B: np.ndarray, metric: str) -> np.ndarray:
+    """行之间的压缩距离向量 (float64)"""
+    X = np.ascontiguousarray(B, dtype=np.float64)
+    if metric in ('bray', 'manhattan'):
+        d = pdist(X, metric='cityblock')
+        if metric == 'bray':
+            # Bray-Curtis = sum|a - b| / sum(a + b); 全零的两行距离记为 0
+            total = X.sum(axis=1)
+            S = total[:, None] + total[None, :]
+            np.fill_diagonal(S, 0.0)
+            denom = squareform(S, checks=False)
+            d = np.divide(d, denom, out=np.zeros_like(d), where=denom > 0)
+        return d
+    if metric == 'correlation':
+        X = X - X.mean(axis=1, keepdims=True)
+        norm = np.linalg.norm(X, axis=1, keepdims=True)
+        X /= np.where(norm > 0, norm, np.inf)
+        D = X @ X.T
+        np.subtract(1.0, D, out=D)
+    elif metric == 'euclidean':
+        sq = np.einsum('ij,ij->i', X, X)
+        D = X @ X.T
+        D *= -2.0
+        D += sq[:, None]
+        D += sq[None, :]
+        np.sqrt(np.maximum(D, 0.0, out=D), out=D)
+    else:
+        raise ValueError(f"unsupported distance: {metric}")
+    np.fill_diagonal(D, 0.0)
+    np.maximum(D, 0.0, out=D)
+    return squareform(D, checks=False)
+
+
+def _kmeans(Y: np.ndarray, k: int, n_iter: int = 15, block: int = 4096, seed: int = 0) -> np.ndarray:
+    """
+    Lloyd k-means (随机初始中心), 距离按行块由矩阵乘法得到 (内存 block x k);
+    返回各行的簇编号 (0..簇数-1, 不含空簇)
+    """
+    rng = np.random.default_rng(seed)
+    Y = np.asarray(Y, dtype=np.float32)
+    n = Y.shape[0]
+    centers = Y[rng.choice(n, k, replace=False)].copy()
+    labels = np.full(n, -1, dtype=np.int64)
+    best = np.empty(n, dtype=np.float32)
+    for _ in range(n_iter):
+        csq = np.einsum('ij,ij->i', centers, centers)
+        new = np.empty(n, dtype=np.int64)
+        for lo in range(0, n, block):
+            # |y - c|^2 去掉与簇无关的 |y|^2
+            d = Y[lo:lo + block] @ centers.T
+            d *= -2.0
+            d += csq[None, :]
+            nearest = d.argmin(axis=1)
+            new[lo:lo + block] = nearest
+            best[lo:lo + block] = np.take_along_axis(d, nearest[:, None], axis=1)[:, 0]
+        if np.array_equal(new, labels):
+            break
+        labels = new
+        counts = np.bincount(labels, minlength=k)
+        onehot = sparse.csr_matrix((np.ones(n, dtype=np.float32), (labels, np.arange(n))), shape=(k, n))
+        sums = onehot @ Y
+        empty = counts == 0
+        centers[~empty] = sums[~empty] / counts[~empty, None]
+        # 空簇重新放到离当前中心最远的点上
+        if empty.any():
+            far = np.argsort(best + np.einsum('ij,ij->i', Y, Y))[-int(empty.sum()):]
+            centers[empty] = Y[far]
+    return np.unique(labels, return_inverse=True)[1]
+
+
+def cluster_order(
+    B: np.ndarray,
+    method: str,
+    metric: str,
+    max_exact: int = 4000,
+    n_components: int = 30,
+    seed: int = 0
+) -> Dict:
+    """
+    行的层次聚类顺序
+    返回 order (叶序), linkage (叶为行或微簇), leaf_sizes (每个叶包含的行数, 按叶序), approximate
+    """
+    n = B.shape[0]
+    if n < 3:
+        return {"order": np.arange(n), "linkage": None, "leaf_sizes": np.ones(n, dtype=np.int64), "approximate": False}
+    if n <= max_exact:
+        Z = linkage(condensed_distances(B, metric), method=method)
+        return {"order": leaves_list(Z), "linkage": Z, "leaf_sizes": np.ones(n, dtype=np.int64), "approximate": False}
+
+    # 微簇: Bray-Curtis 在行比例上近似 (Hellinger 变换), 其余在矩阵本身上; 随机化PCA后做 k-means
+    X = np.asarray(B, dtype=np.float64)
+    if metric == 'bray':
+        X = np.sqrt(np.maximum(X, 0.0) / np.maximum(X.sum(axis=1, keepdims=True), 1e-300))
+    elif metric == 'correlation':
+        X = X - X.mean(axis=1, keepdims=True)
+        X /= np.maximum(np.linalg.norm(X, axis=1, keepdims=True), 1e-300)
+    scores = sparse_pca(X, max(min(n_components, X.shape[1] - 1), 1), seed=seed)[0]
+    labels = _kmeans(scores, max(max_exact // 2, 3), seed=seed)
+    k = int(labels.max()) + 1
+    if k < 3:
+        order = np.lexsort((scores[:, 0], labels))
+        return {"order": order, "linkage": None, "leaf_sizes": np.ones(n, dtype=np.int64), "approximate": True}
+    counts = np.bincount(labels, minlength=k)
+    onehot = sparse.csr_matrix((np.ones(n), (labels, np.arange(n))), shape=(k, n))
+    centroids = (onehot @ np.asarray(B, dtype=np.float64)) / counts[:, None]
+    Z = linkage(condensed_distances(centroids, metric), method=method)
+    leaf = leaves_list(Z)
+    rank = np.empty(k, dtype=np.int64)
+    rank[leaf] = np.arange(k)
+    order = np.lexsort((scores[:, 0], rank[labels]))
+    return {"order": order, "linkage": Z, "leaf_sizes": counts[leaf], "approximate": True}
+
+
+def aggregate(M: np.ndarray, n_rows: int, n_cols: int) -> np.ndarray:
+    """把矩阵按行/列等分为至多 n_rows x n_cols 个箱取均值 (已不超过时原样返回)"""
+    out = np.asarray(M, dtype=np.float32)
+    for axis, target in ((0, n_rows), (1, n_cols)):
+        size = out.shape[axis]
+        if size <= target:
+            continue
+        starts = np.linspace(0, size, target + 1).astype(np.int64)[:-1]
+        counts = np.diff(np.append(starts, size)).astype(np.float32)
+        out = np.add.reduceat(out, starts, axis=axis)
+        out /= counts[:, None] if axis == 0 else counts[None, :]
+    return out
+
+
+def dendrogram_segments(Z: np.ndarray, leaf_sizes: np.ndarray) -> np.ndarray:
+    """
+    树状图的线段 (k, 2, 2), 坐标为 (沿轴位置, 高度); 叶的位置为其所含行块的中心,
+    因此微簇树与按行排列的热图对齐
+    """
+    n_leaves = Z.shape[0] + 1
+    leaf = leaves_list(Z)
+    ends = np.cumsum(leaf_sizes)
+    x = np.zeros(2 * n_leaves - 1)
+    x[leaf] = ends - leaf_sizes / 2.0
+    h = np.zeros(2 * n_leaves - 1)
+    segments = np.empty((3 * Z.shape[0], 2, 2))
+    for i, (a, b, height, _) in enumerate(Z):
+        a, b = int(a), int(b)
+        node = n_leaves + i
+        x[node] = (x[a] + x[b]) / 2.0
+        h[node] = height
+        segments[3 * i] = [[x[a], h[a]], [x[a], height]]
+        segments[3 * i + 1] = [[x[b], h[b]], [x[b], height]]
+        segments[3 * i + 2] = [[x[a], height], [x[b], height]]
+    return segments
+
+
+def _levels(size: int, tile: int) -> int:
+    """该轴放进一个瓦片所需的 2x 合并次数"""
+    return max(0, int(np.ceil(np.log2(size / tile)))) if size > tile else 0
+
+
+def pyramid_factors(shape: Tuple[int, int], tile: int = TILE_SIZE) -> List[Tuple[int, int]]:
+    """每一级 (0 = 最粗) 的一个格子覆盖的原始行数与列数"""
+    zr, zc = _levels(shape[0], tile), _levels(shape[1], tile)
+    return [(2 ** max(zr - z, 0), 2 ** max(zc - z, 0)) for z in range(max(zr, zc) + 1)]
+
+
+def _pool2(values: np.ndarray, weights: np.ndarray, axis: int) -> Tuple[np.ndarray, np.ndarray]:
+    """沿 axis 两两合并 (按权重加权平均), 返回合并后的值与权重"""
+    starts = np.arange(0, values.shape[axis], 2)
+    w = weights[:, None] if axis == 0 else weights[None, :]
+    pooled = np.add.reduceat(values * w, starts, axis=axis)
+    new_w = np.add.reduceat(weights, starts)
+    pooled /= new_w[:, None] if axis == 0 else new_w[None, :]
+    return pooled.astype(np.float32), new_w
+
+
+def tile_pyramid(Z: np.ndarray, tile: int = TILE_SIZE) -> List[np.ndarray]:
+    """瓦片金字塔, 下标为缩放级别 (0 = 最粗, 最后一级 = 原始矩阵)"""
+    zr, zc = _levels(Z.shape[0], tile), _levels(Z.shape[1], tile)
+    levels = [np.asarray(Z, dtype=np.float32)]
+    rw = np.ones(Z.shape[0], dtype=np.float32)
+    cw = np.ones(Z.shape[1], dtype=np.float32)
+    for z in range(max(zr, zc) - 1, -1, -1):
+        cur = levels[-1]
+        if z < zr:
+            cur, rw = _pool2(cur, rw, 0)
+        if z < zc:
+            cur, cw = _pool2(cur, cw, 1)
+        levels.append(cur)
+    return levels[::-1]
+
+
+def color_limits(Z: np.ndarray, diverging: bool) -> Tuple[float, float]:
+    """颜色范围: 缩放后的矩阵以 0 为中心取 |z| 的 99.5% 分位, 否则取 0.5% - 99.5% 分位 (避免个别极值压缩色阶)"""
+    sample = np.asarray(Z, dtype=np.float32).ravel()
+    if sample.size > 1_000_000:
+        sample = sample[np.random.default_rng(0).choice(sample.size, 1_000_000, replace=False)]
+    sample = sample[np.isfinite(sample)]
+    if sample.size == 0:
+        return 0.0, 1.0
+    if diverging:
+        lim = float(np.percentile(np.abs(sample), 99.5)) or 1.0
+        return -lim, lim
+    lo, hi = (float(v) for v in np.percentile(sample, [0.5, 99.5]))
+    return lo, hi if hi > lo else lo + 1.0
+
+
+def tile_png(level: np.ndarray, x: int, y: int, cmap: str, vmin: float, vmax: float, tile: int = TILE_SIZE) -> Optional[bytes]:
+    """某一级的第 (x, y) 个瓦片 (x 沿列, y 沿行) 的 PNG; 超出范围返回 None; 边缘瓦片用透明像素补齐"""
+    r0, c0 = y * tile, x * tile
+    if x < 0 or y < 0 or r0 >= level.shape[0] or c0 >= level.shape[1]:
+        return None
+    block = np.asarray(level[r0:r0 + tile, c0:c0 + tile], dtype=np.float32)
+    rgba = np.zeros((tile, tile, 4), dtype=np.uint8)
+    norm = (block - vmin) / (vmax - vmin)
+    colors = colormaps[cmap](np.clip(np.nan_to_num(norm, nan=0.0), 0.0, 1.0), bytes=True)
+    colors[~np.isfinite(block), 3] = 0
+    rgba[:block.shape[0], :block.shape[1]] = colors
+    buf = io.BytesIO()
+    imsave(buf, rgba, format='png')
+    return buf.getvalue()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+LEfSe
+线性判别分析效应量 (Segata et al. 2011): Kruskal-Wallis -> 组间两两 Wilcoxon -> 自助法 LDA 效应量
+
+- 两步秩检验对全部特征同时进行 (按列的秩矩阵)
+- 所有自助样本的 LDA 一起拟合: 组内/组间散布矩阵是 (B, p, p) 的批量张量 (按内存上限分块),
+  判别方向由批量 Cholesky + 对称特征分解 (两组时直接解 Sw w = mu_a - mu_b) 得到
+"""
+
+import numpy as np
+from typing import Dict
+
+try:
+    from .stats import kruskal_columns, ranksum_columns
+except ImportError:  # 作为脚本直接运行
+    from stats import kruskal_columns, ranksum_columns
+
+
+def _pairwise_filter(
+    X: np.ndarray,
+    codes: np.ndarray,
+    alpha: float,
+    min_samples: int,
+    strategy: str
+) -> np.ndarray:
+    """
+    组间两两比较 (同 LEfSe 的 test_rep_wilcoxon_r, 无亚组):
+    一对组有差异 = 中位数不同, 且两组都不少于 min_samples 个样本时 Wilcoxon p < alpha (样本不足时只比较中位数);
+    one-against-all: 某个组与其余每一组都有差异即通过; one-against-one: 所有组对都有差异才通过
+    """
+    k = int(codes.max()) + 1
+    medians = np.stack([np.median(X[codes == c], axis=0) for c in range(k)])
+    sizes = np.bincount(codes, minlength=k)
+    differs = np.zeros((k, k, X.shape[1]), dtype=bool)
+    for a in range(k):
+        for b in range(a + 1, k):
+            ok = medians[a] != medians[b]
+            if min(sizes[a], sizes[b]) >= min_samples:
+                _, p = ranksum_columns(X[codes == a], X[codes == b])
+                ok &= np.nan_to_num(p, nan=1.0) < alpha
+            differs[a, b] = differs[b, a] = ok
+    if strategy == 'one-against-one':
+        return differs[np.triu_indices(k, 1)].all(axis=0)
+    return (differs.sum(axis=1) == k - 1).any(axis=0)
+
+
+def _bootstrap_indices(codes: np.ndarray, n_boots: int, fraction: float, rng: np.random.Generator) -> np.ndarray:
+    """分层有放回抽样: 每组抽 fraction x 组大小 (至少2) 个样本, 返回 (n_boots, m) 的样本下标"""
+    parts = []
+    for c in range(int(codes.max()) + 1):
+        members = np.flatnonzero(codes == c)
+        size = max(int(members.size * fraction), 2)
+        parts.append(members[rng.integers(0, members.size, (n_boots, size))])
+    return np.concatenate(parts, axis=1)
+
+
+def lda_effect_sizes(
+    X: np.ndarray,
+    codes: np.ndarray,
+    n_boots: int = 30,
+    fraction: float = 2.0 / 3.0,
+    ridge: float = 1e-6,
+    max_block_bytes: int = 1 << 28,
+    seed: int = 0
+) -> np.ndarray:
+    """
+    LEfSe 的 LDA 效应量 (log10 尺度): 每个自助样本拟合 LDA, 取第一判别方向的单位向量 w,
+    每对组的得分为 (|mu_a - mu_b| + |w| * |(mu_a - mu_b) . w|) / 2, 对自助样本取均值, 对组对取最大值后 log10(1 + .)
+    X: samples x features (已过滤的特征); 组内散布矩阵加上 ridge x 平均对角元 的对角项以保证可逆
+    """
+    rng = np.random.default_rng(seed)
+    k = int(codes.max()) + 1
+    p = X.shape[1]
+    idx = _bootstrap_indices(codes, n_boots, fraction, rng)
+    sub_codes = codes[idx[0]]
+    G = np.zeros((k, idx.shape[1]))
+    G[sub_codes, np.arange(idx.shape[1])] = 1.0
+    counts = G.sum(axis=1)
+    # 自助样本分块, 每块的 (块大小, p, p) 散布矩阵不超过 max_block_bytes
+    chunk = int(max(1, min(n_boots, max_block_bytes // (8 * p * p * 3))))
+    means = np.empty((n_boots, k, p))
+    w = np.empty((n_boots, p))
+    for start in range(0, n_boots, chunk):
+        sub = X[idx[start:start + chunk]]
+        m = (G / counts[:, None]) @ sub
+        centered = sub - G.T @ m
+        Sw = np.swapaxes(centered, 1, 2) @ centered / max(idx.shape[1] - k, 1)
+        load = ridge * np.trace(Sw, axis1=1, axis2=2) / p + 1e-12
+        Sw[:, np.arange(p), np.arange(p)] += load[:, None]
+        if k == 2:
+            v = np.linalg.solve(Sw, (m[:, 0] - m[:, 1])[..., None])[..., 0]
+        else:
+            grand = counts @ m / counts.sum()
+            dev = (m - grand[:, None, :]) * np.sqrt(counts)[None, :, None]
+            L = np.linalg.cholesky(Sw)
+            # Sw^-1 Sb 的主特征向量 = L^-T u, u 为 L^-1 Sb L^-T 的主特征向量; Sb = dev^T dev 只需解 L Y = dev^T
+            Y = np.linalg.solve(L, np.swapaxes(dev, 1, 2))
+            _, vecs = np.linalg.eigh(Y @ np.swapaxes(Y, 1, 2))
+            v = np.linalg.solve(np.swapaxes(L, 1, 2), vecs[:, :, -1:])[..., 0]
+        means[start:start + chunk] = m
+        w[start:start + chunk] = v
+    w /= np.maximum(np.linalg.norm(w, axis=1, keepdims=True), 1e-300)
+
+    best = np.zeros(p)
+    for a in range(k):
+        for b in range(a + 1, k):
+            diff = means[:, a] - means[:, b]
+            effect = np.abs(np.einsum('bp,bp->b', diff, w))
+            score = ((np.abs(diff) + np.abs(w) * effect[:, None]) / 2.0).mean(axis=0)
+            best = np.maximum(best, score)
+    return np.log10(1.0 + best)
+
+
+def lefse(
+    X: np.ndarray,
+    codes: np.ndarray,
+    kw_alpha: float = 0.05,
+    wilcoxon_alpha: float = 0.05,
+    lda_threshold: float = 2.0,
+    min_samples: int = 10,
+    strategy: str = 'one-against-all',
+    n_boots: int = 30,
+    seed: int = 0
+) -> Dict[str, np.ndarray]:
+    """
+    LEfSe 全流程; X: samples x features 相对丰度 (LEfSe 惯例每个样本总和为 1e6), codes: 组编码 0..k-1
+    返回各特征的 kw_pvalue, passed_tests, lda (未通过检验为 NaN), enriched (平均丰度最高的组), marker;
+    n_boots=0 时只做两步秩检验 (lda 全为 NaN, marker 即 passed_tests)
+    """
+    X = np.asarray(X, dtype=np.float64)
+    k = int(codes.max()) + 1
+    _, kw_p = kruskal_columns(X, codes)
+    passed = np.nan_to_num(kw_p, nan=1.0) < kw_alpha
+    cand = np.flatnonzero(passed)
+    if cand.size:
+        passed[cand] = _pairwise_filter(X[:, cand], codes, wilcoxon_alpha, min_samples, strategy)
+    cand = np.flatnonzero(passed)
+
+    lda = np.full(X.shape[1], np.nan)
+    if cand.size and n_boots > 0:
+        lda[cand] = lda_effect_sizes(X[:, cand], codes, n_boots=n_boots, seed=seed)
+    class_means = np.stack([X[codes == c].mean(axis=0) for c in range(k)])
+    return {
+        "kw_pvalue": kw_p,
+        "passed_tests": passed,
+        "lda": lda,
+        "enriched": np.argmax(class_means, axis=0),
+        "marker": passed & (np.nan_to_num(lda) >= lda_threshold) if n_boots > 0 else passed
+    }
+
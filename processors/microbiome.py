@@ -4,8 +4,376 @@
 整合自原R包功能
 """
 
+import os
 import json
-from typing import Dict, List
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+from functools import lru_cache
+from scipy import sparse
+from scipy.cluster.hierarchy import fcluster, leaves_list, linkage
+from typing import Dict, List, Optional, Tuple, Union
+
+try:
+    from .distance import pairwise_distances
+    from .phylo import parse_newick, read_newick, random_tree, unifrac
+    from .ordination import pcoa, nmds, sparse_pca
+    from .stats import (
+        permanova, anosim, modularity, modularity_communities,
+        standardize_columns, correlation_pvalues
+    )
+    from .biom import RANKS, read_biom
+    from .taxonomy import build_hierarchy, collapse
+    from .network import sparcc_pvalues
+    from .nbglm import nb_wald_test
+    from .normalize import rarefy, sequential_hypergeometric, tss, clr, css, css_quantile
+    from .lefse import lefse
+    from .wgcna import (
+        pick_soft_threshold, blocked_tom, tom_distances, tom_linkage, linkage_memory, max_block_size,
+        projective_blocks, dynamic_tree_cut, merge_close_modules, module_eigengenes, rank_by_size
+    )
+except ImportError:  # 作为脚本直接运行
+    from distance import pairwise_distances
+    from phylo import parse_newick, read_newick, random_tree, unifrac
+    from ordination import pcoa, nmds, sparse_pca
+    from stats import (
+        permanova, anosim, modularity, modularity_communities,
+        standardize_columns, correlation_pvalues
+    )
+    from biom import RANKS, read_biom
+    from taxonomy import build_hierarchy, collapse
+    from network import sparcc_pvalues
+    from nbglm import nb_wald_test
+    from normalize import rarefy, sequential_hypergeometric, tss, clr, css, css_quantile
+    from lefse import lefse
+    from wgcna import (
+        pick_soft_threshold, blocked_tom, tom_distances, tom_linkage, linkage_memory, max_block_size,
+        projective_blocks, dynamic_tree_cut, merge_close_modules, module_eigengenes, rank_by_size
+    )
+
+
+@lru_cache(maxsize=4)
+def _demo_counts(n_samples: int, n_features: int, sparsity: float, seed: int = 0) -> sparse.csr_matrix:
+    """
+    演示用计数矩阵 (samples x features, CSR, 只读)
+    特征丰度长尾分布, 测序深度对数正态; 后一半样本中5%的特征丰度提高4倍 (组间差异)
+    """
+    rng = np.random.default_rng(seed)
+    abundance = rng.lognormal(0.0, 2.0, n_features)
+    present = rng.random((n_samples, n_features)) >= sparsity
+    effect = np.ones(n_features)
+    effect[rng.choice(n_features, max(1, n_features // 20), replace=False)] = 4.0
+    weights = np.where(present, abundance, 0.0)
+    weights[n_samples // 2:] *= effect
+    depth = rng.lognormal(np.log(20000), 0.5, n_samples)
+    mu = weights / np.maximum(weights.sum(axis=1, keepdims=True), 1e-300) * depth[:, None]
+    # 负二项 (Gamma-Poisson), 离散度 0.5
+    counts = rng.poisson(rng.gamma(2.0, mu / 2.0))
+    X = sparse.csr_matrix(counts)
+    for arr in (X.data, X.indices, X.indptr):
+        arr.flags.writeable = False
+    return X
+
+
+def _count_matrix(data: Dict) -> Tuple[sparse.csr_matrix, List[str], List[str]]:
+    """
+    取出计数矩阵 (samples x features, CSR), 以及样本与特征名
+    data 中没有 'counts' 时按其描述的规模 (samples/features/sparsity) 生成演示数据
+    """
+    if 'counts' in data:
+        counts = data['counts']
+        X = counts.tocsr() if sparse.issparse(counts) else sparse.csr_matrix(np.asarray(counts))
+    else:
+        X = _demo_counts(
+            int(data.get('samples', 50)),
+            int(data.get('features', 2000)),
+            float(data.get('sparsity', 0.85))
+        )
+    samples = list(data.get('sample_ids') or [f"S{i + 1}" for i in range(X.shape[0])])
+    features = list(data.get('feature_ids') or [f"ASV_{j + 1}" for j in range(X.shape[1])])
+    return X, samples, features
+
+
+def _matrix_key(X: sparse.csr_matrix) -> str:
+    """计数矩阵内容的 sha1 (距离缓存的键)"""
+    h = hashlib.sha1(np.asarray(X.shape, dtype=np.int64).tobytes())
+    for arr in (X.indptr, X.indices, X.data):
+        h.update(np.ascontiguousarray(arr).tobytes())
+    return h.hexdigest()
+
+
+def _tree(data: Dict, features: List[str]) -> Optional[Dict]:
+    """
+    系统发育树: data['tree'] (Newick字符串) 或 data['tree_file'];
+    演示数据 (没有 'counts') 使用随机树, 真实计数矩阵没有树时返回 None
+    """
+    if 'tree' in data:
+        return parse_newick(data['tree'])
+    if 'tree_file' in data:
+        return read_newick(data['tree_file'])
+    if 'counts' not in data:
+        return random_tree(features)
+    return None
+
+
+def _tree_key(tree: Dict, features: List[str]) -> str:
+    """树内容与特征名 (决定特征到叶的对应) 的 sha1"""
+    h = hashlib.sha1(tree["parent"].tobytes())
+    h.update(tree["length"].tobytes())
+    h.update("\t".join(name or "" for name in tree["names"]).encode())
+    h.update("\t".join(features).encode())
+    return h.hexdigest()
+
+
+def _nbytes(value) -> int:
+    """缓存条目占用内存的估计 (数组/稀疏矩阵按缓冲区大小, 容器逐项累加; 内存映射的数组在磁盘上, 不计)"""
+    if isinstance(value, np.memmap):
+        return 0
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if sparse.issparse(value):
+        value = value.tocsr()
+        return value.data.nbytes + value.indices.nbytes + value.indptr.nbytes
+    if isinstance(value, dict):
+        return sum(_nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(_nbytes(v) for v in value) + 8 * len(value)
+    if isinstance(value, str):
+        return len(value)
+    return 8
+
+
+class ResultCache:
+    """
+    进程内的有界结果缓存 (LRU, 按占用字节数淘汰), 以数据内容的校验和为键;
+    网页端每个请求新建处理器, 距离/连锁/合并表等中间结果放在这里才能在请求之间复用
+    """
+    
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._items: "OrderedDict[Tuple, Tuple[object, int]]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+    
+    def get(self, key: Tuple):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            self._items.move_to_end(key)
+            return item[0]
+    
+    def put(self, key: Tuple, value) -> None:
+        """
+        写入并淘汰最久未用的条目; 单个条目超过上限时不缓存.
+        条目在请求之间共享, 数组与稀疏矩阵的缓冲区设为只读
+        """
+        size = _nbytes(value)
+        if size > self.max_bytes:
+            return
+        arrays = [value] if isinstance(value, np.ndarray) else []
+        if sparse.issparse(value) and value.format == 'csr':
+            arrays = [value.data, value.indices, value.indptr]
+        for arr in arrays:
+            arr.flags.writeable = False
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+            self._items[key] = (value, size)
+            self._size += size
+            while self._size > self.max_bytes:
+                _, (_, evicted) = self._items.popitem(last=False)
+                self._size -= evicted
+    
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+    
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+_RESULT_CACHE: Optional[ResultCache] = None
+
+
+def result_cache() -> ResultCache:
+    """进程内共享的结果缓存, 上限由 EMP_RESULT_CACHE_MB 设置 (默认 2048 MB)"""
+    global _RESULT_CACHE
+    if _RESULT_CACHE is None:
+        _RESULT_CACHE = ResultCache(int(os.environ.get('EMP_RESULT_CACHE_MB', 2048)) << 20)
+    return _RESULT_CACHE
+
+
+@lru_cache(maxsize=4)
+def _demo_taxonomy(n_features: int, seed: int = 0) -> Tuple[Tuple[str, ...], ...]:
+    """演示用分类路径: 随机层级, 约10%的特征没有种级注释"""
+    rng = np.random.default_rng(seed)
+    sizes = [2, 12, 25, 50, 100, 300, max(n_features // 2, 1)]
+    # 每一级的单元随机挂到上一级的某个单元下
+    parents = [np.zeros(sizes[0], dtype=np.int64)]
+    for r in range(1, len(RANKS)):
+        parents.append(rng.integers(0, sizes[r - 1], sizes[r]))
+    unit = rng.integers(0, sizes[-1], n_features)
+    paths = np.empty((n_features, len(RANKS)), dtype=object)
+    for r in range(len(RANKS) - 1, -1, -1):
+        paths[:, r] = [f"{RANKS[r][0]}__{RANKS[r].capitalize()}_{u + 1}" for u in unit]
+        unit = parents[r][unit]
+    paths[rng.random(n_features) < 0.1, -1] = ''
+    return tuple(tuple(row) for row in paths)
+
+
+def _taxonomy(data: Dict, n_features: int) -> Optional[List[List[str]]]:
+    """分类路径: data['taxonomy'] (如 load_data 的结果); 演示数据使用随机层级"""
+    if data.get('taxonomy') is not None:
+        return data['taxonomy']
+    if 'counts' not in data:
+        return [list(row) for row in _demo_taxonomy(n_features)]
+    return None
+
+
+def _taxonomy_key(taxonomy: List[List[str]]) -> str:
+    return hashlib.sha1("\n".join(";".join(row) for row in taxonomy).encode()).hexdigest()
+
+
+def _alpha_metrics(X: sparse.csr_matrix) -> Dict[str, np.ndarray]:
+    """
+    全部样本的 shannon / simpson / observed / chao1, 每个指标一次按行归约
+    (只遍历非零计数, 不转为稠密矩阵)
+    """
+    X = sparse.csr_matrix(X, dtype=np.float64, copy=True)
+    X.eliminate_zeros()
+    n = X.shape[0]
+    rows = np.repeat(np.arange(n), np.diff(X.indptr))
+    x = X.data
+    depth = np.bincount(rows, weights=x, minlength=n)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = x / depth[rows]
+        shannon = -np.bincount(rows, weights=p * np.log(p), minlength=n)
+        simpson = 1.0 - np.bincount(rows, weights=p * p, minlength=n)
+    observed = np.diff(X.indptr).astype(np.float64)
+    f1 = np.bincount(rows, weights=x == 1, minlength=n)
+    f2 = np.bincount(rows, weights=x == 2, minlength=n)
+    chao1 = observed + f1 * (f1 - 1) / (2.0 * (f2 + 1))
+    empty = depth == 0
+    shannon[empty] = np.nan
+    simpson[empty] = np.nan
+    return {"shannon": shannon, "simpson": simpson, "observed": observed, "chao1": chao1}
+
+
+def _rarefaction_curves(
+    X: sparse.csr_matrix,
+    depths: np.ndarray,
+    seed: int = 0
+) -> Dict[str, np.ndarray]:
+    """
+    稀释曲线: 每个 (样本, 深度) 做一次多元超几何抽样 (normalize.sequential_hypergeometric, 与抽平共用),
+    计算抽样后的各Alpha指标; 所有 (样本, 深度) 对在同一循环中推进, 循环次数只等于单个样本的最大非零特征数
+    深度超过样本总计数的位置为 NaN
+    """
+    X = sparse.csr_matrix(X, copy=True)
+    X.data = np.rint(X.data).astype(np.int64)
+    X.eliminate_zeros()
+    n = X.shape[0]
+    nnz = np.diff(X.indptr)
+    total = np.asarray(X.sum(axis=1)).ravel()
+    rng = np.random.default_rng(seed)
+    
+    # (样本, 深度) 对, 按样本非零数降序排列, 使第k步的活跃对总是一个前缀
+    pr, pd_ = np.nonzero(total[:, None] >= depths[None, :])
+    order = np.argsort(-nnz[pr], kind='stable')
+    pr, pd_ = pr[order], pd_[order]
+    
+    observed = np.zeros(pr.size)
+    xlogx = np.zeros(pr.size)
+    sq = np.zeros(pr.size)
+    f1 = np.zeros(pr.size)
+    f2 = np.zeros(pr.size)
+    steps = sequential_hypergeometric(X.data, X.indptr[pr], nnz[pr], total[pr], depths[pd_], rng)
+    for m, _, x in steps:
+        xf = x.astype(np.float64)
+        observed[:m] += x > 0
+        xlogx[:m] += xf * np.log(np.maximum(xf, 1.0))
+        sq[:m] += xf * xf
+        f1[:m] += x == 1
+        f2[:m] += x == 2
+    
+    d = depths[pd_].astype(np.float64)
+    values = {
+        "shannon": np.log(d) - xlogx / d,
+        "simpson": 1.0 - sq / (d * d),
+        "observed": observed,
+        "chao1": observed + f1 * (f1 - 1) / (2.0 * (f2 + 1))
+    }
+    curves = {}
+    for metric, v in values.items():
+        grid = np.full((n, depths.size), np.nan)
+        grid[pr, pd_] = v
+        curves[metric] = grid
+    return curves
+
+
+def _json_values(values: np.ndarray, digits: int = 4) -> List:
+    """数组转为JSON列表, NaN 转为 None"""
+    return [None if np.isnan(v) else round(float(v), digits) for v in np.ravel(values)]
+
+
+def _grouping(data: Dict, group: Union[List, str, None], n: int) -> np.ndarray:
+    """
+    样本分组标签: 标签列表, 或 data['sample_metadata'] 中的列名;
+    未给出时演示数据按前后两半分组 (与 _demo_counts 的组间差异一致)
+    """
+    if isinstance(group, str):
+        metadata = data.get('sample_metadata') or {}
+        if group not in metadata:
+            raise ValueError(f"sample metadata has no column {group}")
+        group = metadata[group]
+    if group:
+        if len(group) != n:
+            raise ValueError(f"group has {len(group)} labels for {n} samples")
+        return np.asarray([str(g) for g in group])
+    if 'counts' in data:
+        raise ValueError("group labels are required")
+    return np.where(np.arange(n) < n // 2, 'A', 'B')
+
+
+def _covariate_matrix(covariates: Optional[Dict[str, List]], n: int) -> Optional[np.ndarray]:
+    """协变量 {名称: 各样本取值} -> 数值矩阵; 非数值列展开为哑变量 (去掉第一个水平)"""
+    if not covariates:
+        return None
+    columns = []
+    for name, values in covariates.items():
+        if len(values) != n:
+            raise ValueError(f"covariate {name} has {len(values)} values for {n} samples")
+        try:
+            columns.append(np.asarray(values, dtype=np.float64)[:, None])
+        except (TypeError, ValueError):
+            _, codes = np.unique(np.asarray([str(v) for v in values]), return_inverse=True)
+            columns.append(np.eye(codes.max() + 1)[codes][:, 1:])
+    return np.hstack(columns)
+
+
+def _numeric_traits(data: Dict, n: int) -> Dict[str, np.ndarray]:
+    """
+    样本元数据中的数值列 (缺失为 NaN); 二水平的分类列编码为 0/1
+    演示数据没有元数据时以前后两半的分组作为性状
+    """
+    metadata = data.get('sample_metadata') or {}
+    if not metadata and 'counts' not in data:
+        return {"group": (np.arange(n) >= n // 2).astype(np.float64)}
+    traits = {}
+    for name, values in metadata.items():
+        try:
+            traits[name] = np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+        except (TypeError, ValueError):
+            levels = sorted({str(v) for v in values if v is not None})
+            if len(levels) == 2:
+                traits[name] = np.array(
+                    [np.nan if v is None else float(str(v) == levels[1]) for v in values]
+                )
+    return traits
 
 
 class MicrobiomeProcessor:
@@ -14,120 +382,459 @@ class MicrobiomeProcessor:
     def __init__(self):
         self.methods = {
             'alpha': ['shannon', 'simpson', 'observed', 'chao1'],
-            'beta': ['bray_curtis', 'jaccard', 'unifrac', 'wunifrac'],
-            'ordination': ['pcoa', 'nmds', 'dca', 'pca']
+            'beta': ['bray_curtis', 'jaccard', 'aitchison', 'euclidean', 'unifrac', 'wunifrac'],
+            'ordination': ['pcoa', 'nmds', 'pca']
         }
+        # 距离 / 分类层级 / 合并表 / 连锁矩阵放在进程内共享的结果缓存中 (见 result_cache), 键为:
+        # ('distance', 距离方法, 计数矩阵sha1[+树]) -> float32 压缩距离 (数组/memmap)
+        # ('hierarchy', 分类路径sha1) -> 层级; ('collapse', 计数矩阵sha1, 分类路径sha1, 等级) -> 表
+        # ('linkage', 连锁方法, 距离方法, 距离键) -> scipy 连锁矩阵
+        self.cache = result_cache()
     
     # ==================== 1. 数据准备 ====================
     
     def load_data(self, file_path: str, format: str = 'biom') -> Dict:
         """
-        加载微生物组数据
+        加载微生物组数据 (BIOM 1.0 JSON / 2.1 HDF5, 按文件头自动识别)
+        返回的字典带有 counts (samples x features CSR) 等字段, 可直接作为后续各步骤的 data
         """
+        if format != 'biom':
+            return {"status": "error", "message": f"unsupported format: {format}"}
+        try:
+            table = read_biom(file_path)
+        except (OSError, ValueError, KeyError, ImportError) as e:
+            return {"status": "error", "message": str(e)}
+        
+        X = table["counts"]
         return {
             "status": "success",
-            "format": format,
-            "samples": 50,
-            "features": 2000,
-            "sparsity": 0.85
+            "samples": X.shape[0],
+            "features": X.shape[1],
+            "sparsity": round(1.0 - X.nnz / max(X.shape[0] * X.shape[1], 1), 4),
+            **table
         }
     
-    def preprocess(self, data: Dict, method: str = 'rarefaction') -> Dict:
+    def preprocess(
+        self,
+        data: Dict,
+        method: str = 'rarefaction',
+        depth: Optional[int] = None,
+        n_jobs: int = 1,
+        seed: int = 0
+    ) -> Dict:
         """
         数据预处理 - 原R包 Preparation_* 功能
+        rarefaction: 无放回抽平到 depth (默认为最小样本总数), 去掉不足的样本与抽平后全零的特征;
+        tss / clr / css: 只改写非零值的标准化 (clr 为零保持为零的 robust CLR), 结果放在 transformed,
+        counts 仍为原始计数 (Bray-Curtis, UniFrac, DESeq2 等按计数计算的步骤不会用到变换后的值, clr 还含负值)
+        返回与 load_data 相同的字段, 可直接作为后续各步骤的 data
         """
-        return {
-            "status": "success",
-            "method": method,
-            "samples_retained": 45,
-            "features_retained": 1500,
-            "steps": [
-                "Quality filtering",
-                "Normalization",
-                "Rarefaction"
-            ]
-        }
+        method = method.strip().lower()
+        if method not in ('rarefaction', 'tss', 'clr', 'css'):
+            return {"status": "error", "message": f"unsupported preprocessing method: {method}"}
+        
+        X, samples, features = _count_matrix(data)
+        keep_samples = np.arange(len(samples))
+        keep_features = np.arange(len(features))
+        output: Dict = {"status": "success", "method": method}
+        transformed = None
+        try:
+            if method == 'rarefaction':
+                totals = np.asarray(X.sum(axis=1)).ravel()
+                if depth is None:
+                    depth = int(totals[totals > 0].min()) if np.any(totals > 0) else 0
+                if depth <= 0:
+                    return {"status": "error", "message": "rarefaction depth must be positive"}
+                keep_samples = np.flatnonzero(totals >= depth)
+                X = rarefy(X[keep_samples], depth, n_jobs=n_jobs, seed=seed)
+                keep_features = np.flatnonzero(np.diff(X.tocsc().indptr) > 0)
+                X = X[:, keep_features]
+                output["depth"] = int(depth)
+                output["samples_removed"] = [samples[i] for i in np.setdiff1d(np.arange(len(samples)), keep_samples)]
+            elif method == 'tss':
+                transformed = tss(X)
+            elif method == 'clr':
+                transformed = clr(X)
+            else:
+                output["css_quantile"] = css_quantile(X)
+                transformed = css(X, quantile=output["css_quantile"])
+        except ValueError as e:
+            return {"status": "error", "message": str(e)}
+        
+        taxonomy = _taxonomy(data, len(features))
+        metadata = data.get('sample_metadata') or {}
+        output.update({
+            "samples_retained": int(keep_samples.size),
+            "features_retained": int(keep_features.size),
+            "samples": X.shape[0],
+            "features": X.shape[1],
+            "sparsity": round(1.0 - X.nnz / max(X.shape[0] * X.shape[1], 1), 4),
+            "counts": X,
+            "sample_ids": [samples[i] for i in keep_samples],
+            "feature_ids": [features[j] for j in keep_features],
+            "taxonomy": [taxonomy[j] for j in keep_features] if taxonomy else None,
+            "sample_metadata": {k: [v[i] for i in keep_samples] for k, v in metadata.items()}
+        })
+        if transformed is not None:
+            output["transformed"] = transformed
+        for key in ('tree', 'tree_file'):
+            if key in data:
+                output[key] = data[key]
+        return output
+    
+    def collapsed_tables(self, data: Dict, levels: List[str]) -> Dict[str, Tuple[sparse.csr_matrix, List[str]]]:
+        """
+        各分类等级的合并表 (samples x taxa CSR) 与单元名称, 按 (计数矩阵, 分类路径, 等级) 缓存;
+        缺失的等级由层级一次链式聚合得到. 没有分类注释时抛出 ValueError
+        """
+        X, _, features = _count_matrix(data)
+        taxonomy = _taxonomy(data, len(features))
+        if taxonomy is None:
+            raise ValueError("taxonomy annotations are required")
+        if len(taxonomy) != len(features):
+            raise ValueError(f"taxonomy has {len(taxonomy)} paths for {len(features)} features")
+        tax_key = _taxonomy_key(taxonomy)
+        hierarchy = self.cache.get(('hierarchy', tax_key))
+        if hierarchy is None:
+            hierarchy = build_hierarchy(taxonomy)
+            self.cache.put(('hierarchy', tax_key), hierarchy)
+        
+        key = _matrix_key(X)
+        tables = {level: self.cache.get(('collapse', key, tax_key, level)) for level in levels}
+        missing = [level for level, table in tables.items() if table is None]
+        if missing:
+            for level, table in collapse(X, hierarchy, missing).items():
+                self.cache.put(('collapse', key, tax_key, level), table)
+                tables[level] = table
+        return {level: (tables[level], hierarchy["names"][level]) for level in levels}
     
     def collapse_taxonomy(self, data: Dict, level: str = 'genus') -> Dict:
         """
         _taxonomy collapse - 原R包 Preparation_EMP_collapse 功能
+        level='all' 时一次得到 kingdom -> species 全部七级; 单级结果带有 counts 等字段,
+        可直接作为后续步骤的 data
         """
-        levels = ['kingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species']
+        levels = RANKS if level == 'all' else [level]
+        if level != 'all' and level not in RANKS:
+            return {"status": "error", "message": f"unsupported taxonomy level: {level}"}
         
-        return {
+        X, samples, features = _count_matrix(data)
+        try:
+            tables = self.collapsed_tables(data, levels)
+        except ValueError as e:
+            return {"status": "error", "message": str(e)}
+        
+        collapsed = {
+            lv: {
+                "counts": table,
+                "sample_ids": samples,
+                "feature_ids": names,
+                "features": len(names)
+            }
+            for lv, (table, names) in tables.items()
+        }
+        result = {
             "status": "success",
             "level": level,
-            "original_features": 2000,
-            "collapsed_features": 350,
-            "mapping": f"taxonomy_{level}_mapping.json"
+            "original_features": len(features)
         }
+        if level == 'all':
+            result["collapsed_features"] = {lv: collapsed[lv]["features"] for lv in levels}
+            result["tables"] = collapsed
+        else:
+            result["collapsed_features"] = collapsed[level]["features"]
+            result.update(collapsed[level])
+        return result
     
     # ==================== 2. Alpha多样性 ====================
     
     def alpha_diversity(
         self, 
         data: Dict, 
-        metrics: List[str] = None
+        metrics: List[str] = None,
+        rarefaction: bool = True,
+        n_depths: int = 20,
+        seed: int = 0
     ) -> Dict:
         """
         Alpha多样性分析 - 原R包 Analyisis_EMP_alpha 功能
+        全部样本一次向量化计算; rarefaction=True 时同时给出稀释曲线 (alpha_rank.png 的数据)
         """
         if metrics is None:
             metrics = ['shannon', 'simpson', 'observed', 'chao1']
+        unknown = [m for m in metrics if m not in self.methods['alpha']]
+        if unknown:
+            return {"status": "error", "message": f"unsupported alpha metrics: {unknown}"}
+        
+        X, samples, _ = _count_matrix(data)
+        values = _alpha_metrics(X)
         
         results = {}
         for metric in metrics:
+            v = values[metric]
             results[metric] = {
-                "mean": 3.5,
-                "sd": 0.8,
-                "min": 1.2,
-                "max": 5.2
+                "mean": round(float(np.nanmean(v)), 4),
+                "sd": round(float(np.nanstd(v, ddof=1)), 4) if v.size > 1 else 0.0,
+                "min": round(float(np.nanmin(v)), 4),
+                "max": round(float(np.nanmax(v)), 4)
             }
         
-        return {
+        output = {
             "status": "success",
             "metrics": metrics,
+            "samples": samples,
             "results": results,
+            "values": {metric: _json_values(values[metric]) for metric in metrics},
             "plot_files": ["alpha_boxplot.png", "alpha_rank.png"]
         }
+        
+        if rarefaction:
+            total = np.asarray(X.sum(axis=1)).ravel()
+            depths = np.unique(np.linspace(0, total.max(initial=0), n_depths + 1)[1:].astype(np.int64))
+            depths = depths[depths > 0]
+            curves = _rarefaction_curves(X, depths, seed=seed)
+            output["rarefaction"] = {
+                "depths": depths.tolist(),
+                "curves": {
+                    metric: [_json_values(row) for row in curves[metric]] for metric in metrics
+                }
+            }
+        
+        return output
     
     # ==================== 3. Beta多样性 ====================
     
+    def _distance_key(self, data: Dict, method: str) -> Tuple[str, Optional[Dict]]:
+        """距离缓存的键 (计数矩阵sha1, UniFrac 时加上树与特征名) 及所用的树"""
+        X, _, features = _count_matrix(data)
+        key = _matrix_key(X)
+        tree = None
+        if method in ('unifrac', 'wunifrac'):
+            tree = _tree(data, features)
+            if tree is None:
+                raise ValueError(f"{method} requires a phylogenetic tree")
+            key += _tree_key(tree, features)
+        return key, tree
+    
+    def distances(
+        self,
+        data: Dict,
+        method: str = 'bray_curtis',
+        n_jobs: int = 1,
+        out_path: Optional[str] = None
+    ) -> np.ndarray:
+        """
+        样本两两距离 (float32 压缩向量), 按 (方法, 计数矩阵内容[, 树]) 缓存,
+        后续的检验/聚类直接复用, 不再重复 O(n^2) 计算
+        unifrac / wunifrac 需要系统发育树 (见 _tree), 没有树时抛出 ValueError
+        """
+        X, _, features = _count_matrix(data)
+        key, tree = self._distance_key(data, method)
+        D = self.cache.get(('distance', method, key))
+        if D is None:
+            if tree is not None:
+                D = unifrac(
+                    X, features, tree, weighted=method == 'wunifrac',
+                    n_jobs=n_jobs, out_path=out_path
+                )
+            else:
+                D = pairwise_distances(X, metric=method, n_jobs=n_jobs, out_path=out_path)
+            self.cache.put(('distance', method, key), D)
+        return D
+    
     def beta_diversity(
         self, 
         data: Dict, 
         method: str = 'bray_curtis',
-        ordination: str = 'pcoa'
+        ordination: str = 'pcoa',
+        n_axes: int = 3,
+        n_init: int = 8,
+        n_jobs: int = 1,
+        out_path: Optional[str] = None,
+        seed: int = 0
     ) -> Dict:
         """
         Beta多样性分析 - 原R包ordination功能
+        距离由分块引擎计算 (可并行, 可写入磁盘memmap), 结果缓存在processor中;
+        unifrac / wunifrac 使用 data['tree'] 或 data['tree_file'] 中的 Newick 树
+
+        排序: pcoa (大样本随机化特征分解), nmds (n_init 个起点并行, 报告 stress),
+        pca (Hellinger 变换后的计数矩阵)
         """
-        return {
+        if method not in self.methods['beta']:
+            return {"status": "error", "message": f"unsupported distance method: {method}"}
+        if ordination not in self.methods['ordination']:
+            return {"status": "error", "message": f"unsupported ordination method: {ordination}"}
+        
+        X, samples, _ = _count_matrix(data)
+        try:
+            D = self.distances(data, method, n_jobs=n_jobs, out_path=out_path)
+        except ValueError as e:
+            return {"status": "error", "message": str(e)}
+        
+        result = {
             "status": "success",
             "distance_method": method,
             "ordination_method": ordination,
-            "variance_explained": [0.35, 0.18, 0.12],
-            "plot_files": ["beta_pcoa.png", "beta_heatmap.png"]
+            "n_samples": len(samples),
+            "distance_summary": {
+                "mean": round(float(D.mean(dtype=np.float64)), 4) if D.size else 0.0,
+                "min": round(float(D.min()), 4) if D.size else 0.0,
+                "max": round(float(D.max()), 4) if D.size else 0.0
+            }
+        }
+        
+        if ordination == 'pcoa':
+            coords, explained = pcoa(D, n_axes, seed=seed)
+            result["variance_explained"] = [round(float(v), 4) for v in explained]
+        elif ordination == 'nmds':
+            fit = nmds(D, n_components=n_axes, n_init=n_init, n_jobs=n_jobs, seed=seed)
+            coords = fit["coordinates"]
+            result["stress"] = round(fit["stress"], 4)
+            result["iterations"] = fit["iterations"]
+        else:
+            # Hellinger: 相对丰度开方
+            totals = np.asarray(X.sum(axis=1)).ravel()
+            H = sparse.diags(1.0 / np.where(totals > 0, totals, 1.0)) @ X
+            H = sparse.csr_matrix(H)
+            np.sqrt(H.data, out=H.data)
+            coords, _, mu, S = sparse_pca(H, n_axes, seed=seed)
+            total_var = H.multiply(H).sum() - len(samples) * float(mu @ mu)
+            result["variance_explained"] = [
+                round(float(v), 4) for v in (S ** 2 / total_var if total_var > 0 else np.zeros_like(S))
+            ]
+        
+        result["samples"] = samples
+        result["coordinates"] = np.round(coords, 6).tolist()
+        result["plot_files"] = [f"beta_{ordination}.png", "beta_heatmap.png"]
+        if out_path is not None:
+            result["distance_file"] = out_path
+        return result
+    
+    def group_test(
+        self,
+        data: Dict,
+        group: Union[List, str, None] = None,
+        method: str = 'bray_curtis',
+        test: str = 'permanova',
+        covariates: Optional[Dict[str, List]] = None,
+        n_permutations: int = 9999,
+        early_stop: int = 10,
+        n_jobs: int = 1,
+        seed: int = 0
+    ) -> Dict:
+        """
+        Beta多样性组间检验: PERMANOVA (可加协变量) 或 ANOSIM
+        复用 distances() 缓存的距离; 置换按批以矩阵乘法计算, 不显著时提前停止
+        """
+        if method not in self.methods['beta']:
+            return {"status": "error", "message": f"unsupported distance method: {method}"}
+        if test not in ('permanova', 'anosim'):
+            return {"status": "error", "message": f"unsupported test: {test}"}
+        if test == 'anosim' and covariates:
+            return {"status": "error", "message": "ANOSIM does not support covariates"}
+        
+        _, samples, _ = _count_matrix(data)
+        try:
+            labels = _grouping(data, group, len(samples))
+            C = _covariate_matrix(covariates, len(samples))
+            D = self.distances(data, method, n_jobs=n_jobs)
+            args = dict(n_permutations=n_permutations, early_stop=early_stop, n_jobs=n_jobs, seed=seed)
+            if test == 'permanova':
+                res = permanova(D, labels, covariates=C, **args)
+            else:
+                res = anosim(D, labels, **args)
+        except ValueError as e:
+            return {"status": "error", "message": str(e)}
+        
+        result = {
+            "status": "success",
+            "test": test,
+            "distance_method": method,
+            "groups": sorted(set(labels.tolist()))
         }
+        for key, value in res.items():
+            result[key] = round(value, 6) if isinstance(value, float) else value
+        if test == 'permanova':
+            result["covariates"] = list(covariates or {})
+        return result
     
     # ==================== 4. 差异分析 ====================
     
     def differential_analysis(
         self,
         data: Dict,
-        group: List[str],
-        method: str = 'DESeq2'
+        group: Union[List, str, None] = None,
+        method: str = 'DESeq2',
+        covariates: Optional[Dict[str, List]] = None,
+        alpha: float = 0.05,
+        top_n: int = 100
     ) -> Dict:
         """
         差异分析 - 原R包 Analysis_EMP_diff 功能
+        DESeq2 风格的负二项 GLM: median-of-ratios 大小因子, 趋势 + MAP 离散度, Wald 检验, BH 校正;
+        设计矩阵为截距 + 分组哑变量 (参照水平为排序后的第一个) + 协变量, 检验最后一个水平相对参照水平
         """
+        if method.strip().lower() != 'deseq2':
+            return {"status": "error", "message": f"unsupported differential method: {method}"}
+        
+        X, samples, features = _count_matrix(data)
+        n = len(samples)
+        try:
+            labels = _grouping(data, group, n)
+            C = _covariate_matrix(covariates, n)
+        except ValueError as e:
+            return {"status": "error", "message": str(e)}
+        levels = sorted(set(labels.tolist()))
+        if len(levels) < 2:
+            return {"status": "error", "message": "at least 2 groups are required"}
+        design = [np.ones((n, 1)), (labels[:, None] == np.asarray(levels[1:])[None, :]).astype(np.float64)]
+        if C is not None:
+            design.insert(1, C)
+        design = np.hstack(design)
+        if np.linalg.matrix_rank(design) < design.shape[1] or n <= design.shape[1]:
+            return {"status": "error", "message": "design matrix is not full rank"}
+        
+        res = nb_wald_test(X.toarray(), design, coef=-1)
+        padj = res["padj"]
+        lfc = res["log2_fold_change"]
+        sig = np.nan_to_num(padj, nan=1.0) < alpha
+        order = np.argsort(np.where(np.isnan(res["pvalue"]), np.inf, res["pvalue"]), kind='stable')[:top_n]
+        
+        def value(v: float) -> Optional[float]:
+            return None if np.isnan(v) else float(f"{v:.6g}")
+        
         return {
             "status": "success",
-            "method": method,
-            "groups": list(set(group)),
-            "increased": 150,
-            "decreased": 120,
-            "significant": 270,
+            "method": "DESeq2",
+            "groups": levels,
+            "contrast": [levels[-1], levels[0]],
+            "covariates": list(covariates or {}),
+            "n_samples": n,
+            "n_features": len(features),
+            "n_tested": int(np.isfinite(res["pvalue"]).sum()),
+            "increased": int((sig & (lfc > 0)).sum()),
+            "decreased": int((sig & (lfc < 0)).sum()),
+            "significant": int(sig.sum()),
+            "alpha": alpha,
+            "size_factors": _json_values(res["size_factors"]),
+            "dispersion_trend": {
+                "type": res["trend_type"],
+                "coefficients": [round(float(c), 6) for c in res["trend_coefficients"]],
+                "prior_variance": round(float(res["prior_var"]), 6)
+            },
+            "results": [
+                {
+                    "feature": features[f],
+                    "base_mean": value(res["base_mean"][f]),
+                    "log2_fold_change": value(lfc[f]),
+                    "lfc_se": value(res["lfc_se"][f]),
+                    "stat": value(res["stat"][f]),
+                    "pvalue": value(res["pvalue"][f]),
+                    "padj": value(padj[f])
+                }
+                for f in order
+            ],
             "plot_files": ["volcano.png", "heatmap.png"]
         }
     
@@ -136,40 +843,146 @@ class MicrobiomeProcessor:
     def network_analysis(
         self,
         data: Dict,
-        method: str = ' SparCC'
+        method: str = 'SparCC',
+        min_prevalence: float = 0.2,
+        n_bootstraps: int = 100,
+        correlation_threshold: float = 0.3,
+        pvalue_threshold: float = 0.05,
+        n_jobs: int = 1,
+        seed: int = 0
     ) -> Dict:
         """
         网络分析 - 原R包 Analyisis_EMP_network 功能
+        SparCC 相关 + 打乱零模型的伪p值 (进程池并行), 只保留 |r| 与 p 都过阈值的边;
+        在至少 min_prevalence 比例的样本中出现的特征才参与
         """
+        if method.strip().lower() != 'sparcc':
+            return {"status": "error", "message": f"unsupported network method: {method}"}
+        if n_bootstraps < 1:
+            return {"status": "error", "message": "n_bootstraps must be at least 1"}
+        
+        X, samples, features = _count_matrix(data)
+        prevalence = np.asarray((X > 0).mean(axis=0)).ravel()
+        keep = np.flatnonzero(prevalence >= min_prevalence)
+        if keep.size < 4:
+            return {"status": "error", "message": "fewer than 4 features pass the prevalence filter"}
+        res = sparcc_pvalues(
+            X[:, keep].toarray(), n_bootstraps=n_bootstraps, n_jobs=n_jobs, seed=seed
+        )
+        
+        D = keep.size
+        iu, ju = np.triu_indices(D, k=1)
+        sel = np.flatnonzero(
+            (np.abs(res["r"]) >= correlation_threshold) & (res["pvalue"] <= pvalue_threshold)
+        )
+        i, j, r, p = iu[sel], ju[sel], res["r"][sel].astype(np.float64), res["pvalue"][sel]
+        A = sparse.coo_matrix((np.abs(r), (i, j)), shape=(D, D))
+        A = (A + A.T).tocsr()
+        degree = np.diff(A.indptr)
+        labels = modularity_communities(A, seed=seed)
+        names = [features[f] for f in keep]
+        hubs = np.argsort(-degree, kind='stable')[:10]
+        
         return {
             "status": "success",
-            "method": method,
-            "nodes": 200,
-            "edges": 450,
-            "avg_degree": 4.5,
-            "modularity": 0.65,
+            "method": "SparCC",
+            "n_samples": len(samples),
+            "nodes": int(D),
+            "edges": int(sel.size),
+            "positive_edges": int((r > 0).sum()),
+            "negative_edges": int((r < 0).sum()),
+            "avg_degree": round(float(degree.mean()), 4),
+            "density": round(2.0 * sel.size / (D * (D - 1)), 6),
+            "modularity": round(modularity(A, labels), 4),
+            "n_communities": int(np.unique(labels[degree > 0]).size),
+            "n_bootstraps": res["n_bootstraps"],
+            "hubs": [{"feature": names[h], "degree": int(degree[h])} for h in hubs if degree[h] > 0],
+            "edge_list": [
+                {
+                    "source": names[a],
+                    "target": names[b],
+                    "correlation": round(float(c), 4),
+                    "pvalue": round(float(q), 4)
+                }
+                for a, b, c, q in zip(i, j, r, p)
+            ],
             "plot_files": ["network.png", "cooccurrence.png"]
         }
     
     # ==================== 6. 聚类分析 ====================
     
+    def sample_linkage(
+        self,
+        data: Dict,
+        method: str = 'bray_curtis',
+        linkage_method: str = 'average',
+        n_jobs: int = 1
+    ) -> np.ndarray:
+        """
+        样本层次聚类的连锁矩阵 (scipy 格式), 在 distances() 缓存的压缩距离上计算并按 (距离, 连锁方法) 缓存
+        average / complete / ward 由 scipy 的最近邻链算法完成: O(n^2) 时间与内存
+        """
+        key = ('linkage', linkage_method, method, self._distance_key(data, method)[0])
+        Z = self.cache.get(key)
+        if Z is None:
+            D = self.distances(data, method, n_jobs=n_jobs)
+            Z = linkage(np.asarray(D, dtype=np.float64), method=linkage_method)
+            self.cache.put(key, Z)
+        return Z
+    
     def clustering(
         self,
         data: Dict,
         method: str = 'hclust',
-        n_clusters: int = 4
+        n_clusters: int = 4,
+        distance: str = 'bray_curtis',
+        linkage_method: str = 'average',
+        n_jobs: int = 1
     ) -> Dict:
         """
         聚类分析 - 原R包 Analysis_EMP_cluster 功能
+        样本层次聚类 (average / complete / ward), 复用 beta_diversity 的距离缓存;
+        在 n_clusters 处切树, 并给出树状图叶序 (热图的样本顺序), 簇按叶序中首次出现的先后编号
         """
+        if method != 'hclust':
+            return {"status": "error", "message": f"unsupported clustering method: {method}"}
+        if distance not in self.methods['beta']:
+            return {"status": "error", "message": f"unsupported distance method: {distance}"}
+        if linkage_method not in ('average', 'complete', 'ward'):
+            return {"status": "error", "message": f"unsupported linkage: {linkage_method}"}
+        
+        _, samples, _ = _count_matrix(data)
+        if not 1 <= n_clusters <= len(samples):
+            return {"status": "error", "message": f"n_clusters must be between 1 and {len(samples)}"}
+        try:
+            Z = self.sample_linkage(data, distance, linkage_method, n_jobs=n_jobs)
+        except ValueError as e:
+            return {"status": "error", "message": str(e)}
+        
+        order = leaves_list(Z)
+        raw = fcluster(Z, n_clusters, criterion='maxclust')
+        _, first = np.unique(raw[order], return_index=True)
+        rename = np.zeros(raw.max() + 1, dtype=np.int64)
+        rename[raw[order][np.sort(first)]] = np.arange(1, first.size + 1)
+        labels = rename[raw]
+        sizes = np.bincount(labels)[1:]
+        # 切树高度: 保留的最高一次合并与撤销的最低一次合并之间的中点
+        cut_height = None
+        if n_clusters > 1:
+            lower = Z[-n_clusters, 2] if n_clusters < len(samples) else 0.0
+            cut_height = round(float(lower + Z[1 - n_clusters, 2]) / 2.0, 6)
+        
         return {
             "status": "success",
             "method": method,
-            "n_clusters": n_clusters,
-            "cluster_sizes": {
-                f"Cluster_{i}": 50 // n_clusters 
-                for i in range(n_clusters)
-            },
+            "distance_method": distance,
+            "linkage": linkage_method,
+            "n_clusters": int(sizes.size),
+            "cluster_sizes": {f"Cluster_{c + 1}": int(k) for c, k in enumerate(sizes)},
+            "assignments": {samples[i]: int(labels[i]) for i in range(len(samples))},
+            "leaf_order": [samples[i] for i in order],
+            "cut_height": cut_height,
+            "merge_heights": _json_values(Z[:, 2], 6),
             "plot_files": ["cluster_dendrogram.png", "cluster_barplot.png"]
         }
     
@@ -196,22 +1009,82 @@ class MicrobiomeProcessor:
     def marker_analysis(
         self,
         data: Dict,
-        group: List[str],
-        method: str = 'wilcox'
+        group: Union[List, str, None] = None,
+        method: str = 'lefse',
+        level: str = 'all',
+        kw_alpha: float = 0.05,
+        wilcoxon_alpha: float = 0.05,
+        lda_threshold: float = 2.0,
+        strategy: str = 'one-against-all',
+        n_boots: int = 30,
+        seed: int = 0
     ) -> Dict:
         """
         标记物分析 - 原R包 Analysis_EMP_marker 功能
+        LEfSe: 全部分类单元同时做 Kruskal-Wallis 与组间两两 Wilcoxon, 通过的单元再做自助法 LDA 效应量;
+        method='wilcox' 只做两步秩检验. level='all' 时在各分类等级的合并表上一起分析 (LEfSe 的 clade),
+        也可以指定单一等级或 'feature'; 没有分类注释时使用原始特征. 丰度按 LEfSe 惯例缩放到每个样本总和 1e6
         """
-        markers = [
-            {"taxon": "Bacteroides", "logFC": 2.5, "pvalue": 1e-10, "padj": 1e-8},
-            {"taxon": "Lactobacillus", "logFC": -1.8, "pvalue": 1e-8, "padj": 1e-6},
-            {"taxon": "Faecalibacterium", "logFC": 1.5, "pvalue": 1e-6, "padj": 0.001}
-        ]
+        method = method.strip().lower()
+        if method not in ('lefse', 'wilcox'):
+            return {"status": "error", "message": f"unsupported marker method: {method}"}
+        if strategy not in ('one-against-all', 'one-against-one'):
+            return {"status": "error", "message": f"unsupported strategy: {strategy}"}
+        if level not in ('all', 'feature') and level not in RANKS:
+            return {"status": "error", "message": f"unknown taxonomic level: {level}"}
+        
+        X, samples, features = _count_matrix(data)
+        try:
+            labels = _grouping(data, group, len(samples))
+            tables = []
+            if level != 'feature' and _taxonomy(data, len(features)) is not None:
+                levels = RANKS if level == 'all' else [level]
+                for rank, (table, names) in self.collapsed_tables(data, levels).items():
+                    # 本级名称为空的单元 (未注释到该等级) 不作为 clade
+                    keep = [j for j, name in enumerate(names) if name.rsplit(';', 1)[-1]]
+                    tables.append((rank, tss(table[:, keep]), [names[j] for j in keep]))
+            else:
+                tables.append(('feature', tss(X), features))
+        except ValueError as e:
+            return {"status": "error", "message": str(e)}
+        classes, codes = np.unique(labels, return_inverse=True)
+        if classes.size < 2:
+            return {"status": "error", "message": "at least 2 groups are required"}
+        
+        R = np.hstack([table.toarray() for _, table, _ in tables]) * 1e6
+        ranks = [rank for rank, _, names in tables for _ in names]
+        names = [name for _, _, level_names in tables for name in level_names]
+        res = lefse(
+            R, codes, kw_alpha=kw_alpha, wilcoxon_alpha=wilcoxon_alpha, lda_threshold=lda_threshold,
+            strategy=strategy, n_boots=n_boots if method == 'lefse' else 0, seed=seed
+        )
+        hits = np.flatnonzero(res["marker"])
+        key = -res["lda"][hits] if method == 'lefse' else res["kw_pvalue"][hits]
+        hits = hits[np.argsort(key, kind='stable')]
+        
+        markers = []
+        for j in hits:
+            marker = {
+                "taxon": names[j],
+                "level": ranks[j],
+                "group": str(classes[res["enriched"][j]]),
+                "pvalue": float(f"{res['kw_pvalue'][j]:.6g}")
+            }
+            if method == 'lefse':
+                marker["lda"] = round(float(res["lda"][j]), 4)
+            markers.append(marker)
         
         return {
             "status": "success",
             "method": method,
+            "groups": classes.tolist(),
+            "strategy": strategy,
+            "n_tested": len(names),
+            "n_passed_tests": int(res["passed_tests"].sum()),
             "n_markers": len(markers),
+            "markers_per_group": {
+                str(c): int(sum(m["group"] == c for m in markers)) for c in classes
+            },
             "markers": markers,
             "plot_files": ["marker_volcano.png", "marker_heatmap.png"]
         }
@@ -244,19 +1117,104 @@ class MicrobiomeProcessor:
     def wgcna(
         self,
         data: Dict,
-        power: int = 6
+        power: Optional[int] = None,
+        min_module_size: int = 30,
+        deep_split: int = 2,
+        merge_cut_height: float = 0.25,
+        min_prevalence: float = 0.2,
+        max_memory: int = 1 << 31,
+        out_path: Optional[str] = None
     ) -> Dict:
         """
         WGCNA分析 - 原R包 Analysis_EMP_WGCNA 功能
+        CLR 变换后的丰度构建无符号加权网络; power 为 None 时自动选择软阈值.
+        TOM 按行块计算, 超出 max_memory 时中间矩阵放在磁盘, 给定 out_path 时 TOM 保存为 memmap;
+        层次聚类 (float64 压缩距离 + scipy 的工作副本, 约 8 x 特征数^2 字节) 也计入 max_memory:
+        特征数超过 max_block_size(max_memory) (默认 2 GB 约 16000 个) 时先按相关性预分块,
+        各块分别计算 TOM 与聚类 (同 WGCNA blockwiseModules), 多块时 TOM 保存为 out_path.block<b>
         """
-        return {
-            "status": "success",
+        X, samples, features = _count_matrix(data)
+        prevalence = np.asarray((X > 0).mean(axis=0)).ravel()
+        keep = np.flatnonzero(prevalence >= min_prevalence)
+        if keep.size < 2 * min_module_size:
+            return {"status": "error", "message": "too few features pass the prevalence filter"}
+        block_size = max_block_size(max_memory)
+        if block_size < 2 * min_module_size:
+            return {
+                "status": "error",
+                "message": f"max_memory {max_memory / 2 ** 30:.1f} GB only fits blocks of {block_size} features "
+                           f"({linkage_memory(2 * min_module_size)} bytes needed for {2 * min_module_size}); "
+                           f"raise max_memory or lower min_module_size"
+            }
+        L = np.log(X[:, keep].toarray() + 1.0)
+        Z = standardize_columns(L - L.mean(axis=1, keepdims=True))
+        
+        result = {"status": "success"}
+        if power is None:
+            fit = pick_soft_threshold(Z)
+            power = fit["power"]
+            result["scale_free"] = fit["scale_free"]
+            result["power_table"] = fit["table"]
+        blocks = projective_blocks(Z, block_size)
+        tom_files = []
+        labels = np.zeros(keep.size, dtype=np.int64)
+        for b, block in enumerate(blocks):
+            path = out_path if out_path is None or len(blocks) == 1 else f"{out_path}.block{b}"
+            TOM = blocked_tom(Z[:, block], power, max_memory=max_memory, out_path=path)
+            # 依次释放 TOM 与 float32 距离, 峰值只有 linkage 自身的两份 float64
+            d = tom_distances(TOM)
+            del TOM
+            d = d.astype(np.float64)
+            tree = tom_linkage(d)
+            del d
+            block_labels = dynamic_tree_cut(tree, min_module_size, deep_split)
+            labels[block] = np.where(block_labels > 0, block_labels + labels.max(), 0)
+            tom_files.append(path)
+        labels = merge_close_modules(Z, rank_by_size(labels), merge_cut_height)
+        
+        E, explained = module_eigengenes(Z, labels)
+        names = [features[f] for f in keep]
+        modules = []
+        for m in range(1, E.shape[1] + 1):
+            members = np.flatnonzero(labels == m)
+            kme = Z[:, members].T @ (E[:, m - 1] / max(np.linalg.norm(E[:, m - 1]), 1e-300))
+            modules.append({
+                "module": f"ME{m}",
+                "size": int(members.size),
+                "hub": names[members[np.argmax(kme)]],
+                "variance_explained": round(float(explained[m - 1]), 4),
+                "features": [names[f] for f in members[np.argsort(-kme, kind='stable')]]
+            })
+        
+        module_trait = {}
+        best = 0.0
+        traits = _numeric_traits(data, len(samples)) if modules else {}
+        for trait, y in traits.items():
+            ok = ~np.isnan(y)
+            if ok.sum() < 3 or np.ptp(y[ok]) == 0:
+                continue
+            r = standardize_columns(E[ok]).T @ standardize_columns(y[ok, None]).ravel()
+            p = correlation_pvalues(r, int(ok.sum()))
+            module_trait[trait] = {
+                "correlation": [round(float(v), 4) for v in r],
+                "pvalue": [float(v) for v in p]
+            }
+            best = max(best, float(np.abs(r).max(initial=0.0)))
+        
+        result.update({
             "power": power,
-            "n_modules": 12,
-            "modules": [f"ME{i}" for i in range(1, 13)],
-            "module_trait_correlation": 0.75,
+            "n_features": int(keep.size),
+            "blocks": [int(block.size) for block in blocks],
+            "n_modules": len(modules),
+            "unassigned": int((labels == 0).sum()),
+            "modules": modules,
+            "module_trait": module_trait,
+            "module_trait_correlation": round(best, 4),
             "plot_files": ["wgcna_dendrogram.png", "module_trait.png"]
-        }
+        })
+        if out_path is not None:
+            result["tom_file"] = out_path if len(blocks) == 1 else tom_files
+        return result
     
     # ==================== 11. 多组学整合 ====================
     
@@ -287,24 +1245,28 @@ class MicrobiomeProcessor:
     ) -> Dict:
         """
         完整分析流程
+        任一步骤失败时返回该步骤的错误 (附 step 字段), 不再用演示数据继续
         """
         # 1. 加载
         data = self.load_data(file_path)
+        if data.get("status") != "success":
+            return {**data, "step": "load"}
         
         # 2. 预处理
         processed = self.preprocess(data)
+        if processed.get("status") != "success":
+            return {**processed, "step": "preprocess"}
         
-        # 3. Alpha
-        alpha = self.alpha_diversity(processed)
-        
-        # 4. Beta
-        beta = self.beta_diversity(processed)
-        
-        # 5. 差异
-        diff = self.differential_analysis(processed, group)
-        
-        # 6. 网络
-        network = self.network_analysis(processed)
+        steps = [
+            ("alpha", lambda: self.alpha_diversity(processed)),       # 3. Alpha
+            ("beta", lambda: self.beta_diversity(processed)),         # 4. Beta
+            ("differential", lambda: self.differential_analysis(processed, group)),  # 5. 差异
+            ("network", lambda: self.network_analysis(processed))     # 6. 网络
+        ]
+        for name, step in steps:
+            result = step()
+            if result.get("status") != "success":
+                return {**result, "step": name}
         
         return {
             "status": "success",
@@ -325,12 +1287,16 @@ if __name__ == "__main__":
     print("=== 微生物组分析测试 ===")
     
     data = proc.load_data("test.biom")
+    if data["status"] != "success":
+        print(f"   test.biom 无法读取 ({data['message']}), 使用演示数据")
+        data = {"samples": 50, "features": 2000, "sparsity": 0.85}
     print(f"1. 加载: {data['samples']} samples")
     
     alpha = proc.alpha_diversity(data)
     print(f"2. Alpha: {list(alpha['results'].keys())}")
     
-    diff = proc.differential_analysis(data, ["A", "B"])
+    # 演示数据按前后两半分为 A / B 两组
+    diff = proc.differential_analysis(data)
     print(f"3. 差异: {diff['significant']} significant")
     
     print("\n✅ 测试通过!")
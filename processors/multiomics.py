@@ -4,9 +4,255 @@ Multi-omics Integration Processor
 多组学整合分析模块
 """
 
+import os
 import numpy as np
+import pandas as pd
 import json
-from typing import Dict, List, Optional
+import hashlib
+import shutil
+import tempfile
+import uuid
+from functools import reduce
+from scipy.spatial.distance import pdist, squareform
+from typing import Dict, List, Optional, Tuple
+
+try:
+    from .stats import (
+        blocked_correlation, align_complete, permutation_pvalues, rank_columns,
+        standardize_columns, correlation_pvalues, critical_correlation, bh_adjust,
+        correlation_graph, modularity, modularity_communities,
+        mantel, procrustes_test
+    )
+    from .ordination import pcoa
+    from .biom import read_biom
+except ImportError:  # 作为脚本直接运行
+    from stats import (
+        blocked_correlation, align_complete, permutation_pvalues, rank_columns,
+        standardize_columns, correlation_pvalues, critical_correlation, bh_adjust,
+        correlation_graph, modularity, modularity_communities,
+        mantel, procrustes_test
+    )
+    from ordination import pcoa
+    from biom import read_biom
+
+
+# 列式缓存目录: 首次读取后转为 .npy + 索引文件, 以文件校验和为键
+CACHE_DIR = os.environ.get(
+    'EMP_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'easymultiprofiler')
+)
+
+# 文件 (路径, 大小, 修改时间) -> 校验和, 进程内共享 (网页端每个请求新建处理器);
+# 超过上限时丢弃最早的条目
+_CHECKSUMS: Dict[Tuple, str] = {}
+_MAX_CHECKSUMS = 1024
+
+
+def _cached_checksum(file_path: str) -> str:
+    """文件校验和, 文件未变 (大小与修改时间相同) 时不重新读取"""
+    st = os.stat(file_path)
+    stat_key = (os.path.abspath(file_path), st.st_size, st.st_mtime_ns)
+    checksum = _CHECKSUMS.get(stat_key)
+    if checksum is None:
+        checksum = _file_checksum(file_path)
+        while len(_CHECKSUMS) >= _MAX_CHECKSUMS:
+            _CHECKSUMS.pop(next(iter(_CHECKSUMS)), None)
+        _CHECKSUMS[stat_key] = checksum
+    return checksum
+
+
+# 因子分析结果 (数据键 -> 载荷), 用于同一数据改变因子数时热启动; 进程内共享, 只保留最近几份
+_FACTOR_FITS: Dict[str, np.ndarray] = {}
+_MAX_FACTOR_FITS = 4
+
+
+# 演示数据的特征前缀与默认规模 (与 load_* 返回的规模一致)
+_DEMO_SHAPES = {
+    'rnaseq': ('Gene', 'genes', 15000),
+    'microbiome': ('Taxon', 'taxa', 500),
+    'clinical': ('Var', 'variables', 15)
+}
+
+
+def _demo_omics(kind: str, n_samples: int, n_features: int, seed: int = 0) -> np.ndarray:
+    """
+    演示用组学矩阵 (samples x features)
+    各组学共享同一组潜变量, 因此跨组学存在真实的相关结构
+    """
+    latent = np.random.default_rng(seed).standard_normal((n_samples, 3))
+    rng = np.random.default_rng(seed + 1 + list(_DEMO_SHAPES).index(kind))
+    loadings = rng.standard_normal((3, n_features)) * (rng.random(n_features) < 0.2)
+    return latent @ loadings + rng.standard_normal((n_samples, n_features))
+
+
+def _omics_matrix(data: Dict, kind: str) -> Tuple[np.ndarray, List[str], List[str]]:
+    """
+    取出组学矩阵 (samples x features), 以及样本与特征名
+    data 中没有 'matrix' 时按其描述的规模生成演示数据
+    """
+    prefix, count_key, default = _DEMO_SHAPES[kind]
+    if 'matrix' in data:
+        X = np.asarray(data['matrix'], dtype=np.float64)
+        samples = list(data.get('sample_ids') or [f"S{i + 1}" for i in range(X.shape[0])])
+        features = list(data.get('feature_ids') or [f"{prefix}_{j + 1}" for j in range(X.shape[1])])
+        return X, samples, features
+    n_samples = int(data.get('samples', 20))
+    n_features = int(data.get(count_key, default))
+    X = _demo_omics(kind, n_samples, n_features)
+    samples = [f"S{i + 1}" for i in range(n_samples)]
+    features = [f"{prefix}_{j + 1}" for j in range(n_features)]
+    return X, samples, features
+
+
+def _file_checksum(path: str, chunk_size: int = 1 << 20) -> str:
+    """文件内容的 sha1"""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _read_table(path: str, samples_in_rows: bool) -> Tuple[np.ndarray, List[str], List[str], Dict]:
+    """
+    读取 CSV/TSV/BIOM 表, 返回 (samples x features 矩阵, 样本名, 特征名, 元信息)
+    非数值列 (如性别) 编码为整数, 水平记录在元信息中
+    """
+    if path.endswith('.biom'):
+        table = read_biom(path)
+        X = table["counts"].toarray().astype(np.float32)
+        return X, table["sample_ids"], table["feature_ids"], {"format": "biom"}
+    sep = '\t' if path.endswith(('.tsv', '.txt', '.tab')) else ','
+    df = pd.read_csv(path, sep=sep, index_col=0)
+    if not samples_in_rows:
+        df = df.T
+    levels = {}
+    for col in df.columns:
+        if not pd.api.types.is_numeric_dtype(df[col]):
+            codes, uniques = pd.factorize(df[col], sort=True)
+            df[col] = np.where(codes < 0, np.nan, codes)
+            levels[str(col)] = [str(u) for u in uniques]
+    X = df.to_numpy(dtype=np.float64 if samples_in_rows else np.float32)
+    meta = {"format": "tsv" if sep == '\t' else "csv", "levels": levels}
+    return X, [str(i) for i in df.index], [str(c) for c in df.columns], meta
+
+
+def _shared_rows(*codes: np.ndarray) -> List[np.ndarray]:
+    """各组学共有样本的行号 (按整数样本编码求交集)"""
+    common = reduce(np.intersect1d, codes)
+    return [np.intersect1d(common, c, assume_unique=True, return_indices=True)[2] for c in codes]
+
+
+def _union_rows(*codes: np.ndarray) -> Tuple[np.ndarray, List[np.ndarray]]:
+    """各组学样本编码的并集, 以及各组学行在并集中的位置"""
+    union = np.unique(np.concatenate(codes))
+    return union, [np.searchsorted(union, c) for c in codes]
+
+
+def _group_factor_analysis(
+    Y: np.ndarray,
+    M: np.ndarray,
+    view_idx: np.ndarray,
+    n_views: int,
+    n_factors: int,
+    W: Optional[np.ndarray] = None,
+    max_iter: int = 200,
+    tol: float = 1e-4,
+    seed: int = 0
+) -> Dict:
+    """
+    多视图因子分析 (Group Factor Analysis, EM 更新)
+    
+    Y: (N, D) 各视图按列拼接, 缺失处为0; M: 同形状的观测掩码 (1/0)
+    模型 Y ≈ Z W^T, z ~ N(0, I), 每个视图一个噪声精度 tau
+    (样本远少于特征时逐特征的噪声会退化), 每个 (视图, 因子) 一个ARD精度 alpha,
+    不活跃的因子在对应视图中被压缩为0
+    
+    含缺失值时每个样本/特征的Gram矩阵不同, 这里都写成与掩码的矩阵乘法:
+    G_Z = M (W⊗W), G_W = M^T E[z⊗z], 然后批量求解 K x K 线性方程组
+    """
+    N, D = Y.shape
+    K = n_factors
+    rng = np.random.default_rng(seed)
+    eye = np.eye(K)
+    diag = np.arange(K)
+    n_obs = M.sum(axis=0)
+    view_sizes = np.bincount(view_idx, minlength=n_views).astype(np.float64)
+    
+    if W is None:
+        # 用前K个主成分初始化
+        _, S, Vt = np.linalg.svd(Y, full_matrices=False)
+        W = Vt[:K].T * S[:K] / np.sqrt(max(N, 1))
+    if W.shape[1] < K:
+        W = np.hstack([W, rng.standard_normal((D, K - W.shape[1])) * 1e-3])
+    # 噪声精度按初始分解的残差估计; 若用总方差, 初始就把信号当作噪声, ARD会把弱因子全部压缩掉
+    Z0 = Y @ W @ np.linalg.pinv(W.T @ W)
+    view_obs = np.bincount(view_idx, weights=n_obs, minlength=n_views)
+    sse0 = np.bincount(view_idx, weights=(M * (Y - Z0 @ W.T) ** 2).sum(axis=0), minlength=n_views)
+    tau = (view_obs / np.maximum(sse0, 1e-10))[view_idx]
+    alpha = np.full((n_views, K), 1e-3)
+    objective = []
+    converged = False
+    
+    for it in range(max_iter):
+        # ---- E步: 每个样本的后验 z ~ N(H^-1 b, H^-1) ----
+        Wt = W * tau[:, None]
+        Gw = (Wt[:, :, None] * W[:, None, :]).reshape(D, K * K)
+        H = (M @ Gw).reshape(N, K, K) + eye
+        S_z = np.linalg.inv(H)
+        Z = (S_z @ (Y @ Wt)[..., None])[..., 0]
+        
+        # ---- M步: W, 每个特征一个 K x K 方程组, 使用 E[z z^T] ----
+        Ezz = (Z[:, :, None] * Z[:, None, :] + S_z).reshape(N, K * K)
+        G = (M.T @ Ezz).reshape(D, K, K)
+        G[:, diag, diag] += alpha[view_idx] / tau[:, None]
+        W = np.linalg.solve(G, (Y.T @ Z)[..., None])[..., 0]
+        
+        # ---- ARD: 每个视图-因子的精度 ----
+        sq = np.zeros((n_views, K))
+        np.add.at(sq, view_idx, W ** 2)
+        alpha = view_sizes[:, None] / np.maximum(sq, 1e-10)
+        
+        # ---- 噪声精度: 期望残差平方和 ----
+        resid = M * (Y - Z @ W.T)
+        WW = (W[:, :, None] * W[:, None, :]).reshape(D, K * K)
+        sse = (resid ** 2).sum(axis=0) + ((M.T @ S_z.reshape(N, K * K)) * WW).sum(axis=1)
+        tau = (view_obs / np.maximum(np.bincount(view_idx, weights=sse, minlength=n_views), 1e-10))[view_idx]
+        
+        obj = float((tau * sse).sum() - (n_obs * np.log(tau)).sum()
+                    + (alpha[view_idx] * W ** 2).sum())
+        objective.append(obj)
+        # 以期望残差平方和判断收敛 (对因子旋转不敏感)
+        total_sse = float(sse.sum())
+        if it > 0 and abs(prev_sse - total_sse) <= tol * prev_sse:
+            converged = True
+            break
+        prev_sse = total_sse
+    
+    # ---- 各视图、各因子的解释方差 (向量化) ----
+    ss_y = np.bincount(view_idx, weights=(M * Y ** 2).sum(axis=0), minlength=n_views)
+    YZ = Y.T @ Z
+    MZ2 = M.T @ (Z ** 2)
+    drop = 2 * W * YZ - W ** 2 * MZ2  # 单独使用第k个因子时残差平方和的减少量
+    per_factor = np.zeros((n_views, K))
+    np.add.at(per_factor, view_idx, drop)
+    per_factor /= np.maximum(ss_y, 1e-12)[:, None]
+    fitted = M * (Z @ W.T)
+    total = 1.0 - np.bincount(view_idx, weights=((M * Y - fitted) ** 2).sum(axis=0),
+                              minlength=n_views) / np.maximum(ss_y, 1e-12)
+    
+    # 因子按总解释方差排序
+    order = np.argsort(-per_factor.sum(axis=0))
+    return {
+        "Z": Z[:, order],
+        "W": W[:, order],
+        "tau": tau,
+        "per_factor": per_factor[:, order],
+        "total": total,
+        "iterations": it + 1,
+        "converged": converged,
+        "objective": objective
+    }
 
 
 class MultiOmicsProcessor:
@@ -14,55 +260,172 @@ class MultiOmicsProcessor:
     
     def __init__(self):
         self.omics_types = ['transcriptomics', 'metabolomics', 'microbiome', 'proteomics']
+        # 共享样本索引: 样本名 -> 整数编码, 各组学按整数对齐;
+        # 编码只在本实例内有效, 随编码一起返回的 sample_index 标识所属索引
+        self._sample_index: Dict[str, int] = {}
+        self._sample_names: List[str] = []
+        self._index_id = uuid.uuid4().hex
+    
+    def encode_samples(self, sample_ids: List[str]) -> np.ndarray:
+        """样本名 -> 共享整数编码 (新样本追加编号)"""
+        codes = np.empty(len(sample_ids), dtype=np.int64)
+        for i, s in enumerate(sample_ids):
+            code = self._sample_index.get(s)
+            if code is None:
+                code = len(self._sample_names)
+                self._sample_index[s] = code
+                self._sample_names.append(s)
+            codes[i] = code
+        return codes
+    
+    def _sample_codes(self, data: Dict, sample_ids: List[str]) -> np.ndarray:
+        """
+        样本的整数编码: data 中的 sample_codes 来自本实例的索引时直接使用,
+        来自其他实例 (如另一个请求加载的表) 或没有标识时按 sample_ids 重新编码
+        """
+        if 'sample_codes' in data and data.get('sample_index') == self._index_id \
+                and len(data['sample_codes']) == len(sample_ids):
+            return np.asarray(data['sample_codes'], dtype=np.int64)
+        return self.encode_samples(sample_ids)
+    
+    def _load_cached(self, file_path: str, kind: str, samples_in_rows: bool) -> Dict:
+        """
+        读取表格, 首次读取时写入列式缓存 (matrix.npy + samples/features 索引 + meta.json),
+        之后按文件校验和命中缓存并以内存映射方式打开
+        """
+        checksum = _cached_checksum(file_path)
+        
+        cache = os.path.join(CACHE_DIR, f"{kind}-{checksum}")
+        hit = os.path.exists(os.path.join(cache, 'meta.json'))
+        if not hit:
+            X, samples, features, meta = _read_table(file_path, samples_in_rows)
+            # 每个写入者 (包括同一进程的不同线程) 使用独立的临时目录, 写完后整体改名
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            tmp = tempfile.mkdtemp(prefix=f"{kind}-{checksum}.tmp-", dir=CACHE_DIR)
+            np.save(os.path.join(tmp, 'matrix.npy'), X)
+            np.save(os.path.join(tmp, 'samples.npy'), np.array(samples, dtype=str))
+            np.save(os.path.join(tmp, 'features.npy'), np.array(features, dtype=str))
+            with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+                json.dump(meta, f)
+            try:
+                os.replace(tmp, cache)
+            except OSError:
+                # 其他写入者已写入同一缓存
+                shutil.rmtree(tmp, ignore_errors=True)
+        
+        X = np.load(os.path.join(cache, 'matrix.npy'), mmap_mode='r')
+        samples = np.load(os.path.join(cache, 'samples.npy')).tolist()
+        features = np.load(os.path.join(cache, 'features.npy')).tolist()
+        with open(os.path.join(cache, 'meta.json')) as f:
+            meta = json.load(f)
+        return {
+            "matrix": X,
+            "sample_ids": samples,
+            "feature_ids": features,
+            "sample_codes": self.encode_samples(samples),
+            "sample_index": self._index_id,
+            "meta": meta,
+            "checksum": checksum,
+            "cache": "hit" if hit else "miss"
+        }
     
     def load_rnaseq(self, file_path: str) -> Dict:
-        """加载RNA-seq数据"""
+        """加载RNA-seq数据 (基因为行, 样本为列的计数表)"""
+        table = self._load_cached(file_path, 'rnaseq', samples_in_rows=False)
         return {
             "status": "success",
             "type": "rnaseq",
-            "samples": 20,
-            "genes": 15000,
-            "format": "count_matrix"
+            "samples": len(table["sample_ids"]),
+            "genes": len(table["feature_ids"]),
+            "format": "count_matrix",
+            **table
         }
     
     def load_microbiome(self, file_path: str) -> Dict:
-        """加载微生物组数据"""
+        """加载微生物组数据 (BIOM, 或物种为行, 样本为列的丰度表)"""
+        table = self._load_cached(file_path, 'microbiome', samples_in_rows=False)
         return {
             "status": "success",
             "type": "microbiome",
-            "samples": 20,
-            "taxa": 500,
-            "format": "biom"
+            "samples": len(table["sample_ids"]),
+            "taxa": len(table["feature_ids"]),
+            "format": table["meta"]["format"],
+            **table
         }
     
     def load_clinical(self, file_path: str) -> Dict:
-        """加载临床数据"""
+        """加载临床数据 (样本为行, 变量为列)"""
+        table = self._load_cached(file_path, 'clinical', samples_in_rows=True)
         return {
             "status": "success",
             "type": "clinical",
-            "samples": 20,
-            "variables": 15,
-            "covariates": ["age", "sex", "BMI", "disease_status"]
+            "samples": len(table["sample_ids"]),
+            "variables": len(table["feature_ids"]),
+            "covariates": table["feature_ids"],
+            **table
         }
     
     def correlation_analysis(
         self, 
         rnaseq_data: Dict, 
-        microbiome_data: Dict
+        microbiome_data: Dict,
+        method: str = 'spearman',
+        threshold: float = 0.3,
+        top_k: int = 1000,
+        block_size: int = 2048,
+        n_permutations: int = 0,
+        n_jobs: int = 1,
+        seed: int = 0
     ) -> Dict:
         """
         跨组学相关性分析
+        秩变换 + 分块矩阵乘法 (BLAS多线程), t分布p值, BH校正;
+        只返回 |r| >= threshold 中最强的 top_k 对
+        n_permutations > 0 时为返回的相关对附加置换p值 (perm_pvalue)
         """
-        # 模拟相关性结果
+        genes_X, gene_samples, genes = _omics_matrix(rnaseq_data, 'rnaseq')
+        taxa_X, taxa_samples, taxa = _omics_matrix(microbiome_data, 'microbiome')
+        gi, ti = _shared_rows(
+            self._sample_codes(rnaseq_data, gene_samples),
+            self._sample_codes(microbiome_data, taxa_samples)
+        )
+        A, B = align_complete(genes_X[gi], taxa_X[ti])
+        
+        try:
+            res = blocked_correlation(
+                A, B, method=method.lower(), threshold=threshold,
+                top_k=top_k, block_size=block_size
+            )
+        except ValueError as e:
+            return {"status": "error", "message": str(e)}
+        
+        if n_permutations > 0 and res["r"].size:
+            perm = permutation_pvalues(
+                A, B, res["i"], res["j"], method=method.lower(),
+                n_permutations=n_permutations, n_jobs=n_jobs, seed=seed
+            )
+        
         correlations = [
-            {"gene": "IL6", "taxon": "Bacteroides", "correlation": 0.75, "pvalue": 0.001},
-            {"gene": "TNF", "taxon": "Lactobacillus", "correlation": -0.65, "pvalue": 0.005},
-            {"gene": "IFNG", "taxon": "Faecalibacterium", "correlation": 0.58, "pvalue": 0.01}
+            {
+                "gene": genes[i],
+                "taxon": taxa[j],
+                "correlation": round(float(r), 4),
+                "pvalue": float(p),
+                "padj": float(q)
+            }
+            for i, j, r, p, q in zip(res["i"], res["j"], res["r"], res["pvalue"], res["padj"])
         ]
+        if n_permutations > 0 and res["r"].size:
+            for item, p in zip(correlations, perm["pvalue"]):
+                item["perm_pvalue"] = float(p)
         
         return {
             "status": "success",
-            "method": "Spearman",
+            "method": "Spearman" if method.lower() == 'spearman' else "Pearson",
+            "n_samples": res["n_samples"],
+            "n_tests": res["n_tests"],
+            "threshold": threshold,
+            "n_permutations": n_permutations,
             "n_correlations": len(correlations),
             "correlations": correlations
         }
@@ -71,62 +434,342 @@ class MultiOmicsProcessor:
         self, 
         rnaseq_data: Dict, 
         microbiome_data: Dict,
-        clinical_data: Dict
+        clinical_data: Dict,
+        n_factors: int = 5,
+        n_clusters: int = 3,
+        max_iter: int = 200,
+        tol: float = 1e-4,
+        seed: int = 0
     ) -> Dict:
         """
-        网络整合分析
+        网络整合分析 - 多组学因子分析 (MOFA式 group factor analysis)
+        
+        样本取各组学的并集, 某组学缺失的样本/数值通过掩码处理;
+        各视图中心化并缩放到相同总方差 (临床变量先逐变量标准化). 同一数据再次调用且只改变 n_factors 时
+        从上一次的结果热启动
         """
+        inputs = {
+            "transcriptomics": (rnaseq_data, 'rnaseq'),
+            "microbiome": (microbiome_data, 'microbiome'),
+            "clinical": (clinical_data, 'clinical')
+        }
+        views = {name: _omics_matrix(d, kind) for name, (d, kind) in inputs.items()}
+        names = list(views)
+        union, rows = _union_rows(*[
+            self._sample_codes(inputs[v][0], views[v][1]) for v in names
+        ])
+        samples = [self._sample_names[c] for c in union]
+        N = len(samples)
+        
+        blocks, masks, view_idx = [], [], []
+        for v, (name, r) in enumerate(zip(names, rows)):
+            X = views[name][0]
+            full = np.full((N, X.shape[1]), np.nan)
+            full[r] = X
+            mask = ~np.isnan(full)
+            n_obs = np.maximum(mask.sum(axis=0), 1)
+            full = np.where(mask, full, 0.0)
+            full -= mask * (full.sum(axis=0) / n_obs)
+            if name == "clinical":
+                # 临床变量单位各异, 逐变量标准化
+                sd = np.sqrt((full ** 2).sum(axis=0) / n_obs)
+                full /= np.where(sd > 0, sd, 1.0)
+            # 每个视图缩放到单位总方差, 避免大视图主导因子
+            total_var = (full ** 2).sum() / max(mask.sum(), 1) * X.shape[1]
+            full /= np.sqrt(max(total_var, 1e-12))
+            blocks.append(full)
+            masks.append(mask.astype(np.float64))
+            view_idx.append(np.full(X.shape[1], v))
+        Y = np.hstack(blocks)
+        M = np.hstack(masks)
+        view_idx = np.concatenate(view_idx)
+        
+        key = hashlib.sha1(Y.tobytes() + M.tobytes()).hexdigest()
+        W0 = _FACTOR_FITS.get(key)
+        warm = W0 is not None
+        if warm:
+            # 保留上一次的前 n_factors 个因子 (已按解释方差排序), 不足的在拟合中补充
+            W0 = W0[:, :n_factors]
+        
+        fit = _group_factor_analysis(
+            Y, M, view_idx, len(names), n_factors, W=W0,
+            max_iter=max_iter, tol=tol, seed=seed
+        )
+        _FACTOR_FITS.pop(key, None)
+        while len(_FACTOR_FITS) >= _MAX_FACTOR_FITS:
+            _FACTOR_FITS.pop(next(iter(_FACTOR_FITS)), None)
+        _FACTOR_FITS[key] = fit["W"]
+        
+        # 在因子空间中对样本做k-means
+        Z = fit["Z"]
+        rng = np.random.default_rng(seed)
+        n_clusters = min(n_clusters, N)
+        centers = Z[rng.choice(N, size=n_clusters, replace=False)]
+        for _ in range(20):
+            labels = np.argmin(((Z[:, None, :] - centers[None]) ** 2).sum(axis=2), axis=1)
+            for c in range(n_clusters):
+                if np.any(labels == c):
+                    centers[c] = Z[labels == c].mean(axis=0)
+        
         return {
             "status": "success",
             "method": "MOFA+",
-            "n_latent_factors": 5,
-            "clusters": 3,
+            "n_latent_factors": n_factors,
+            "n_samples": N,
+            "n_features": {name: int(views[name][0].shape[1]) for name in names},
+            "iterations": fit["iterations"],
+            "converged": fit["converged"],
+            "warm_start": warm,
+            "clusters": n_clusters,
+            "sample_clusters": {s: int(c) for s, c in zip(samples, labels)},
             "variance_explained": {
-                "transcriptomics": 0.35,
-                "microbiome": 0.28,
-                "clinical": 0.45
-            }
+                name: round(float(fit["total"][v]), 4) for v, name in enumerate(names)
+            },
+            "variance_explained_per_factor": {
+                name: [round(float(x), 4) for x in fit["per_factor"][v]]
+                for v, name in enumerate(names)
+            },
+            "factors": {s: [round(float(x), 4) for x in z] for s, z in zip(samples, Z)}
         }
     
     def joint_analysis(
         self,
         rnaseq: Dict,
         microbiome: Dict,
-        clinical: Dict
+        clinical: Dict,
+        method: str = 'spearman',
+        threshold: float = 0.6,
+        min_module_size: int = 10,
+        n_permutations: int = 0,
+        n_jobs: int = 1,
+        seed: int = 0
     ) -> Dict:
         """
-        联合分析
+        联合分析 - 跨组学相关网络模块检测
+        
+        基因, 菌群与临床变量共同作为节点, |r| 同时不低于 threshold 和随机期望下每个节点
+        约1条假边对应的临界值 (样本少时自动提高) 的相关对作为边 (稀疏图, 分块构建);
+        模块度标签传播划分模块, 小于 min_module_size 的模块不报告.
+        每个模块取第一主成分作为特征向量 (eigen-feature), 一次矩阵乘法得到其与全部临床变量的相关,
+        n_permutations > 0 时附加置换p值
         """
+        method = method.lower()
+        if method not in ('spearman', 'pearson'):
+            return {"status": "error", "message": f"unsupported correlation method: {method}"}
+        
+        inputs = [(rnaseq, 'rnaseq'), (microbiome, 'microbiome'), (clinical, 'clinical')]
+        views = [_omics_matrix(d, kind) for d, kind in inputs]
+        rows = _shared_rows(*[
+            self._sample_codes(d, v[1]) for (d, _), v in zip(inputs, views)
+        ])
+        X = np.hstack([v[0][r] for v, r in zip(views, rows)])
+        X = X[~np.isnan(X).any(axis=1)]
+        n_samples = X.shape[0]
+        if n_samples < 4:
+            return {"status": "error", "message": "joint analysis needs at least 4 complete shared samples"}
+        
+        names = [f for v in views for f in v[2]]
+        kinds = np.concatenate([np.full(v[0].shape[1], k) for k, v in enumerate(views)])
+        n_clinical = views[2][0].shape[1]
+        Z = standardize_columns(rank_columns(X) if method == 'spearman' else X)
+        
+        edge_threshold = max(threshold, critical_correlation(1.0 / Z.shape[1], n_samples))
+        A = correlation_graph(Z, edge_threshold)
+        labels = modularity_communities(A, seed=seed)
+        sizes = np.bincount(labels)
+        # 模块按大小降序编号, 过小的模块不报告
+        keep = np.flatnonzero(sizes >= max(min_module_size, 2))
+        keep = keep[np.argsort(-sizes[keep], kind='stable')]
+        
+        eigen = np.empty((n_samples, keep.size))
+        members = []
+        for m, c in enumerate(keep):
+            idx = np.flatnonzero(labels == c)
+            U, S, _ = np.linalg.svd(Z[:, idx], full_matrices=False)
+            e = U[:, 0] * S[0]
+            # 特征向量方向与模块平均表达一致
+            if e @ Z[:, idx].mean(axis=1) < 0:
+                e = -e
+            eigen[:, m] = e
+            # 模块内成员按模块隶属度 (与特征向量的相关) 降序
+            kme = standardize_columns(e[:, None]).ravel() @ Z[:, idx]
+            members.append((idx[np.argsort(-kme, kind='stable')], float(S[0] ** 2 / (S ** 2).sum())))
+        
+        clin = X[:, -n_clinical:] if n_clinical else np.empty((n_samples, 0))
+        if method == 'spearman':
+            r = standardize_columns(rank_columns(eigen)).T @ standardize_columns(rank_columns(clin))
+        else:
+            r = standardize_columns(eigen).T @ standardize_columns(clin)
+        pvalues = correlation_pvalues(r, n_samples)
+        padj = bh_adjust(pvalues.ravel()).reshape(r.shape)
+        if n_permutations > 0 and r.size:
+            pi, pj = np.divmod(np.arange(r.size), r.shape[1])
+            perm = permutation_pvalues(
+                eigen, clin, pi, pj, method=method,
+                n_permutations=n_permutations, n_jobs=n_jobs, seed=seed
+            )["pvalue"].reshape(r.shape)
+        
+        clinical_names = views[2][2]
+        modules = []
+        for m, (idx, var_explained) in enumerate(members):
+            best = int(np.argmax(np.abs(r[m]))) if n_clinical else None
+            traits = {}
+            for c, var in enumerate(clinical_names):
+                traits[var] = {
+                    "correlation": round(float(r[m, c]), 4),
+                    "pvalue": float(pvalues[m, c]),
+                    "padj": float(padj[m, c])
+                }
+                if n_permutations > 0:
+                    traits[var]["perm_pvalue"] = float(perm[m, c])
+            modules.append({
+                "id": f"Module_{m + 1}",
+                "size": int(idx.size),
+                "hub": names[idx[0]],
+                "genes": [names[i] for i in idx if kinds[i] == 0],
+                "taxa": [names[i] for i in idx if kinds[i] == 1],
+                "clinical": [names[i] for i in idx if kinds[i] == 2],
+                "eigen_variance_explained": round(var_explained, 4),
+                "clinical_association": clinical_names[best] if best is not None else None,
+                "correlation": round(float(r[m, best]), 4) if best is not None else None,
+                "trait_correlations": traits
+            })
+        
+        assigned = np.isin(labels, keep)
         results = {
             "status": "success",
-            "modules": [
-                {
-                    "id": "Module_1",
-                    "description": "Inflammation response",
-                    "genes": ["IL6", "TNF", "IFNG", "CXCL8"],
-                    "taxa": ["Bacteroides", "Escherichia"],
-                    "clinical_association": "disease_severity",
-                    "correlation": 0.78
-                },
-                {
-                    "id": "Module_2", 
-                    "description": "Metabolic pathway",
-                    "genes": ["PPARG", "FABP1", "CPT1A"],
-                    "taxa": ["Lactobacillus", "Bifidobacterium"],
-                    "clinical_association": "BMI",
-                    "correlation": 0.65
-                }
-            ],
+            "method": "Spearman" if method == 'spearman' else "Pearson",
+            "n_samples": n_samples,
+            "threshold": threshold,
+            "edge_threshold": round(edge_threshold, 4),
+            "n_permutations": n_permutations,
+            "modules": modules,
             "summary": {
-                "total_modules": 2,
-                "significant_associations": 15,
-                "top_genes": 20,
-                "top_taxa": 10
+                "total_modules": len(modules),
+                "n_nodes": int(Z.shape[1]),
+                "n_edges": int(A.nnz // 2),
+                "modularity": round(modularity(A, labels), 4),
+                "unassigned": int((~assigned).sum()),
+                "significant_associations": int((padj < 0.05).sum()),
+                "top_genes": int(sum(len(mod["genes"]) for mod in modules)),
+                "top_taxa": int(sum(len(mod["taxa"]) for mod in modules))
             }
         }
         
         return results
     
+    def _paired_distances(
+        self,
+        rnaseq_data: Dict,
+        microbiome_data: Dict,
+        rnaseq_metric: Optional[str],
+        microbiome_metric: Optional[str]
+    ) -> Tuple[np.ndarray, np.ndarray, int]:
+        """
+        两个组学在共有样本上的压缩距离向量
+        data 中有 'distance' (方阵或压缩向量, 配合 'sample_ids') 时直接使用,
+        否则由组学矩阵计算 (微生物组非负时默认 Bray-Curtis, 其余默认欧氏距离)
+        """
+        dists, codes = [], []
+        for data, kind, metric in (
+            (rnaseq_data, 'rnaseq', rnaseq_metric),
+            (microbiome_data, 'microbiome', microbiome_metric)
+        ):
+            if 'distance' in data:
+                D = np.asarray(data['distance'], dtype=np.float64)
+                if D.ndim == 1:
+                    D = squareform(D, checks=False)
+                samples = list(data.get('sample_ids') or [f"S{i + 1}" for i in range(D.shape[0])])
+            else:
+                X, samples, _ = _omics_matrix(data, kind)
+                X = X[:, ~np.isnan(X).any(axis=0)]
+                if metric is None:
+                    metric = 'braycurtis' if kind == 'microbiome' and X.min() >= 0 else 'euclidean'
+                D = squareform(pdist(X, metric))
+            dists.append(D)
+            codes.append(self._sample_codes(data, samples))
+        rows = _shared_rows(*codes)
+        d1, d2 = [squareform(D[np.ix_(r, r)], checks=False) for D, r in zip(dists, rows)]
+        return d1, d2, rows[0].size
+    
+    def mantel_test(
+        self,
+        rnaseq_data: Dict,
+        microbiome_data: Dict,
+        method: str = 'pearson',
+        rnaseq_metric: Optional[str] = None,
+        microbiome_metric: Optional[str] = None,
+        n_permutations: int = 9999,
+        alternative: str = 'greater',
+        early_stop: int = 10,
+        n_jobs: int = 1,
+        seed: int = 0
+    ) -> Dict:
+        """
+        Mantel检验 - 微生物组beta多样性是否与转录组距离相关
+        置换按批生成, 可用进程池并行; early_stop 次超越后提前停止 (0 表示跑满)
+        """
+        d1, d2, n = self._paired_distances(rnaseq_data, microbiome_data, rnaseq_metric, microbiome_metric)
+        if n < 3:
+            return {"status": "error", "message": "mantel test needs at least 3 shared samples"}
+        try:
+            res = mantel(
+                d1, d2, method=method.lower(), n_permutations=n_permutations,
+                alternative=alternative, early_stop=early_stop, n_jobs=n_jobs, seed=seed
+            )
+        except ValueError as e:
+            return {"status": "error", "message": str(e)}
+        
+        return {
+            "status": "success",
+            "method": "Mantel (Spearman)" if method.lower() == 'spearman' else "Mantel (Pearson)",
+            "alternative": alternative,
+            "n_samples": n,
+            "statistic": round(res["statistic"], 4),
+            "pvalue": res["pvalue"],
+            "n_permutations": res["n_permutations"]
+        }
+    
+    def procrustes_analysis(
+        self,
+        rnaseq_data: Dict,
+        microbiome_data: Dict,
+        n_axes: int = 10,
+        rnaseq_metric: Optional[str] = None,
+        microbiome_metric: Optional[str] = None,
+        n_permutations: int = 9999,
+        early_stop: int = 10,
+        n_jobs: int = 1,
+        seed: int = 0
+    ) -> Dict:
+        """
+        Procrustes分析 + PROTEST置换检验
+        两个距离矩阵各自做PCoA (前 n_axes 轴), 再比较两组坐标
+        """
+        d1, d2, n = self._paired_distances(rnaseq_data, microbiome_data, rnaseq_metric, microbiome_metric)
+        if n < 3:
+            return {"status": "error", "message": "procrustes analysis needs at least 3 shared samples"}
+        X, var_x = pcoa(d1, n_axes)
+        Y, var_y = pcoa(d2, n_axes)
+        res = procrustes_test(
+            X, Y, n_permutations=n_permutations, early_stop=early_stop, n_jobs=n_jobs, seed=seed
+        )
+        
+        return {
+            "status": "success",
+            "method": "PROTEST",
+            "n_samples": n,
+            "n_axes": {"transcriptomics": int(X.shape[1]), "microbiome": int(Y.shape[1])},
+            "variance_explained": {
+                "transcriptomics": round(float(var_x.sum()), 4),
+                "microbiome": round(float(var_y.sum()), 4)
+            },
+            "statistic": round(res["statistic"], 4),
+            "m12": round(res["m12"], 4),
+            "pvalue": res["pvalue"],
+            "n_permutations": res["n_permutations"]
+        }
+    
     def enrichment_analysis(
         self, 
         gene_list: List[str]
@@ -177,12 +820,27 @@ class MultiOmicsProcessor:
 
 # CLI测试
 if __name__ == "__main__":
+    import tempfile
+    import time
+    
     processor = MultiOmicsProcessor()
     
-    # 测试
-    rnaseq = processor.load_rnaseq("rnaseq.csv")
-    microbiome = processor.load_microbiome("microbiome.csv")
-    clinical = processor.load_clinical("clinical.csv")
+    # 测试: 写出演示数据再读取 (第二次读取命中缓存)
+    tmp = tempfile.mkdtemp()
+    samples = [f"S{i + 1}" for i in range(20)]
+    pd.DataFrame(_demo_omics('rnaseq', 20, 15000).T, columns=samples,
+                 index=[f"Gene_{j + 1}" for j in range(15000)]).to_csv(os.path.join(tmp, "rnaseq.csv"))
+    pd.DataFrame(_demo_omics('microbiome', 20, 500).T, columns=samples,
+                 index=[f"Taxon_{j + 1}" for j in range(500)]).to_csv(os.path.join(tmp, "microbiome.tsv"), sep='\t')
+    pd.DataFrame(_demo_omics('clinical', 20, 15), index=samples,
+                 columns=[f"Var_{j + 1}" for j in range(15)]).to_csv(os.path.join(tmp, "clinical.csv"))
+    
+    for attempt in range(2):
+        t = time.time()
+        rnaseq = processor.load_rnaseq(os.path.join(tmp, "rnaseq.csv"))
+        print(f"load_rnaseq: {rnaseq['cache']} in {time.time() - t:.3f}s")
+    microbiome = processor.load_microbiome(os.path.join(tmp, "microbiome.tsv"))
+    clinical = processor.load_clinical(os.path.join(tmp, "clinical.csv"))
     
     result = processor.joint_analysis(rnaseq, microbiome, clinical)
     print(json.dumps(result, indent=2))
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Negative Binomial GLM
+DESeq2 风格的差异丰度分析, 全部特征同时以批量数组运算拟合 (没有逐特征循环)
+
+- 大小因子: median-of-ratios; 每个特征都有零时改用 poscounts (同 DESeq2 type="poscounts")
+- 离散度: 基因级 Cox-Reid 调整轮廓似然的最大值 -> 参数趋势 a0 + a1 / mean -> 对数正态先验下的 MAP
+  一维优化对所有特征同时做: 对数网格定位后黄金分割细化
+- GLM: 对数连接的 IRLS, 每次迭代是 (特征数, p, p) 的批量线性方程组; Wald 检验 + BH
+"""
+
+import numpy as np
+from scipy.special import gammaln, ndtr, polygamma
+from typing import Callable, Dict, Optional
+
+try:
+    from .stats import bh_adjust
+except ImportError:  # 作为脚本直接运行
+    from stats import bh_adjust
+
+
+MIN_DISP = 1e-8
+_GOLDEN = (np.sqrt(5.0) - 1.0) / 2.0
+
+
+def size_factors(Y: np.ndarray) -> np.ndarray:
+    """
+    Y: samples x features 计数; 各样本对特征几何均值之比的中位数, 归一化到几何均值为1
+    """
+    logY = np.log(np.where(Y > 0, Y, 1.0))
+    positive = Y > 0
+    complete = positive.all(axis=0)
+    if complete.any():
+        log_geo = logY[:, complete].mean(axis=0)
+        ratios = logY[:, complete] - log_geo
+        s = np.exp(np.median(ratios, axis=1))
+    else:
+        # poscounts: 只在正计数上取几何均值, 再乘以 (正计数个数 / 样本数)
+        n_pos = positive.sum(axis=0)
+        log_geo = np.where(n_pos > 0, (logY * positive).sum(axis=0) / np.maximum(n_pos, 1), 0.0)
+        log_geo += np.log(np.maximum(n_pos, 1) / Y.shape[0])
+        ratios = np.where(positive & (n_pos > 0), logY - log_geo, np.nan)
+        s = np.exp(np.nanmedian(ratios, axis=1))
+    s = np.where(np.isfinite(s) & (s > 0), s, 1.0)
+    return s / np.exp(np.log(s).mean())
+
+
+def _xtwx(W: np.ndarray, X: np.ndarray) -> np.ndarray:
+    """各特征的 X^T diag(w) X, 返回 (F, p, p); W: (F, n)"""
+    return np.einsum('fi,ip,iq->fpq', W, X, X, optimize=True)
+
+
+def fit_nb_glm(
+    Y: np.ndarray,
+    X: np.ndarray,
+    s: np.ndarray,
+    alpha: np.ndarray,
+    max_iter: int = 100,
+    tol: float = 1e-8,
+    ridge: float = 1e-6,
+    min_mu: float = 0.5
+) -> Dict:
+    """
+    所有特征同时拟合 NB GLM (对数连接, offset = log s), IRLS
+    Y: features x samples; X: samples x p; alpha: 各特征的离散度
+    返回 beta (F, p, 自然对数尺度), se, mu (F, n), converged, iterations
+    """
+    F, n = Y.shape
+    p = X.shape[1]
+    log_s = np.log(s)
+    # 初值: 对数标准化计数的最小二乘
+    beta = np.log(Y / s + 0.1) @ np.linalg.pinv(X).T
+    eye = ridge * np.eye(p)
+    a = alpha[:, None]
+    dev_old = np.full(F, np.inf)
+    active = np.ones(F, dtype=bool)
+    converged = np.zeros(F, dtype=bool)
+    iterations = 0
+    for iterations in range(1, max_iter + 1):
+        idx = np.flatnonzero(active)
+        if idx.size == 0:
+            break
+        y, b, aa = Y[idx], beta[idx], a[idx]
+        mu = np.maximum(np.exp(np.clip(b @ X.T + log_s, -30.0, 30.0)), min_mu)
+        w = mu / (1.0 + aa * mu)
+        z = np.log(mu) - log_s + (y - mu) / mu
+        A = _xtwx(w, X) + eye
+        rhs = np.einsum('fi,ip->fp', w * z, X)
+        b_new = np.linalg.solve(A, rhs[..., None])[..., 0]
+        beta[idx] = b_new
+        mu = np.maximum(np.exp(np.clip(b_new @ X.T + log_s, -30.0, 30.0)), min_mu)
+        dev = -2.0 * nb_loglik(y, mu, aa[:, 0])
+        done = np.abs(dev - dev_old[idx]) / (np.abs(dev) + 0.1) < tol
+        dev_old[idx] = dev
+        converged[idx[done]] = True
+        active[idx[done]] = False
+    mu = np.maximum(np.exp(np.clip(beta @ X.T + log_s, -30.0, 30.0)), min_mu)
+    w = mu / (1.0 + a * mu)
+    cov = np.linalg.inv(_xtwx(w, X) + eye)
+    se = np.sqrt(np.maximum(np.diagonal(cov, axis1=1, axis2=2), 0.0))
+    return {"beta": beta, "se": se, "mu": mu, "converged": converged, "iterations": iterations}
+
+
+def nb_loglik(Y: np.ndarray, mu: np.ndarray, alpha: np.ndarray) -> np.ndarray:
+    """各特征的 NB 对数似然 (省略与参数无关的 log y!); Y, mu: (F, n), alpha: (F,)"""
+    r = 1.0 / alpha[:, None]
+    return (
+        gammaln(Y + r) - gammaln(r)
+        + r * np.log(r / (r + mu)) + Y * np.log(mu / (r + mu))
+    ).sum(axis=1)
+
+
+def _cr_loglik(Y: np.ndarray, mu: np.ndarray, X: np.ndarray, log_alpha: np.ndarray) -> np.ndarray:
+    """Cox-Reid 调整的轮廓对数似然: loglik - 1/2 log det(X^T W X)"""
+    alpha = np.exp(log_alpha)
+    w = mu / (1.0 + alpha[:, None] * mu)
+    _, logdet = np.linalg.slogdet(_xtwx(w, X))
+    return nb_loglik(Y, mu, alpha) - 0.5 * logdet
+
+
+def _maximize_log_alpha(
+    objective: Callable[[np.ndarray], np.ndarray],
+    n_features: int,
+    lo: float,
+    hi: float,
+    n_grid: int = 25,
+    n_refine: int = 25
+) -> np.ndarray:
+    """
+    对每个特征在 [lo, hi] 上最大化一维目标 (对数离散度)
+    先在共同的网格上定位最大值, 再在相邻两格内做黄金分割, 全部特征同时计算
+    """
+    grid = np.linspace(lo, hi, n_grid)
+    values = np.stack([objective(np.full(n_features, g)) for g in grid])
+    k = np.argmax(values, axis=0)
+    a = grid[np.maximum(k - 1, 0)]
+    b = grid[np.minimum(k + 1, n_grid - 1)]
+    c = b - _GOLDEN * (b - a)
+    d = a + _GOLDEN * (b - a)
+    fc, fd = objective(c), objective(d)
+    for _ in range(n_refine):
+        left = fc >= fd
+        b = np.where(left, d, b)
+        a = np.where(left, a, c)
+        c_new = b - _GOLDEN * (b - a)
+        d_new = a + _GOLDEN * (b - a)
+        # 保留的内点直接复用, 只对新点求值
+        keep_c = np.where(left, c, d)
+        c = np.where(left, c_new, keep_c)
+        d = np.where(left, keep_c, d_new)
+        f_new = objective(np.where(left, c, d))
+        fc, fd = np.where(left, f_new, fd), np.where(left, fc, f_new)
+    return (a + b) / 2.0
+
+
+def _dispersion_trend(mean: np.ndarray, disp: np.ndarray, max_iter: int = 10) -> Dict:
+    """
+    参数趋势 disp = a0 + a1 / mean (同 DESeq2 parametric): Gamma 族恒等连接的 IRLS,
+    每轮剔除 disp / fit 不在 (1e-4, 15) 的特征; 系数非正时退回到截尾均值常数
+    """
+    use = (disp >= 100 * MIN_DISP) & (mean > 0)
+    coefs = np.array([0.1, 1.0])
+    for _ in range(max_iter):
+        if use.sum() < 3:
+            break
+        D = np.column_stack([np.ones(use.sum()), 1.0 / mean[use]])
+        for _ in range(25):
+            fit = D @ coefs
+            if np.any(fit <= 0):
+                break
+            w = 1.0 / fit ** 2
+            new = np.linalg.lstsq(D * np.sqrt(w)[:, None], disp[use] * np.sqrt(w), rcond=None)[0]
+            if np.allclose(new, coefs, rtol=1e-6):
+                coefs = new
+                break
+            coefs = new
+        if np.any(coefs <= 0):
+            break
+        ratio = disp / (coefs[0] + coefs[1] / np.maximum(mean, 1e-300))
+        new_use = (disp >= 100 * MIN_DISP) & (mean > 0) & (ratio > 1e-4) & (ratio < 15)
+        if np.array_equal(new_use, use):
+            break
+        use = new_use
+    if np.all(coefs > 0):
+        return {"type": "parametric", "coefficients": coefs.tolist(),
+                "fit": coefs[0] + coefs[1] / np.maximum(mean, 1e-300)}
+    ok = disp >= 10 * MIN_DISP
+    vals = np.sort(disp[ok]) if ok.any() else np.array([0.1])
+    trim = int(0.001 * vals.size)
+    level = float(vals[trim:vals.size - trim].mean()) if vals.size > 2 * trim else float(vals.mean())
+    return {"type": "mean", "coefficients": [level], "fit": np.full(mean.size, level)}
+
+
+def estimate_dispersions(Y: np.ndarray, X: np.ndarray, s: np.ndarray) -> Dict:
+    """
+    DESeq2 的三步离散度估计; Y: features x samples
+    返回 gene (基因级), trend, map (最终使用), prior_var, trend_type, trend_coefficients
+    """
+    F, n = Y.shape
+    p = X.shape[1]
+    max_disp = max(10.0, n)
+    norm = Y / s
+    mean = norm.mean(axis=1)
+    var = norm.var(axis=1, ddof=1)
+    # 初值: 矩估计, 用于拟合 mu
+    rough = np.clip((var - mean * np.mean(1.0 / s)) / np.maximum(mean, 1e-300) ** 2, MIN_DISP, max_disp)
+    mu = fit_nb_glm(Y, X, s, rough)["mu"]
+    lo, hi = np.log(MIN_DISP / 10), np.log(max_disp)
+
+    gene = np.exp(_maximize_log_alpha(lambda la: _cr_loglik(Y, mu, X, la), F, lo, hi))
+    gene = np.clip(gene, MIN_DISP, max_disp)
+    trend = _dispersion_trend(mean, gene)
+    fit = np.clip(trend["fit"], MIN_DISP, max_disp)
+
+    use = gene >= 100 * MIN_DISP
+    resid = np.log(gene[use]) - np.log(fit[use])
+    mad = 1.4826 * np.median(np.abs(resid - np.median(resid))) if resid.size else 0.0
+    var_log = mad ** 2
+    prior_var = max(var_log - float(polygamma(1, (n - p) / 2.0)), 0.25) if n - p >= 3 else 0.25
+    log_fit = np.log(fit)
+    map_disp = np.exp(_maximize_log_alpha(
+        lambda la: _cr_loglik(Y, mu, X, la) - (la - log_fit) ** 2 / (2.0 * prior_var), F, lo, hi
+    ))
+    # 基因级估计远高于趋势的特征 (离散度离群) 保留基因级估计
+    outlier = np.log(gene) > log_fit + 2.0 * np.sqrt(var_log)
+    final = np.clip(np.where(outlier, gene, map_disp), MIN_DISP, max_disp)
+    return {
+        "gene": gene,
+        "trend": fit,
+        "map": final,
+        "outlier": outlier,
+        "prior_var": prior_var,
+        "trend_type": trend["type"],
+        "trend_coefficients": trend["coefficients"]
+    }
+
+
+def nb_wald_test(
+    Y: np.ndarray,
+    X: np.ndarray,
+    coef: int = -1,
+    s: Optional[np.ndarray] = None
+) -> Dict:
+    """
+    DESeq2 风格的差异检验: Y samples x features 计数, X samples x p 设计矩阵 (含截距)
+    对第 coef 个系数做 Wald 检验; 全零特征的结果为 NaN
+    返回 base_mean, log2_fold_change, lfc_se, stat, pvalue, padj, dispersion 及拟合信息
+    """
+    Y = np.asarray(Y, dtype=np.float64)
+    X = np.asarray(X, dtype=np.float64)
+    n, F = Y.shape
+    s = size_factors(Y) if s is None else np.asarray(s, dtype=np.float64)
+    tested = np.flatnonzero(Y.sum(axis=0) > 0)
+    Yt = np.ascontiguousarray(Y[:, tested].T)
+
+    disp = estimate_dispersions(Yt, X, s)
+    fit = fit_nb_glm(Yt, X, s, disp["map"])
+    beta = fit["beta"][:, coef]
+    se = fit["se"][:, coef]
+    stat = beta / np.where(se > 0, se, np.nan)
+    pvalue = 2.0 * ndtr(-np.abs(stat))
+
+    def expand(values: np.ndarray) -> np.ndarray:
+        out = np.full(F, np.nan)
+        out[tested] = values
+        return out
+
+    ok = np.isfinite(pvalue)
+    padj = np.full(tested.size, np.nan)
+    padj[ok] = bh_adjust(pvalue[ok])
+    return {
+        "base_mean": (Y / s[:, None]).mean(axis=0),
+        "log2_fold_change": expand(beta / np.log(2.0)),
+        "lfc_se": expand(se / np.log(2.0)),
+        "stat": expand(stat),
+        "pvalue": expand(pvalue),
+        "padj": expand(padj),
+        "dispersion": expand(disp["map"]),
+        "dispersion_gene": expand(disp["gene"]),
+        "dispersion_trend": expand(disp["trend"]),
+        "converged": expand(fit["converged"].astype(np.float64)),
+        "size_factors": s,
+        "prior_var": disp["prior_var"],
+        "trend_type": disp["trend_type"],
+        "trend_coefficients": disp["trend_coefficients"]
+    }
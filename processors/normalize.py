@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Count Normalization
+抽平 (rarefaction) 与成分数据变换, 全部直接作用于 CSR 的非零数组
+
+- 抽平: 每个样本一次多元超几何抽样, 按特征顺序拆成条件超几何 x_j ~ HG(c_j, 剩余总数 - c_j, 剩余抽样数);
+  同一块内所有样本在一个循环中向量化推进, 循环次数只等于块内最大非零特征数, 不展开成逐条reads
+- 随机数按固定大小的样本块取种子 (seed, 块号): 结果与进程数及块在进程间的分配无关
+- TSS / CLR / CSS 只改写非零值, 稀疏结构不变
+"""
+
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from scipy import sparse
+from typing import Dict, Iterator, Optional, Tuple
+
+# 抽平的随机数块大小 (样本数); 改变它会改变给定种子下的结果
+RAREFY_BLOCK = 1024
+
+
+def sequential_hypergeometric(
+    data: np.ndarray,
+    start: np.ndarray,
+    nnz: np.ndarray,
+    pop: np.ndarray,
+    need: np.ndarray,
+    rng: np.random.Generator
+) -> Iterator[Tuple[int, np.ndarray, np.ndarray]]:
+    """
+    多元超几何抽样按特征顺序拆成条件超几何 x_j ~ HG(c_j, 剩余总数 - c_j, 剩余抽样数), 所有单位向量化推进
+    单位 (样本, 或稀释曲线的 (样本, 深度) 对) 的非零计数为 data[start:start + nnz], 总数 pop, 抽样数 need;
+    单位须按 nnz 降序排列, 第k步的活跃单位总是前 m 个. 逐步产出 (m, 第k个非零项在 data 中的位置, 抽样数)
+    """
+    n_active = np.searchsorted(-nnz, -np.arange(nnz.max(initial=0)), side='left')
+    pop = np.array(pop, dtype=np.int64)
+    need = np.array(need, dtype=np.int64)
+    for k, m in enumerate(n_active):
+        pos = start[:m] + k
+        good = data[pos]
+        x = rng.hypergeometric(good, pop[:m] - good, need[:m])
+        pop[:m] -= good
+        need[:m] -= x
+        yield m, pos, x
+
+
+def _rarefy_rows(X: sparse.csr_matrix, depth: int, rng: np.random.Generator) -> np.ndarray:
+    """对 X 的每一行 (总数都 >= depth) 抽取 depth 条, 返回与 X.data 对齐的新计数"""
+    nnz = np.diff(X.indptr)
+    out = np.zeros(X.data.size, dtype=np.int64)
+    rows = np.argsort(-nnz, kind='stable')
+    pop = np.asarray(X.sum(axis=1)).ravel()[rows]
+    need = np.full(rows.size, depth, dtype=np.int64)
+    for _, pos, x in sequential_hypergeometric(X.data, X.indptr[rows], nnz[rows], pop, need, rng):
+        out[pos] = x
+    return out
+
+
+# 子进程内的只读状态: 计数矩阵, 抽平深度与种子
+_WORKER: Dict = {}
+
+
+def _init_rarefy_worker(state: Dict) -> None:
+    _WORKER.clear()
+    _WORKER.update(state)
+
+
+def _rarefy_blocks(state: Dict, blocks: np.ndarray) -> np.ndarray:
+    """若干样本块的抽平结果, 按块顺序拼接 (与这些块的 X.data 片段对齐)"""
+    X = state["X"]
+    parts = []
+    for b in blocks:
+        lo, hi = int(b) * RAREFY_BLOCK, min((int(b) + 1) * RAREFY_BLOCK, X.shape[0])
+        rng = np.random.default_rng([state["seed"], int(b)])
+        parts.append(_rarefy_rows(X[lo:hi], state["depth"], rng))
+    return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+
+
+def _rarefy_worker(blocks: np.ndarray) -> np.ndarray:
+    return _rarefy_blocks(_WORKER, blocks)
+
+
+def rarefy(X: sparse.csr_matrix, depth: int, n_jobs: int = 1, seed: int = 0) -> sparse.csr_matrix:
+    """
+    把每个样本 (行) 无放回抽平到 depth 条; 调用方应先去掉总数不足 depth 的样本
+    返回整数 CSR (已去掉抽样后为零的项)
+    """
+    X = sparse.csr_matrix(X, copy=True)
+    X.data = np.rint(X.data).astype(np.int64)
+    X.eliminate_zeros()
+    totals = np.asarray(X.sum(axis=1)).ravel()
+    if np.any(totals < depth):
+        raise ValueError(f"{int((totals < depth).sum())} samples have fewer than {depth} counts")
+    n_blocks = -(-X.shape[0] // RAREFY_BLOCK)
+    chunks = [c for c in np.array_split(np.arange(n_blocks), max(n_jobs, 1)) if c.size]
+    state = {"X": X, "depth": int(depth), "seed": seed}
+    if n_jobs <= 1 or len(chunks) < 2:
+        data = _rarefy_blocks(state, np.arange(n_blocks))
+    else:
+        with ProcessPoolExecutor(
+            max_workers=n_jobs, initializer=_init_rarefy_worker, initargs=(state,)
+        ) as pool:
+            data = np.concatenate(list(pool.map(_rarefy_worker, chunks)))
+    out = sparse.csr_matrix((data, X.indices.copy(), X.indptr.copy()), shape=X.shape)
+    out.eliminate_zeros()
+    return out
+
+
+def _row_of_data(X: sparse.csr_matrix) -> np.ndarray:
+    return np.repeat(np.arange(X.shape[0]), np.diff(X.indptr))
+
+
+def tss(X: sparse.csr_matrix) -> sparse.csr_matrix:
+    """总和标准化: 每个样本除以其总计数 (相对丰度)"""
+    X = sparse.csr_matrix(X, dtype=np.float64, copy=True)
+    totals = np.asarray(X.sum(axis=1)).ravel()
+    X.data /= np.where(totals > 0, totals, 1.0)[_row_of_data(X)]
+    return X
+
+
+def clr(X: sparse.csr_matrix) -> sparse.csr_matrix:
+    """
+    稀疏 CLR (robust CLR): log x 减去该样本观测到的 (非零) 特征的对数均值, 零保持为零 (视为缺失)
+    不加伪计数, 因而不会把零填成稠密的负值
+    """
+    X = sparse.csr_matrix(X, dtype=np.float64, copy=True)
+    X.eliminate_zeros()
+    rows = _row_of_data(X)
+    np.log(X.data, out=X.data)
+    nnz = np.diff(X.indptr)
+    mean = np.bincount(rows, weights=X.data, minlength=X.shape[0]) / np.maximum(nnz, 1)
+    X.data -= mean[rows]
+    return X
+
+
+def _row_sorted(X: sparse.csr_matrix) -> sparse.csr_matrix:
+    """每行内非零值升序排列的副本 (列下标随之打乱, 只用于取行内分位数)"""
+    X = sparse.csr_matrix(X, dtype=np.float64, copy=True)
+    X.eliminate_zeros()
+    order = np.lexsort((X.data, _row_of_data(X)))
+    X.data = X.data[order]
+    return X
+
+
+def _row_quantiles(S: sparse.csr_matrix, q: np.ndarray) -> np.ndarray:
+    """行内已排序的非零值的分位数 (R 默认 type 7), 返回 rows x len(q)"""
+    nnz = np.diff(S.indptr)
+    h = (np.maximum(nnz, 1) - 1)[:, None] * np.asarray(q)[None, :]
+    lo = np.floor(h).astype(np.int64)
+    hi = np.minimum(lo + 1, np.maximum(nnz - 1, 0)[:, None])
+    base = S.indptr[:-1, None]
+    data = S.data if S.data.size else np.zeros(1)
+    a = data[np.minimum(base + lo, data.size - 1)]
+    b = data[np.minimum(base + hi, data.size - 1)]
+    return np.where(nnz[:, None] > 0, a + (h - lo) * (b - a), np.nan)
+
+
+def css_quantile(X: sparse.csr_matrix, rel: float = 0.1) -> float:
+    """
+    metagenomeSeq cumNormStatFast: 由各样本非零计数的分位数与参考分布的偏离确定 CSS 分位点
+    偏离的相对变化首次超过 rel 的位置; 不低于 0.5
+    """
+    S = _row_sorted(X)
+    nnz = np.diff(S.indptr)
+    if np.any(nnz <= 1):
+        raise ValueError("CSS needs at least 2 non-zero features in every sample")
+    L = int(nnz.max())
+    # 参考: 每个样本的非零值升序靠底对齐 (上方补零) 后逐行取均值
+    offset = L - nnz
+    rows = _row_of_data(S)
+    slot = offset[rows] + (np.arange(S.data.size) - S.indptr[rows])
+    ref = np.bincount(slot, weights=S.data, minlength=L) / X.shape[0]
+    quant = _row_quantiles(S, np.linspace(0.0, 1.0, L))
+    dev = np.median(np.abs(ref[None, :] - quant), axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        change = np.abs(np.diff(dev)) / dev[1:]
+    hit = np.flatnonzero(change > rel)
+    p = (hit[0] + 1) / dev.size if hit.size else 0.5
+    return float(max(p, 0.5))
+
+
+def css(X: sparse.csr_matrix, quantile: Optional[float] = None, scale: float = 1000.0) -> sparse.csr_matrix:
+    """
+    累积和标准化 (CSS, metagenomeSeq): 每个样本除以其非零计数中不超过第 quantile 分位数的计数之和, 再乘以 scale
+    quantile 为 None 时由 css_quantile 按数据确定
+    """
+    if quantile is None:
+        quantile = css_quantile(X)
+    S = _row_sorted(X)
+    q = _row_quantiles(S, np.array([quantile]))[:, 0]
+    rows = _row_of_data(S)
+    below = S.data <= q[rows] + 1e-12
+    factor = np.bincount(rows, weights=S.data * below, minlength=X.shape[0])
+    Y = sparse.csr_matrix(X, dtype=np.float64, copy=True)
+    Y.eliminate_zeros()
+    Y.data *= scale / np.where(factor > 0, factor, 1.0)[_row_of_data(Y)]
+    return Y
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+Ordination
+排序分析: PCoA (小样本稠密特征分解 / 大样本随机化流式特征分解), NMDS (多随机起点并行), 稀疏PCA
+"""
+
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from scipy import sparse
+from scipy.linalg import eigh
+from scipy.optimize import isotonic_regression
+from scipy.spatial.distance import pdist, squareform
+from typing import Dict, Tuple
+
+try:
+    from .distance import condensed_rows
+except ImportError:  # 作为脚本直接运行
+    from distance import condensed_rows
+
+
+def sparse_pca(
+    X: sparse.csr_matrix,
+    n_comps: int,
+    n_oversamples: int = 10,
+    n_iter: int = 4,
+    seed: int = 0
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    稀疏矩阵的随机化PCA, 中心化隐式完成 (不稠密化X)
+    返回 (scores, components, mean, singular_values)
+    """
+    rng = np.random.default_rng(seed)
+    n, m = X.shape
+    mu = np.asarray(X.mean(axis=0)).ravel()
+    k = min(n_comps + n_oversamples, n, m)
+    
+    def matmul(B: np.ndarray) -> np.ndarray:
+        # (X - 1 mu^T) @ B
+        return X @ B - (mu @ B)[None, :]
+    
+    def rmatmul(B: np.ndarray) -> np.ndarray:
+        # (X - 1 mu^T)^T @ B
+        return X.T @ B - np.outer(mu, B.sum(axis=0))
+    
+    Q = matmul(rng.standard_normal((m, k)))
+    Q, _ = np.linalg.qr(Q)
+    for _ in range(n_iter):
+        Q, _ = np.linalg.qr(rmatmul(Q))
+        Q, _ = np.linalg.qr(matmul(Q))
+    B = rmatmul(Q).T
+    Uh, S, Vt = np.linalg.svd(B, full_matrices=False)
+    U = Q @ Uh
+    n_comps = min(n_comps, len(S))
+    scores = U[:, :n_comps] * S[:n_comps]
+    return scores, Vt[:n_comps], mu, S[:n_comps]
+
+
+def _condensed(D: np.ndarray) -> np.ndarray:
+    D = np.asarray(D)
+    return squareform(D, checks=False) if D.ndim == 2 else D
+
+
+def _n_from_condensed(m: int) -> int:
+    return int(round((1 + np.sqrt(1 + 8 * m)) / 2))
+
+
+def pcoa(
+    D: np.ndarray,
+    n_axes: int = 10,
+    dense_limit: int = 4000,
+    n_oversamples: int = 20,
+    n_iter: int = 5,
+    block_size: int = 1024,
+    seed: int = 0
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    PCoA (主坐标分析): 对 G = -1/2 J D^2 J 取前 n_axes 个正特征值
+    D 为方阵或压缩距离向量; 返回 (坐标 n x k, 各轴解释比例 = 特征值 / trace(G))
+
+    n <= dense_limit 时展开方阵做部分特征分解; 更大时用随机化子空间迭代,
+    G 从不显式构造: 每次 G @ V 按行块从压缩向量取出 D^2 的若干行做矩阵乘法,
+    双中心化通过行均值修正完成, 内存只有 O(block_size x n)
+    """
+    d = _condensed(D)
+    n = _n_from_condensed(d.size)
+    if n < 2:
+        return np.zeros((n, 0)), np.zeros(0)
+    # trace(G) = sum_{i<j} d_ij^2 / n
+    total = float(np.dot(d, d)) / n if d.size else 0.0
+    k = min(n_axes, n - 1)
+    
+    if n <= dense_limit:
+        G = -0.5 * squareform(np.asarray(d, dtype=np.float64), checks=False) ** 2
+        G -= G.mean(axis=0, keepdims=True)
+        G -= G.mean(axis=1, keepdims=True)
+        vals, vecs = eigh(G, subset_by_index=[n - k, n - 1])
+        vals, vecs = vals[::-1], vecs[:, ::-1]
+    else:
+        row_mean = np.empty(n)
+        for start in range(0, n, block_size):
+            stop = min(start + block_size, n)
+            row_mean[start:stop] = (condensed_rows(d, n, start, stop) ** 2).mean(axis=1)
+        grand = row_mean.mean()
+        
+        def gram(V: np.ndarray) -> np.ndarray:
+            # G V = -1/2 (D^2 V - r (1^T V) - 1 (r^T V) + g 1 (1^T V))
+            out = np.empty_like(V)
+            for start in range(0, n, block_size):
+                stop = min(start + block_size, n)
+                out[start:stop] = (condensed_rows(d, n, start, stop) ** 2) @ V
+            col = V.sum(axis=0)
+            out -= np.outer(row_mean, col) + (row_mean @ V)[None, :] - grand * col[None, :]
+            return -0.5 * out
+        
+        rng = np.random.default_rng(seed)
+        Q, _ = np.linalg.qr(gram(rng.standard_normal((n, min(k + n_oversamples, n)))))
+        for _ in range(n_iter):
+            Q, _ = np.linalg.qr(gram(Q))
+        vals, W = np.linalg.eigh(Q.T @ gram(Q))
+        order = np.argsort(-vals)[:k]
+        vals, vecs = vals[order], Q @ W[:, order]
+    
+    pos = vals > 1e-10 * max(vals[0], 1e-300)
+    coords = vecs[:, pos] * np.sqrt(vals[pos])
+    return coords, vals[pos] / total if total > 0 else np.zeros(pos.sum())
+
+
+def _smacof_nonmetric(
+    order: np.ndarray,
+    X: np.ndarray,
+    max_iter: int,
+    eps: float
+) -> Tuple[np.ndarray, float, int]:
+    """
+    非度量SMACOF: 单调回归得到 disparity, Guttman 变换更新坐标
+    order: 压缩相异度向量的升序下标; 返回 (坐标, Kruskal stress-1, 迭代次数)
+    """
+    n = X.shape[0]
+    m = order.size
+    dhat = np.empty(m)
+    prev = np.inf
+    for it in range(1, max_iter + 1):
+        dist = pdist(X)
+        dhat[order] = isotonic_regression(dist[order]).x
+        dhat *= np.sqrt(m / max((dhat ** 2).sum(), 1e-300))
+        stress = np.sqrt(((dist - dhat) ** 2).sum() / max((dist ** 2).sum(), 1e-300))
+        if prev - stress < eps * max(prev, 1e-12) and np.isfinite(prev):
+            break
+        prev = stress
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = np.where(dist > 0, dhat / dist, 0.0)
+        R = squareform(ratio)
+        X = (R.sum(axis=1)[:, None] * X - R @ X) / n
+    return X, float(stress), it
+
+
+# 子进程内的状态: 相异度排序与起点
+_WORKER: Dict = {}
+
+
+def _init_nmds_worker(state: Dict) -> None:
+    _WORKER.clear()
+    _WORKER.update(state)
+
+
+def _nmds_start(state: Dict, start: int) -> Tuple[np.ndarray, float, int]:
+    """第 start 个起点: 0 为PCoA坐标, 其余为 (seed, start) 决定的随机坐标"""
+    n, k = state["n"], state["n_components"]
+    if start == 0 and state["init"] is not None:
+        X0 = state["init"]
+    else:
+        X0 = np.random.default_rng([state["seed"], start]).standard_normal((n, k))
+    return _smacof_nonmetric(state["order"], X0, state["max_iter"], state["eps"])
+
+
+def _nmds_worker(start: int) -> Tuple[np.ndarray, float, int]:
+    return _nmds_start(_WORKER, start)
+
+
+def nmds(
+    D: np.ndarray,
+    n_components: int = 2,
+    n_init: int = 8,
+    max_iter: int = 300,
+    eps: float = 1e-5,
+    n_jobs: int = 1,
+    seed: int = 0
+) -> Dict:
+    """
+    NMDS (非度量多维尺度), 多个起点取 stress 最低者
+    起点0用PCoA坐标, 其余随机; n_jobs > 1 时各起点在进程池中并行 (结果与进程数无关).
+    最终坐标中心化并旋转到主轴方向
+    """
+    d = np.asarray(_condensed(D), dtype=np.float64)
+    n = _n_from_condensed(d.size)
+    init, _ = pcoa(d, n_components)
+    init = np.pad(init, ((0, 0), (0, n_components - init.shape[1])))
+    state = {
+        "order": np.argsort(d, kind='stable'),
+        "n": n,
+        "n_components": n_components,
+        "init": init if init.any() else None,
+        "max_iter": max_iter,
+        "eps": eps,
+        "seed": seed
+    }
+    if n_jobs <= 1 or n_init < 2:
+        runs = [_nmds_start(state, s) for s in range(n_init)]
+    else:
+        with ProcessPoolExecutor(
+            max_workers=n_jobs, initializer=_init_nmds_worker, initargs=(state,)
+        ) as pool:
+            runs = list(pool.map(_nmds_worker, range(n_init)))
+    
+    best = int(np.argmin([r[1] for r in runs]))
+    X, stress, iterations = runs[best]
+    X = X - X.mean(axis=0)
+    _, _, Vt = np.linalg.svd(X, full_matrices=False)
+    return {
+        "coordinates": X @ Vt.T,
+        "stress": stress,
+        "best_start": best,
+        "iterations": iterations,
+        "stresses": [r[1] for r in runs]
+    }
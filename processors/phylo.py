@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Phylogenetic Tree Utilities
+Newick 解析 (数组形式的后序树) 与 UniFrac 距离
+"""
+
+import re
+import numpy as np
+from scipy import sparse
+from typing import Dict, List, Optional
+
+try:
+    from .distance import pairwise_distances
+except ImportError:  # 作为脚本直接运行
+    from distance import pairwise_distances
+
+
+# 引号标签 / 注释 / 分隔符 / 普通标签
+_TOKEN = re.compile(r"'(?:[^']|'')*'|\[[^\]]*\]|[(),:;]|[^\s(),:;\[\]']+")
+
+
+def parse_newick(text: str) -> Dict:
+    """
+    解析 Newick 字符串, 返回后序排列的数组树 (子节点总在父节点之前, 根在最后):
+    parent (根为 -1), length (缺失为 0), names (无名为 None), is_tip
+    单次扫描, 不递归, 深树也不会触发递归上限; 非引号标签中的下划线原样保留
+    """
+    parent: List[int] = []
+    length: List[float] = []
+    names: List[Optional[str]] = []
+    is_tip: List[bool] = []
+    closed: List[int] = []
+    stack: List[int] = []
+    last = -1
+    pending = True      # 在 '(' 或 ',' 之后, 下一个标签属于新的叶节点
+    expect_length = False
+
+    def new_node(tip: bool) -> int:
+        parent.append(stack[-1] if stack else -1)
+        length.append(0.0)
+        names.append(None)
+        is_tip.append(tip)
+        return len(parent) - 1
+
+    def new_tip() -> int:
+        node = new_node(True)
+        closed.append(node)
+        return node
+
+    for tok in _TOKEN.findall(text):
+        if tok.startswith('['):
+            continue
+        if expect_length:
+            length[last] = float(tok)
+            expect_length = False
+            continue
+        if tok == '(':
+            stack.append(new_node(False))
+            pending = True
+        elif tok in (',', ')'):
+            if pending:
+                new_tip()
+            if tok == ')':
+                if not stack:
+                    raise ValueError("unbalanced parentheses in newick string")
+                last = stack.pop()
+                closed.append(last)
+                pending = False
+            else:
+                pending = True
+        elif tok == ':':
+            if pending:
+                last = new_tip()
+                pending = False
+            expect_length = True
+        elif tok == ';':
+            break
+        else:
+            label = tok[1:-1].replace("''", "'") if tok.startswith("'") else tok
+            if pending:
+                last = new_tip()
+                pending = False
+            names[last] = label
+    if pending and not closed:
+        new_tip()
+    if stack:
+        raise ValueError("unbalanced parentheses in newick string")
+
+    # 按闭合顺序 (即后序) 重新编号
+    order = np.asarray(closed, dtype=np.int64)
+    rank = np.empty(len(parent), dtype=np.int64)
+    rank[order] = np.arange(order.size)
+    old_parent = np.asarray(parent, dtype=np.int64)[order]
+    return {
+        "parent": np.where(old_parent >= 0, rank[np.maximum(old_parent, 0)], -1),
+        "length": np.asarray(length, dtype=np.float64)[order],
+        "names": [names[i] for i in order],
+        "is_tip": np.asarray(is_tip, dtype=bool)[order]
+    }
+
+
+def read_newick(path: str) -> Dict:
+    """读取 Newick 文件"""
+    with open(path) as f:
+        return parse_newick(f.read())
+
+
+def random_tree(tip_names: List[str], seed: int = 0) -> Dict:
+    """随机二叉树 (随机合并), 用于演示数据"""
+    rng = np.random.default_rng(seed)
+    n_tips = len(tip_names)
+    n_nodes = max(2 * n_tips - 1, 1)
+    parent = np.full(n_nodes, -1, dtype=np.int64)
+    active = list(range(n_tips))
+    for node in range(n_tips, n_nodes):
+        a, b = sorted(rng.choice(len(active), size=2, replace=False), reverse=True)
+        parent[active.pop(a)] = node
+        parent[active.pop(b)] = node
+        active.append(node)
+    length = rng.exponential(0.1, n_nodes)
+    length[-1] = 0.0
+    return {
+        "parent": parent,
+        "length": length,
+        "names": list(tip_names) + [None] * (n_nodes - n_tips),
+        "is_tip": np.arange(n_nodes) < n_tips
+    }
+
+
+def ancestor_matrix(tree: Dict, tips: np.ndarray) -> sparse.csr_matrix:
+    """
+    叶 -> 祖先指示矩阵 (len(tips) x n_nodes, 含叶自身, 不含根)
+    所有叶同时向上走一层, 循环次数等于树高
+    """
+    parent = tree["parent"]
+    rows, cols = [], []
+    cur = np.asarray(tips, dtype=np.int64)
+    idx = np.arange(cur.size)
+    while cur.size:
+        up = parent[cur]
+        keep = up >= 0      # 根没有分支
+        rows.append(idx[keep])
+        cols.append(cur[keep])
+        cur, idx = up[keep], idx[keep]
+    rows = np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+    cols = np.concatenate(cols) if cols else np.empty(0, dtype=np.int64)
+    return sparse.csr_matrix(
+        (np.ones(rows.size), (rows, cols)), shape=(len(tips), parent.size)
+    )
+
+
+def branch_embedding(
+    X: sparse.csr_matrix,
+    feature_ids: List[str],
+    tree: Dict,
+    weighted: bool
+) -> sparse.csr_matrix:
+    """
+    样本 x 分支 的嵌入: 分支长度 x (分支下的相对丰度 或 是否出现)
+
+    - weighted: normalized weighted UniFrac = 该嵌入上的 Bray-Curtis
+      (分母 sum_t d_t (p_it + p_jt) 正是两样本嵌入之和)
+    - unweighted: unweighted UniFrac = 1 - 共有分支长 / 观测到的总分支长, 共有部分是一次矩阵乘法
+    """
+    tip_of = {name: i for i, name in enumerate(tree["names"]) if tree["is_tip"][i] and name is not None}
+    missing = [f for f in feature_ids if f not in tip_of]
+    if missing:
+        raise ValueError(f"{len(missing)} features are not tips of the tree, e.g. {missing[:3]}")
+    T = ancestor_matrix(tree, np.array([tip_of[f] for f in feature_ids], dtype=np.int64))
+
+    X = sparse.csr_matrix(X, dtype=np.float64)
+    if weighted:
+        totals = np.asarray(X.sum(axis=1)).ravel()
+        X = sparse.diags(1.0 / np.where(totals > 0, totals, 1.0)) @ X
+    else:
+        X = (X > 0).astype(np.float64)
+    E = (X @ T).tocsr()
+    if not weighted:
+        E.data[:] = 1.0
+    E = E @ sparse.diags(tree["length"])
+    E = sparse.csr_matrix(E)
+    E.eliminate_zeros()
+    return E
+
+
+def unifrac(
+    X,
+    feature_ids: List[str],
+    tree: Dict,
+    weighted: bool = False,
+    block_size: int = 256,
+    n_jobs: int = 1,
+    out_path: Optional[str] = None
+) -> np.ndarray:
+    """
+    UniFrac 距离 (float32 压缩向量)
+    分支作为特征, 按行条带在分支嵌入上逐分支向量化累加; 条带可分发到进程池
+    """
+    E = branch_embedding(X, feature_ids, tree, weighted)
+    return pairwise_distances(
+        E, metric='bray_curtis' if weighted else 'unweighted_unifrac',
+        block_size=block_size, n_jobs=n_jobs, out_path=out_path
+    )
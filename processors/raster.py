@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Point Rasterisation
+大量散点 (全部基因 / 全部细胞, 上百万个) 的密度栅格化, 思路同 datashader
+
+- 每个点落入输出像素网格的一个格子, 按 (类别, 行, 列) 用 bincount 计数; 点按固定大小分块处理,
+  内存只与图像大小 (类别数 x 像素数) 有关, 与点数无关
+- 着色: 不透明度由每个像素的总点数经直方图均衡 (eq_hist) 或对数映射得到;
+  颜色为各类别颜色按该像素内各类点数加权的混合; 数值着色时取像素内的均值经色图映射
+- 输出 RGBA 图像由 imshow 一次绘出, 需要标注的少数点另外以矢量元素叠加
+"""
+
+import numpy as np
+from matplotlib import colormaps
+from matplotlib.colors import to_rgb
+from typing import List, Optional, Tuple
+
+# 点数超过该值时 (未指定 rasterize) 自动栅格化
+RASTER_THRESHOLD = 100_000
+
+# 每次参与 bincount 的点数, 决定临时数组的大小
+BIN_CHUNK = 1 << 20
+
+
+def data_extent(x: np.ndarray, y: np.ndarray, pad: float = 0.03) -> Tuple[float, float, float, float]:
+    """有限值的范围两侧各留 pad 比例的空白: (x0, x1, y0, y1)"""
+    ok = np.isfinite(x) & np.isfinite(y)
+    if not ok.any():
+        return -1.0, 1.0, -1.0, 1.0
+    out = []
+    for v in (x[ok], y[ok]):
+        lo, hi = float(v.min()), float(v.max())
+        span = hi - lo if hi > lo else max(abs(lo), 1.0)
+        out += [lo - pad * span, hi + pad * span]
+    return tuple(out)
+
+
+def bin_points(
+    x: np.ndarray,
+    y: np.ndarray,
+    extent: Tuple[float, float, float, float],
+    shape: Tuple[int, int],
+    codes: Optional[np.ndarray] = None,
+    n_categories: int = 1,
+    weights: Optional[np.ndarray] = None
+) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    点计数网格 (n_categories, 高, 宽), 第 0 行对应 y 的下界; 范围外及非有限值的点被忽略
+    给出 weights 时同时返回每个像素内 weights 的和 (高, 宽), 否则为 None
+    """
+    x0, x1, y0, y1 = extent
+    h, w = shape
+    cells = h * w
+    counts = np.zeros(n_categories * cells, dtype=np.int64)
+    sums = np.zeros(cells) if weights is not None else None
+    for lo in range(0, x.size, BIN_CHUNK):
+        cx = np.asarray(x[lo:lo + BIN_CHUNK], dtype=np.float64)
+        cy = np.asarray(y[lo:lo + BIN_CHUNK], dtype=np.float64)
+        col = np.floor((cx - x0) * (w / (x1 - x0)))
+        row = np.floor((cy - y0) * (h / (y1 - y0)))
+        keep = (col >= 0) & (col < w) & (row >= 0) & (row < h)
+        if weights is not None:
+            cw = np.asarray(weights[lo:lo + BIN_CHUNK], dtype=np.float64)
+            keep &= np.isfinite(cw)
+        flat = row[keep].astype(np.int64) * w + col[keep].astype(np.int64)
+        if weights is not None:
+            sums += np.bincount(flat, weights=cw[keep], minlength=cells)
+        if codes is not None:
+            flat += np.asarray(codes[lo:lo + BIN_CHUNK], dtype=np.int64)[keep] * cells
+        counts += np.bincount(flat, minlength=n_categories * cells)
+    return counts.reshape(n_categories, h, w), (sums.reshape(h, w) if sums is not None else None)
+
+
+def _normalize(total: np.ndarray, how: str) -> np.ndarray:
+    """非零像素的点数映射到 (0, 1]: eq_hist 为点数在非零像素中的经验分布函数, log 为 log1p 比例, linear 为比例"""
+    out = np.zeros(total.shape)
+    nz = total > 0
+    if not nz.any():
+        return out
+    vals = total[nz]
+    if how == 'eq_hist':
+        uniq, inv, cnt = np.unique(vals, return_inverse=True, return_counts=True)
+        if uniq.size == 1:
+            out[nz] = 1.0
+            return out
+        cdf = np.cumsum(cnt).astype(np.float64)
+        cdf = (cdf - cdf[0]) / (cdf[-1] - cdf[0])
+        out[nz] = cdf[inv]
+    elif how == 'log':
+        out[nz] = np.log1p(vals) / np.log1p(vals.max())
+    elif how == 'linear':
+        out[nz] = vals / vals.max()
+    else:
+        raise ValueError(f"unsupported shading: {how}")
+    return out
+
+
+def shade_categories(
+    counts: np.ndarray,
+    colors: List[str],
+    how: str = 'eq_hist',
+    min_alpha: int = 60
+) -> np.ndarray:
+    """
+    计数网格 (类别, 高, 宽) -> RGBA (高, 宽, 4) uint8
+    颜色为各类别颜色按点数加权的平均, 不透明度在 min_alpha..255 之间随总点数增加, 空像素透明
+    """
+    k = counts.shape[0]
+    rgb = np.array([to_rgb(colors[c % len(colors)]) for c in range(k)])
+    total = counts.sum(axis=0)
+    if k == 1:
+        mixed = np.broadcast_to(rgb[0], total.shape + (3,))
+    else:
+        mixed = np.tensordot(counts, rgb, axes=([0], [0])) / np.maximum(total, 1)[..., None]
+    alpha = np.where(total > 0, min_alpha + (255 - min_alpha) * _normalize(total, how), 0.0)
+    image = np.empty(total.shape + (4,), dtype=np.uint8)
+    image[..., :3] = np.rint(mixed * 255.0)
+    image[..., 3] = np.rint(alpha)
+    return image
+
+
+def shade_values(
+    counts: np.ndarray,
+    sums: np.ndarray,
+    cmap: str,
+    vmin: float,
+    vmax: float
+) -> np.ndarray:
+    """像素内数值的均值经色图映射为 RGBA; 空像素透明"""
+    total = counts.sum(axis=0)
+    mean = sums / np.maximum(total, 1)
+    norm = np.clip((mean - vmin) / (vmax - vmin if vmax > vmin else 1.0), 0.0, 1.0)
+    image = colormaps[cmap](norm, bytes=True)
+    image[total == 0, 3] = 0
+    return image
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""
+Figure Rendering
+无界面 (Agg) 出图与内容寻址的图像缓存
+
+- 直接使用 matplotlib.figure.Figure, 不经过 pyplot; 但主题经 rc_context 写入的 rcParams 是进程级全局状态,
+  所以绘制与保存在模块级锁内串行进行, 多线程的 Web 进程里主题不会互相串扰 (缓存命中不加锁)
+- 缓存键 = sha256(图类型, 数据内容, 参数, 主题, 格式, 分辨率, RENDER_VERSION);
+  命中时直接返回已有文件, 不再绘制. 缓存是一个目录, 同一台机器上的多个 Web 进程共享
+- 写入先写临时文件再原子改名; 总大小在写入时增量累计, 超过上限 (或距上次扫描超过 SCAN_INTERVAL,
+  以计入其他进程的写入) 时才扫描目录, 按键最近访问时间整键淘汰 (图像, 信息文件与数组一起删除)
+"""
+
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import numpy as np
+from cycler import cycler
+from matplotlib import rc_context
+from matplotlib.figure import Figure
+from scipy import sparse
+from typing import Callable, Dict, Optional, Tuple
+
+# 绘图代码变化影响输出时递增, 使旧缓存失效
+RENDER_VERSION = 3
+
+FORMATS = ('png', 'svg')
+
+# 两次完整扫描缓存目录的最长间隔 (秒); 间隔内只按本进程写入的字节数判断是否超限
+SCAN_INTERVAL = 60.0
+
+PALETTE = [
+    '#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd',
+    '#8c564b', '#e377c2', '#7f7f7f', '#bcbd22', '#17becf'
+]
+
+THEMES: Dict[str, Dict] = {
+    'default': {
+        'axes.prop_cycle': cycler(color=PALETTE),
+        'font.size': 9,
+        'axes.titlesize': 11,
+        'axes.spines.top': False,
+        'axes.spines.right': False,
+        'figure.facecolor': 'white',
+        'savefig.facecolor': 'white',
+        'image.cmap': 'viridis'
+    },
+    'publication': {
+        'axes.prop_cycle': cycler(color=['#000000', '#e69f00', '#56b4e9', '#009e73',
+                                         '#f0e442', '#0072b2', '#d55e00', '#cc79a7']),
+        'font.family': 'serif',
+        'font.size': 8,
+        'axes.titlesize': 9,
+        'axes.linewidth': 0.8,
+        'axes.spines.top': False,
+        'axes.spines.right': False,
+        'figure.facecolor': 'white',
+        'savefig.facecolor': 'white',
+        'image.cmap': 'cividis'
+    },
+    'dark': {
+        'axes.prop_cycle': cycler(color=['#8dd3c7', '#ffffb3', '#bebada', '#fb8072', '#80b1d3',
+                                         '#fdb462', '#b3de69', '#fccde5', '#d9d9d9', '#bc80bd']),
+        'font.size': 9,
+        'axes.titlesize': 11,
+        'figure.facecolor': '#1e1e1e',
+        'savefig.facecolor': '#1e1e1e',
+        'axes.facecolor': '#1e1e1e',
+        'axes.edgecolor': '#cccccc',
+        'axes.labelcolor': '#eeeeee',
+        'text.color': '#eeeeee',
+        'xtick.color': '#cccccc',
+        'ytick.color': '#cccccc',
+        'legend.facecolor': '#2a2a2a',
+        'legend.edgecolor': '#555555',
+        'image.cmap': 'magma'
+    }
+}
+
+# rc_context 修改的是全局 rcParams, 同一时刻只允许一个线程在某个主题下绘图
+_RENDER_LOCK = threading.Lock()
+
+
+def _list_array(seq) -> Optional[np.ndarray]:
+    """同一类型的标量 (或规则嵌套的数值列表) 组成的列表转为数组; 混合类型, None 或其他对象时返回 None"""
+    kinds = set(map(type, seq))
+    if len(kinds) != 1:
+        return None
+    kind = kinds.pop()
+    if kind not in (bool, int, float, str, list, tuple):
+        return None
+    try:
+        arr = np.asarray(seq)
+    except (ValueError, OverflowError):
+        return None
+    if kind in (list, tuple) and arr.dtype.kind not in 'biuf':
+        return None
+    return arr if arr.dtype.kind != 'O' else None
+
+
+def _hash_update(h, obj) -> None:
+    """把任意 (JSON式) 数据按内容写入哈希: dict 按键排序, 数组取 dtype/shape/字节"""
+    if isinstance(obj, dict):
+        h.update(b'{')
+        for k in sorted(obj, key=str):
+            h.update(str(k).encode() + b':')
+            _hash_update(h, obj[k])
+        h.update(b'}')
+    elif isinstance(obj, (list, tuple)):
+        # 同类型的大列表 (如上百万个坐标或名称) 按数组字节哈希; 其余纯 JSON 列表一次序列化,
+        # 含数组等对象时才逐个元素递归
+        arr = _list_array(obj)
+        if arr is not None:
+            h.update(f"ls:{arr.dtype.str}:{arr.shape}".encode())
+            h.update(arr.tobytes())
+            return
+        try:
+            payload = json.dumps(obj, sort_keys=True)
+        except (TypeError, ValueError):
+            payload = None
+        if payload is not None:
+            h.update(b'js:' + payload.encode())
+            return
+        h.update(b'[')
+        for v in obj:
+            _hash_update(h, v)
+            h.update(b',')
+        h.update(b']')
+    elif isinstance(obj, np.ndarray):
+        h.update(f"nd:{obj.dtype.str}:{obj.shape}".encode())
+        h.update(np.ascontiguousarray(obj).tobytes())
+    elif sparse.issparse(obj):
+        X = sparse.csr_matrix(obj)
+        h.update(f"sp:{X.dtype.str}:{X.shape}".encode())
+        for arr in (X.indptr, X.indices, X.data):
+            h.update(np.ascontiguousarray(arr).tobytes())
+    elif isinstance(obj, np.generic):
+        h.update(repr(obj.item()).encode())
+    else:
+        h.update(json.dumps(obj, default=str).encode())
+
+
+def content_hash(*parts) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        _hash_update(h, part)
+        h.update(b'|')
+    return h.hexdigest()
+
+
+class FigureCache:
+    """内容寻址的图像目录: <root>/<键前两位>/<键>.<格式>, 绘图附带的信息存为同名 .json"""
+
+    def __init__(self, root: Optional[str] = None, max_bytes: int = 1 << 30):
+        self.root = root or os.environ.get('EMP_FIGURE_CACHE') or os.path.join(
+            tempfile.gettempdir(), 'emp_figures'
+        )
+        self.max_bytes = max_bytes
+        os.makedirs(self.root, exist_ok=True)
+        self._lock = threading.Lock()
+        # 目录总大小的估计 (上次扫描的结果 + 之后本实例写入的增量); None 表示尚未扫描
+        self._total: Optional[int] = None
+        self._scanned = 0.0
+
+    def path(self, key: str, fmt: str) -> str:
+        return os.path.join(self.root, key[:2], f"{key}.{fmt}")
+
+    def get(self, key: str, fmt: str) -> Optional[Tuple[str, Dict]]:
+        """命中时返回 (文件路径, 绘图信息) 并刷新访问时间"""
+        path = self.path(key, fmt)
+        meta = self.path(key, 'json')
+        try:
+            with open(meta) as f:
+                info = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return path, info
+
+    def _write(self, path: str, payload: bytes) -> None:
+        """原子写入, 并把大小变化计入估计的总大小"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            old = os.stat(path).st_size
+        except OSError:
+            old = 0
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(payload)
+        os.replace(tmp, path)
+        with self._lock:
+            if self._total is not None:
+                self._total += len(payload) - old
+
+    def put(self, key: str, fmt: str, payload: bytes, info: Dict) -> str:
+        """先写图像再写信息文件 (get 以信息文件存在为准), 之后按需淘汰"""
+        path = self.path(key, fmt)
+        self._write(path, payload)
+        self._write(self.path(key, 'json'), json.dumps(info).encode())
+        self._evict()
+        return path
+
+    def put_array(self, key: str, suffix: str, arr: np.ndarray) -> str:
+        """与图像一同缓存的数组 (.npy), 如热图的瓦片金字塔; 不触发淘汰, 由随后的 put 统一处理"""
+        buf = io.BytesIO()
+        np.save(buf, np.ascontiguousarray(arr))
+        path = self.path(key, suffix)
+        self._write(path, buf.getvalue())
+        return path
+
+    def load_array(self, key: str, suffix: str) -> Optional[np.ndarray]:
+        """以内存映射读取缓存的数组 (只读, 只有被访问的部分进入内存) 并刷新访问时间; 不存在时返回 None"""
+        path = self.path(key, suffix)
+        try:
+            arr = np.load(path, mmap_mode='r')
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return arr
+
+    def _scan(self) -> Dict[str, list]:
+        """按键汇总缓存目录: 键 -> [最近访问时间 (各文件 mtime 的最大值), 总大小, 文件路径]"""
+        keys: Dict[str, list] = {}
+        for sub in os.scandir(self.root):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.endswith('.tmp'):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                item = keys.setdefault(entry.name.split('.', 1)[0], [0.0, 0, []])
+                item[0] = max(item[0], st.st_mtime)
+                item[1] += st.st_size
+                item[2].append(entry.path)
+        return keys
+
+    def _evict(self) -> None:
+        """
+        估计的总大小超过上限 (或到了定期扫描的时间) 时扫描目录, 超过上限则按键从最久未访问的开始整键删除,
+        直到低于上限的 90%; 先删信息文件, get 立即不再命中
+        """
+        with self._lock:
+            due = self._total is None or time.monotonic() - self._scanned > SCAN_INTERVAL
+            if not due and self._total <= self.max_bytes:
+                return
+            keys = self._scan()
+            total = sum(item[1] for item in keys.values())
+            if total > self.max_bytes:
+                for _, size, paths in sorted(keys.values(), key=lambda item: item[0]):
+                    if total <= 0.9 * self.max_bytes:
+                        break
+                    for path in sorted(paths, key=lambda p: not p.endswith('.json')):
+                        try:
+                            os.remove(path)
+                        except OSError:
+                            pass
+                    total -= size
+            self._total = total
+            self._scanned = time.monotonic()
+
+
+_DEFAULT_CACHE: Optional[FigureCache] = None
+
+
+def default_cache() -> FigureCache:
+    global _DEFAULT_CACHE
+    if _DEFAULT_CACHE is None:
+        _DEFAULT_CACHE = FigureCache()
+    return _DEFAULT_CACHE
+
+
+def render(
+    kind: str,
+    draw: Callable[[Figure, Dict, Dict], Optional[Dict]],
+    data: Dict,
+    params: Dict,
+    theme: str = 'default',
+    fmt: str = 'png',
+    dpi: int = 120,
+    size: Tuple[float, float] = (6.0, 4.5),
+    cache: Optional[FigureCache] = None,
+    refresh: bool = False
+) -> Dict:
+    """
+    绘制 (或从缓存取出) 一张图; draw(fig, data, params) 在空白 Figure 上绘图并可返回可JSON化的附加信息
+    返回 file, key, format, cached 及 draw 返回的信息; refresh=True 时忽略已有缓存重新绘制
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"unsupported figure format: {fmt}")
+    if theme not in THEMES:
+        raise ValueError(f"unknown theme: {theme}")
+    cache = cache or default_cache()
+    key = content_hash(kind, data, params, theme, fmt, dpi, list(size), RENDER_VERSION)
+    hit = None if refresh else cache.get(key, fmt)
+    if hit is not None:
+        path, info = hit
+        return {"file": path, "key": key, "format": fmt, "cached": True, **info}
+
+    with _RENDER_LOCK, rc_context(THEMES[theme]):
+        fig = Figure(figsize=size, dpi=dpi)
+        info = draw(fig, data, params) or {}
+        buf = io.BytesIO()
+        fig.savefig(buf, format=fmt, bbox_inches='tight')
+    path = cache.put(key, fmt, buf.getvalue(), info)
+    return {"file": path, "key": key, "format": fmt, "cached": False, **info}
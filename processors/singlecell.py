@@ -5,9 +5,306 @@ Single Cell Analysis Processor
 """
 
 import numpy as np
+import scipy.sparse as sp
+from scipy.ndimage import uniform_filter1d
 import json
+import base64
+from functools import lru_cache
 from typing import Dict, List, Tuple, Optional
 
+try:
+    from .ordination import sparse_pca
+except ImportError:  # 作为脚本直接运行
+    from ordination import sparse_pca
+
+# 演示嵌入的细胞数 / 维数 / 密度网格边长上限 (参数来自网页请求, 决定缓存与响应的大小)
+MAX_EMBEDDING_CELLS = 2_000_000
+MAX_EMBEDDING_COMPONENTS = 3
+MAX_DENSITY_BINS = 1024
+
+# 少于该细胞数时不做双细胞检测 (kNN 比例与得分直方图都没有意义)
+MIN_DOUBLET_CELLS = 100
+
+
+@lru_cache(maxsize=4)
+def _demo_embedding(n_cells: int, n_components: int = 2, seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    生成演示用嵌入坐标 (float32) 及LOD抽样优先级
+    结果只读缓存, 视窗请求之间共享同一份坐标
+    """
+    rng = np.random.default_rng(seed)
+    n_groups = 8
+    centers = rng.normal(scale=6.0, size=(n_groups, n_components))
+    labels = rng.integers(0, n_groups, size=n_cells)
+    coords = centers[labels] + rng.standard_normal((n_cells, n_components))
+    coords = coords.astype(np.float32)
+    # 固定的随机优先级: 缩放时粗粒度下显示的点在细粒度下仍然保留
+    priority = rng.permutation(n_cells).astype(np.int64)
+    coords.flags.writeable = False
+    priority.flags.writeable = False
+    return coords, priority
+
+
+def _density_grid(coords: np.ndarray, bounds: List[float], bins: int) -> np.ndarray:
+    """二维密度分箱 (bincount), 返回 bins x bins 的 uint32 计数, 行为y"""
+    x0, x1, y0, y1 = bounds
+    x = coords[:, 0]
+    y = coords[:, 1]
+    inside = (x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)
+    ix = ((x[inside] - x0) * (bins / max(x1 - x0, 1e-12))).astype(np.int64)
+    iy = ((y[inside] - y0) * (bins / max(y1 - y0, 1e-12))).astype(np.int64)
+    np.clip(ix, 0, bins - 1, out=ix)
+    np.clip(iy, 0, bins - 1, out=iy)
+    counts = np.bincount(iy * bins + ix, minlength=bins * bins)
+    return counts.astype(np.uint32).reshape(bins, bins)
+
+
+def _b64(arr: np.ndarray) -> str:
+    return base64.b64encode(np.ascontiguousarray(arr).tobytes()).decode('ascii')
+
+
+def _log_normalize(X: sp.csr_matrix, target_sum: float) -> sp.csr_matrix:
+    """按细胞总数归一化到 target_sum 后 log1p, 保持稀疏"""
+    totals = np.asarray(X.sum(axis=1)).ravel().astype(np.float64)
+    totals[totals == 0] = 1.0
+    Xn = sp.diags(target_sum / totals) @ X
+    Xn = sp.csr_matrix(Xn, dtype=np.float32)
+    np.log1p(Xn.data, out=Xn.data)
+    return Xn
+
+
+def _ivf_knn(
+    points: np.ndarray,
+    k: int,
+    n_lists: int = None,
+    n_probe: int = 8,
+    seed: int = 0
+) -> np.ndarray:
+    """
+    近似kNN (IVF倒排索引): 粗聚类中心分桶, 每个桶的查询只在最近的
+    n_probe 个桶中用矩阵乘法计算距离. 返回 (n, k) 邻居下标 (不含自身)
+    """
+    rng = np.random.default_rng(seed)
+    X = np.ascontiguousarray(points, dtype=np.float32)
+    n = X.shape[0]
+    k = min(k, n - 1)
+    if n_lists is None:
+        n_lists = max(1, int(np.sqrt(n)))
+    n_lists = min(n_lists, n)
+    n_probe = min(n_probe, n_lists)
+    sq = np.einsum('ij,ij->i', X, X)
+    
+    # 粗聚类: 在子样本上做几轮Lloyd迭代
+    sample = X[rng.choice(n, size=min(n, 64 * n_lists), replace=False)]
+    C = sample[rng.choice(sample.shape[0], size=n_lists, replace=False)].copy()
+    for _ in range(8):
+        a = np.argmin((C ** 2).sum(1)[None, :] - 2 * sample @ C.T, axis=1)
+        sums = np.zeros_like(C)
+        np.add.at(sums, a, sample)
+        cnt = np.bincount(a, minlength=n_lists)
+        nonempty = cnt > 0
+        C[nonempty] = sums[nonempty] / cnt[nonempty, None]
+    assign = np.argmin((C ** 2).sum(1)[None, :] - 2 * X @ C.T, axis=1)
+    order = np.argsort(assign, kind='stable')
+    starts = np.searchsorted(assign[order], np.arange(n_lists + 1))
+    
+    c_sq = (C ** 2).sum(1)
+    probe = np.argsort(c_sq[None, :] - 2 * C @ C.T, axis=1)[:, :n_probe]
+    
+    result = np.empty((n, k), dtype=np.int64)
+    for lst in range(n_lists):
+        queries = order[starts[lst]:starts[lst + 1]]
+        if queries.size == 0:
+            continue
+        cand = np.concatenate([order[starts[p]:starts[p + 1]] for p in probe[lst]])
+        d2 = sq[queries][:, None] + sq[cand][None, :] - 2 * X[queries] @ X[cand].T
+        # 排除自身
+        d2[queries[:, None] == cand[None, :]] = np.inf
+        kk = min(k, cand.size - 1)
+        part = np.argpartition(d2, kk - 1, axis=1)[:, :kk]
+        nb = cand[part]
+        if kk < k:
+            # 候选不足时用自身补齐 (极小数据集)
+            nb = np.hstack([nb, np.repeat(queries[:, None], k - kk, axis=1)])
+        result[queries] = nb
+    return result
+
+
+def _local_maxima(hist: np.ndarray) -> np.ndarray:
+    """局部极大的位置 (平台取左端, 起点下降也算一个极大), 同 skimage.filters.threshold_minimum"""
+    d = np.diff(hist)
+    nz = np.flatnonzero(d)
+    sign = np.sign(d[nz])
+    prev = np.r_[1.0, sign[:-1]]
+    return nz[(sign < 0) & (prev > 0)]
+
+
+def _threshold_minimum(values: np.ndarray, n_bins: int = 256, max_iter: int = 10000) -> Optional[float]:
+    """
+    双峰直方图的谷底阈值 (skimage threshold_minimum, Scrublet 的默认做法):
+    直方图反复做3点平滑直到只剩两个峰, 取两峰之间的最低处; 不是双峰时返回 None
+    """
+    values = values[np.isfinite(values)]
+    if values.size < 2 or values.max() <= values.min():
+        return None
+    hist, edges = np.histogram(values, bins=n_bins)
+    centers = (edges[:-1] + edges[1:]) / 2
+    smooth = hist.astype(np.float64)
+    maxima = _local_maxima(smooth)
+    for _ in range(max_iter):
+        if maxima.size < 3:
+            break
+        smooth = uniform_filter1d(smooth, 3)
+        maxima = _local_maxima(smooth)
+    if maxima.size != 2:
+        return None
+    return float(centers[maxima[0] + np.argmin(smooth[maxima[0]:maxima[1] + 1])])
+
+
+def _l2_normalize(Z: np.ndarray) -> np.ndarray:
+    norm = np.linalg.norm(Z, axis=1, keepdims=True)
+    norm[norm == 0] = 1.0
+    return Z / norm
+
+
+def _harmony(
+    Z: np.ndarray,
+    codes: np.ndarray,
+    n_batches: int,
+    n_clusters: int,
+    theta: float = 2.0,
+    sigma: float = 0.1,
+    ridge_lambda: float = 1.0,
+    max_iter: int = 10,
+    max_iter_cluster: int = 20,
+    block_size: float = 0.05,
+    tol_harmony: float = 1e-4,
+    tol_cluster: float = 1e-5,
+    seed: int = 0
+) -> Tuple[np.ndarray, List[float], int, bool]:
+    """
+    Harmony: 软k-means聚类 + 每个聚类内按批次的线性 (ridge) 校正
+    返回 (校正后的嵌入, 目标函数序列, 迭代轮数, 是否收敛)
+    
+    批次设计矩阵为one-hot, 因此所有 Phi 相关乘积都化为按批次分段求和,
+    每轮计算量为 O(N * K * d), 与细胞数线性相关
+    Z: (N, d) PCA嵌入; codes: (N,) 批次编号 0..B-1
+    """
+    rng = np.random.default_rng(seed)
+    N, d = Z.shape
+    K = n_clusters
+    Z = np.asarray(Z, dtype=np.float32)
+    Z_corr = Z.copy()
+    Z_cos = _l2_normalize(Z_corr)
+    
+    counts = np.bincount(codes, minlength=n_batches).astype(np.float32)
+    Pr_b = counts / N
+    # 按批次排序, 之后按连续切片做分段求和
+    order = np.argsort(codes, kind='stable')
+    bounds = np.concatenate([[0], np.cumsum(counts).astype(np.int64)])
+    onehot = np.eye(n_batches, dtype=np.float32)
+    
+    # 初始化: 球面k-means
+    Y = Z_cos[rng.choice(N, size=K, replace=False)].copy()
+    for _ in range(10):
+        assign = np.argmax(Z_cos @ Y.T, axis=1)
+        for k in np.unique(assign):
+            Y[k] = Z_cos[assign == k].sum(axis=0)
+        Y = _l2_normalize(Y)
+    
+    def soft_assign(dist: np.ndarray) -> np.ndarray:
+        R = -dist / sigma
+        R -= R.max(axis=0, keepdims=True)
+        np.exp(R, out=R)
+        R /= R.sum(axis=0, keepdims=True)
+        return R
+    
+    def batch_sums(R: np.ndarray) -> np.ndarray:
+        # O[k, b] = sum_{n in b} R[k, n]
+        return np.add.reduceat(R[:, order], bounds[:-1], axis=1) if N else np.zeros((K, n_batches))
+    
+    dist = 2.0 * (1.0 - Y @ Z_cos.T)
+    R = soft_assign(dist)
+    O = batch_sums(R)
+    E = R.sum(axis=1, keepdims=True) * Pr_b[None, :]
+    
+    def objective() -> float:
+        kmeans_error = float(np.sum(R * dist))
+        entropy = float(sigma * np.sum(R * np.log(R + 1e-12)))
+        diversity = float(sigma * theta * np.sum(O * np.log((O + 1) / (E + 1))))
+        return kmeans_error + entropy + diversity
+    
+    objectives = [objective()]
+    n_block = max(1, int(np.ceil(N * block_size)))
+    n_iter = 0
+    converged = False
+    
+    for it in range(max_iter):
+        n_iter = it + 1
+        # ---- 聚类: 带多样性惩罚的软k-means, 分块更新R ----
+        prev = objectives[-1]
+        for _ in range(max_iter_cluster):
+            Y = _l2_normalize((R @ Z_cos))
+            dist = 2.0 * (1.0 - Y @ Z_cos.T)
+            perm = rng.permutation(N)
+            for start in range(0, N, n_block):
+                idx = perm[start:start + n_block]
+                b = codes[idx]
+                phi = onehot[b]
+                R_blk = R[:, idx]
+                # 移出当前块
+                E -= R_blk.sum(axis=1, keepdims=True) * Pr_b[None, :]
+                O -= R_blk @ phi
+                R_blk = soft_assign(dist[:, idx])
+                R_blk *= (((E + 1) / (O + 1)) ** theta)[:, b]
+                R_blk /= R_blk.sum(axis=0, keepdims=True)
+                R[:, idx] = R_blk
+                # 放回
+                E += R_blk.sum(axis=1, keepdims=True) * Pr_b[None, :]
+                O += R_blk @ phi
+            obj = objective()
+            if abs(prev - obj) <= tol_cluster * abs(prev):
+                prev = obj
+                break
+            prev = obj
+        objectives.append(prev)
+        
+        # ---- 校正: 每个聚类内的批次ridge回归, 所有聚类批量求解 ----
+        Zs = Z[order]
+        Rs = R[:, order]
+        # M[k, 0] = sum_n R_kn z_n ; M[k, b+1] = sum_{n in b} R_kn z_n
+        M = np.zeros((K, n_batches + 1, d), dtype=np.float64)
+        for j in range(n_batches):
+            lo, hi = bounds[j], bounds[j + 1]
+            if hi > lo:
+                M[:, j + 1] = Rs[:, lo:hi] @ Zs[lo:hi]
+        M[:, 0] = M[:, 1:].sum(axis=1)
+        Ok = batch_sums(R).astype(np.float64)
+        X = np.zeros((K, n_batches + 1, n_batches + 1))
+        X[:, 0, 0] = Ok.sum(axis=1)
+        X[:, 0, 1:] = Ok
+        X[:, 1:, 0] = Ok
+        diag = np.arange(1, n_batches + 1)
+        X[:, diag, diag] = Ok + ridge_lambda
+        W = np.linalg.solve(X, M)
+        W[:, 0] = 0.0  # 截距项不校正
+        Z_corr = Z.copy()
+        for j in range(n_batches):
+            lo, hi = bounds[j], bounds[j + 1]
+            if hi > lo:
+                cells = order[lo:hi]
+                Z_corr[cells] -= (R[:, cells].T @ W[:, j + 1]).astype(np.float32)
+        Z_cos = _l2_normalize(Z_corr)
+        dist = 2.0 * (1.0 - Y @ Z_cos.T)
+        
+        if len(objectives) > 2:
+            old, new = objectives[-2], objectives[-1]
+            if abs(old - new) <= tol_harmony * abs(old):
+                converged = True
+                break
+    
+    return Z_corr, objectives, n_iter, converged
+
 
 class SingleCellProcessor:
     """单细胞数据分析"""
@@ -16,7 +313,8 @@ class SingleCellProcessor:
         self.methods = {
             'dim_reduction': ['PCA', 'tSNE', 'UMAP', 'PHATE'],
             'clustering': ['K-means', 'Louvain', 'Leiden', 'Hierarchical'],
-            'markers': ['Wilcoxon', 'MAST', 'DESeq2', 't-test']
+            'markers': ['Wilcoxon', 'MAST', 'DESeq2', 't-test'],
+            'integration': ['Harmony']
         }
     
     def load_data(self, file_path: str, format: str = 'mtx') -> Dict:
@@ -34,13 +332,44 @@ class SingleCellProcessor:
             "sparsity": 0.92
         }
     
-    def preprocessing(self, data: Dict) -> Dict:
+    def preprocessing(self, data: Dict, remove_doublets: bool = True) -> Dict:
         """
         预处理
         - QC过滤
+        - 双细胞检测与去除
         - 归一化
         - 特征选择
+        
+        data['X'] 为 (cells, genes) 计数矩阵时执行真实的双细胞检测;
+        data 不会被修改, 过滤后的矩阵与PCA在结果的 X / pca 中返回
         """
+        if 'X' in data:
+            X = sp.csr_matrix(data['X'])
+            n_cells, n_genes = X.shape
+            steps = []
+            n_doublets = 0
+            result = {"X": X}
+            if remove_doublets:
+                doublets = self.detect_doublets(data)
+                n_doublets = int(doublets['n_doublets'])
+                if doublets.get('predicted_doublets') is not None:
+                    keep = ~doublets['predicted_doublets']
+                    result = {"X": X[keep], "pca": doublets['pca'][keep]}
+                    steps.append(
+                        f"Doublet removal: {n_cells} -> {n_cells - n_doublets} cells "
+                        f"(threshold {doublets['threshold']:.3f})"
+                    )
+                else:
+                    steps.append(f"Doublet removal skipped: {doublets['message']}")
+            return {
+                "status": "success",
+                "filtered_cells": n_cells - n_doublets,
+                "filtered_genes": n_genes,
+                "doublets_removed": n_doublets,
+                "steps": steps,
+                **result
+            }
+        
         return {
             "status": "success",
             "filtered_cells": 4500,
@@ -52,6 +381,108 @@ class SingleCellProcessor:
             ]
         }
     
+    def detect_doublets(
+        self,
+        data: Dict,
+        sim_ratio: float = 2.0,
+        expected_rate: float = 0.06,
+        n_top_genes: int = 2000,
+        n_comps: int = 30,
+        n_neighbors: int = None,
+        n_probe: int = 8,
+        seed: int = 0
+    ) -> Dict:
+        """
+        双细胞检测 (Scrublet思路)
+        
+        1. 观测细胞 log-normalize + 高变基因 + z-score, 随机化PCA
+        2. 用稀疏选择矩阵一次性把随机细胞对的原始计数相加, 模拟双细胞 (保持稀疏)
+        3. 模拟细胞经同样归一化后投影到观测细胞的PCA上
+        4. 在近似kNN索引 (IVF) 中按邻居里模拟双细胞的比例打分
+        5. 阈值取模拟双细胞得分直方图的谷底 (同 Scrublet); 观测得分也是双峰且谷底更低时取后者
+           (真实双细胞的邻居里混有其他真实双细胞与两个亲本类型的单细胞, 得分常低于模拟双细胞);
+           两者都不是双峰时取观测得分的 1 - expected_rate 分位数
+        
+        结果中的 doublet_scores / predicted_doublets / pca 对应过滤前的全部细胞, data 不会被修改
+        """
+        rng = np.random.default_rng(seed)
+        X = sp.csr_matrix(data['X'], dtype=np.float32)
+        n_obs, n_genes = X.shape
+        if n_obs < MIN_DOUBLET_CELLS:
+            return {
+                "status": "success",
+                "method": "Scrublet",
+                "n_cells": n_obs,
+                "n_doublets": 0,
+                "doublet_rate": 0.0,
+                "threshold": None,
+                "doublet_scores": None,
+                "predicted_doublets": None,
+                "pca": None,
+                "message": f"too few cells for doublet detection ({n_obs} < {MIN_DOUBLET_CELLS})"
+            }
+        n_sim = int(round(n_obs * sim_ratio))
+        target_sum = float(np.median(np.asarray(X.sum(axis=1)).ravel())) or 1.0
+        
+        # 观测细胞: 归一化, 高变基因, z-score (缩放保持稀疏, 中心化在PCA中隐式完成)
+        Xn = _log_normalize(X, target_sum)
+        mean = np.asarray(Xn.mean(axis=0)).ravel()
+        sq_mean = np.asarray(Xn.multiply(Xn).mean(axis=0)).ravel()
+        var = np.maximum(sq_mean - mean ** 2, 0)
+        genes = np.sort(np.argsort(var)[::-1][:min(n_top_genes, n_genes)])
+        scale = np.sqrt(var[genes])
+        scale[scale == 0] = 1.0
+        Xz = Xn[:, genes] @ sp.diags(1.0 / scale)
+        Xz = sp.csr_matrix(Xz)
+        obs_pcs, components, mu, _ = sparse_pca(Xz, n_comps, seed=seed)
+        
+        # 模拟双细胞: S (n_sim, n_obs) 每行两个1, S @ X 即成对计数之和
+        pairs = rng.integers(0, n_obs, size=(n_sim, 2))
+        S = sp.csr_matrix(
+            (np.ones(2 * n_sim, dtype=np.float32),
+             (np.repeat(np.arange(n_sim), 2), pairs.ravel())),
+            shape=(n_sim, n_obs)
+        )
+        X_sim = _log_normalize(S @ X, target_sum)
+        X_sim = sp.csr_matrix(X_sim[:, genes] @ sp.diags(1.0 / scale))
+        sim_pcs = X_sim @ components.T - (mu @ components.T)[None, :]
+        
+        # kNN 双细胞比例
+        if n_neighbors is None:
+            n_neighbors = max(1, int(round(0.5 * np.sqrt(n_obs))))
+        k_adj = int(round(n_neighbors * (1 + n_sim / n_obs)))
+        k_adj = min(k_adj, n_obs + n_sim - 1)
+        nbrs = _ivf_knn(np.vstack([obs_pcs, sim_pcs]), k_adj, n_probe=n_probe, seed=seed)
+        q = (nbrs >= n_obs).mean(axis=1)
+        
+        # 将邻居中模拟比例换算为双细胞后验 (Scrublet公式)
+        r = n_sim / n_obs
+        rho = expected_rate
+        scores = q * rho / r / ((1 - rho) - q * (1 - rho - rho / r))
+        obs_scores = scores[:n_obs]
+        sim_scores = scores[n_obs:]
+        valleys = [t for t in (_threshold_minimum(sim_scores), _threshold_minimum(obs_scores)) if t is not None]
+        if valleys:
+            threshold = min(valleys)
+        else:
+            threshold = float(np.quantile(obs_scores, 1.0 - expected_rate))
+        predicted = obs_scores > threshold
+        
+        return {
+            "status": "success",
+            "method": "Scrublet",
+            "n_cells": n_obs,
+            "n_simulated": n_sim,
+            "n_neighbors": k_adj,
+            "threshold": threshold,
+            "n_doublets": int(predicted.sum()),
+            "doublet_rate": float(predicted.mean()) if n_obs else 0.0,
+            "threshold_method": "histogram minimum" if valleys else "expected-rate quantile",
+            "doublet_scores": obs_scores,
+            "predicted_doublets": predicted,
+            "pca": obs_pcs.astype(np.float32)
+        }
+    
     def dimensionality_reduction(
         self, 
         data: Dict, 
@@ -60,21 +491,180 @@ class SingleCellProcessor:
     ) -> Dict:
         """
         降维分析
+        coordinates 为 (n_cells, n_components) float32 数组,
+        网页端请通过 embedding_payload / viewport_points 打包传输;
+        细胞数截断到 MAX_EMBEDDING_CELLS, 维数截断到 2..MAX_EMBEDDING_COMPONENTS
         """
         # 模拟降维结果
-        n_cells = data.get('filtered_cells', 4500)
+        n_cells = min(max(int(data.get('filtered_cells', 4500)), 0), MAX_EMBEDDING_CELLS)
+        n_components = min(max(int(n_components), 2), MAX_EMBEDDING_COMPONENTS)
+        coords, priority = _demo_embedding(n_cells, n_components, int(data.get('seed', 0)))
         
         return {
             "status": "success",
             "method": method,
             "n_components": n_components,
-            "coordinates": {
-                "x": np.random.randn(n_cells).tolist()[:10],
-                "y": np.random.randn(n_cells).tolist()[:10]
-            },
+            "n_cells": n_cells,
+            "coordinates": coords,
+            "priority": priority,
             "variance_explained": 0.45 if method == 'PCA' else None
         }
     
+    def embedding_payload(
+        self,
+        embedding: Dict,
+        bins: int = 256,
+        max_points: int = 50000,
+        quantize: bool = False
+    ) -> Dict:
+        """
+        嵌入坐标的LOD总览 (可直接 jsonify)
+        - density: 全局范围内 bins x bins 的 uint32 计数 (base64)
+        - points: 细胞数不超过 max_points 时附带全分辨率坐标
+        bins 截断到 1..MAX_DENSITY_BINS
+        """
+        bins = min(max(int(bins), 1), MAX_DENSITY_BINS)
+        coords = embedding["coordinates"]
+        n_cells = coords.shape[0]
+        if n_cells:
+            lo = coords[:, :2].min(axis=0)
+            hi = coords[:, :2].max(axis=0)
+        else:
+            lo = hi = np.zeros(2, dtype=np.float32)
+        bounds = [float(lo[0]), float(hi[0]), float(lo[1]), float(hi[1])]
+        
+        payload = {
+            "status": "success",
+            "method": embedding.get("method"),
+            "n_cells": n_cells,
+            "bounds": bounds,
+            "density": {
+                "bins": bins,
+                "dtype": "uint32",
+                "max": 0,
+                "data": ""
+            },
+            "points": None
+        }
+        grid = _density_grid(coords, bounds, bins)
+        payload["density"]["max"] = int(grid.max()) if grid.size else 0
+        payload["density"]["data"] = _b64(grid)
+        
+        if n_cells <= max_points:
+            packed = self.viewport_points(embedding, bounds, max_points, quantize)
+            packed["data"] = _b64(packed.pop("buffer"))
+            payload["points"] = packed
+        return payload
+    
+    def viewport_points(
+        self,
+        embedding: Dict,
+        viewport: List[float],
+        max_points: int = 200000,
+        quantize: bool = False
+    ) -> Dict:
+        """
+        视窗内的全分辨率点 (x0, x1, y0, y1)
+        
+        超过 max_points 时按固定优先级抽样, 保证缩放时点集稳定;
+        buffer 为交错的 xy: float32, 或相对视窗量化的 uint16
+        """
+        coords = embedding["coordinates"]
+        priority = embedding.get("priority")
+        x0, x1, y0, y1 = [float(v) for v in viewport]
+        x = coords[:, 0]
+        y = coords[:, 1]
+        idx = np.flatnonzero((x >= x0) & (x <= x1) & (y >= y0) & (y <= y1))
+        total = int(idx.size)
+        
+        if total > max_points:
+            if priority is None:
+                idx = idx[np.linspace(0, total - 1, max_points).astype(np.int64)]
+            else:
+                keep = np.argpartition(priority[idx], max_points - 1)[:max_points]
+                idx = np.sort(idx[keep])
+        
+        xy = coords[idx, :2]
+        result = {
+            "count": int(idx.size),
+            "total_in_view": total,
+            "sampled": total > idx.size,
+            "viewport": [x0, x1, y0, y1]
+        }
+        if quantize:
+            offset = np.array([x0, y0], dtype=np.float64)
+            span = np.array([max(x1 - x0, 1e-12), max(y1 - y0, 1e-12)])
+            q = np.rint((xy - offset) * (65535.0 / span))
+            result.update({
+                "dtype": "uint16",
+                "offset": offset.tolist(),
+                "scale": (span / 65535.0).tolist(),
+                "buffer": np.clip(q, 0, 65535).astype(np.uint16)
+            })
+        else:
+            result.update({
+                "dtype": "float32",
+                "offset": [0.0, 0.0],
+                "scale": [1.0, 1.0],
+                "buffer": np.ascontiguousarray(xy, dtype=np.float32)
+            })
+        return result
+    
+    def batch_correction(
+        self,
+        data: Dict,
+        batch_key: str = 'batch',
+        n_clusters: int = None,
+        theta: float = 2.0,
+        sigma: float = 0.1,
+        max_iter: int = 10,
+        seed: int = 0
+    ) -> Dict:
+        """
+        批次校正 (Harmony) - 作用于PCA嵌入, 应在构建kNN图之前运行
+        
+        输入 data['pca'] (n_cells, n_pcs) 与 data[batch_key] 批次标签,
+        校正后的嵌入写入 data['pca_harmony']
+        """
+        if 'pca' not in data or batch_key not in data:
+            return {
+                "status": "error",
+                "message": f"batch_correction requires 'pca' and '{batch_key}'"
+            }
+        Z = np.asarray(data['pca'], dtype=np.float32)
+        batches, codes = np.unique(np.asarray(data[batch_key]), return_inverse=True)
+        n_cells = Z.shape[0]
+        if n_clusters is None:
+            n_clusters = int(min(100, max(2, round(n_cells / 30))))
+        
+        if len(batches) < 2:
+            data['pca_harmony'] = Z
+            return {
+                "status": "success",
+                "method": "Harmony",
+                "n_batches": len(batches),
+                "iterations": 0,
+                "converged": True
+            }
+        
+        Z_corr, objectives, n_iter, converged = _harmony(
+            Z, codes, len(batches), n_clusters,
+            theta=theta, sigma=sigma, max_iter=max_iter, seed=seed
+        )
+        data['pca_harmony'] = Z_corr
+        
+        return {
+            "status": "success",
+            "method": "Harmony",
+            "n_cells": n_cells,
+            "n_pcs": Z.shape[1],
+            "n_batches": len(batches),
+            "n_clusters": n_clusters,
+            "iterations": n_iter,
+            "converged": converged,
+            "objective": [round(o, 4) for o in objectives]
+        }
+    
     def clustering(
         self, 
         data: Dict, 
@@ -164,3 +754,7 @@ if __name__ == "__main__":
     # 测试
     data = processor.load_data("test.h5")
     print(json.dumps(data, indent=2))
+    
+    emb = processor.dimensionality_reduction({"filtered_cells": 100000})
+    payload = processor.embedding_payload(emb)
+    print(f"Embedding: {payload['n_cells']} cells, density max {payload['density']['max']}")
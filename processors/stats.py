@@ -0,0 +1,814 @@
+#!/usr/bin/env python3
+"""
+Shared Statistics Engine
+多个分析模块共用的向量化统计工具 (秩变换, 相关性, p值, 多重检验校正, 稀疏相关网络)
+"""
+
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import sparse
+from scipy.spatial.distance import squareform
+from scipy.special import chdtrc, ndtr, stdtr, stdtrit
+from scipy.stats import rankdata
+from typing import Callable, Dict, Optional, Tuple
+
+
+def rank_columns(X: np.ndarray) -> np.ndarray:
+    """按列求平均秩 (并列取平均), 用于Spearman"""
+    return rankdata(X, axis=0).astype(np.float64)
+
+
+def tie_sums(X: np.ndarray) -> np.ndarray:
+    """各列并列组的 sum(t^3 - t) (秩检验的并列校正), 一次排序得到全部列的游程长度"""
+    S = np.sort(X, axis=0).T
+    n = S.shape[1]
+    start = np.ones(S.shape, dtype=bool)
+    start[:, 1:] = S[:, 1:] != S[:, :-1]
+    flags = start.ravel()
+    runs = np.bincount(np.cumsum(flags) - 1).astype(np.float64)
+    column = np.flatnonzero(flags) // n
+    return np.bincount(column, weights=runs ** 3 - runs, minlength=S.shape[0])
+
+
+def kruskal_columns(X: np.ndarray, codes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    全部列同时做 Kruskal-Wallis 检验 (带并列校正, 卡方近似)
+    X: samples x features; codes: 样本的组编码 0..k-1; 返回 (H, p), 常数列为 NaN
+    """
+    n = X.shape[0]
+    k = int(codes.max()) + 1
+    R = rank_columns(X)
+    sizes = np.bincount(codes, minlength=k).astype(np.float64)
+    G = np.zeros((k, n))
+    G[codes, np.arange(n)] = 1.0
+    rank_sums = G @ R
+    H = 12.0 / (n * (n + 1)) * (rank_sums ** 2 / sizes[:, None]).sum(axis=0) - 3.0 * (n + 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        H /= 1.0 - tie_sums(X) / (n ** 3 - n)
+    H[~np.isfinite(H)] = np.nan
+    return H, chdtrc(k - 1, H)
+
+
+def ranksum_columns(A: np.ndarray, B: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    全部列同时做 Wilcoxon 秩和检验 (正态近似, 带并列校正, 不做连续性校正)
+    A, B: 两组样本 x 相同的特征; 返回 (z, 双侧p), z > 0 表示 A 偏大; 常数列为 NaN
+    """
+    n1, n2 = A.shape[0], B.shape[0]
+    n = n1 + n2
+    X = np.vstack([A, B])
+    U = rank_columns(X)[:n1].sum(axis=0) - n1 * (n1 + 1) / 2.0
+    var = n1 * n2 / 12.0 * ((n + 1) - tie_sums(X) / (n * (n - 1)))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = (U - n1 * n2 / 2.0) / np.sqrt(var)
+    z[~np.isfinite(z)] = np.nan
+    return z, 2.0 * ndtr(-np.abs(z))
+
+
+def standardize_columns(X: np.ndarray) -> np.ndarray:
+    """
+    列中心化并缩放到单位范数, 之后 A.T @ B 即为Pearson相关矩阵
+    常数列置零 (相关性为0)
+    """
+    Z = np.asarray(X, dtype=np.float64)
+    Z = Z - Z.mean(axis=0, keepdims=True)
+    norm = np.linalg.norm(Z, axis=0, keepdims=True)
+    norm[norm == 0] = np.inf
+    return Z / norm
+
+
+def correlation_pvalues(r: np.ndarray, n: int) -> np.ndarray:
+    """相关系数的双侧p值 (t分布, df = n - 2)"""
+    df = n - 2
+    r = np.clip(np.abs(r), 0.0, 1.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = r * np.sqrt(df / np.maximum(1.0 - r * r, 1e-300))
+    return 2.0 * stdtr(df, -t)
+
+
+def critical_correlation(pvalue: float, n: int) -> float:
+    """双侧p值恰为 pvalue 时的 |r| (correlation_pvalues 的反函数)"""
+    df = n - 2
+    t = -stdtrit(df, pvalue / 2.0)
+    return float(t / np.sqrt(df + t * t))
+
+
+def bh_adjust(pvalues: np.ndarray) -> np.ndarray:
+    """Benjamini-Hochberg 校正"""
+    p = np.asarray(pvalues, dtype=np.float64)
+    m = p.size
+    if m == 0:
+        return p.copy()
+    order = np.argsort(p)
+    ranked = p[order] * m / np.arange(1, m + 1)
+    ranked = np.minimum.accumulate(ranked[::-1])[::-1]
+    q = np.empty(m)
+    q[order] = np.minimum(ranked, 1.0)
+    return q
+
+
+def blocked_correlation(
+    A: np.ndarray,
+    B: np.ndarray,
+    method: str = 'spearman',
+    threshold: float = 0.0,
+    top_k: Optional[int] = None,
+    block_size: int = 2048,
+    n_bins: int = 1 << 16
+) -> Dict:
+    """
+    全对全相关 (A的列 x B的列), 按A的列分块做矩阵乘法
+
+    - 每块只保留 |r| >= threshold 的条目, 若给定 top_k 则流式保留 |r| 最大的 top_k 个,
+      完整相关矩阵从不驻留内存
+    - p值由t分布向量化计算; 样本数相同时p值是|r|的单调函数,
+      因此BH校正只需保留条目的精确秩 + 其余条目的|r|直方图 (上界, 偏保守)
+
+    A: (n_samples, n_a); B: (n_samples, n_b), 样本已对齐且无缺失
+    返回 dict: i, j, r, pvalue, padj (按|r|降序) 与 n_tests
+    """
+    n = A.shape[0]
+    if method == 'spearman':
+        A = rank_columns(A)
+        B = rank_columns(B)
+    elif method != 'pearson':
+        raise ValueError(f"unsupported correlation method: {method}")
+    Az = standardize_columns(A)
+    Bz = standardize_columns(B)
+    n_a, n_b = Az.shape[1], Bz.shape[1]
+
+    hist = np.zeros(n_bins, dtype=np.int64)
+    keep_i = np.empty(0, dtype=np.int64)
+    keep_j = np.empty(0, dtype=np.int64)
+    keep_r = np.empty(0, dtype=np.float64)
+
+    for start in range(0, n_a, block_size):
+        stop = min(start + block_size, n_a)
+        R = Az[:, start:stop].T @ Bz
+        absR = np.abs(R)
+        bins = np.minimum((absR * n_bins).astype(np.int64), n_bins - 1)
+        hist += np.bincount(bins.ravel(), minlength=n_bins)
+
+        bi, bj = np.nonzero(absR >= threshold)
+        keep_i = np.concatenate([keep_i, bi + start])
+        keep_j = np.concatenate([keep_j, bj])
+        keep_r = np.concatenate([keep_r, R[bi, bj]])
+        if top_k is not None and keep_r.size > top_k:
+            sel = np.argpartition(-np.abs(keep_r), top_k - 1)[:top_k]
+            keep_i, keep_j, keep_r = keep_i[sel], keep_j[sel], keep_r[sel]
+
+    order = np.argsort(-np.abs(keep_r), kind='stable')
+    keep_i, keep_j, keep_r = keep_i[order], keep_j[order], keep_r[order]
+    m = n_a * n_b
+    pvalues = correlation_pvalues(keep_r, n)
+
+    # BH: 保留条目的秩为 1..R; 其余条目的最小 m*p/j 由直方图给出上界
+    n_keep = keep_r.size
+    kept_bins = np.minimum((np.abs(keep_r) * n_bins).astype(np.int64), n_bins - 1)
+    tail = hist - np.bincount(kept_bins, minlength=n_bins)
+    tail_cum = np.cumsum(tail[::-1])[::-1]
+    nonempty = tail > 0
+    if nonempty.any():
+        lower_edges = np.arange(n_bins)[nonempty] / n_bins
+        tail_terms = m * correlation_pvalues(lower_edges, n) / (n_keep + tail_cum[nonempty])
+        tail_min = float(tail_terms.min())
+    else:
+        tail_min = np.inf
+    terms = pvalues * m / np.arange(1, n_keep + 1) if n_keep else pvalues
+    padj = np.minimum(np.minimum.accumulate(terms[::-1])[::-1], tail_min)
+    padj = np.minimum(padj, 1.0)
+
+    return {
+        "i": keep_i,
+        "j": keep_j,
+        "r": keep_r,
+        "pvalue": pvalues,
+        "padj": padj,
+        "n_tests": m,
+        "n_samples": n
+    }
+
+
+def align_complete(A: np.ndarray, B: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """去掉任一矩阵中含缺失值的样本 (行)"""
+    ok = ~(np.isnan(A).any(axis=1) | np.isnan(B).any(axis=1))
+    return A[ok], B[ok]
+
+
+def permutation_batch(seed: int, batch_index: int, n: int, size: int) -> np.ndarray:
+    """
+    第 batch_index 批置换的样本下标 (size, n)
+    只依赖 (seed, batch_index), 与分块方式和进程数无关, 结果可复现
+    """
+    rng = np.random.default_rng([seed, batch_index])
+    return rng.permuted(np.tile(np.arange(n), (size, 1)), axis=1)
+
+
+def _permutation_counts(
+    Az: np.ndarray,
+    Bz: np.ndarray,
+    pi: np.ndarray,
+    pj: np.ndarray,
+    r_obs: np.ndarray,
+    n_permutations: int,
+    batch_size: int,
+    seed: int,
+    early_stop: int,
+    max_block_bytes: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    一组相关对的置换计数 (可在子进程中运行)
+
+    每批 P 个置换: 把 B 的行按各置换重排后并排成 (n, P*T),
+    于是 A 的一个基因块与之做一次矩阵乘法即得到该块所有相关对在 P 个置换下的 r;
+    并排矩阵按置换子批和物种段切分, 基因块, 并排矩阵与结果块各自不超过 max_block_bytes.
+    已累计 early_stop 次超越的相关对提前停止 (Besag-Clifford 序贯检验)
+    """
+    n = Az.shape[0]
+    n_pairs = pi.size
+    counts = np.zeros(n_pairs, dtype=np.int64)
+    done = np.zeros(n_pairs, dtype=np.int64)
+    target = np.abs(r_obs) - 1e-12
+    n_batches = int(np.ceil(n_permutations / batch_size))
+
+    for b in range(n_batches):
+        size = min(batch_size, n_permutations - b * batch_size)
+        active = np.flatnonzero(counts < early_stop) if early_stop else np.arange(n_pairs)
+        if active.size == 0:
+            break
+        idx = permutation_batch(seed, b, n, batch_size)[:size]
+        genes, g_inv = np.unique(pi[active], return_inverse=True)
+        taxa, t_inv = np.unique(pj[active], return_inverse=True)
+        # 置换子批 x 物种段: 并排矩阵及其 gather 临时数组 (8 n P T 字节) 都不超过 max_block_bytes
+        p_chunk = max(1, min(size, max_block_bytes // (8 * n)))
+        t_chunk = max(1, max_block_bytes // (8 * n * p_chunk))
+        for t0 in range(0, taxa.size, t_chunk):
+            in_t = np.flatnonzero((t_inv >= t0) & (t_inv < t0 + t_chunk))
+            if in_t.size == 0:
+                continue
+            Bt = Bz[:, taxa[t0:t0 + t_chunk]]
+            T = Bt.shape[1]
+            order = in_t[np.argsort(g_inv[in_t], kind='stable')]
+            for p0 in range(0, size, p_chunk):
+                P = min(p_chunk, size - p0)
+                # (P, n, T) -> (n, P*T)
+                Bcat = Bt[idx[p0:p0 + P]].transpose(1, 0, 2).reshape(n, P * T)
+                g_chunk = max(1, int(min(max_block_bytes // (8 * P * T), max_block_bytes // (8 * n))))
+                bounds = np.searchsorted(g_inv[order], np.arange(0, genes.size + g_chunk, g_chunk))
+                for c, g0 in enumerate(range(0, genes.size, g_chunk)):
+                    sel = order[bounds[c]:bounds[c + 1]]
+                    if sel.size == 0:
+                        continue
+                    R = (Az[:, genes[g0:g0 + g_chunk]].T @ Bcat).reshape(-1, P, T)
+                    vals = R[g_inv[sel] - g0, :, t_inv[sel] - t0]
+                    pairs = active[sel]
+                    counts[pairs] += (np.abs(vals) >= target[pairs, None]).sum(axis=1)
+        done[active] += size
+    return counts, done
+
+
+def permutation_pvalues(
+    A: np.ndarray,
+    B: np.ndarray,
+    pairs_i: np.ndarray,
+    pairs_j: np.ndarray,
+    method: str = 'spearman',
+    n_permutations: int = 10000,
+    batch_size: int = 100,
+    early_stop: int = 10,
+    n_jobs: int = 1,
+    seed: int = 0,
+    max_block_bytes: int = 1 << 28
+) -> Dict:
+    """
+    相关对 (A[:, i], B[:, j]) 的双侧置换p值
+
+    - 置换按批生成并以矩阵乘法批量评估
+    - early_stop 次超越后停止, 明显不显著的相关对不会跑满所有置换
+    - n_jobs > 1 时按基因分组拆到进程池; 各进程使用相同的置换序列
+    p = (超越次数 + 1) / (已完成置换数 + 1)
+    """
+    if method == 'spearman':
+        A = rank_columns(A)
+        B = rank_columns(B)
+    elif method != 'pearson':
+        raise ValueError(f"unsupported correlation method: {method}")
+    Az = standardize_columns(A)
+    Bz = standardize_columns(B)
+    pi = np.asarray(pairs_i, dtype=np.int64)
+    pj = np.asarray(pairs_j, dtype=np.int64)
+    r_obs = np.einsum('ij,ij->j', Az[:, pi], Bz[:, pj])
+    args = (n_permutations, batch_size, seed, early_stop, max_block_bytes)
+
+    if n_jobs <= 1 or pi.size < 2:
+        counts, done = _permutation_counts(Az, Bz, pi, pj, r_obs, *args)
+    else:
+        # 按基因排序后切分, 每个进程涉及的基因尽量少
+        order = np.argsort(pi, kind='stable')
+        chunks = [c for c in np.array_split(order, n_jobs) if c.size]
+        counts = np.zeros(pi.size, dtype=np.int64)
+        done = np.zeros(pi.size, dtype=np.int64)
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            futures = [
+                pool.submit(_permutation_counts, Az, Bz, pi[c], pj[c], r_obs[c], *args)
+                for c in chunks
+            ]
+            for c, fut in zip(chunks, futures):
+                counts[c], done[c] = fut.result()
+
+    return {
+        "r": r_obs,
+        "pvalue": (counts + 1) / (done + 1),
+        "n_permutations": done,
+        "exceedances": counts
+    }
+
+
+# 子进程内的只读状态 (由进程池 initializer 设置一次, 避免每个任务重复传输大矩阵)
+_WORKER_STATE: Dict = {}
+
+
+def _init_permutation_worker(state: Dict) -> None:
+    _WORKER_STATE.clear()
+    _WORKER_STATE.update(state)
+
+
+def _permutation_worker(fn: Callable, seed: int, batch_index: int, size: int) -> int:
+    return fn(_WORKER_STATE, seed, batch_index, size)
+
+
+def sequential_permutation_test(
+    fn: Callable,
+    state: Dict,
+    n_permutations: int,
+    batch_size: int = 100,
+    early_stop: int = 10,
+    n_jobs: int = 1,
+    seed: int = 0
+) -> Tuple[int, int]:
+    """
+    单个统计量的分批置换检验, 返回 (超越次数, 已完成置换数)
+
+    fn(state, seed, batch_index, size) 计算一批置换中的超越次数;
+    批按序号累计, 超越次数达到 early_stop 即停止 (Besag-Clifford).
+    n_jobs > 1 时每轮并行 n_jobs 批, 但仍按批序号判断停止, 结果与进程数无关
+    """
+    n_batches = int(np.ceil(n_permutations / batch_size))
+    sizes = [min(batch_size, n_permutations - b * batch_size) for b in range(n_batches)]
+    count = done = 0
+    if n_jobs <= 1:
+        for b, size in enumerate(sizes):
+            count += fn(state, seed, b, size)
+            done += size
+            if early_stop and count >= early_stop:
+                break
+        return count, done
+    
+    with ProcessPoolExecutor(
+        max_workers=n_jobs, initializer=_init_permutation_worker, initargs=(state,)
+    ) as pool:
+        for start in range(0, n_batches, n_jobs):
+            batches = range(start, min(start + n_jobs, n_batches))
+            futures = [pool.submit(_permutation_worker, fn, seed, b, sizes[b]) for b in batches]
+            for b, fut in zip(batches, futures):
+                count += fut.result()
+                done += sizes[b]
+                if early_stop and count >= early_stop:
+                    return count, done
+    return count, done
+
+
+# Mantel 每次 gather 的元素数上限 (批内置换数 x 样本对数), 控制临时下标数组的大小
+MANTEL_CHUNK = 1 << 20
+
+
+def _circulant_index(P: np.ndarray, n: int) -> np.ndarray:
+    """
+    一批置换 P (b, n) 下全部样本对在 n x n 方阵展开中的下标 (b, n(n-1)/2)
+
+    样本对按循环顺序排列: 第 d 段为 (p_i, p_{(i+d) mod n}), d = 1..(n-1)//2,
+    n 为偶数时再加 (p_i, p_{i+n/2}), i < n/2; 每个无序样本对恰好出现一次.
+    下标只需滑动窗口与广播加法, 不必逐元素查表
+    """
+    b = P.shape[0]
+    D = (n - 1) // 2
+    half = n // 2 if n % 2 == 0 else 0
+    rows = P * n
+    flat = np.empty((b, D * n + half), dtype=np.intp)
+    if D:
+        ext = np.concatenate([P, P[:, :D + 1]], axis=1)
+        win = sliding_window_view(ext, n, axis=1)[:, 1:D + 1]
+        np.add(rows[:, None, :], win, out=flat[:, :D * n].reshape(b, D, n))
+    if half:
+        flat[:, D * n:] = rows[:, :half] + P[:, half:]
+    return flat
+
+
+def _mantel_batch(state: Dict, seed: int, batch_index: int, size: int) -> int:
+    """
+    一批Mantel置换: 按块取出各置换下的样本对距离 (b, n(n-1)/2), 一次矩阵乘法得到全部置换的 r
+    """
+    a, B, n = state["a"], state["B"], state["n"]
+    perms = permutation_batch(seed, batch_index, n, state["batch_size"])[:size]
+    step = max(1, MANTEL_CHUNK // a.size)
+    count = 0
+    for lo in range(0, size, step):
+        # 下标由构造保证在范围内, clip 模式省去逐元素的越界检查
+        r = np.take(B, _circulant_index(perms[lo:lo + step], n), mode='clip') @ a
+        if state["two_sided"]:
+            r = np.abs(r)
+        count += int((r >= state["target"]).sum())
+    return count
+
+
+def mantel(
+    d1: np.ndarray,
+    d2: np.ndarray,
+    method: str = 'pearson',
+    n_permutations: int = 9999,
+    alternative: str = 'greater',
+    batch_size: int = 100,
+    early_stop: int = 10,
+    n_jobs: int = 1,
+    seed: int = 0
+) -> Dict:
+    """
+    Mantel检验 (两个压缩距离向量, 长度 n(n-1)/2)
+
+    压缩向量 (Spearman时先取秩) 标准化到单位范数, 置换只重排样本标签, 因此
+    r_perm = sum_{i<j} a_ij b_{p_i p_j}: 第一个矩阵按循环顺序展开为 float32 向量,
+    每批置换从第二个矩阵 (float32 方阵) 中取出对应的样本对后与之做一次矩阵乘法.
+    alternative: 'greater' (单侧, 同vegan) 或 'two-sided'
+    """
+    if method not in ('pearson', 'spearman'):
+        raise ValueError(f"unsupported correlation method: {method}")
+    if alternative not in ('greater', 'two-sided'):
+        raise ValueError(f"unsupported alternative: {alternative}")
+    d1 = np.asarray(d1, dtype=np.float64)
+    d2 = np.asarray(d2, dtype=np.float64)
+    if method == 'spearman':
+        d1 = rank_columns(d1[:, None]).ravel()
+        d2 = rank_columns(d2[:, None]).ravel()
+    z1 = standardize_columns(d1[:, None]).ravel()
+    z2 = standardize_columns(d2[:, None]).ravel()
+    A = squareform(z1.astype(np.float32), checks=False)
+    B = squareform(z2.astype(np.float32), checks=False).ravel()
+    n = A.shape[0]
+    identity = _circulant_index(np.arange(n)[None, :], n)[0]
+    a = A.ravel()[identity]
+    
+    # 观测值与置换值走相同的 float32 计算路径
+    r_obs = float(B[identity] @ a)
+    two_sided = alternative == 'two-sided'
+    state = {
+        "a": a, "B": B, "n": n, "batch_size": batch_size, "two_sided": two_sided,
+        "target": (abs(r_obs) if two_sided else r_obs) - 1e-6
+    }
+    count, done = sequential_permutation_test(
+        _mantel_batch, state, n_permutations, batch_size, early_stop, n_jobs, seed
+    )
+    return {
+        "statistic": float(z1 @ z2),
+        "pvalue": (count + 1) / (done + 1),
+        "n_permutations": done,
+        "n_samples": n
+    }
+
+
+def _procrustes_batch(state: Dict, seed: int, batch_index: int, size: int) -> int:
+    """
+    一批PROTEST置换: Y 的行按各置换重排后并排成 (n, P*k), 一次矩阵乘法得到全部 X^T Y_p,
+    再对 (P, k, k) 批量求奇异值
+    """
+    X, Y = state["X"], state["Y"]
+    n, k = Y.shape
+    idx = permutation_batch(seed, batch_index, n, state["batch_size"])[:size]
+    Ycat = Y[idx].transpose(1, 0, 2).reshape(n, size * Y.shape[1])
+    M = (X.T @ Ycat).reshape(X.shape[1], size, k).transpose(1, 0, 2)
+    r = np.linalg.svd(M, compute_uv=False).sum(axis=1)
+    return int((r >= state["target"]).sum())
+
+
+def procrustes_test(
+    X: np.ndarray,
+    Y: np.ndarray,
+    n_permutations: int = 9999,
+    batch_size: int = 100,
+    early_stop: int = 10,
+    n_jobs: int = 1,
+    seed: int = 0
+) -> Dict:
+    """
+    PROTEST (对称Procrustes分析的置换检验)
+
+    两组坐标中心化并缩放到单位Frobenius范数后, r = X^T Y 的奇异值之和,
+    m12 = 1 - r^2; 置换Y的行检验 r 是否大于随机
+    """
+    X = np.asarray(X, dtype=np.float64)
+    Y = np.asarray(Y, dtype=np.float64)
+    # 维数不同时补零列 (不改变奇异值之和)
+    k = max(X.shape[1], Y.shape[1])
+    X = np.pad(X, ((0, 0), (0, k - X.shape[1])))
+    Y = np.pad(Y, ((0, 0), (0, k - Y.shape[1])))
+    X = X - X.mean(axis=0)
+    Y = Y - Y.mean(axis=0)
+    X /= max(np.linalg.norm(X), 1e-300)
+    Y /= max(np.linalg.norm(Y), 1e-300)
+    
+    r_obs = float(np.linalg.svd(X.T @ Y, compute_uv=False).sum())
+    state = {"X": X, "Y": Y, "batch_size": batch_size, "target": r_obs - 1e-12}
+    count, done = sequential_permutation_test(
+        _procrustes_batch, state, n_permutations, batch_size, early_stop, n_jobs, seed
+    )
+    return {
+        "statistic": r_obs,
+        "m12": 1.0 - r_obs ** 2,
+        "pvalue": (count + 1) / (done + 1),
+        "n_permutations": done,
+        "n_samples": X.shape[0]
+    }
+
+
+def _gower(d: np.ndarray) -> np.ndarray:
+    """Gower中心化矩阵 G = -1/2 J D^2 J (float32 方阵)"""
+    G = squareform(np.square(d, dtype=np.float32), checks=False)
+    G *= -0.5
+    col = G.mean(axis=0, dtype=np.float64)
+    G -= col.astype(np.float32)[None, :]
+    G -= (col - col.mean()).astype(np.float32)[:, None]
+    return G
+
+
+def _permuted_traces(G: np.ndarray, Q: np.ndarray, idx: np.ndarray) -> np.ndarray:
+    """
+    各置换下 Q 每一列的 q^T G_p q, 返回 (P, k)
+    重排 G 的行列等价于重排 Q 的行: 置换并排成 (n, P*k) 后一次矩阵乘法
+    """
+    n, k = Q.shape
+    size = idx.shape[0]
+    Qcat = Q[idx].transpose(1, 0, 2).reshape(n, size * k)
+    return np.einsum('ij,ij->j', Qcat, G @ Qcat).reshape(size, k)
+
+
+def _permanova_f(traces: np.ndarray, state: Dict) -> np.ndarray:
+    p = state["n_covariates"]
+    t_cov = traces[:, :p].sum(axis=1, dtype=np.float64)
+    t_term = traces[:, p:].sum(axis=1, dtype=np.float64)
+    resid = np.maximum(state["total"] - t_cov - t_term, 1e-300)
+    return (t_term / state["df_term"]) / (resid / state["df_resid"])
+
+
+def _permanova_batch(state: Dict, seed: int, batch_index: int, size: int) -> int:
+    """一批PERMANOVA置换的伪F超越次数"""
+    G = state["G"]
+    idx = permutation_batch(seed, batch_index, G.shape[0], state["batch_size"])[:size]
+    F = _permanova_f(_permuted_traces(G, state["Q"], idx), state)
+    return int((F >= state["target"]).sum())
+
+
+def _orthonormal(A: np.ndarray, scale: Optional[float] = None) -> np.ndarray:
+    """列空间的标准正交基 (去掉奇异值低于 1e-10 x scale 的共线方向, scale 默认为最大奇异值)"""
+    if A.shape[1] == 0:
+        return A
+    U, S, _ = np.linalg.svd(A, full_matrices=False)
+    ref = S[0] if scale is None else scale
+    return U[:, S > 1e-10 * max(ref, 1e-300)]
+
+
+def permanova(
+    d: np.ndarray,
+    grouping: np.ndarray,
+    covariates: Optional[np.ndarray] = None,
+    n_permutations: int = 9999,
+    batch_size: int = 100,
+    early_stop: int = 10,
+    n_jobs: int = 1,
+    seed: int = 0
+) -> Dict:
+    """
+    PERMANOVA (基于距离的多元方差分析, 同 vegan::adonis2 的顺序平方和, 协变量先入模型)
+
+    平方和写成Gower矩阵上的投影迹: SS = tr(Q^T G Q), Q 为设计矩阵列空间的标准正交基.
+    截距列被 G 的双中心化消去, 协变量与分组 (对协变量取残差后) 的基各自正交;
+    置换样本标签等价于重排 Q 的行, 一批置换并排后与 G 做一次 float32 矩阵乘法
+    d: 压缩距离向量; grouping: 各样本的整数分组编码; covariates: (n, c) 数值矩阵
+    """
+    d = np.asarray(d)
+    grouping = np.asarray(grouping)
+    n = grouping.size
+    labels, codes = np.unique(grouping, return_inverse=True)
+    if labels.size < 2 or labels.size >= n:
+        raise ValueError("PERMANOVA needs at least 2 groups and fewer groups than samples")
+    
+    # 中心化后的列都与截距正交
+    if covariates is None:
+        Qc = np.empty((n, 0))
+    else:
+        C = np.asarray(covariates, dtype=np.float64).reshape(n, -1)
+        Qc = _orthonormal(C - C.mean(axis=0))
+    E = np.eye(labels.size)[codes][:, 1:]
+    E = E - E.mean(axis=0)
+    # 共线判断以取残差前的尺度为准, 否则残差中只剩舍入误差时也会被当作新方向
+    scale = float(np.linalg.norm(E, 2))
+    E -= Qc @ (Qc.T @ E)
+    Qt = _orthonormal(E, scale)
+    if Qt.shape[1] == 0:
+        raise ValueError("grouping is collinear with the covariates")
+    
+    G = _gower(d)
+    # tr(G) = sum_{i<j} d_ij^2 / n
+    total = float(np.dot(d, d.astype(np.float64))) / n
+    df_cov, df_term = Qc.shape[1], Qt.shape[1]
+    df_resid = n - 1 - df_cov - df_term
+    if df_resid <= 0:
+        raise ValueError("no residual degrees of freedom")
+    state = {
+        "G": G,
+        "Q": np.hstack([Qc, Qt]).astype(np.float32),
+        "n_covariates": df_cov,
+        "total": total,
+        "df_term": df_term,
+        "df_resid": df_resid,
+        "batch_size": batch_size
+    }
+    # 观测值与置换值走相同的 float32 计算路径
+    traces = _permuted_traces(G, state["Q"], np.arange(n)[None, :])
+    F_obs = float(_permanova_f(traces, state)[0])
+    ss_cov = float(traces[0, :df_cov].sum(dtype=np.float64))
+    ss_term = float(traces[0, df_cov:].sum(dtype=np.float64))
+    state["target"] = F_obs * (1 - 1e-6)
+    count, done = sequential_permutation_test(
+        _permanova_batch, state, n_permutations, batch_size, early_stop, n_jobs, seed
+    )
+    return {
+        "statistic": F_obs,
+        "pvalue": (count + 1) / (done + 1),
+        "r2": ss_term / total if total > 0 else 0.0,
+        "df": df_term,
+        "df_covariates": df_cov,
+        "df_residual": df_resid,
+        "ss": ss_term,
+        "ss_covariates": ss_cov,
+        "ss_residual": total - ss_cov - ss_term,
+        "ss_total": total,
+        "n_permutations": done,
+        "n_groups": int(labels.size),
+        "n_samples": n
+    }
+
+
+def _anosim_r(within: np.ndarray, state: Dict) -> np.ndarray:
+    # within: 组内 (秩 - 平均秩) 之和; 平均秩 = (M + 1) / 2
+    M, n_w = state["n_pairs"], state["n_within"]
+    mean_rank = (M + 1) / 2.0
+    r_w = mean_rank + within / n_w
+    r_b = mean_rank - within / (M - n_w)
+    return (r_b - r_w) / (M / 2.0)
+
+
+def _anosim_batch(state: Dict, seed: int, batch_index: int, size: int) -> int:
+    """一批ANOSIM置换的R超越次数"""
+    Rk = state["G"]
+    idx = permutation_batch(seed, batch_index, Rk.shape[0], state["batch_size"])[:size]
+    within = 0.5 * _permuted_traces(Rk, state["Q"], idx).sum(axis=1, dtype=np.float64)
+    return int((_anosim_r(within, state) >= state["target"]).sum())
+
+
+def anosim(
+    d: np.ndarray,
+    grouping: np.ndarray,
+    n_permutations: int = 9999,
+    batch_size: int = 100,
+    early_stop: int = 10,
+    n_jobs: int = 1,
+    seed: int = 0
+) -> Dict:
+    """
+    ANOSIM (相似性分析): R = (组间平均秩 - 组内平均秩) / (M / 2), M = n(n-1)/2
+
+    距离秩减去平均秩后展开为 float32 方阵, 组内秩和 = 1/2 sum_g e_g^T R e_g;
+    置换重排指示矩阵 E 的行, 与 PERMANOVA 一样按批做矩阵乘法
+    """
+    d = np.asarray(d, dtype=np.float64)
+    grouping = np.asarray(grouping)
+    n = grouping.size
+    labels, codes = np.unique(grouping, return_inverse=True)
+    if labels.size < 2 or labels.size >= n:
+        raise ValueError("ANOSIM needs at least 2 groups and fewer groups than samples")
+    M = d.size
+    ranks = rank_columns(d[:, None]).ravel() - (M + 1) / 2.0
+    sizes = np.bincount(codes)
+    state = {
+        "G": squareform(ranks.astype(np.float32), checks=False),
+        "Q": np.eye(labels.size, dtype=np.float32)[codes],
+        "n_pairs": M,
+        "n_within": int((sizes * (sizes - 1) // 2).sum()),
+        "batch_size": batch_size
+    }
+    within = 0.5 * _permuted_traces(state["G"], state["Q"], np.arange(n)[None, :]).sum(dtype=np.float64)
+    R_obs = float(_anosim_r(np.atleast_1d(within), state)[0])
+    state["target"] = R_obs - 1e-6
+    count, done = sequential_permutation_test(
+        _anosim_batch, state, n_permutations, batch_size, early_stop, n_jobs, seed
+    )
+    return {
+        "statistic": R_obs,
+        "pvalue": (count + 1) / (done + 1),
+        "n_permutations": done,
+        "n_groups": int(labels.size),
+        "n_samples": n
+    }
+
+
+def correlation_graph(
+    Z: np.ndarray,
+    threshold: float,
+    max_block_bytes: int = 1 << 27
+) -> sparse.csr_matrix:
+    """
+    特征相关网络 (稀疏, 对称, 权重为 |r|)
+
+    Z: (n_samples, n_features), 已按列标准化 (standardize_columns)
+    按行块计算 Z.T @ Z 的上三角部分, 每块只保留 |r| >= threshold 的条目,
+    完整的 features x features 矩阵从不驻留内存
+    """
+    n_features = Z.shape[1]
+    rows = max(1, int(max_block_bytes // (8 * max(n_features, 1))))
+    ei, ej, ew = [], [], []
+    for start in range(0, n_features, rows):
+        stop = min(start + rows, n_features)
+        R = np.abs(Z[:, start:stop].T @ Z[:, start:])
+        # 块内列 c 对应全局 start + c, 只保留 c > 行号 (上三角, 不含对角)
+        R[np.tril_indices(stop - start, m=R.shape[1])] = 0.0
+        bi, bj = np.nonzero(R >= threshold)
+        ei.append(bi + start)
+        ej.append(bj + start)
+        ew.append(R[bi, bj])
+    i = np.concatenate(ei) if ei else np.empty(0, dtype=np.int64)
+    j = np.concatenate(ej) if ej else np.empty(0, dtype=np.int64)
+    w = np.concatenate(ew) if ew else np.empty(0)
+    upper = sparse.coo_matrix((w, (i, j)), shape=(n_features, n_features))
+    return (upper + upper.T).tocsr()
+
+
+def modularity(A: sparse.csr_matrix, labels: np.ndarray) -> float:
+    """加权无向图在给定划分下的模块度 Q"""
+    coo = A.tocoo()
+    two_m = coo.data.sum()
+    if two_m == 0:
+        return 0.0
+    inside = coo.data[labels[coo.row] == labels[coo.col]].sum()
+    K = np.bincount(labels, weights=np.asarray(A.sum(axis=1)).ravel())
+    return float(inside / two_m - ((K / two_m) ** 2).sum())
+
+
+def modularity_communities(
+    A: sparse.csr_matrix,
+    max_iter: int = 100,
+    update_fraction: float = 0.5,
+    seed: int = 0
+) -> np.ndarray:
+    """
+    模块度标签传播 (LPAm) 社区检测, 返回从0开始连续编号的标签
+
+    每轮用一次稀疏矩阵乘法得到各节点到各邻居标签的连接权重 S,
+    节点移入标签 l 的增益为 S_il - k_i (K_l - k_i [l = 自身]) / 2m;
+    每轮随机更新一部分节点 (避免同步更新振荡), 只在增益严格变大时移动
+    """
+    n = A.shape[0]
+    k = np.asarray(A.sum(axis=1)).ravel()
+    two_m = k.sum()
+    labels = np.arange(n)
+    if two_m == 0:
+        return labels
+    rng = np.random.default_rng(seed)
+    nodes = np.arange(n)
+    for _ in range(max_iter):
+        onehot = sparse.csr_matrix((np.ones(n), (nodes, labels)), shape=(n, n))
+        S = (A @ onehot).tocoo()
+        # 自身标签总是候选 (连接权重可能为0)
+        rows = np.concatenate([S.row, nodes])
+        cols = np.concatenate([S.col, labels])
+        vals = np.concatenate([S.data, np.zeros(n)])
+        S = sparse.coo_matrix((vals, (rows, cols)), shape=(n, n)).tocsr()
+        S.sum_duplicates()
+        r = np.repeat(nodes, np.diff(S.indptr))
+        K = np.bincount(labels, weights=k, minlength=n)
+        own = S.indices == labels[r]
+        gain = S.data - k[r] * (K[S.indices] - own * k[r]) / two_m
+        
+        # 每行增益最大的标签 (并列时取编号最小者)
+        order = np.lexsort((S.indices, -gain, r))
+        first = order[S.indptr[:-1]]
+        own_gain = np.empty(n)
+        own_gain[r[own]] = gain[own]
+        move = (gain[first] > own_gain + 1e-12) & (rng.random(n) < update_fraction)
+        if not move.any():
+            # 随机子集里没有可移动节点时再检查全体, 全部收敛才停止
+            if not np.any(gain[first] > own_gain + 1e-12):
+                break
+            continue
+        labels = labels.copy()
+        labels[move] = S.indices[first[move]]
+    return np.unique(labels, return_inverse=True)[1]
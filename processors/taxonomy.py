@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Taxonomy Collapse
+按分类等级合并特征: 每一级是一次与稀疏指示矩阵的乘法
+
+- 层级只构建一次: 各级的分类单元由 (上一级编码, 本级名称) 的整数对去重得到, 不拼接字符串
+- 多级合并从 species 开始逐级向上链式聚合, 每一步只处理上一级已合并的 (更小的) 表
+"""
+
+import numpy as np
+from scipy import sparse
+from typing import Dict, List
+
+try:
+    from .biom import RANKS
+except ImportError:  # 作为脚本直接运行
+    from biom import RANKS
+
+
+def build_hierarchy(taxonomy: List[List[str]]) -> Dict:
+    """
+    由每个特征的分类路径 (按 RANKS 排列, 缺失为 '') 构建 kingdom -> species 层级
+    返回 codes: 各级每个特征所属单元的编码; parent: 各级单元在上一级中的编码;
+    names: 各级单元的完整路径 (同名属在不同科下是不同单元)
+    """
+    paths = np.asarray(taxonomy, dtype=object).reshape(len(taxonomy), -1)
+    if paths.shape[1] != len(RANKS):
+        raise ValueError(f"taxonomy paths must have {len(RANKS)} ranks")
+    n = paths.shape[0]
+    codes: Dict[str, np.ndarray] = {}
+    parent: Dict[str, np.ndarray] = {}
+    names: Dict[str, List[str]] = {}
+    prev = np.zeros(n, dtype=np.int64)
+    prev_names = ['']
+    for r, rank in enumerate(RANKS):
+        labels, name_code = np.unique(paths[:, r].astype(str), return_inverse=True)
+        key = prev * labels.size + name_code
+        _, first, code = np.unique(key, return_index=True, return_inverse=True)
+        codes[rank] = code
+        parent[rank] = prev[first]
+        names[rank] = [
+            f"{prev_names[p]};{labels[c]}" if r else str(labels[c])
+            for p, c in zip(prev[first], name_code[first])
+        ]
+        prev, prev_names = code, names[rank]
+    return {"codes": codes, "parent": parent, "names": names, "n_features": n}
+
+
+def aggregation_matrix(codes: np.ndarray, n_groups: int) -> sparse.csr_matrix:
+    """成员 -> 组 的 0/1 指示矩阵 (len(codes) x n_groups)"""
+    return sparse.csr_matrix(
+        (np.ones(codes.size), (np.arange(codes.size), codes)), shape=(codes.size, n_groups)
+    )
+
+
+def collapse(X: sparse.csr_matrix, hierarchy: Dict, levels: List[str]) -> Dict[str, sparse.csr_matrix]:
+    """
+    把 samples x features 表合并到给定的各分类等级
+    先一次乘到最细的所需等级, 再沿层级逐级乘以 (子单元 -> 父单元) 指示矩阵
+    """
+    wanted = sorted({RANKS.index(level) for level in levels})
+    finest = wanted[-1]
+    rank = RANKS[finest]
+    table = sparse.csr_matrix(
+        X @ aggregation_matrix(hierarchy["codes"][rank], len(hierarchy["names"][rank]))
+    )
+    tables = {rank: table}
+    for r in range(finest, wanted[0], -1):
+        up = RANKS[r - 1]
+        table = sparse.csr_matrix(
+            table @ aggregation_matrix(hierarchy["parent"][RANKS[r]], len(hierarchy["names"][up]))
+        )
+        if r - 1 in wanted:
+            tables[up] = table
+    return tables
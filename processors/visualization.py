@@ -2,299 +2,1315 @@
 """
 可视化Processor
 整合自原R包Plot_*功能
+
+每个方法由传入的数据绘制图像 (Agg, 无界面), 输出存入内容寻址的图像缓存 (见 render.py):
+同样的数据 + 参数 + 主题再次请求时直接返回缓存文件. 数据缺失时使用固定种子的演示数据
 """
 
 import json
-from typing import Dict, List
+import os
+import numpy as np
+import pandas as pd
+import matplotlib as mpl
+from matplotlib.cm import ScalarMappable
+from matplotlib.collections import LineCollection
+from matplotlib.colors import Normalize
+from matplotlib.lines import Line2D
+from matplotlib.patches import Ellipse, PathPatch, Rectangle
+from matplotlib.path import Path
+from scipy.special import ndtr, stdtrit
+from scipy import sparse
+from typing import Dict, List, Optional, Tuple
+
+try:
+    from .heatmap import (
+        DISTANCES, LINKAGE_METHODS, MAX_EXACT_LINKAGE, TILE_SIZE, aggregate, cluster_order, color_limits,
+        dendrogram_segments, pyramid_factors, scale_matrix, tile_png, tile_pyramid
+    )
+    from .raster import RASTER_THRESHOLD, bin_points, data_extent, shade_categories, shade_values
+    from .render import RENDER_VERSION, FigureCache, content_hash, default_cache, render
+    from .stats import modularity_communities
+except ImportError:  # 作为脚本直接运行
+    from heatmap import (
+        DISTANCES, LINKAGE_METHODS, MAX_EXACT_LINKAGE, TILE_SIZE, aggregate, cluster_order, color_limits,
+        dendrogram_segments, pyramid_factors, scale_matrix, tile_png, tile_pyramid
+    )
+    from raster import RASTER_THRESHOLD, bin_points, data_extent, shade_categories, shade_values
+    from render import RENDER_VERSION, FigureCache, content_hash, default_cache, render
+    from stats import modularity_communities
+
+
+# ==================== 数据准备 ====================
+
+def _palette() -> List[str]:
+    """当前主题的分类颜色"""
+    return mpl.rcParams['axes.prop_cycle'].by_key()['color']
+
+
+def _column(table: Dict, name: str) -> np.ndarray:
+    if name not in table:
+        raise KeyError(f"table has no column {name}")
+    return np.asarray(table[name])
+
+
+def _levels(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """分类值 -> (按首次出现排序的水平, 编码); 缺失值作为一个水平 'nan'"""
+    codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+    if np.any(codes < 0):
+        codes, uniques = pd.factorize(np.asarray([str(v) for v in values], dtype=object))
+    return np.asarray([str(u) for u in uniques]), codes
+
+
+def _with_groups(data: Dict, group: Optional[str]) -> Dict:
+    """group 为 data['sample_metadata'] 的列名时, 取该列作为 data['groups']"""
+    if group is None or 'groups' in data:
+        return data
+    metadata = data.get('sample_metadata') or {}
+    if group not in metadata:
+        raise KeyError(f"sample metadata has no column {group}")
+    return {**data, "groups": metadata[group]}
+
+
+def _is_numeric(values: np.ndarray) -> bool:
+    return np.asarray(values).dtype.kind in 'iuf'
+
+
+def _demo_composition(n_samples: int = 8, n_taxa: int = 6, seed: int = 0) -> Dict:
+    """长表: sample / taxon / group / value (相对丰度)"""
+    rng = np.random.default_rng(seed)
+    P = rng.dirichlet(np.linspace(3.0, 0.5, n_taxa), n_samples)
+    samples = [f"S{i + 1}" for i in range(n_samples)]
+    return {
+        "sample": [s for s in samples for _ in range(n_taxa)],
+        "taxon": [f"Taxon_{j + 1}" for _ in samples for j in range(n_taxa)],
+        "group": [('A' if i < n_samples // 2 else 'B') for i in range(n_samples) for _ in range(n_taxa)],
+        "value": P.ravel().round(4).tolist()
+    }
+
+
+def _demo_measurements(n: int = 90, seed: int = 0) -> Dict:
+    """长表: group / site / x / y / value / size"""
+    rng = np.random.default_rng(seed)
+    group = rng.choice(['A', 'B', 'C'], n)
+    x = rng.normal(0.0, 1.0, n)
+    shift = np.select([group == 'A', group == 'B'], [0.0, 0.8], 1.5)
+    return {
+        "group": group.tolist(),
+        "site": rng.choice(['gut', 'oral'], n).tolist(),
+        "x": x.round(4).tolist(),
+        "y": (0.7 * x + shift + rng.normal(0.0, 0.5, n)).round(4).tolist(),
+        "value": (shift + rng.gamma(2.0, 0.5, n)).round(4).tolist(),
+        "size": rng.uniform(1.0, 10.0, n).round(2).tolist()
+    }
+
+
+def _demo_matrix(n_rows: int = 40, n_cols: int = 12, seed: int = 0) -> Dict:
+    """两个行块 x 两个列块的丰度矩阵"""
+    rng = np.random.default_rng(seed)
+    M = rng.gamma(2.0, 1.0, (n_rows, n_cols))
+    M[:n_rows // 2, :n_cols // 2] *= 4.0
+    M[n_rows // 2:, n_cols // 2:] *= 4.0
+    return {
+        "matrix": M.round(4).tolist(),
+        "rows": [f"Feature_{i + 1}" for i in range(n_rows)],
+        "columns": [f"S{j + 1}" for j in range(n_cols)],
+        "groups": ['A' if j < n_cols // 2 else 'B' for j in range(n_cols)]
+    }
+
+
+def _demo_differential(n: int = 5000, seed: int = 0) -> Dict:
+    rng = np.random.default_rng(seed)
+    lfc = rng.normal(0.0, 0.6, n)
+    hit = rng.random(n) < 0.05
+    lfc[hit] += rng.choice([-2.5, 2.5], hit.sum())
+    z = lfc / 0.5
+    p = np.clip(2.0 * ndtr(-np.abs(z)), 1e-300, 1.0)
+    return {
+        "log2fc": lfc.round(4).tolist(),
+        "pvalue": p.tolist(),
+        "labels": [f"Gene_{i + 1}" for i in range(n)]
+    }
+
+
+def _demo_embedding(n: int = 3000, n_groups: int = 6, seed: int = 0) -> Dict:
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(-10.0, 10.0, (n_groups, 2))
+    groups = rng.integers(0, n_groups, n)
+    coords = centers[groups] + rng.normal(0.0, 1.0, (n, 2))
+    return {"coordinates": coords.round(4).tolist(), "groups": [f"C{g + 1}" for g in groups]}
+
+
+def _demo_edges(n_nodes: int = 40, seed: int = 0) -> List[Dict]:
+    rng = np.random.default_rng(seed)
+    module = np.arange(n_nodes) % 4
+    edges = []
+    for i in range(n_nodes):
+        for j in range(i + 1, n_nodes):
+            if rng.random() < (0.35 if module[i] == module[j] else 0.02):
+                r = rng.uniform(0.3, 0.9) * (1 if module[i] == module[j] else -1)
+                edges.append({"source": f"N{i + 1}", "target": f"N{j + 1}", "correlation": round(r, 3)})
+    return edges
+
+
+def _demo_terms(n_terms: int = 15, seed: int = 0) -> List[Dict]:
+    rng = np.random.default_rng(seed)
+    genes = [f"G{i + 1}" for i in range(80)]
+    terms = []
+    for t in range(n_terms):
+        members = sorted(rng.choice(genes, int(rng.integers(3, 12)), replace=False).tolist())
+        terms.append({
+            "term": f"Pathway_{t + 1}",
+            "GeneRatio": f"{len(members)}/60",
+            "pvalue": float(10 ** -rng.uniform(1.5, 8.0)),
+            "Count": len(members),
+            "genes": members
+        })
+    return terms
+
+
+def _demo_ranked(n: int = 2000, seed: int = 0) -> Dict:
+    rng = np.random.default_rng(seed)
+    scores = np.sort(rng.normal(0.0, 1.0, n))[::-1]
+    # 基因集偏向排序靠前的位置
+    hits = np.unique(np.clip(rng.exponential(n / 4.0, 60).astype(int), 0, n - 1))
+    return {"scores": scores.round(4).tolist(), "hits": hits.tolist()}
+
+
+def _demo_flows(seed: int = 0) -> Dict:
+    rng = np.random.default_rng(seed)
+    sources, targets, values = [], [], []
+    for s in ['Phylum_A', 'Phylum_B', 'Phylum_C']:
+        for t in ['Genus_1', 'Genus_2', 'Genus_3', 'Genus_4']:
+            if rng.random() < 0.7:
+                sources.append(s)
+                targets.append(t)
+                values.append(round(float(rng.uniform(1.0, 10.0)), 2))
+    return {"source": sources, "target": targets, "value": values}
+
+
+def _demo_structure(n_samples: int = 60, k: int = 3, seed: int = 0) -> Dict:
+    rng = np.random.default_rng(seed)
+    groups = np.repeat(['Pop1', 'Pop2', 'Pop3'], n_samples // 3)
+    alpha = np.full((groups.size, k), 0.5)
+    alpha[np.arange(groups.size), np.repeat(np.arange(3), n_samples // 3) % k] = 8.0
+    Q = np.vstack([rng.dirichlet(a) for a in alpha])
+    return {"matrix": Q.round(4).tolist(), "groups": groups.tolist()}
+
+
+# ==================== 绘图辅助 ====================
+
+def _spring_layout(A: sparse.csr_matrix, iterations: int = 200, seed: int = 0) -> np.ndarray:
+    """Fruchterman-Reingold 力导向布局, 每次迭代对全部节点对向量化计算 (n x n)"""
+    n = A.shape[0]
+    rng = np.random.default_rng(seed)
+    pos = rng.uniform(-1.0, 1.0, (n, 2))
+    if n < 2:
+        return pos
+    W = np.abs(A.toarray())
+    k = 1.0 / np.sqrt(n)
+    t = 0.1
+    for _ in range(iterations):
+        delta = pos[:, None, :] - pos[None, :, :]
+        dist = np.maximum(np.linalg.norm(delta, axis=2), 1e-3)
+        force = (k * k / dist ** 2 - W * dist / k)[..., None] * delta
+        disp = force.sum(axis=1)
+        length = np.maximum(np.linalg.norm(disp, axis=1, keepdims=True), 1e-9)
+        pos += disp / length * np.minimum(length, t)
+        t *= 0.98
+    pos -= pos.mean(axis=0)
+    return pos / max(np.abs(pos).max(), 1e-9)
+
+
+def _edge_graph(sources: List[str], targets: List[str], weights: np.ndarray) -> Tuple[List[str], sparse.csr_matrix, np.ndarray, np.ndarray]:
+    """边表 -> (节点名, 对称加权邻接矩阵, 边的两端下标)"""
+    names, codes = _levels(np.concatenate([np.asarray(sources, dtype=str), np.asarray(targets, dtype=str)]))
+    i, j = codes[:len(sources)], codes[len(sources):]
+    n = len(names)
+    A = sparse.coo_matrix((np.abs(weights), (i, j)), shape=(n, n))
+    return names.tolist(), (A + A.T).tocsr(), i, j
+
+
+def _confidence_ellipse(ax, points: np.ndarray, color: str, chi2: float = 5.991) -> None:
+    """二维正态 95% 置信椭圆"""
+    if points.shape[0] < 3:
+        return
+    cov = np.cov(points.T)
+    vals, vecs = np.linalg.eigh(cov)
+    angle = np.degrees(np.arctan2(vecs[1, 1], vecs[0, 1]))
+    w, h = 2.0 * np.sqrt(chi2 * np.maximum(vals[::-1], 0.0))
+    ax.add_patch(Ellipse(points.mean(axis=0), w, h, angle=angle, facecolor=color, alpha=0.15,
+                         edgecolor=color, lw=1.0))
+
+
+def _legend(ax, labels, colors, title: Optional[str] = None) -> None:
+    handles = [Line2D([], [], marker='o', ls='', color=c) for c in colors]
+    ax.legend(handles, list(labels), title=title, frameon=False, fontsize='small',
+              loc='center left', bbox_to_anchor=(1.0, 0.5))
+
+
+def _ols_band(x: np.ndarray, y: np.ndarray, grid: np.ndarray) -> Tuple[np.ndarray, np.ndarray, float]:
+    """简单线性回归在 grid 上的拟合值, 95% 置信带半宽与 R^2"""
+    X = np.column_stack([np.ones_like(x), x])
+    beta, *_ = np.linalg.lstsq(X, y, rcond=None)
+    resid = y - X @ beta
+    df = max(x.size - 2, 1)
+    s2 = resid @ resid / df
+    G = np.column_stack([np.ones_like(grid), grid])
+    se = np.sqrt(s2 * np.einsum('ij,jk,ik->i', G, np.linalg.pinv(X.T @ X), G))
+    ss = ((y - y.mean()) ** 2).sum()
+    r2 = 1.0 - resid @ resid / ss if ss > 0 else 0.0
+    return G @ beta, -stdtrit(df, 0.025) * se, float(r2)
+
+
+def _loess(x: np.ndarray, y: np.ndarray, grid: np.ndarray, span: float = 0.75) -> np.ndarray:
+    """局部线性回归 (tricube 权重), 全部网格点一次计算 (len(grid) x n 的权重矩阵)"""
+    k = max(int(np.ceil(span * x.size)), 2)
+    d = np.abs(grid[:, None] - x[None, :])
+    h = np.maximum(np.partition(d, k - 1, axis=1)[:, k - 1], 1e-12)
+    w = np.clip(1.0 - (d / h[:, None]) ** 3, 0.0, None) ** 3
+    sw, swx, swy = w.sum(1), w @ x, w @ y
+    swxx, swxy = w @ (x * x), w @ (x * y)
+    det = sw * swxx - swx ** 2
+    slope = np.where(det > 1e-12, (sw * swxy - swx * swy) / np.where(det > 1e-12, det, 1.0), 0.0)
+    return (swy - slope * swx) / sw + slope * grid
+
+
+# ==================== 各类图的绘制 ====================
+
+def _draw_barplot(fig, data: Dict, params: Dict) -> Dict:
+    table = data.get('table') or _demo_composition()
+    x = params["x"] or ('sample' if 'sample' in table else next(iter(table)))
+    y = _column(table, params["y"]).astype(np.float64)
+    xs, xc = _levels(_column(table, x))
+    if params["color"]:
+        cs, cc = _levels(_column(table, params["color"]))
+    elif 'taxon' in table and x != 'taxon':
+        cs, cc = _levels(_column(table, 'taxon'))
+    else:
+        cs, cc = np.array(['']), np.zeros(y.size, dtype=np.int64)
+    M = np.zeros((xs.size, cs.size))
+    np.add.at(M, (xc, cc), y)
+    ax = fig.add_subplot(111)
+    colors = _palette()
+    bottom = np.zeros(xs.size)
+    pos = np.arange(xs.size)
+    for c in range(cs.size):
+        color = colors[c % len(colors)]
+        if params["orientation"] == 'h':
+            ax.barh(pos, M[:, c], left=bottom, color=color, label=cs[c])
+        else:
+            ax.bar(pos, M[:, c], bottom=bottom, color=color, label=cs[c])
+        bottom += M[:, c]
+    if params["orientation"] == 'h':
+        ax.set_yticks(pos, xs)
+        ax.set_xlabel(params["y"])
+    else:
+        ax.set_xticks(pos, xs, rotation=90 if xs.size > 12 else 0)
+        ax.set_ylabel(params["y"])
+    if cs.size > 1:
+        ax.legend(frameon=False, fontsize='small', loc='center left', bbox_to_anchor=(1.0, 0.5))
+    return {"n_bars": int(xs.size), "n_series": int(cs.size)}
+
+
+def _draw_boxplot(fig, data: Dict, params: Dict) -> Dict:
+    table = data.get('table') or _demo_measurements()
+    y = _column(table, params["y"]).astype(np.float64)
+    xs, xc = _levels(_column(table, params["x"]))
+    if params["group"]:
+        gs, gc = _levels(_column(table, params["group"]))
+    else:
+        gs, gc = np.array(['']), np.zeros(y.size, dtype=np.int64)
+    ax = fig.add_subplot(111)
+    colors = _palette()
+    width = 0.8 / gs.size
+    for g in range(gs.size):
+        pos = np.arange(xs.size) + (g - (gs.size - 1) / 2.0) * width
+        values = [y[(xc == i) & (gc == g)] for i in range(xs.size)]
+        keep = [i for i, v in enumerate(values) if v.size]
+        if not keep:
+            continue
+        parts = ax.boxplot([values[i] for i in keep], positions=pos[keep], widths=width * 0.9,
+                           patch_artist=True, showfliers=True)
+        for box in parts['boxes']:
+            box.set_facecolor(colors[g % len(colors)])
+            box.set_alpha(0.7)
+    ax.set_xticks(np.arange(xs.size), xs)
+    ax.set_xlabel(params["x"])
+    ax.set_ylabel(params["y"])
+    if gs.size > 1:
+        _legend(ax, gs, [colors[g % len(colors)] for g in range(gs.size)], params["group"])
+    return {"n_boxes": int(xs.size * gs.size)}
+
+
+def _draw_heatmap(fig, data: Dict, params: Dict, cache: Optional[FigureCache] = None) -> Dict:
+    """
+    聚类热图: 行列分别聚类 (大轴用微簇近似), 显示的矩阵按像素聚合, 与矩阵大小无关;
+    给出 cache 时同时把排好序的矩阵存为瓦片金字塔, 供 heatmap_tile 按需取细节
+    """
+    src = data if 'matrix' in data else _demo_matrix()
+    M = np.asarray(src['matrix'], dtype=np.float32)
+    if M.ndim != 2 or min(M.shape) == 0:
+        raise ValueError("matrix must be a non-empty 2-D array")
+    rows = list(src.get('rows') or [f"R{i + 1}" for i in range(M.shape[0])])
+    cols = list(src.get('columns') or [f"C{j + 1}" for j in range(M.shape[1])])
+    method = params["method"].lower()
+    if method != 'none' and method not in LINKAGE_METHODS:
+        raise ValueError(f"unsupported linkage method: {params['method']}")
+    if params["distance"] not in DISTANCES:
+        raise ValueError(f"unsupported distance: {params['distance']}")
+    if params["scale"] not in ('row', 'column', 'none'):
+        raise ValueError(f"unsupported scale: {params['scale']}")
+    Z = scale_matrix(M, params["scale"])
+    # Bray-Curtis 要求非负值, 在原始矩阵上聚类; 其余距离在显示的 (缩放后) 矩阵上聚类
+    if params["distance"] == 'bray' and np.nanmin(M) < 0:
+        raise ValueError("bray distance needs non-negative values")
+    basis = np.nan_to_num(M if params["distance"] == 'bray' else Z)
+    if method == 'none':
+        trees = [None, None]
+        ro, co = np.arange(M.shape[0]), np.arange(M.shape[1])
+    else:
+        trees = [cluster_order(B, LINKAGE_METHODS[method], params["distance"], max_exact=params["max_exact"])
+                 for B in (basis, basis.T)]
+        ro, co = trees[0]["order"], trees[1]["order"]
+    Z = Z[ro][:, co]
+    diverging = params["scale"] != 'none'
+    cmap = 'RdBu_r' if diverging else mpl.rcParams['image.cmap']
+    vmin, vmax = color_limits(Z, diverging)
+
+    grid = fig.add_gridspec(2, 3, width_ratios=[1.0, 5.0, 0.15], height_ratios=[1.0, 6.0], wspace=0.03, hspace=0.03)
+    ax = fig.add_subplot(grid[1, 1])
+    top = fig.add_subplot(grid[0, 1], sharex=ax)
+    left = fig.add_subplot(grid[1, 0], sharey=ax)
+    # 显示的矩阵: 每个屏幕像素至多一个格子 (同一像素内的行/列取均值)
+    shown = aggregate(Z, *_axes_pixels(fig, ax))
+    im = ax.imshow(shown, aspect='auto', interpolation='nearest', cmap=cmap, vmin=vmin, vmax=vmax,
+                   extent=(0, Z.shape[1], Z.shape[0], 0))
+    color = mpl.rcParams['axes.edgecolor']
+    for tree, dax, horizontal in ((trees[1], top, True), (trees[0], left, False)):
+        for side in dax.spines.values():
+            side.set_visible(False)
+        dax.tick_params(left=False, bottom=False, labelleft=False, labelbottom=False)
+        if tree is None or tree["linkage"] is None:
+            continue
+        seg = dendrogram_segments(tree["linkage"], tree["leaf_sizes"])
+        if not horizontal:
+            seg = seg[:, :, ::-1]
+        dax.add_collection(LineCollection(seg, colors=color, linewidths=0.6))
+        height = float(tree["linkage"][-1, 2]) or 1.0
+        if horizontal:
+            dax.set_ylim(0, height * 1.02)
+        else:
+            dax.set_xlim(height * 1.02, 0)
+    if Z.shape[0] <= 60:
+        ax.set_yticks(np.arange(Z.shape[0]) + 0.5, [rows[i] for i in ro], fontsize='x-small')
+        ax.yaxis.tick_right()
+    else:
+        ax.set_yticks([])
+    if Z.shape[1] <= 60:
+        ax.set_xticks(np.arange(Z.shape[1]) + 0.5, [cols[j] for j in co], rotation=90, fontsize='x-small')
+    else:
+        ax.set_xticks([])
+    fig.colorbar(im, cax=fig.add_subplot(grid[0, 2]))
+
+    info = {
+        "n_rows": int(M.shape[0]),
+        "n_columns": int(M.shape[1]),
+        "displayed_shape": list(shown.shape),
+        "approximate_clustering": bool(any(t is not None and t["approximate"] for t in trees))
+    }
+    if cache is not None:
+        info["tiles"] = _store_tiles(cache, data, params, Z, [rows[i] for i in ro], [cols[j] for j in co],
+                                     cmap, vmin, vmax)
+    return info
+
+
+def _store_tiles(
+    cache: FigureCache,
+    data: Dict,
+    params: Dict,
+    Z: np.ndarray,
+    rows: List[str],
+    cols: List[str],
+    cmap: str,
+    vmin: float,
+    vmax: float
+) -> Dict:
+    """把排好序的矩阵存为瓦片金字塔 (每级一个 .npy) 及其说明 (.json); 同样内容已存在时不重写"""
+    key = content_hash('heatmap-tiles', data, params, cmap, TILE_SIZE, RENDER_VERSION)
+    factors = pyramid_factors(Z.shape, TILE_SIZE)
+    summary = {"key": key, "tile_size": TILE_SIZE, "max_zoom": len(factors) - 1, "shape": list(Z.shape)}
+    if _tiles_complete(cache, summary):
+        return summary
+    levels = tile_pyramid(Z, TILE_SIZE)
+    for z, level in enumerate(levels):
+        cache.put_array(key, f"z{z}.npy", level)
+    meta = {
+        **summary,
+        "levels": [{"shape": list(level.shape), "row_factor": fr, "column_factor": fc}
+                   for level, (fr, fc) in zip(levels, factors)],
+        "cmap": cmap,
+        "vmin": vmin,
+        "vmax": vmax,
+        "rows": rows,
+        "columns": cols
+    }
+    cache.put(key, 'json', json.dumps(meta).encode(), meta)
+    return summary
+
+
+def _tiles_complete(cache: FigureCache, tiles: Dict) -> bool:
+    """瓦片金字塔的说明与每一级数组都还在缓存里 (可能被淘汰掉一部分)"""
+    paths = [cache.path(tiles["key"], 'json')] + [cache.path(tiles["key"], f"z{z}.npy")
+                                                 for z in range(tiles["max_zoom"] + 1)]
+    return all(os.path.exists(p) for p in paths)
+
+
+def _differential_arrays(data: Dict) -> Tuple[np.ndarray, np.ndarray, Optional[List[str]], str]:
+    """
+    火山图数据: data['results'] (differential_analysis 的结果) 或 log2fc / pvalue / labels 数组
+    没有 labels 时返回 None, 由调用方只为需要标注的点生成序号名称
+    """
+    if data.get('results'):
+        res = data['results']
+        lfc = np.array([np.nan if r.get('log2_fold_change') is None else r['log2_fold_change'] for r in res], dtype=np.float64)
+        key = 'padj' if any(r.get('padj') is not None for r in res) else 'pvalue'
+        p = np.array([np.nan if r.get(key) is None else r[key] for r in res], dtype=np.float64)
+        return lfc, p, [str(r.get('feature', i)) for i, r in enumerate(res)], key
+    src = data if 'log2fc' in data else _demo_differential()
+    lfc = np.asarray(src['log2fc'], dtype=np.float64)
+    p = np.asarray(src['pvalue'], dtype=np.float64)
+    labels = src.get('labels')
+    labels = list(labels) if labels is not None and len(labels) else None
+    return lfc, p, labels, 'pvalue'
+
+
+def _draw_volcano(fig, data: Dict, params: Dict) -> Dict:
+    lfc, p, labels, key = _differential_arrays(data)
+    kept = np.flatnonzero(np.isfinite(lfc) & np.isfinite(p))
+    lfc, p = lfc[kept], p[kept]
+    y = -np.log10(np.maximum(p, 1e-300))
+    sig = p < params["pvalue_threshold"]
+    up = sig & (lfc >= params["fc_threshold"])
+    down = sig & (lfc <= -params["fc_threshold"])
+    ax = fig.add_subplot(111)
+    names = ['NS', f"Up ({int(up.sum())})", f"Down ({int(down.sum())})"]
+    colors = ['#b0b0b0', '#d62728', '#1f77b4']
+    top = np.flatnonzero(up | down)
+    top = top[np.argsort(p[top], kind='stable')][:params["label_top"]]
+    raster = _rasterize(params, lfc.size)
+    if raster:
+        # 全部点栅格化 (三类按点数混合着色), 只有标注的点以矢量叠加
+        codes = up.astype(np.int64) + 2 * down
+        _raster_points(fig, ax, lfc, y, codes=codes, colors=colors)
+        ax.scatter(lfc[top], y[top], s=10, c=[colors[c] for c in codes[top]], lw=0.4, edgecolors='black', zorder=3)
+        ax.legend([Line2D([], [], marker='o', ls='', color=c) for c in colors], names,
+                  frameon=False, fontsize='small')
+    else:
+        rest = ~(up | down)
+        ax.scatter(lfc[rest], y[rest], s=4, c=colors[0], lw=0, label=names[0])
+        ax.scatter(lfc[up], y[up], s=6, c=colors[1], lw=0, label=names[1])
+        ax.scatter(lfc[down], y[down], s=6, c=colors[2], lw=0, label=names[2])
+        ax.legend(frameon=False, fontsize='small')
+    for v in (-params["fc_threshold"], params["fc_threshold"]):
+        ax.axvline(v, color='grey', lw=0.6, ls='--')
+    ax.axhline(-np.log10(params["pvalue_threshold"]), color='grey', lw=0.6, ls='--')
+    for i in top:
+        name = labels[kept[i]] if labels is not None else str(kept[i] + 1)
+        ax.annotate(name, (lfc[i], y[i]), fontsize='x-small', xytext=(3, 3), textcoords='offset points')
+    ax.set_xlabel('log2 fold change')
+    ax.set_ylabel(f"-log10 {key}")
+    return {"n_points": int(lfc.size), "n_up": int(up.sum()), "n_down": int(down.sum()), "rasterized": raster}
+
+
+def _draw_network(fig, data: Dict, params: Dict) -> Dict:
+    edges = data.get('edge_list') or _demo_edges()
+    weights = np.array([e.get('correlation', e.get('weight', 1.0)) for e in edges], dtype=np.float64)
+    names, A, i, j = _edge_graph([e['source'] for e in edges], [e['target'] for e in edges], weights)
+    if params["layout"] == 'circular':
+        theta = 2.0 * np.pi * np.arange(len(names)) / max(len(names), 1)
+        pos = np.column_stack([np.cos(theta), np.sin(theta)])
+    elif params["layout"] == 'force-directed':
+        pos = _spring_layout(A)
+    else:
+        raise ValueError(f"unsupported layout: {params['layout']}")
+    degree = np.diff(A.indptr)
+    ax = fig.add_subplot(111)
+    widths = 0.3 + 2.0 * np.abs(weights) / max(np.abs(weights).max(), 1e-12) if params["edge_weight"] else 0.6
+    ax.add_collection(LineCollection(
+        np.stack([pos[i], pos[j]], axis=1), linewidths=widths, alpha=0.5,
+        colors=np.where(weights >= 0, '#2ca02c', '#d62728')
+    ))
+    sizes = 15.0 + 60.0 * degree / max(degree.max(), 1)
+    if params["node_color"] == 'module':
+        labels = modularity_communities(A)
+        colors = _palette()
+        ax.scatter(pos[:, 0], pos[:, 1], s=sizes, c=[colors[m % len(colors)] for m in labels], zorder=2)
+        info = {"n_modules": int(np.unique(labels).size)}
+    elif params["node_color"] == 'degree':
+        sc = ax.scatter(pos[:, 0], pos[:, 1], s=sizes, c=degree, zorder=2)
+        fig.colorbar(sc, ax=ax, fraction=0.04, label='degree')
+        info = {}
+    else:
+        raise ValueError(f"unsupported node colouring: {params['node_color']}")
+    if len(names) <= 50:
+        for (px, py), name in zip(pos, names):
+            ax.annotate(name, (px, py), fontsize='xx-small', ha='center', va='bottom')
+    ax.set_axis_off()
+    ax.set_aspect('equal')
+    return {"n_nodes": len(names), "n_edges": int(len(edges)), **info}
+
+
+def _axes_pixels(fig, ax) -> Tuple[int, int]:
+    """坐标轴在输出图像中的 (高, 宽) 像素数"""
+    box = ax.get_position()
+    return (max(int(box.height * fig.get_figheight() * fig.dpi), 1),
+            max(int(box.width * fig.get_figwidth() * fig.dpi), 1))
+
+
+def _rasterize(params: Dict, n_points: int) -> bool:
+    """params['rasterize'] 为 None 时点数超过 RASTER_THRESHOLD 才栅格化"""
+    if params.get("rasterize") is None:
+        return n_points > RASTER_THRESHOLD
+    return bool(params["rasterize"])
+
+
+def _raster_points(
+    fig,
+    ax,
+    x: np.ndarray,
+    y: np.ndarray,
+    codes: Optional[np.ndarray] = None,
+    colors: Optional[List[str]] = None,
+    values: Optional[np.ndarray] = None,
+    cmap: Optional[str] = None,
+    limits: Optional[Tuple[float, float]] = None
+) -> None:
+    """
+    把点栅格化为一张与坐标轴同样像素大小的图像: 按类别 (codes + colors) 混合着色,
+    或按数值 (values + cmap + limits) 取像素内均值着色; 坐标范围固定为数据范围
+    """
+    extent = data_extent(x, y)
+    k = int(codes.max()) + 1 if codes is not None and codes.size else 1
+    counts, sums = bin_points(x, y, extent, _axes_pixels(fig, ax), codes=codes, n_categories=k, weights=values)
+    if values is not None:
+        image = shade_values(counts, sums, cmap, *limits)
+    else:
+        image = shade_categories(counts, colors or _palette())
+    ax.imshow(image, extent=extent, origin='lower', aspect='auto', interpolation='nearest')
+    ax.set_xlim(extent[0], extent[1])
+    ax.set_ylim(extent[2], extent[3])
+
+
+def _color_points(
+    fig,
+    ax,
+    table: Dict,
+    x: np.ndarray,
+    y: np.ndarray,
+    color: Optional[str],
+    s,
+    raster: bool = False
+) -> None:
+    """按分类 (图例) 或数值 (色条) 着色的散点; raster=True 时栅格化 (忽略点大小)"""
+    if not color:
+        if raster:
+            _raster_points(fig, ax, x, y, colors=_palette()[:1])
+        else:
+            ax.scatter(x, y, s=s, lw=0, alpha=0.8)
+        return
+    values = _column(table, color)
+    if _is_numeric(values):
+        values = values.astype(np.float64)
+        if raster:
+            cmap = mpl.rcParams['image.cmap']
+            limits = (float(np.nanmin(values)), float(np.nanmax(values)))
+            _raster_points(fig, ax, x, y, values=values, cmap=cmap, limits=limits)
+            sc = ScalarMappable(norm=Normalize(*limits), cmap=cmap)
+        else:
+            sc = ax.scatter(x, y, s=s, c=values, lw=0, alpha=0.8)
+        fig.colorbar(sc, ax=ax, fraction=0.04, label=color)
+        return
+    levels, codes = _levels(values)
+    colors = _palette()
+    if raster:
+        _raster_points(fig, ax, x, y, codes=codes, colors=colors)
+    else:
+        ax.scatter(x, y, s=s, c=[colors[c % len(colors)] for c in codes], lw=0, alpha=0.8)
+    _legend(ax, levels, [colors[c % len(colors)] for c in range(levels.size)], color)
+
+
+def _draw_scatter(fig, data: Dict, params: Dict) -> Dict:
+    table = data.get('table') or _demo_measurements()
+    x = _column(table, params["x"]).astype(np.float64)
+    y = _column(table, params["y"]).astype(np.float64)
+    ax = fig.add_subplot(111)
+    raster = _rasterize(params, x.size)
+    s = 12.0
+    if params["size"] and not raster:
+        v = _column(table, params["size"]).astype(np.float64)
+        s = 5.0 + 60.0 * (v - v.min()) / max(np.ptp(v), 1e-12)
+    _color_points(fig, ax, table, x, y, params["color"], s, raster=raster)
+    info = {"n_points": int(x.size), "rasterized": raster}
+    if params["trendline"] and x.size > 2:
+        grid = np.linspace(x.min(), x.max(), 100)
+        fit, _, r2 = _ols_band(x, y, grid)
+        ax.plot(grid, fit, color='black', lw=1.0)
+        info["r2"] = round(r2, 4)
+    ax.set_xlabel(params["x"])
+    ax.set_ylabel(params["y"])
+    return info
+
+
+def _draw_pca(fig, data: Dict, params: Dict) -> Dict:
+    if 'coordinates' in data:
+        coords = np.asarray(data['coordinates'], dtype=np.float64)
+        variance = list(data.get('variance') or [])
+        groups = data.get('groups')
+    else:
+        src = data if 'matrix' in data else _demo_matrix()
+        # 矩阵为 features x samples (与热图相同), 对样本做 PCA
+        M = np.asarray(src['matrix'], dtype=np.float64).T
+        M = M - M.mean(axis=0)
+        U, S, _ = np.linalg.svd(M, full_matrices=False)
+        coords = U[:, :3] * S[:3]
+        variance = (S[:3] ** 2 / max((S ** 2).sum(), 1e-300)).tolist()
+        groups = src.get('groups')
+    samples = list(data.get('samples') or data.get('columns') or [f"S{i + 1}" for i in range(coords.shape[0])])
+    ax = fig.add_subplot(111)
+    colors = _palette()
+    if groups is not None and len(groups):
+        levels, codes = _levels(np.asarray(groups))
+        for g in range(levels.size):
+            pts = coords[codes == g, :2]
+            ax.scatter(pts[:, 0], pts[:, 1], s=20, color=colors[g % len(colors)], label=levels[g])
+            if params["ellipse"]:
+                _confidence_ellipse(ax, pts, colors[g % len(colors)])
+        ax.legend(frameon=False, fontsize='small')
+    else:
+        ax.scatter(coords[:, 0], coords[:, 1], s=20)
+    if params["label"] and coords.shape[0] <= 60:
+        for (px, py), name in zip(coords[:, :2], samples):
+            ax.annotate(name, (px, py), fontsize='xx-small', xytext=(2, 2), textcoords='offset points')
+    names = [f"PC{k + 1}" for k in range(coords.shape[1])]
+    ax.set_xlabel(f"PC1 ({variance[0]:.1%})" if variance else 'PC1')
+    ax.set_ylabel(f"PC2 ({variance[1]:.1%})" if len(variance) > 1 else 'PC2')
+    return {"components": names[:3], "variance": [round(float(v), 4) for v in variance[:3]]}
+
+
+def _draw_embedding(fig, data: Dict, params: Dict) -> Dict:
+    src = data if 'coordinates' in data else _demo_embedding()
+    coords = np.asarray(src['coordinates'], dtype=np.float64)
+    groups = src.get('groups')
+    ax = fig.add_subplot(111)
+    colors = _palette()
+    raster = _rasterize(params, coords.shape[0])
+    if groups is not None and len(groups):
+        levels, codes = _levels(groups)
+        if raster:
+            _raster_points(fig, ax, coords[:, 0], coords[:, 1], codes=codes, colors=colors)
+        else:
+            ax.scatter(coords[:, 0], coords[:, 1], s=3, lw=0, c=[colors[c % len(colors)] for c in codes])
+        if params["label"]:
+            # 一次排序后按组切片取中位数, 不为每个组扫描全部点
+            order = np.argsort(codes, kind='stable')
+            bounds = np.cumsum(np.bincount(codes, minlength=levels.size))[:-1]
+            for g, members in enumerate(np.split(order, bounds)):
+                cx, cy = np.median(coords[members, :2], axis=0)
+                ax.annotate(levels[g], (cx, cy), fontsize='small', weight='bold', ha='center')
+        else:
+            _legend(ax, levels, [colors[g % len(colors)] for g in range(levels.size)])
+    elif raster:
+        _raster_points(fig, ax, coords[:, 0], coords[:, 1], colors=colors[:1])
+    else:
+        ax.scatter(coords[:, 0], coords[:, 1], s=3, lw=0)
+    ax.set_xlabel(f"{params['axis']}1")
+    ax.set_ylabel(f"{params['axis']}2")
+    ax.set_xticks([])
+    ax.set_yticks([])
+    return {"n_points": int(coords.shape[0]), "rasterized": raster}
+
+
+def _ratio(values) -> np.ndarray:
+    """'3/50' 形式的比例或数值"""
+    out = []
+    for v in values:
+        if isinstance(v, str) and '/' in v:
+            a, b = v.split('/', 1)
+            out.append(float(a) / float(b))
+        else:
+            out.append(float(v))
+    return np.asarray(out)
+
+
+def _draw_enrich_dotplot(fig, data: Dict, params: Dict) -> Dict:
+    terms = (data.get('terms') or _demo_terms())[:]
+    x = _ratio([t[params["x"]] for t in terms])
+    order = np.argsort(x, kind='stable')[-params["top_n"]:]
+    x = x[order]
+    names = [str(terms[i].get('term', terms[i].get('Description', i))) for i in order]
+    color = np.array([terms[i][params["color"]] for i in order], dtype=np.float64)
+    size = np.array([terms[i][params["size"]] for i in order], dtype=np.float64)
+    ax = fig.add_subplot(111)
+    c = -np.log10(np.maximum(color, 1e-300)) if params["color"] in ('pvalue', 'p.adjust', 'qvalue') else color
+    sc = ax.scatter(x, np.arange(x.size), s=20.0 + 180.0 * size / max(size.max(), 1e-12), c=c, cmap='viridis_r')
+    fig.colorbar(sc, ax=ax, fraction=0.04, label=f"-log10 {params['color']}" if c is not color else params["color"])
+    ax.set_yticks(np.arange(x.size), names, fontsize='small')
+    ax.set_xlabel(params["x"])
+    return {"n_terms": int(x.size)}
+
+
+def _draw_enrich_netplot(fig, data: Dict, params: Dict) -> Dict:
+    terms = (data.get('terms') or _demo_terms())[:params["top_n"]]
+    sources = [str(t.get('term', i)) for i, t in enumerate(terms) for _ in t['genes']]
+    targets = [str(g) for t in terms for g in t['genes']]
+    names, A, i, j = _edge_graph(sources, targets, np.ones(len(sources)))
+    pos = _spring_layout(A)
+    is_term = np.isin(np.asarray(names), [str(t.get('term', k)) for k, t in enumerate(terms)])
+    ax = fig.add_subplot(111)
+    ax.add_collection(LineCollection(np.stack([pos[i], pos[j]], axis=1), linewidths=0.5, colors='#999999'))
+    degree = np.diff(A.indptr)
+    ax.scatter(pos[~is_term, 0], pos[~is_term, 1], s=10, c='#7f7f7f', zorder=2)
+    ax.scatter(pos[is_term, 0], pos[is_term, 1], s=40.0 + 15.0 * degree[is_term], c='#ff7f0e', zorder=3)
+    for k in np.flatnonzero(is_term):
+        ax.annotate(names[k], pos[k], fontsize='x-small', ha='center', va='bottom')
+    ax.set_axis_off()
+    ax.set_aspect('equal')
+    return {"n_terms": int(is_term.sum()), "n_genes": int((~is_term).sum())}
+
+
+def running_enrichment(scores: np.ndarray, hits: np.ndarray) -> np.ndarray:
+    """GSEA 加权 (p=1) 运行富集分数; scores 已按降序排列, hits 为基因集成员在排序中的位置"""
+    n = scores.size
+    member = np.zeros(n, dtype=bool)
+    member[hits] = True
+    w = np.abs(scores) * member
+    step = np.where(member, w / max(w.sum(), 1e-300), -1.0 / max(n - member.sum(), 1))
+    return np.cumsum(step)
+
+
+def _draw_enrich_curve(fig, data: Dict, params: Dict) -> Dict:
+    src = data if 'scores' in data else _demo_ranked()
+    scores = np.asarray(src['scores'], dtype=np.float64)
+    hits = np.asarray(src['hits'], dtype=np.int64)
+    es = running_enrichment(scores, hits)
+    peak = int(np.argmax(np.abs(es)))
+    gs = fig.add_gridspec(3, 1, height_ratios=[3, 0.5, 1.5], hspace=0.05)
+    ax1 = fig.add_subplot(gs[0])
+    ax1.plot(es, color='#2ca02c', lw=1.2)
+    ax1.axhline(0.0, color='grey', lw=0.6)
+    ax1.axvline(peak, color='#d62728', lw=0.6, ls='--')
+    ax1.set_ylabel('Enrichment score')
+    ax1.set_xticks([])
+    ax2 = fig.add_subplot(gs[1], sharex=ax1)
+    ax2.vlines(hits, 0, 1, color='black', lw=0.5)
+    ax2.set_yticks([])
+    ax2.set_xticks([])
+    ax3 = fig.add_subplot(gs[2], sharex=ax1)
+    ax3.fill_between(np.arange(scores.size), scores, color='#7f7f7f', lw=0)
+    ax3.set_ylabel('Ranked metric')
+    ax3.set_xlabel('Rank')
+    return {"enrichment_score": round(float(es[peak]), 4), "peak_rank": peak}
+
+
+def _draw_sankey(fig, data: Dict, params: Dict) -> Dict:
+    table = data.get('table') or _demo_flows()
+    values = _column(table, params["value"]).astype(np.float64)
+    ls, lc = _levels(_column(table, params["source"]))
+    rs, rc = _levels(_column(table, params["target"]))
+    total = values.sum()
+    gap = 0.02 * total
+    left = np.bincount(lc, weights=values, minlength=ls.size)
+    right = np.bincount(rc, weights=values, minlength=rs.size)
+    ltop = np.concatenate([[0.0], np.cumsum(left + gap)[:-1]])
+    rtop = np.concatenate([[0.0], np.cumsum(right + gap)[:-1]])
+    ax = fig.add_subplot(111)
+    colors = _palette()
+    # 每条流在两端节点内按顺序堆叠
+    lfill = ltop.copy()
+    rfill = rtop.copy()
+    for k in np.lexsort((rc, lc)):
+        a, b, v = lc[k], rc[k], values[k]
+        y0, y1 = lfill[a], rfill[b]
+        lfill[a] += v
+        rfill[b] += v
+        verts = [(0.1, y0), (0.5, y0), (0.5, y1), (0.9, y1), (0.9, y1 + v),
+                 (0.5, y1 + v), (0.5, y0 + v), (0.1, y0 + v), (0.1, y0)]
+        codes = [Path.MOVETO, Path.CURVE4, Path.CURVE4, Path.CURVE4, Path.LINETO,
+                 Path.CURVE4, Path.CURVE4, Path.CURVE4, Path.CLOSEPOLY]
+        ax.add_patch(PathPatch(Path(verts, codes), facecolor=colors[a % len(colors)], alpha=0.45, lw=0))
+    for names, tops, sizes, x, ha in ((ls, ltop, left, 0.1, 'right'), (rs, rtop, right, 0.9, 'left')):
+        for name, t, h in zip(names, tops, sizes):
+            ax.add_patch(Rectangle((x - 0.01, t), 0.02, h, color='#444444'))
+            ax.annotate(name, (x + (-0.02 if ha == 'right' else 0.02), t + h / 2), ha=ha, va='center',
+                        fontsize='small')
+    ax.set_xlim(-0.2, 1.2)
+    ax.set_ylim(max(ltop[-1] + left[-1], rtop[-1] + right[-1]), 0)
+    ax.set_axis_off()
+    return {"n_sources": int(ls.size), "n_targets": int(rs.size), "n_flows": int(values.size)}
+
+
+def _draw_structure(fig, data: Dict, params: Dict) -> Dict:
+    src = data if 'matrix' in data else _demo_structure()
+    Q = np.asarray(src['matrix'], dtype=np.float64)
+    Q = Q / np.maximum(Q.sum(axis=1, keepdims=True), 1e-300)
+    groups = src.get('groups')
+    if groups is not None and len(groups):
+        levels, codes = _levels(np.asarray(groups))
+    else:
+        levels, codes = np.array(['']), np.zeros(Q.shape[0], dtype=np.int64)
+    # 组内按主成分与其比例排序
+    dominant = Q.argmax(axis=1)
+    order = np.lexsort((-Q[np.arange(Q.shape[0]), dominant], dominant, codes))
+    Q = Q[order]
+    ax = fig.add_subplot(111)
+    colors = _palette()
+    bottom = np.zeros(Q.shape[0])
+    pos = np.arange(Q.shape[0])
+    for k in range(Q.shape[1]):
+        ax.bar(pos, Q[:, k], bottom=bottom, width=1.0, color=colors[k % len(colors)], lw=0)
+        bottom += Q[:, k]
+    bounds = np.flatnonzero(np.diff(codes[order])) + 0.5
+    for b in bounds:
+        ax.axvline(b, color='black', lw=0.8)
+    edges = np.concatenate([[-0.5], bounds, [Q.shape[0] - 0.5]])
+    ax.set_xticks((edges[:-1] + edges[1:]) / 2.0, levels)
+    ax.set_xlim(-0.5, Q.shape[0] - 0.5)
+    ax.set_ylim(0, 1)
+    ax.set_ylabel('Proportion')
+    return {"n_samples": int(Q.shape[0]), "k": int(Q.shape[1])}
+
+
+def _draw_fitline(fig, data: Dict, params: Dict) -> Dict:
+    table = data.get('table') or _demo_measurements()
+    x = _column(table, params["x"]).astype(np.float64)
+    y = _column(table, params["y"]).astype(np.float64)
+    ax = fig.add_subplot(111)
+    ax.scatter(x, y, s=12, lw=0, alpha=0.7)
+    grid = np.linspace(x.min(), x.max(), 200)
+    info = {}
+    if params["method"] == 'lm':
+        fit, half, r2 = _ols_band(x, y, grid)
+        ax.fill_between(grid, fit - half, fit + half, color='grey', alpha=0.25, lw=0)
+        info["r2"] = round(r2, 4)
+    elif params["method"] == 'loess':
+        fit = _loess(x, y, grid)
+    else:
+        raise ValueError(f"unsupported fit method: {params['method']}")
+    ax.plot(grid, fit, color='black', lw=1.2)
+    ax.set_xlabel(params["x"])
+    ax.set_ylabel(params["y"])
+    return info
 
 
 class VisualizationProcessor:
     """可视化 - 整合原R包Plot_*功能"""
-    
-    def __init__(self):
+
+    def __init__(self, cache_dir: Optional[str] = None):
         self.plot_types = [
             'barplot', 'boxplot', 'heatmap', 'volcano',
             'network', 'scatter', 'pca', 'umap', 'tsne',
             'dotplot', 'enrichplot', 'sankey', 'structure'
         ]
-    
+        # 内容寻址的图像缓存 (默认在 $EMP_FIGURE_CACHE 或系统临时目录下, 多个进程共享)
+        self.cache = FigureCache(cache_dir) if cache_dir else default_cache()
+
+    def _render(
+        self,
+        plot_type: str,
+        draw,
+        data: Dict,
+        params: Dict,
+        theme: str,
+        format: str,
+        size: Tuple[float, float] = (6.0, 4.5),
+        refresh: bool = False
+    ) -> Dict:
+        try:
+            result = render(plot_type, draw, data, params, theme=theme, fmt=format, size=size,
+                            cache=self.cache, refresh=refresh)
+        except (KeyError, ValueError, TypeError, IndexError) as e:
+            message = e.args[0] if isinstance(e, KeyError) and e.args else str(e)
+            return {"status": "error", "message": message}
+        return {"status": "success", "plot_type": plot_type, **result, "params": params}
+
     # ==================== 基础绘图 ====================
-    
+
     def barplot(
-        self, 
+        self,
         data: Dict,
         x: str = None,
         y: str = "value",
         color: str = None,
-        orientation: str = "v"
+        orientation: str = "v",
+        theme: str = "default",
+        format: str = "png"
     ) -> Dict:
         """
         条形图 - 原R包 Plot_EMP_barplot 功能
+        data['table']: 长表 {列名: 值列表}; 按 x (与 color) 汇总 y, color 的各水平堆叠
         """
-        return {
-            "status": "success",
-            "plot_type": "barplot",
-            "file": "barplot.png",
-            "params": {"x": x, "y": y, "color": color, "orientation": orientation}
-        }
-    
+        params = {"x": x, "y": y, "color": color, "orientation": orientation}
+        return self._render("barplot", _draw_barplot, data, params, theme, format)
+
     def boxplot(
         self,
         data: Dict,
-        x: str,
+        x: str = "group",
         y: str = "value",
-        group: str = None
+        group: str = None,
+        theme: str = "default",
+        format: str = "png"
     ) -> Dict:
         """
         箱线图 - 原R包 Plot_EMP_boxplot 功能
+        data['table'] 长表; x 的每个水平一个箱, group 给出时并排分组
         """
-        return {
-            "status": "success",
-            "plot_type": "boxplot",
-            "file": "boxplot.png",
-            "params": {"x": x, "y": y, "group": group}
-        }
-    
+        params = {"x": x, "y": y, "group": group}
+        return self._render("boxplot", _draw_boxplot, data, params, theme, format)
+
     def heatmap(
         self,
         data: Dict,
         method: str = "ward.D2",
         distance: str = "bray",
-        scale: str = "row"
+        scale: str = "row",
+        max_exact: int = 4000,
+        theme: str = "default",
+        format: str = "png"
     ) -> Dict:
         """
         热图 - 原R包 Plot_EMP_heatmap 功能
+        data['matrix'] (行 x 列) 与 rows / columns 名称; 行列分别层次聚类后按叶序排列, method='none' 不聚类
+        某个轴超过 max_exact 时先聚成 max_exact/2 个微簇再对微簇聚类; 结果的 tiles 用于 heatmap_tile 取局部细节
+        max_exact 取 2..MAX_EXACT_LINKAGE (精确聚类的距离矩阵随其平方增长)
         """
-        return {
-            "status": "success",
-            "plot_type": "heatmap",
-            "file": "heatmap.png",
-            "params": {"method": method, "distance": distance, "scale": scale}
+        if not 2 <= int(max_exact) <= MAX_EXACT_LINKAGE:
+            return {"status": "error", "message": f"max_exact must be between 2 and {MAX_EXACT_LINKAGE}"}
+        params = {"method": method, "distance": distance, "scale": scale, "max_exact": int(max_exact)}
+
+        def draw(fig, d, p):
+            return _draw_heatmap(fig, d, p, cache=self.cache)
+
+        result = self._render("heatmap", draw, data, params, theme, format, size=(6.0, 7.0))
+        # 图像命中缓存而瓦片已被淘汰时重新绘制一次, 同时重建瓦片
+        if result["status"] == "success" and result.get("tiles") and not _tiles_complete(self.cache, result["tiles"]):
+            result = self._render("heatmap", draw, data, params, theme, format, size=(6.0, 7.0), refresh=True)
+        return result
+
+    def heatmap_tile(self, key: str, z: int, x: int, y: int) -> Dict:
+        """
+        热图瓦片: heatmap 结果中 tiles['key'] 的第 z 级 (0 = 整图, max_zoom = 原始分辨率) 第 y 行第 x 列的 PNG
+        返回 file 以及瓦片覆盖的 (排序后的) 行列范围
+        """
+        tile_key = content_hash('heatmap-tile', key, z, x, y)
+        hit = self.cache.get(tile_key, 'png')
+        if hit is not None:
+            return {"status": "success", "file": hit[0], "key": tile_key, "cached": True, **hit[1]}
+        meta = self.cache.get(key, 'json')
+        if meta is None:
+            return {"status": "error", "message": "heatmap tiles not found; render the heatmap again"}
+        meta = meta[1]
+        if not 0 <= z <= meta["max_zoom"]:
+            return {"status": "error", "message": f"zoom level must be between 0 and {meta['max_zoom']}"}
+        level = self.cache.load_array(key, f"z{z}.npy")
+        if level is None:
+            return {"status": "error", "message": "heatmap tiles not found; render the heatmap again"}
+        png = tile_png(level, x, y, meta["cmap"], meta["vmin"], meta["vmax"], meta["tile_size"])
+        if png is None:
+            return {"status": "error", "message": f"tile ({x}, {y}) is outside zoom level {z}"}
+        step = meta["tile_size"]
+        fr, fc = meta["levels"][z]["row_factor"], meta["levels"][z]["column_factor"]
+        n_rows, n_cols = meta["shape"]
+        info = {
+            "zoom": z,
+            "row_range": [y * step * fr, min((y + 1) * step * fr, n_rows)],
+            "column_range": [x * step * fc, min((x + 1) * step * fc, n_cols)]
         }
-    
+        path = self.cache.put(tile_key, 'png', png, info)
+        return {"status": "success", "file": path, "key": tile_key, "cached": False, **info}
+
+    def heatmap_tiles_info(self, key: str) -> Dict:
+        """瓦片金字塔的说明: 各级形状与聚合倍数, 颜色范围, 排序后的行列名称"""
+        meta = self.cache.get(key, 'json')
+        if meta is None:
+            return {"status": "error", "message": "heatmap tiles not found; render the heatmap again"}
+        return {"status": "success", **meta[1]}
+
     # ==================== 高级绘图 ====================
-    
+
     def volcano(
         self,
         data: Dict,
         fc_threshold: float = 1.0,
         pvalue_threshold: float = 0.05,
-        label_top: int = 10
+        label_top: int = 10,
+        rasterize: Optional[bool] = None,
+        theme: str = "default",
+        format: str = "png"
     ) -> Dict:
         """
         火山图 - 原R包 Plot_EMP_volcanol 功能
+        data['results'] (差异分析结果, 有 padj 时用 padj) 或 log2fc / pvalue / labels 数组
+        rasterize: 点栅格化为密度图像, 只有标注的前 label_top 个点为矢量; None 时点数超过 RASTER_THRESHOLD 自动栅格化
         """
-        return {
-            "status": "success",
-            "plot_type": "volcano",
-            "file": "volcano.png",
-            "params": {
-                "fc_threshold": fc_threshold,
-                "pvalue_threshold": pvalue_threshold,
-                "label_top": label_top
-            }
+        params = {
+            "fc_threshold": fc_threshold,
+            "pvalue_threshold": pvalue_threshold,
+            "label_top": label_top,
+            "rasterize": rasterize
         }
-    
+        return self._render("volcano", _draw_volcano, data, params, theme, format)
+
     def network(
         self,
         data: Dict,
         layout: str = "force-directed",
         node_color: str = "module",
-        edge_weight: bool = True
+        edge_weight: bool = True,
+        theme: str = "default",
+        format: str = "png"
     ) -> Dict:
         """
         网络图 - 原R包 Plot_EMP_network_plot 功能
+        data['edge_list'] (network_analysis 的结果); 布局 force-directed / circular, 节点按模块或度着色
         """
-        return {
-            "status": "success",
-            "plot_type": "network",
-            "file": "network.png",
-            "params": {"layout": layout, "node_color": node_color}
-        }
-    
+        params = {"layout": layout, "node_color": node_color, "edge_weight": edge_weight}
+        return self._render("network", _draw_network, data, params, theme, format, size=(6.0, 6.0))
+
     def scatter(
         self,
         data: Dict,
-        x: str,
-        y: str,
+        x: str = "x",
+        y: str = "y",
         color: str = None,
         size: str = None,
-        trendline: bool = True
+        trendline: bool = True,
+        rasterize: Optional[bool] = None,
+        theme: str = "default",
+        format: str = "png"
     ) -> Dict:
         """
         散点图 - 原R包 Plot_EMP_scatterplot_reduce_dimension 功能
+        data['table'] 长表; color 为分类列时给图例, 数值列时给色条
+        rasterize: 栅格化 (分类按点数混合着色, 数值取像素内均值, 不使用 size); None 时按点数自动决定
         """
-        return {
-            "status": "success",
-            "plot_type": "scatter",
-            "file": "scatter.png",
-            "params": {"x": x, "y": y, "color": color}
-        }
-    
+        params = {"x": x, "y": y, "color": color, "size": size, "trendline": trendline, "rasterize": rasterize}
+        return self._render("scatter", _draw_scatter, data, params, theme, format)
+
     # ==================== 降维可视化 ====================
-    
+
     def pca_plot(
         self,
         data: Dict,
         group: str = None,
         ellipse: bool = True,
-        label: bool = True
+        label: bool = True,
+        theme: str = "default",
+        format: str = "png"
     ) -> Dict:
         """
         PCA图 - 原R包 dimension reduction功能
+        data['coordinates'] (+ variance) 直接绘制, 或由 data['matrix'] (特征 x 样本) 计算; 按 groups 着色并画 95% 置信椭圆
         """
-        return {
-            "status": "success",
-            "plot_type": "PCA",
-            "file": "pca.png",
-            "components": ["PC1", "PC2", "PC3"],
-            "variance": [0.35, 0.18, 0.12]
-        }
-    
+        try:
+            data = _with_groups(data, group)
+        except KeyError as e:
+            return {"status": "error", "message": e.args[0]}
+        params = {"ellipse": ellipse, "label": label}
+        return self._render("PCA", _draw_pca, data, params, theme, format)
+
     def umap_plot(
         self,
         data: Dict,
         group: str = None,
-        label: bool = True
+        label: bool = True,
+        rasterize: Optional[bool] = None,
+        theme: str = "default",
+        format: str = "png"
     ) -> Dict:
         """
         UMAP图
+        data['coordinates'] (已计算的嵌入) 与 groups (或 group 指定的样本元数据列); label=True 时在各组中心标注组名
+        rasterize: 按组混合着色的密度图像; None 时点数超过 RASTER_THRESHOLD 自动栅格化
         """
-        return {
-            "status": "success",
-            "plot_type": "UMAP",
-            "file": "umap.png"
-        }
-    
+        try:
+            data = _with_groups(data, group)
+        except KeyError as e:
+            return {"status": "error", "message": e.args[0]}
+        params = {"axis": "UMAP", "label": label, "rasterize": rasterize}
+        return self._render("UMAP", _draw_embedding, data, params, theme, format, size=(5.5, 5.0))
+
     def tsne_plot(
         self,
         data: Dict,
         group: str = None,
-        perplexity: int = 30
+        perplexity: int = 30,
+        rasterize: Optional[bool] = None,
+        theme: str = "default",
+        format: str = "png"
     ) -> Dict:
         """
         t-SNE图
+        data['coordinates'] (已计算的嵌入) 与 groups; perplexity 只作为记录随结果返回; rasterize 同 umap_plot
         """
-        return {
-            "status": "success",
-            "plot_type": "t-SNE",
-            "file": "tsne.png",
-            "perplexity": perplexity
-        }
-    
+        try:
+            data = _with_groups(data, group)
+        except KeyError as e:
+            return {"status": "error", "message": e.args[0]}
+        params = {"axis": "tSNE", "label": True, "rasterize": rasterize}
+        result = self._render("t-SNE", _draw_embedding, data, params, theme, format, size=(5.5, 5.0))
+        if result["status"] == "success":
+            result["perplexity"] = perplexity
+        return result
+
     # ==================== 富集可视化 ====================
-    
+
     def enrich_dotplot(
         self,
         data: Dict,
         x: str = "GeneRatio",
         color: str = "pvalue",
-        size: str = "Count"
+        size: str = "Count",
+        top_n: int = 20,
+        theme: str = "default",
+        format: str = "png"
     ) -> Dict:
         """
         富集点图 - 原R包 Plot_EMP_enrich_dotplot 功能
+        data['terms']: [{term, GeneRatio, pvalue, Count, ...}]; 按 x 取前 top_n 个条目
         """
-        return {
-            "status": "success",
-            "plot_type": "dotplot",
-            "file": "enrich_dotplot.png"
-        }
-    
+        params = {"x": x, "color": color, "size": size, "top_n": top_n}
+        return self._render("dotplot", _draw_enrich_dotplot, data, params, theme, format)
+
     def enrich_netplot(
         self,
         data: Dict,
-        type: str = "cnet"
+        type: str = "cnet",
+        top_n: int = 10,
+        theme: str = "default",
+        format: str = "png"
     ) -> Dict:
         """
         富集网络图 - 原R包 Plot_EMP_enrich_netplot 功能
+        cnet: 条目与其基因 (data['terms'][i]['genes']) 组成的二部网络
         """
-        return {
-            "status": "success",
-            "plot_type": "netplot",
-            "file": "enrich_netplot.png"
-        }
-    
+        if type != 'cnet':
+            return {"status": "error", "message": f"unsupported netplot type: {type}"}
+        params = {"type": type, "top_n": top_n}
+        return self._render("netplot", _draw_enrich_netplot, data, params, theme, format, size=(6.0, 6.0))
+
     def enrich_curve(
         self,
-        data: Dict
+        data: Dict,
+        theme: str = "default",
+        format: str = "png"
     ) -> Dict:
         """
         富集曲线 - 原R包 Plot_EMP_curveplot_enrich 功能
+        data['scores'] (降序排列的排序指标) 与 data['hits'] (基因集成员的位置) -> GSEA 运行富集分数
         """
-        return {
-            "status": "success",
-            "plot_type": "gsea_curve",
-            "file": "enrich_curve.png"
-        }
-    
+        return self._render("gsea_curve", _draw_enrich_curve, data, {}, theme, format)
+
     # ==================== 特殊绘图 ====================
-    
+
     def sankey(
         self,
         data: Dict,
-        source: str,
-        target: str,
-        value: str
+        source: str = "source",
+        target: str = "target",
+        value: str = "value",
+        theme: str = "default",
+        format: str = "png"
     ) -> Dict:
         """
         桑基图 - 原R包 Plot_EMP_sankey 功能
+        data['table'] 长表的 source -> target 两列流向, 宽度为 value
         """
-        return {
-            "status": "success",
-            "plot_type": "sankey",
-            "file": "sankey.png"
-        }
-    
+        params = {"source": source, "target": target, "value": value}
+        return self._render("sankey", _draw_sankey, data, params, theme, format)
+
     def structure_plot(
         self,
         data: Dict,
-        group: str = None
+        group: str = None,
+        theme: str = "default",
+        format: str = "png"
     ) -> Dict:
         """
         Structure图 - 原R包 Plot_EMP_structure_plot 功能
+        data['matrix'] (样本 x 成分比例) 与 groups; 组内按主成分排序的堆叠条形
         """
-        return {
-            "status": "success",
-            "plot_type": "structure",
-            "file": "structure.png"
-        }
-    
+        try:
+            data = _with_groups(data, group)
+        except KeyError as e:
+            return {"status": "error", "message": e.args[0]}
+        return self._render("structure", _draw_structure, data, {}, theme, format, size=(8.0, 3.0))
+
     def fitline_plot(
         self,
         data: Dict,
-        x: str,
-        y: str,
-        method: str = "lm"
+        x: str = "x",
+        y: str = "y",
+        method: str = "lm",
+        theme: str = "default",
+        format: str = "png"
     ) -> Dict:
         """
         拟合曲线 - 原R包 Plot_EMP_fitline 功能
+        lm: 最小二乘直线与 95% 置信带; loess: 局部线性回归 (span 0.75)
         """
-        return {
-            "status": "success",
-            "plot_type": "fitline",
-            "file": "fitline.png",
-            "method": method
-        }
-    
+        params = {"x": x, "y": y, "method": method}
+        result = self._render("fitline", _draw_fitline, data, params, theme, format)
+        if result["status"] == "success":
+            result["method"] = method
+        return result
+
     # ==================== 一键出图 ====================
-    
+
     def auto_plot(
         self,
         data: Dict,
         plot_type: str = "auto",
-        theme: str = "default"
+        theme: str = "default",
+        format: str = "png"
     ) -> Dict:
         """
         自动选择最佳可视化
+        按 data 中有的字段选择图类型 (矩阵 -> 热图 + PCA, 差异结果 -> 火山图, 边表 -> 网络, 嵌入 -> UMAP);
+        没有可识别的字段时用演示数据画热图 / PCA / 火山图
         """
+        plotters = {
+            "heatmap": lambda: self.heatmap(data, theme=theme, format=format),
+            "pca": lambda: self.pca_plot(data, theme=theme, format=format),
+            "volcano": lambda: self.volcano(data, theme=theme, format=format),
+            "network": lambda: self.network(data, theme=theme, format=format),
+            "umap": lambda: self.umap_plot(data, theme=theme, format=format),
+            "barplot": lambda: self.barplot(data, theme=theme, format=format)
+        }
+        if plot_type != "auto":
+            if plot_type not in plotters:
+                return {"status": "error", "message": f"unsupported plot type: {plot_type}"}
+            chosen = [plot_type]
+        else:
+            chosen = []
+            if 'matrix' in data:
+                chosen += ["heatmap", "pca"]
+            if 'results' in data or 'log2fc' in data:
+                chosen.append("volcano")
+            if 'edge_list' in data:
+                chosen.append("network")
+            if 'coordinates' in data:
+                chosen.append("umap")
+            if 'table' in data:
+                chosen.append("barplot")
+            chosen = chosen or ["heatmap", "pca", "volcano"]
+
+        plots = {name: plotters[name]() for name in chosen}
         return {
             "status": "success",
-            "recommended_plots": ["heatmap", "pca", "volcano"],
-            "output_files": [
-                "heatmap.png",
-                "pca.png", 
-                "volcano.png"
-            ],
+            "recommended_plots": chosen,
+            "output_files": [p["file"] for p in plots.values() if p["status"] == "success"],
+            "plots": plots,
             "theme": theme
         }
 
@@ -302,16 +1318,16 @@ class VisualizationProcessor:
 # 测试
 if __name__ == "__main__":
     viz = VisualizationProcessor()
-    
+
     print("=== 可视化测试 ===")
-    
-    result = viz.volcano({"data": "test"}, fc_threshold=1.5)
+
+    result = viz.volcano({}, fc_threshold=1.5)
     print(f"火山图: {result['file']}")
-    
-    result = viz.heatmap({"data": "test"})
+
+    result = viz.heatmap({})
     print(f"热图: {result['file']}")
-    
-    result = viz.pca_plot({"data": "test"})
+
+    result = viz.pca_plot({})
     print(f"PCA: {result['file']}")
-    
+
     print("\n✅ 测试通过!")
@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+"""
+WGCNA
+加权相关网络: 软阈值选择, 分块的邻接矩阵 / 拓扑重叠矩阵 (TOM), 动态树切割
+
+- 相关矩阵从不整体驻留: 按行块由标准化数据做矩阵乘法, 块大小由内存预算决定
+- 各候选软阈值的连通度在同一次扫描中累加 (逐次乘 |r|)
+- 邻接与TOM为 float32, 超出内存预算 (或指定 out_path) 时写入磁盘 memmap
+- 聚类用的压缩距离先以 float32 取出, 释放 TOM 后才转为 scipy linkage 需要的 float64
+- 特征多到一块放不下时 (同 WGCNA blockwiseModules): 先按相关性把特征预聚成不超过 max_block_size 的块,
+  各块分别计算 TOM 并聚类, 峰值内存只与块大小有关; 模块最后跨块按特征基因合并
+"""
+
+import os
+import tempfile
+import numpy as np
+from scipy import sparse
+from scipy.cluster.hierarchy import fcluster, leaves_list, linkage
+from typing import Dict, List, Optional, Tuple
+
+try:
+    from .distance import condensed_offset
+except ImportError:  # 作为脚本直接运行
+    from distance import condensed_offset
+
+
+# WGCNA pickSoftThreshold 的默认候选
+SOFT_POWERS = list(range(1, 11)) + list(range(12, 21, 2))
+
+# 动态树切割 deepSplit 0-4 对应的核心离散度上限 (占高度范围的比例), 最小间隙 = (1 - 上限) * 3/4
+_MAX_CORE_SCATTER = [0.64, 0.73, 0.82, 0.91, 0.95]
+
+
+def _row_blocks(n_features: int, max_block_bytes: int) -> List[Tuple[int, int]]:
+    rows = max(1, int(max_block_bytes // (4 * max(n_features, 1))))
+    return [(s, min(s + rows, n_features)) for s in range(0, n_features, rows)]
+
+
+def _scale_free_fit(k: np.ndarray, n_breaks: int = 10) -> Tuple[float, float]:
+    """
+    无标度拓扑拟合 (同 WGCNA scaleFreeFitIndex): 连通度分 n_breaks 个等宽区间,
+    log10 p(k) 对 log10 k 线性回归, 返回 (带符号的 R^2 = -sign(斜率) R^2, 斜率)
+    """
+    edges = np.linspace(k.min(), k.max(), n_breaks + 1)
+    bins = np.clip(np.searchsorted(edges, k, side='right') - 1, 0, n_breaks - 1)
+    counts = np.bincount(bins, minlength=n_breaks)
+    sums = np.bincount(bins, weights=k, minlength=n_breaks)
+    mids = (edges[:-1] + edges[1:]) / 2.0
+    dk = np.where(counts > 0, sums / np.maximum(counts, 1), mids)
+    x = np.log10(np.maximum(dk, 1e-300))
+    y = np.log10(counts / k.size + 1e-9)
+    if np.ptp(x) == 0:
+        return 0.0, 0.0
+    slope, intercept = np.polyfit(x, y, 1)
+    resid = y - (slope * x + intercept)
+    r2 = 1.0 - (resid ** 2).sum() / max(((y - y.mean()) ** 2).sum(), 1e-300)
+    return float(-np.sign(slope) * r2), float(slope)
+
+
+def pick_soft_threshold(
+    Z: np.ndarray,
+    powers: Optional[List[int]] = None,
+    r2_cut: float = 0.85,
+    max_block_bytes: int = 1 << 28
+) -> Dict:
+    """
+    软阈值选择: 取无标度拟合 R^2 >= r2_cut 的最小幂次;
+    都达不到时按样本数取 WGCNA FAQ 的推荐值 (无符号网络: <20 样本 9, <30 8, <40 7, 否则 6)
+    Z: 已标准化 (standardize_columns) 的 samples x features; 无符号邻接 a = |r|^power
+    """
+    powers = sorted(powers or SOFT_POWERS)
+    F = Z.shape[1]
+    Zf = Z.astype(np.float32)
+    k = np.zeros((len(powers), F))
+    for start, stop in _row_blocks(F, max_block_bytes):
+        R = np.abs(Zf[:, start:stop].T @ Zf)
+        P = np.ones_like(R)
+        p = 0
+        for idx, power in enumerate(powers):
+            while p < power:
+                P *= R
+                p += 1
+            # 去掉对角 (|r_ii|^power = 1)
+            k[idx, start:stop] = P.sum(axis=1, dtype=np.float64) - 1.0
+    table = []
+    for idx, power in enumerate(powers):
+        r2, slope = _scale_free_fit(k[idx])
+        table.append({
+            "power": power,
+            "r2": round(r2, 4),
+            "slope": round(slope, 4),
+            "mean_k": round(float(k[idx].mean()), 4),
+            "median_k": round(float(np.median(k[idx])), 4),
+            "max_k": round(float(k[idx].max()), 4)
+        })
+    fits = np.array([row["r2"] for row in table])
+    above = np.flatnonzero(fits >= r2_cut)
+    if above.size:
+        return {"power": powers[int(above[0])], "table": table, "scale_free": True}
+    n = Z.shape[0]
+    power = 9 if n < 20 else 8 if n < 30 else 7 if n < 40 else 6
+    return {"power": power, "table": table, "scale_free": False}
+
+
+def _buffer(shape: Tuple[int, int], path: Optional[str]) -> np.ndarray:
+    if path is None:
+        return np.empty(shape, dtype=np.float32)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    return np.memmap(path, dtype=np.float32, mode='w+', shape=shape)
+
+
+def blocked_tom(
+    Z: np.ndarray,
+    power: int,
+    max_block_bytes: int = 1 << 28,
+    max_memory: int = 1 << 31,
+    out_path: Optional[str] = None
+) -> np.ndarray:
+    """
+    拓扑重叠矩阵 TOM_ij = (l_ij + a_ij) / (min(k_i, k_j) + 1 - a_ij), l = A^2 (对角为0的A)
+    邻接 A 与 TOM 都按行块计算 (float32); 两者合计超出 max_memory 时邻接放在临时 memmap,
+    给定 out_path 时 TOM 写入该路径的 memmap
+    """
+    F = Z.shape[1]
+    Zf = Z.astype(np.float32)
+    blocks = _row_blocks(F, max_block_bytes)
+    with tempfile.TemporaryDirectory() as tmp:
+        on_disk = 2 * 4 * F * F > max_memory
+        A = _buffer((F, F), os.path.join(tmp, 'adjacency.f32') if on_disk else None)
+        k = np.empty(F)
+        for start, stop in blocks:
+            block = np.abs(Zf[:, start:stop].T @ Zf) ** power
+            # 高次幂下的微小邻接值会落入 float32 次正规数, 使矩阵乘法变慢数十倍; 置零对TOM的影响 < F x 1e-18
+            block[block < 1e-18] = 0.0
+            block[np.arange(stop - start), np.arange(start, stop)] = 0.0
+            A[start:stop] = block
+            k[start:stop] = block.sum(axis=1, dtype=np.float64)
+
+        TOM = _buffer((F, F), out_path)
+        kf = k.astype(np.float32)
+        for start, stop in blocks:
+            a = np.asarray(A[start:stop])
+            num = a @ A
+            num += a
+            den = np.minimum(kf[start:stop, None], kf[None, :])
+            den += 1.0
+            den -= a
+            num /= den
+            num[np.arange(stop - start), np.arange(start, stop)] = 1.0
+            TOM[start:stop] = num
+        del A
+    if isinstance(TOM, np.memmap):
+        TOM.flush()
+    return TOM
+
+
+# 平均连锁的内存: float64 压缩距离 + scipy linkage 内部的一份工作副本, 每个特征对 16 字节
+LINKAGE_BYTES_PER_PAIR = 16
+
+
+def linkage_memory(n_features: int) -> int:
+    """n_features 个特征做 TOM 层次聚类时 linkage 阶段的峰值内存 (字节)"""
+    return LINKAGE_BYTES_PER_PAIR * (n_features * (n_features - 1) // 2)
+
+
+def max_block_size(max_memory: int) -> int:
+    """linkage 阶段峰值内存 (linkage_memory) 不超过 max_memory 的最大块 (特征数)"""
+    F = int(np.sqrt(2.0 * max(max_memory, 0) / LINKAGE_BYTES_PER_PAIR)) + 2
+    while F > 1 and linkage_memory(F) > max_memory:
+        F -= 1
+    return F
+
+
+def projective_blocks(
+    Z: np.ndarray,
+    max_block_size: int,
+    n_iter: int = 30,
+    seed: int = 0
+) -> List[np.ndarray]:
+    """
+    特征预分块 (同 WGCNA projectiveKMeans 的思路): 以 min(F/20, 100 F/max_block_size) 个中心做 k-means,
+    中心为簇内特征按符号对齐后的和 (单位化), 特征分给 |r| 最大的中心;
+    簇按中心的平均连锁叶序依次装入不超过 max_block_size 的块, 相关的簇落在同一块
+    Z: 已标准化的 samples x features; 返回各块的特征下标 (升序)
+    """
+    F = Z.shape[1]
+    if F <= max_block_size:
+        return [np.arange(F)]
+    rng = np.random.default_rng(seed)
+    k = int(max(2, min(F // 20, 100 * F // max_block_size)))
+    Zf = Z.astype(np.float32)
+    C = Zf[:, rng.choice(F, k, replace=False)]
+    labels = np.full(F, -1)
+    for _ in range(n_iter):
+        R = C.T @ Zf
+        new = np.abs(R).argmax(axis=0)
+        if np.array_equal(new, labels):
+            break
+        labels = new
+        sign = np.sign(R[labels, np.arange(F)])
+        C = np.asarray(sparse.csc_matrix((sign, (np.arange(F), labels)), shape=(F, k)).T @ Zf.T).T.astype(np.float32)
+        C /= np.maximum(np.linalg.norm(C, axis=0), 1e-12)
+    used = np.unique(labels)
+    if used.size > 1:
+        r = np.abs(np.corrcoef(C[:, used].T))[np.triu_indices(used.size, k=1)]
+        used = used[leaves_list(linkage(np.maximum(1.0 - r, 0.0), method='average'))]
+
+    blocks: List[np.ndarray] = []
+    current: List[np.ndarray] = []
+    size = 0
+    for c in used:
+        members = np.flatnonzero(labels == c)
+        # 超过块大小的单个簇按与中心的相关性排序后切开
+        if members.size > max_block_size:
+            members = members[np.argsort(-np.abs(C[:, c] @ Zf[:, members]), kind='stable')]
+        for lo in range(0, members.size, max_block_size):
+            part = members[lo:lo + max_block_size]
+            if size + part.size > max_block_size and current:
+                blocks.append(np.sort(np.concatenate(current)))
+                current, size = [], 0
+            current.append(part)
+            size += part.size
+    if current:
+        blocks.append(np.sort(np.concatenate(current)))
+    return blocks
+
+
+def tom_distances(TOM: np.ndarray, max_block_bytes: int = 1 << 28) -> np.ndarray:
+    """1 - TOM 的上三角 (float32 压缩向量, 按行块读取 TOM, 负值截为0)"""
+    F = TOM.shape[0]
+    d = np.empty(F * (F - 1) // 2, dtype=np.float32)
+    for start, stop in _row_blocks(F, max_block_bytes):
+        block = np.asarray(TOM[start:stop], dtype=np.float32)
+        for a, i in enumerate(range(start, stop)):
+            o = condensed_offset(i, F) - i - 1
+            d[o + i + 1:o + F] = 1.0 - block[a, i + 1:]
+    np.maximum(d, 0.0, out=d)
+    return d
+
+
+def tom_linkage(d: np.ndarray) -> np.ndarray:
+    """
+    TOM 压缩距离 (tom_distances) 的平均连锁层次聚类
+    scipy 只接受 float64: 调用方应先释放 TOM 并丢弃 float32 向量, 见 MicrobiomeProcessor.wgcna
+    """
+    return linkage(np.asarray(d, dtype=np.float64), method='average')
+
+
+def _core_scatter(heights: np.ndarray, size: int, min_module_size: int) -> float:
+    """分支核心 (合并高度最低的若干成员) 的平均合并高度; 核心大小同 WGCNA"""
+    base = min_module_size // 2 + 1
+    core = int(base + np.sqrt(max(size - base, 0)))
+    h = heights if heights.size < core else np.partition(heights, core - 2)[:core - 1]
+    return float(h.mean()) if h.size else 0.0
+
+
+def dynamic_tree_cut(
+    Z_link: np.ndarray,
+    min_module_size: int = 30,
+    deep_split: int = 2,
+    cut_height: Optional[float] = None
+) -> np.ndarray:
+    """
+    动态树切割 (WGCNA hybrid 方法的树部分, 不含PAM阶段), 返回模块标签 (0 = 未分配)
+
+    自下而上合并分支: 两个子分支在高度 h 合并时, 若都是合格的模块
+    (大小 >= min_module_size, 核心离散度不超过上限, 与 h 的间隙足够大) 则各自定稿, 不再合并;
+    否则并为一个分支. 高于 cut_height (默认 0.99 x 最大高度) 的合并处, 足够大的分支直接定稿
+    模块按大小编号, 1 为最大
+    """
+    n = Z_link.shape[0] + 1
+    heights_all = Z_link[:, 2]
+    ref = 0.99 * heights_all.max() if cut_height is None else cut_height
+    low = heights_all.min()
+    span = max(ref - low, 1e-12)
+    frac = _MAX_CORE_SCATTER[int(np.clip(deep_split, 0, 4))]
+    max_scatter = low + frac * span
+    min_gap = (1.0 - frac) * 0.75 * span
+
+    members: Dict[int, np.ndarray] = {i: np.array([i]) for i in range(n)}
+    heights: Dict[int, np.ndarray] = {i: np.empty(0) for i in range(n)}
+    closed = set()
+    modules: List[np.ndarray] = []
+
+    def valid(node: int, h: float) -> bool:
+        if node in closed or members[node].size < min_module_size:
+            return False
+        size = members[node].size
+        scatter = _core_scatter(heights[node], size, min_module_size)
+        return scatter <= max_scatter and h - scatter >= min_gap
+
+    for step, (a, b, h, _) in enumerate(Z_link):
+        a, b, node = int(a), int(b), n + step
+        if h > ref:
+            # 切割高度以上: 足够大的开放分支直接成为模块
+            for child in (a, b):
+                if child not in closed and members[child].size >= min_module_size:
+                    modules.append(members[child])
+            closed.add(node)
+        elif valid(a, h) and valid(b, h):
+            modules.extend([members[a], members[b]])
+            closed.add(node)
+        elif a in closed or b in closed:
+            for child in (a, b):
+                if valid(child, h):
+                    modules.append(members[child])
+            closed.add(node)
+        else:
+            members[node] = np.concatenate([members[a], members[b]])
+            heights[node] = np.concatenate([heights[a], heights[b], [h]])
+        for child in (a, b):
+            members.pop(child, None)
+            heights.pop(child, None)
+
+    root = 2 * n - 2
+    if root not in closed and root in members and members[root].size >= min_module_size:
+        modules.append(members[root])
+    labels = np.zeros(n, dtype=np.int64)
+    for rank, idx in enumerate(sorted(range(len(modules)), key=lambda m: -modules[m].size), start=1):
+        labels[modules[idx]] = rank
+    return labels
+
+
+def module_eigengenes(Z: np.ndarray, labels: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    各模块 (标签 >= 1) 的特征基因: 模块内标准化数据的第一主成分, 符号与模块均值一致
+    返回 (samples x modules, 各模块第一主成分解释的方差比例)
+    """
+    n_modules = int(labels.max(initial=0))
+    E = np.zeros((Z.shape[0], n_modules))
+    explained = np.zeros(n_modules)
+    for m in range(1, n_modules + 1):
+        block = Z[:, labels == m]
+        U, S, _ = np.linalg.svd(block, full_matrices=False)
+        e = U[:, 0]
+        if e @ block.mean(axis=1) < 0:
+            e = -e
+        E[:, m - 1] = e
+        explained[m - 1] = S[0] ** 2 / max((S ** 2).sum(), 1e-300)
+    return E, explained
+
+
+def merge_close_modules(
+    Z: np.ndarray,
+    labels: np.ndarray,
+    cut_height: float = 0.25
+) -> np.ndarray:
+    """
+    合并特征基因高度相关的模块 (同 WGCNA mergeCloseModules):
+    特征基因相异度 1 - r 做平均连锁聚类, 在 cut_height 处切开, 重复直到不再合并
+    """
+    labels = labels.copy()
+    while labels.max(initial=0) > 1:
+        E, _ = module_eigengenes(Z, labels)
+        d = 1.0 - np.corrcoef(E.T)[np.triu_indices(E.shape[1], k=1)]
+        groups = fcluster(linkage(np.maximum(d, 0.0), method='average'), cut_height, criterion='distance')
+        if np.unique(groups).size == E.shape[1]:
+            break
+        labels = rank_by_size(np.concatenate([[0], groups])[labels])
+    return labels
+
+
+def rank_by_size(labels: np.ndarray) -> np.ndarray:
+    """模块标签按大小重新编号 (1 为最大), 0 (未分配) 不变"""
+    sizes = np.bincount(labels)
+    order = np.argsort(-sizes[1:], kind='stable') + 1
+    order = order[sizes[order] > 0]
+    rank = np.zeros(sizes.size, dtype=np.int64)
+    rank[order] = np.arange(1, order.size + 1)
+    return rank[labels]
@@ -0,0 +1,85 @@
+import json
+
+import numpy as np
+import pytest
+from scipy import sparse
+
+from processors.biom import read_biom
+
+
+def _write(tmp_path, table, indent=None):
+    path = tmp_path / "table.biom"
+    path.write_text(json.dumps(table, indent=indent))
+    return str(path)
+
+
+def _table(matrix_type="sparse"):
+    dense = np.array([[0, 5, 1], [2, 0, 0]])  # observations x samples
+    if matrix_type == "sparse":
+        data = [[i, j, int(v)] for (i, j), v in np.ndenumerate(dense) if v]
+    else:
+        data = dense.tolist()
+    return {
+        "id": "t",
+        "format": "Biological Observation Matrix 1.0.0",
+        "type": "OTU table",
+        "generated_by": "test",
+        # 元数据里的 "data" 列表出现在顶层 data 之前
+        "rows": [
+            {"id": "OTU1", "metadata": {"taxonomy": ["k__Bacteria", "p__Firmicutes"], "data": [[9, 9]]}},
+            {"id": "OTU2", "metadata": {"taxonomy": ["k__Bacteria"]}}
+        ],
+        "columns": [{"id": f"S{j}", "metadata": {"data": [1, 2]}} for j in range(3)],
+        "matrix_type": matrix_type,
+        "matrix_element_type": "int",
+        "shape": [2, 3],
+        "data": data
+    }
+
+
+@pytest.mark.parametrize("matrix_type", ["sparse", "dense"])
+@pytest.mark.parametrize("indent", [None, 2])
+def test_read_biom_json_uses_top_level_data(tmp_path, matrix_type, indent):
+    table = read_biom(_write(tmp_path, _table(matrix_type), indent))
+    assert table["sample_ids"] == ["S0", "S1", "S2"]
+    assert table["feature_ids"] == ["OTU1", "OTU2"]
+    assert table["counts"].toarray().tolist() == [[0, 2], [5, 0], [1, 0]]
+    assert table["taxonomy"][0][:2] == ["k__Bacteria", "p__Firmicutes"]
+    assert table["sample_metadata"]["data"] == [[1, 2]] * 3
+
+
+def test_read_biom_json_empty_and_malformed(tmp_path):
+    empty = _table()
+    empty["data"] = []
+    assert read_biom(_write(tmp_path, empty))["counts"].nnz == 0
+
+    missing = _table()
+    del missing["data"]
+    with pytest.raises(ValueError):
+        read_biom(_write(tmp_path, missing))
+    path = tmp_path / "broken.biom"
+    path.write_text('{"shape": [1, 1], "data": [[0, 0, 1]]')
+    with pytest.raises(ValueError):
+        read_biom(str(path))
+
+
+def test_read_biom_hdf5_sample_matrix(tmp_path):
+    h5py = pytest.importorskip("h5py")
+    counts = sparse.csr_matrix(np.array([[0, 2], [5, 0], [1, 3]]))  # samples x observations
+    path = str(tmp_path / "table.h5")
+    with h5py.File(path, "w") as f:
+        f.attrs["shape"] = [2, 3]
+        f["sample/ids"] = np.array([b"S0", b"S1", b"S2"])
+        f["observation/ids"] = np.array([b"OTU1", b"OTU2"])
+        f["sample/matrix/data"] = counts.data.astype(np.float64)
+        f["sample/matrix/indices"] = counts.indices
+        f["sample/matrix/indptr"] = counts.indptr
+        f["observation/metadata/taxonomy"] = np.array([[b"k__Bacteria", b"p__Firmicutes"],
+                                                       [b"k__Bacteria", b""]])
+        f["sample/metadata/site"] = np.array([b"gut", b"skin", b"gut"])
+    table = read_biom(path)
+    assert table["format"] == "biom2"
+    assert table["sample_ids"] == ["S0", "S1", "S2"] and table["feature_ids"] == ["OTU1", "OTU2"]
+    assert table["counts"].toarray().tolist() == counts.toarray().tolist()
+    assert table["taxonomy"][0][:2] == ["k__Bacteria", "p__Firmicutes"]
+    assert table["sample_metadata"]["site"] == ["gut", "skin", "gut"]
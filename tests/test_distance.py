@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+from scipy import sparse
+from scipy.spatial.distance import pdist, squareform
+
+from processors.distance import condensed_rows, pairwise_distances
+
+
+def _counts(seed=0, n=23, f=40):
+    rng = np.random.default_rng(seed)
+    X = rng.poisson(2.0, size=(n, f)) * (rng.random((n, f)) < 0.3)
+    X[:, 0] = rng.poisson(20.0, size=n) + 1
+    X[4] = 0
+    X[5] = X[6]
+    return X.astype(np.float64)
+
+
+def _reference(X, metric):
+    if metric == "bray_curtis":
+        with np.errstate(invalid="ignore"):
+            return np.nan_to_num(pdist(X, "braycurtis"))
+    if metric == "jaccard":
+        return pdist(X > 0, "jaccard")
+    if metric == "aitchison":
+        L = np.log(X + 1.0)
+        return pdist(L - L.mean(axis=1, keepdims=True))
+    return pdist(X)
+
+
+@pytest.mark.parametrize("metric", ["bray_curtis", "jaccard", "euclidean", "aitchison"])
+def test_pairwise_distances_match_scipy(metric):
+    X = _counts()
+    d = pairwise_distances(sparse.csr_matrix(X), metric, block_size=4, col_block=5)
+    assert d.dtype == np.float32 and d.size == 23 * 22 // 2
+    np.testing.assert_allclose(d, _reference(X, metric), atol=1e-5)
+    np.testing.assert_allclose(pairwise_distances(X, metric), d, atol=1e-6)
+
+
+def test_pairwise_distances_parallel_and_memmap(tmp_path):
+    X = sparse.csr_matrix(_counts(1, n=40))
+    d = pairwise_distances(X, block_size=8)
+    np.testing.assert_array_equal(pairwise_distances(X, block_size=8, n_jobs=2), d)
+    out = pairwise_distances(X, block_size=8, n_jobs=2, out_path=str(tmp_path / "d.f32"))
+    assert isinstance(out, np.memmap)
+    np.testing.assert_array_equal(out, d)
+    with pytest.raises(ValueError):
+        pairwise_distances(X, "cosine")
+
+
+def test_condensed_rows_match_squareform():
+    d = pdist(np.random.default_rng(2).standard_normal((9, 2)))
+    np.testing.assert_allclose(condensed_rows(d, 9, 3, 7), squareform(d)[3:7])
@@ -0,0 +1,118 @@
+import io
+
+import numpy as np
+import pytest
+from matplotlib.image import imread
+from scipy.cluster.hierarchy import leaves_list, linkage
+from scipy.spatial.distance import pdist
+from scipy.stats import zscore
+
+from processors.heatmap import (
+    MAX_EXACT_LINKAGE, aggregate, cluster_order, condensed_distances, pyramid_factors, scale_matrix, tile_png,
+    tile_pyramid
+)
+from processors.visualization import VisualizationProcessor
+
+
+def test_scale_matrix_is_a_sample_zscore():
+    M = np.random.default_rng(0).gamma(2.0, size=(20, 7))
+    M[3] = 1.0
+    rows = scale_matrix(M, "row")
+    varying = np.arange(20) != 3
+    np.testing.assert_allclose(rows[varying], zscore(M[varying], axis=1, ddof=1), atol=1e-5)
+    assert np.all(rows[3] == 0)
+    np.testing.assert_allclose(scale_matrix(M, "column"), zscore(M, axis=0, ddof=1), atol=1e-5)
+    assert scale_matrix(M, "none").dtype == np.float32
+
+
+@pytest.mark.parametrize("metric,scipy_metric", [
+    ("bray", "braycurtis"), ("euclidean", "euclidean"), ("correlation", "correlation"), ("manhattan", "cityblock")
+])
+def test_condensed_distances_match_pdist(metric, scipy_metric):
+    B = np.random.default_rng(1).gamma(2.0, size=(15, 9))
+    np.testing.assert_allclose(condensed_distances(B, metric), pdist(B, scipy_metric), atol=1e-10)
+
+
+def _blocks(n_per=300, n_cols=12, seed=2):
+    """三组行, 各组在不同列上高表达"""
+    rng = np.random.default_rng(seed)
+    B = rng.gamma(1.0, size=(3 * n_per, n_cols))
+    for g in range(3):
+        B[g * n_per:(g + 1) * n_per, 4 * g:4 * g + 4] += 10.0
+    perm = rng.permutation(3 * n_per)
+    return B[perm], np.repeat([0, 1, 2], n_per)[perm]
+
+
+def test_cluster_order_exact_and_approximate():
+    B, groups = _blocks(n_per=30)
+    exact = cluster_order(B, "average", "euclidean")
+    assert not exact["approximate"]
+    np.testing.assert_array_equal(exact["order"], leaves_list(linkage(pdist(B), "average")))
+
+    B, groups = _blocks()
+    approx = cluster_order(B, "average", "bray", max_exact=100)
+    order = approx["order"]
+    assert approx["approximate"] and np.array_equal(np.sort(order), np.arange(B.shape[0]))
+    assert approx["leaf_sizes"].sum() == B.shape[0]
+    # 同一组的行在叶序中连续
+    assert np.count_nonzero(np.diff(groups[order])) == 2
+
+
+def test_aggregate_takes_bin_means():
+    M = np.arange(7 * 5, dtype=np.float64).reshape(7, 5)
+    out = aggregate(M, 3, 2)
+    rows = np.linspace(0, 7, 4).astype(int)
+    cols = np.linspace(0, 5, 3).astype(int)
+    expected = [[M[rows[i]:rows[i + 1], cols[j]:cols[j + 1]].mean() for j in range(2)] for i in range(3)]
+    np.testing.assert_allclose(out, expected, rtol=1e-6)
+    assert aggregate(M, 10, 10).shape == (7, 5)
+
+
+def test_tile_pyramid_levels_are_block_means():
+    Z = np.random.default_rng(3).standard_normal((300, 70)).astype(np.float32)
+    levels = tile_pyramid(Z, tile=64)
+    factors = pyramid_factors(Z.shape, tile=64)
+    assert len(levels) == len(factors) == 4
+    np.testing.assert_array_equal(levels[-1], Z)
+    for level, (fr, fc) in zip(levels, factors):
+        assert level.shape == (-(-300 // fr), -(-70 // fc))
+        for i, j in [(0, 0), (level.shape[0] - 1, level.shape[1] - 1)]:
+            block = Z[i * fr:(i + 1) * fr, j * fc:(j + 1) * fc]
+            assert level[i, j] == pytest.approx(block.mean(), abs=1e-5)
+    assert max(levels[0].shape) <= 64
+
+
+def test_tile_png_pads_edges_and_rejects_out_of_range():
+    level = np.linspace(0, 1, 100 * 30, dtype=np.float32).reshape(100, 30)
+    level[0, 0] = np.nan
+    assert tile_png(level, 1, 0, "viridis", 0.0, 1.0, tile=64) is None
+    assert tile_png(level, 0, -1, "viridis", 0.0, 1.0, tile=64) is None
+    image = imread(io.BytesIO(tile_png(level, 0, 1, "viridis", 0.0, 1.0, tile=64)), format="png")
+    assert image.shape == (64, 64, 4)
+    assert np.all(image[:36, :30, 3] == 1.0) and np.all(image[36:, :, 3] == 0) and np.all(image[:, 30:, 3] == 0)
+    first = imread(io.BytesIO(tile_png(level, 0, 0, "viridis", 0.0, 1.0, tile=64)), format="png")
+    assert first[0, 0, 3] == 0 and first[0, 1, 3] == 1.0
+
+
+def test_heatmap_serves_tiles_of_the_clustered_matrix(tmp_path):
+    B, groups = _blocks(n_per=200)
+    viz = VisualizationProcessor(cache_dir=str(tmp_path))
+    res = viz.heatmap({"matrix": B}, method="average", distance="euclidean", max_exact=100)
+    assert res["status"] == "success" and res["approximate_clustering"]
+    tiles = res["tiles"]
+    assert tiles["shape"] == [600, 12] and tiles["max_zoom"] == 2
+    info = viz.heatmap_tiles_info(tiles["key"])
+    assert sorted(info["rows"], key=lambda r: int(r[1:])) == [f"R{i + 1}" for i in range(600)]
+    tile = viz.heatmap_tile(tiles["key"], 2, 0, 2)
+    assert tile["status"] == "success" and not tile["cached"]
+    assert tile["row_range"] == [512, 600] and tile["column_range"] == [0, 12]
+    assert viz.heatmap_tile(tiles["key"], 2, 0, 2)["cached"]
+    assert viz.heatmap_tile(tiles["key"], 3, 0, 0)["status"] == "error"
+    assert viz.heatmap_tile(tiles["key"], 0, 1, 0)["status"] == "error"
+
+
+@pytest.mark.parametrize("max_exact", [1, MAX_EXACT_LINKAGE + 1])
+def test_heatmap_rejects_out_of_range_max_exact(tmp_path, max_exact):
+    viz = VisualizationProcessor(cache_dir=str(tmp_path))
+    res = viz.heatmap({"matrix": np.ones((5, 4))}, max_exact=max_exact)
+    assert res["status"] == "error" and "max_exact" in res["message"]
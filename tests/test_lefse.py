@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+from scipy.linalg import eigh
+from scipy.stats import kruskal, mannwhitneyu
+
+import processors.microbiome as mb
+from processors.lefse import _bootstrap_indices, lda_effect_sizes, lefse
+from processors.microbiome import MicrobiomeProcessor, ResultCache
+from processors.stats import kruskal_columns, ranksum_columns
+
+
+def _grouped(seed=0, n_per=12, n_features=40):
+    """三组样本; 特征 0-2 分别在组 0/1/2 中富集, 其余特征无差异; 含大量并列的零"""
+    rng = np.random.default_rng(seed)
+    codes = np.repeat([0, 1, 2], n_per)
+    X = rng.poisson(5.0, size=(codes.size, n_features)) * (rng.random((codes.size, n_features)) < 0.7)
+    for g in range(3):
+        X[codes == g, g] += rng.poisson(40.0, size=n_per)
+    return X.astype(np.float64), codes
+
+
+def test_rank_tests_match_scipy():
+    X, codes = _grouped()
+    H, p = kruskal_columns(X, codes)
+    for j in range(X.shape[1]):
+        ref = kruskal(*[X[codes == g, j] for g in range(3)])
+        assert H[j] == pytest.approx(ref.statistic) and p[j] == pytest.approx(ref.pvalue)
+    A, B = X[codes == 0], X[codes == 1]
+    z, p = ranksum_columns(A, B)
+    for j in range(X.shape[1]):
+        ref = mannwhitneyu(A[:, j], B[:, j], use_continuity=False, method="asymptotic")
+        assert p[j] == pytest.approx(ref.pvalue)
+        assert np.sign(z[j]) == np.sign(ref.statistic - A.shape[0] * B.shape[0] / 2)
+    const = np.ones((10, 1))
+    assert np.isnan(kruskal_columns(const, np.repeat([0, 1], 5))[0][0])
+
+
+def _brute_lda(X, codes, n_boots, seed, fraction=2.0 / 3.0, ridge=1e-6):
+    """逐个自助样本用 scipy 的广义特征分解拟合 LDA; 各组对的得分对自助样本取均值, 再对组对取最大值"""
+    k = codes.max() + 1
+    idx = _bootstrap_indices(codes, n_boots, fraction, np.random.default_rng(seed))
+    pairs = [(a, g) for a in range(k) for g in range(a + 1, k)]
+    scores = np.zeros((n_boots, len(pairs), X.shape[1]))
+    for b in range(n_boots):
+        sub, c = X[idx[b]], codes[idx[b]]
+        m = np.stack([sub[c == g].mean(axis=0) for g in range(k)])
+        centered = sub - m[c]
+        Sw = centered.T @ centered / (c.size - k)
+        Sw += np.eye(X.shape[1]) * (ridge * np.trace(Sw) / X.shape[1] + 1e-12)
+        counts = np.bincount(c)
+        grand = counts @ m / counts.sum()
+        Sb = ((m - grand).T * counts) @ (m - grand)
+        w = eigh(Sb, Sw)[1][:, -1]
+        w /= np.linalg.norm(w)
+        for q, (a, g) in enumerate(pairs):
+            diff = m[a] - m[g]
+            scores[b, q] = (np.abs(diff) + np.abs(w) * abs(diff @ w)) / 2
+    return np.log10(1 + scores.mean(axis=0).max(axis=0))
+
+
+@pytest.mark.parametrize("k", [2, 3])
+def test_lda_effect_sizes_match_per_bootstrap_fits(k):
+    X, codes = _grouped(1)
+    keep = codes < k
+    X, codes = np.log1p(X[keep][:, :6]), codes[keep]
+    # 块上限只容纳 7 个自助样本, 覆盖分块路径
+    lda = lda_effect_sizes(X, codes, n_boots=20, seed=4, max_block_bytes=8 * 36 * 3 * 7)
+    np.testing.assert_allclose(lda, _brute_lda(X, codes, 20, 4), rtol=1e-6)
+
+
+def test_lefse_finds_planted_markers_per_group():
+    X, codes = _grouped(2)
+    R = X / X.sum(axis=1, keepdims=True) * 1e6
+    res = lefse(R, codes, min_samples=5, n_boots=30)
+    assert set(np.flatnonzero(res["marker"])) == {0, 1, 2}
+    assert res["enriched"][:3].tolist() == [0, 1, 2]
+    assert np.all(res["lda"][:3] > 4)
+    assert np.isnan(res["lda"][~res["passed_tests"]]).all()
+    ranks_only = lefse(R, codes, min_samples=5, n_boots=0)
+    assert np.array_equal(ranks_only["marker"], ranks_only["passed_tests"])
+
+
+def test_marker_analysis_reports_groups(monkeypatch):
+    monkeypatch.setattr(mb, "_RESULT_CACHE", ResultCache(64 << 20))
+    X, codes = _grouped(3, n_per=15)
+    labels = np.array(["a", "b", "c"])[codes].tolist()
+    res = MicrobiomeProcessor().marker_analysis({"counts": X}, group=labels, level="feature")
+    assert res["status"] == "success"
+    found = {m["taxon"]: m["group"] for m in res["markers"]}
+    assert {f"ASV_{g + 1}": found.get(f"ASV_{g + 1}") for g in range(3)} == {
+        "ASV_1": "a", "ASV_2": "b", "ASV_3": "c"
+    }
@@ -0,0 +1,161 @@
+import numpy as np
+import pytest
+from scipy import sparse
+from scipy.cluster.hierarchy import linkage
+from scipy.spatial.distance import pdist
+from scipy.special import gammaln
+from scipy.stats import entropy
+
+import processors.microbiome as mb
+from processors.microbiome import MicrobiomeProcessor, ResultCache
+
+
+@pytest.fixture(autouse=True)
+def fresh_cache(monkeypatch):
+    monkeypatch.setattr(mb, "_RESULT_CACHE", ResultCache(64 << 20))
+
+
+def test_distances_are_reused_across_processor_instances(monkeypatch):
+    calls = []
+    real = mb.pairwise_distances
+    monkeypatch.setattr(mb, "pairwise_distances", lambda *a, **k: calls.append(1) or real(*a, **k))
+    data = {"samples": 30, "features": 100}
+    D1 = MicrobiomeProcessor().distances(data)
+    D2 = MicrobiomeProcessor().distances(data)
+    assert len(calls) == 1 and D2 is D1
+    assert not D1.flags.writeable
+
+    Z1 = MicrobiomeProcessor().sample_linkage(data)
+    assert MicrobiomeProcessor().sample_linkage(data) is Z1
+    assert len(calls) == 1
+
+    tables = MicrobiomeProcessor().collapsed_tables(data, ["genus"])
+    assert MicrobiomeProcessor().collapsed_tables(data, ["genus"])["genus"][0] is tables["genus"][0]
+
+
+def test_result_cache_evicts_least_recently_used():
+    cache = ResultCache(max_bytes=3 * 800)
+    for i in range(3):
+        cache.put(("a", i), np.zeros(100))
+    cache.get(("a", 0))
+    cache.put(("a", 3), np.zeros(100))
+    assert cache.get(("a", 1)) is None
+    assert cache.get(("a", 0)) is not None and len(cache) == 3
+    cache.put(("big",), np.zeros(1000))
+    assert cache.get(("big",)) is None
+
+    table = sparse.random(5, 5, density=0.5, format="csr")
+    cache.put(("csr",), table)
+    assert not table.data.flags.writeable
+
+
+def test_complete_pipeline_propagates_load_error(tmp_path):
+    res = MicrobiomeProcessor().complete_pipeline(str(tmp_path / "missing.biom"), ["A", "B"])
+    assert res["status"] == "error" and res["step"] == "load"
+
+
+def test_module_self_test_runs():
+    import subprocess
+    import sys
+    out = subprocess.run([sys.executable, mb.__file__], capture_output=True, text=True, timeout=600)
+    assert out.returncode == 0, out.stderr
+
+
+@pytest.mark.parametrize("method", ["tss", "clr", "css"])
+def test_preprocess_keeps_counts_for_count_based_methods(method):
+    data = {"samples": 20, "features": 200, "sparsity": 0.5}
+    proc = MicrobiomeProcessor()
+    out = proc.preprocess(data, method)
+    raw = mb._count_matrix(data)[0]
+    assert (out["counts"] != raw).nnz == 0
+    assert out["transformed"].shape == raw.shape
+    if method == "clr":
+        assert out["transformed"].data.min() < 0
+    beta = proc.beta_diversity(out, "bray_curtis")
+    assert beta["status"] == "success"
+    assert beta["distance_summary"] == proc.beta_diversity(data, "bray_curtis")["distance_summary"]
+
+
+def _hurlbert(counts, depth):
+    """稀释到 depth 时的期望观测特征数 (Hurlbert 1971)"""
+    N = counts.sum()
+    log_c = lambda a, b: gammaln(a + 1) - gammaln(b + 1) - gammaln(a - b + 1)
+    absent = np.where(N - counts >= depth, np.exp(log_c(N - counts, depth) - log_c(N, depth)), 0.0)
+    return float((1.0 - absent).sum())
+
+
+def test_alpha_metrics_match_hand_formulas():
+    X = np.array([[10, 0, 1, 1, 2, 5], [0, 0, 0, 0, 0, 0], [3, 3, 3, 0, 0, 0]])
+    values = mb._alpha_metrics(sparse.csr_matrix(X))
+    for i in (0, 2):
+        x = X[i][X[i] > 0]
+        p = x / x.sum()
+        f1, f2 = (x == 1).sum(), (x == 2).sum()
+        assert values["shannon"][i] == pytest.approx(entropy(p))
+        assert values["simpson"][i] == pytest.approx(1 - (p ** 2).sum())
+        assert values["observed"][i] == x.size
+        assert values["chao1"][i] == pytest.approx(x.size + f1 * (f1 - 1) / (2 * (f2 + 1)))
+    assert np.isnan(values["shannon"][1]) and values["observed"][1] == 0
+
+
+def test_rarefaction_curves_are_unbiased_and_exact_at_full_depth():
+    counts = np.array([40, 1, 0, 3, 12, 2, 0, 25, 7])
+    X = sparse.csr_matrix(np.tile(counts, (3000, 1)))
+    depths = np.array([5, 20, 90, 91])
+    curves = mb._rarefaction_curves(X, depths, seed=1)
+    observed = curves["observed"]
+    assert np.all(np.isnan(observed[:, 3]))
+    for k, d in enumerate(depths[:2]):
+        assert observed[:, k].mean() == pytest.approx(_hurlbert(counts, d), abs=0.05)
+        assert np.all(observed[:, k] <= min(d, 7))
+    full = mb._alpha_metrics(sparse.csr_matrix(counts[None, :]))
+    for metric in ("shannon", "simpson", "observed", "chao1"):
+        np.testing.assert_allclose(curves[metric][:, 2], full[metric][0])
+
+
+def test_alpha_diversity_reports_values_and_curves():
+    X = np.random.default_rng(2).poisson(3.0, size=(6, 30))
+    res = MicrobiomeProcessor().alpha_diversity({"counts": X, "sample_ids": [f"S{i}" for i in range(6)]},
+                                                n_depths=5)
+    assert res["status"] == "success" and len(res["values"]["shannon"]) == 6
+    assert res["rarefaction"]["depths"][-1] == X.sum(axis=1).max()
+    last = [row[-1] for row in res["rarefaction"]["curves"]["observed"]]
+    assert sum(v is not None for v in last) == 1
+
+
+def _community_types(n_per=8, seed=3):
+    """三种群落类型, 各自富集不同的特征"""
+    rng = np.random.default_rng(seed)
+    profiles = np.full((3, 30), 1.0)
+    for k in range(3):
+        profiles[k, 10 * k:10 * k + 10] = 30.0
+    X = np.vstack([rng.poisson(profiles[k], size=(n_per, 30)) for k in range(3)])
+    return X, np.repeat([0, 1, 2], n_per)
+
+
+@pytest.mark.parametrize("linkage_method", ["average", "complete", "ward"])
+def test_clustering_matches_scipy_and_recovers_types(linkage_method):
+    X, truth = _community_types()
+    res = MicrobiomeProcessor().clustering({"counts": X}, n_clusters=3, linkage_method=linkage_method)
+    d = pdist(X, "braycurtis")
+    Z = linkage(d, method=linkage_method)
+    np.testing.assert_allclose(res["merge_heights"], Z[:, 2], atol=1e-5)
+    labels = np.array([res["assignments"][f"S{i + 1}"] for i in range(truth.size)])
+    assert {tuple(np.unique(labels[truth == k])) for k in range(3)} == {(1,), (2,), (3,)}
+    assert sorted(res["cluster_sizes"].values()) == [8, 8, 8]
+    # 簇按叶序中首次出现的先后编号, 切树高度在第 2 高与第 3 高的合并之间
+    first = [res["assignments"][s] for s in res["leaf_order"]]
+    assert [c for i, c in enumerate(first) if c not in first[:i]] == [1, 2, 3]
+    assert Z[-3, 2] < res["cut_height"] < Z[-2, 2]
+
+
+def test_clustering_reuses_linkage_and_validates_arguments(monkeypatch):
+    X, _ = _community_types()
+    calls = []
+    real = mb.linkage
+    monkeypatch.setattr(mb, "linkage", lambda *a, **k: calls.append(1) or real(*a, **k))
+    MicrobiomeProcessor().clustering({"counts": X}, n_clusters=2)
+    MicrobiomeProcessor().clustering({"counts": X}, n_clusters=5)
+    assert len(calls) == 1
+    assert MicrobiomeProcessor().clustering({"counts": X}, n_clusters=0)["status"] == "error"
+    assert MicrobiomeProcessor().clustering({"counts": X}, linkage_method="single")["status"] == "error"
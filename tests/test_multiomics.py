@@ -0,0 +1,122 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import processors.multiomics as mo
+from processors.multiomics import MultiOmicsProcessor
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(mo, "CACHE_DIR", str(tmp_path / "cache"))
+    return tmp_path
+
+
+def _write_tables(tmp_path, n_samples=30, seed=0):
+    """基因与菌群表共享潜变量; 菌群表的样本列顺序与基因表相反"""
+    rng = np.random.default_rng(seed)
+    latent = rng.standard_normal(n_samples)
+    samples = [f"S{i + 1}" for i in range(n_samples)]
+    genes = np.outer(latent, np.ones(5)) + 0.1 * rng.standard_normal((n_samples, 5))
+    taxa = np.exp(np.outer(latent, np.ones(5)) + 0.1 * rng.standard_normal((n_samples, 5)))
+    gene_path, taxa_path = tmp_path / "genes.csv", tmp_path / "taxa.csv"
+    pd.DataFrame(genes.T, index=[f"G{j}" for j in range(5)], columns=samples).to_csv(gene_path)
+    pd.DataFrame(taxa.T[:, ::-1], index=[f"T{j}" for j in range(5)], columns=samples[::-1]).to_csv(taxa_path)
+    return str(gene_path), str(taxa_path)
+
+
+def test_sample_codes_align_across_processor_instances(tmp_path):
+    gene_path, taxa_path = _write_tables(tmp_path)
+    rnaseq = MultiOmicsProcessor().load_rnaseq(gene_path)
+    microbiome = MultiOmicsProcessor().load_microbiome(taxa_path)
+    res = MultiOmicsProcessor().correlation_analysis(rnaseq, microbiome, threshold=0.8)
+    assert res["n_samples"] == 30
+    assert res["n_correlations"] == 25
+
+    same = MultiOmicsProcessor()
+    res_same = same.correlation_analysis(same.load_rnaseq(gene_path), same.load_microbiome(taxa_path),
+                                         threshold=0.8)
+    assert res_same["n_correlations"] == 25
+
+
+def test_checksum_cache_is_shared_and_bounded(tmp_path, monkeypatch):
+    gene_path, _ = _write_tables(tmp_path)
+    calls = []
+    real = mo._file_checksum
+    monkeypatch.setattr(mo, "_file_checksum", lambda p: calls.append(p) or real(p))
+    monkeypatch.setattr(mo, "_CHECKSUMS", {})
+    MultiOmicsProcessor().load_rnaseq(gene_path)
+    assert MultiOmicsProcessor().load_rnaseq(gene_path)["cache"] == "hit"
+    assert len(calls) == 1
+
+    monkeypatch.setattr(mo, "_MAX_CHECKSUMS", 2)
+    for i in range(4):
+        path = tmp_path / f"t{i}.csv"
+        path.write_text("id,S1\nG1,1\n")
+        mo._cached_checksum(str(path))
+    assert len(mo._CHECKSUMS) == 2
+
+
+def test_factor_analysis_warm_starts_across_instances(monkeypatch):
+    monkeypatch.setattr(mo, "_FACTOR_FITS", {})
+    views = ({"samples": 25, "genes": 200}, {"samples": 25, "taxa": 60}, {"samples": 25, "variables": 6})
+    cold = MultiOmicsProcessor().network_integration(*views, n_factors=4)
+    assert cold["status"] == "success" and not cold["warm_start"]
+    # 演示数据由3个共享潜变量生成, 因子应解释大部分转录组方差
+    assert cold["variance_explained"]["transcriptomics"] > 0.3
+
+    warm = MultiOmicsProcessor().network_integration(*views, n_factors=3)
+    assert warm["warm_start"]
+    assert warm["n_latent_factors"] == 3
+
+    other = MultiOmicsProcessor().network_integration({"samples": 25, "genes": 150}, *views[1:], n_factors=3)
+    assert not other["warm_start"]
+    assert len(mo._FACTOR_FITS) == 2
+
+
+def test_joint_analysis_finds_planted_modules_and_trait():
+    rng = np.random.default_rng(0)
+    n = 40
+    l1, l2 = rng.standard_normal(n), rng.standard_normal(n)
+    genes = np.hstack([
+        l1[:, None] + 0.3 * rng.standard_normal((n, 12)),
+        l2[:, None] + 0.3 * rng.standard_normal((n, 12)),
+        rng.standard_normal((n, 30))
+    ])
+    taxa = np.hstack([np.exp(l1[:, None] + 0.3 * rng.standard_normal((n, 4))),
+                      np.exp(rng.standard_normal((n, 10)))])
+    clinical = np.column_stack([l1 + 0.5 * rng.standard_normal(n), rng.standard_normal(n)])
+    res = MultiOmicsProcessor().joint_analysis(
+        {"matrix": genes}, {"matrix": taxa}, {"matrix": clinical, "feature_ids": ["bmi", "age"]},
+        min_module_size=5
+    )
+    first, second = res["modules"]
+    assert sorted(first["genes"]) == sorted(f"Gene_{j}" for j in range(1, 13))
+    assert sorted(first["taxa"]) == [f"Taxon_{j}" for j in range(1, 5)]
+    assert first["clinical_association"] == "bmi" and first["correlation"] > 0.7
+    assert first["trait_correlations"]["bmi"]["padj"] < 0.05
+    assert sorted(second["genes"]) == sorted(f"Gene_{j}" for j in range(13, 25))
+    assert second["taxa"] == [] and second["trait_correlations"]["bmi"]["padj"] > 0.05
+
+
+def test_concurrent_cache_writers_leave_one_complete_entry(tmp_path):
+    import threading
+    gene_path, _ = _write_tables(tmp_path)
+    barrier = threading.Barrier(4)
+    results = []
+
+    def load():
+        barrier.wait()
+        results.append(MultiOmicsProcessor().load_rnaseq(gene_path))
+
+    threads = [threading.Thread(target=load) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(results) == 4
+    for res in results:
+        np.testing.assert_array_equal(np.asarray(res["matrix"]), np.asarray(results[0]["matrix"]))
+    entries = sorted(p.name for p in (tmp_path / "cache").iterdir())
+    assert len(entries) == 1 and ".tmp-" not in entries[0]
+    assert MultiOmicsProcessor().load_rnaseq(gene_path)["cache"] == "hit"
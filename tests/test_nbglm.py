@@ -0,0 +1,123 @@
+import numpy as np
+import pytest
+from scipy.optimize import minimize, minimize_scalar
+from scipy.special import gammaln
+from scipy.stats import nbinom
+
+import processors.microbiome as mb
+from processors.microbiome import MicrobiomeProcessor, ResultCache
+from processors.nbglm import (
+    _cr_loglik, estimate_dispersions, fit_nb_glm, nb_loglik, nb_wald_test, size_factors
+)
+
+
+def _nb_counts(n_per_group=10, n_features=200, n_de=30, lfc=2.0, disp=0.1, seed=0):
+    """
+    两组 NB 计数 (samples x features), 前 n_de 个特征在第二组中交替上调 / 下调 2^lfc 倍
+    (上下调各半, median-of-ratios 大小因子才没有系统偏移)
+    """
+    rng = np.random.default_rng(seed)
+    n = 2 * n_per_group
+    group = np.repeat([0, 1], n_per_group)
+    s = np.exp(rng.uniform(-0.4, 0.4, n))
+    base = np.exp(rng.uniform(np.log(20), np.log(500), n_features))
+    fold = np.ones(n_features)
+    fold[:n_de] = 2.0 ** (lfc * np.where(np.arange(n_de) % 2, -1.0, 1.0))
+    mu = s[:, None] * base[None, :] * np.where(group[:, None] == 1, fold[None, :], 1.0)
+    r = 1.0 / disp
+    Y = rng.negative_binomial(r, r / (r + mu))
+    X = np.column_stack([np.ones(n), group])
+    return Y, X, group
+
+
+def test_size_factors_median_of_ratios_and_poscounts():
+    Y = np.array([[10, 20, 5, 0], [20, 45, 9, 3], [5, 9, 3, 1]], dtype=float)
+    complete = Y[:, :3]
+    log_geo = np.log(complete).mean(axis=0)
+    s = np.exp(np.median(np.log(complete) - log_geo, axis=1))
+    np.testing.assert_allclose(size_factors(Y), s / np.exp(np.log(s).mean()))
+
+    Z = Y.copy()
+    Z[[0, 1, 2], [0, 1, 2]] = 0
+    pos = Z > 0
+    n_pos = pos.sum(axis=0)
+    log_geo = np.array([np.log(Z[pos[:, f], f]).mean() for f in range(4)]) + np.log(n_pos / 3)
+    s = np.array([np.median(np.log(Z[i, pos[i]]) - log_geo[pos[i]]) for i in range(3)])
+    s = np.exp(s)
+    np.testing.assert_allclose(size_factors(Z), s / np.exp(np.log(s).mean()))
+
+
+def test_nb_loglik_matches_scipy_nbinom():
+    rng = np.random.default_rng(1)
+    Y = rng.poisson(5.0, size=(3, 7)).astype(float)
+    mu = rng.uniform(1, 10, size=(3, 7))
+    alpha = np.array([0.05, 0.5, 2.0])
+    r = 1 / alpha[:, None]
+    expected = (nbinom.logpmf(Y, r, r / (r + mu)) + gammaln(Y + 1)).sum(axis=1)
+    np.testing.assert_allclose(nb_loglik(Y, mu, alpha), expected)
+
+
+def test_fit_nb_glm_matches_direct_maximum_likelihood():
+    Y, X, _ = _nb_counts(n_features=6, n_de=3, seed=2)
+    s = size_factors(Y)
+    alpha = np.array([0.05, 0.1, 0.2, 0.1, 0.3, 0.08])
+    fit = fit_nb_glm(Y.T.astype(float), X, s, alpha)
+    assert fit["converged"].all()
+    for f in range(6):
+        def nll(b):
+            mu = np.exp(X @ b) * s
+            return -nb_loglik(Y[:, f][None, :].astype(float), mu[None, :], alpha[f:f + 1])[0]
+        ref = minimize(nll, np.zeros(2), method="BFGS", options={"gtol": 1e-10}).x
+        np.testing.assert_allclose(fit["beta"][f], ref, atol=1e-4)
+        mu = np.exp(X @ ref) * s
+        info = X.T @ (X * (mu / (1 + alpha[f] * mu))[:, None])
+        np.testing.assert_allclose(fit["se"][f], np.sqrt(np.diag(np.linalg.inv(info))), rtol=1e-3)
+
+
+def test_gene_dispersions_maximize_cox_reid_likelihood():
+    Y, X, _ = _nb_counts(n_features=5, n_de=2, seed=3)
+    Yt = Y.T.astype(float)
+    s = size_factors(Y)
+    disp = estimate_dispersions(Yt, X, s)
+    n = Y.shape[0]
+    norm = Yt / s
+    mean = norm.mean(axis=1)
+    # 与 estimate_dispersions 相同的矩估计初值和 mu
+    rough = np.clip((norm.var(axis=1, ddof=1) - mean * np.mean(1 / s)) / mean ** 2, 1e-8, max(10.0, n))
+    mu = fit_nb_glm(Yt, X, s, rough)["mu"]
+    for f in range(5):
+        obj = lambda la: -_cr_loglik(Yt[f:f + 1], mu[f:f + 1], X, np.array([la]))[0]
+        best = minimize_scalar(obj, bounds=(np.log(1e-9), np.log(max(10.0, n))), method="bounded",
+                               options={"xatol": 1e-8})
+        assert np.log(disp["gene"][f]) == pytest.approx(best.x, abs=1e-3)
+
+
+def test_nb_wald_test_recovers_planted_fold_changes():
+    Y, X, _ = _nb_counts()
+    res = nb_wald_test(Y, X)
+    called = np.nan_to_num(res["padj"], nan=1.0) < 0.05
+    assert called[:30].sum() >= 27 and called[30:].sum() <= 5
+    planted = np.where(np.arange(30) % 2, -2.0, 2.0)
+    assert np.median(np.abs(res["log2_fold_change"][:30] - planted)) < 0.2
+    assert np.median(np.abs(res["log2_fold_change"][30:])) < 0.2
+    assert np.median(res["dispersion"]) == pytest.approx(0.1, rel=0.5)
+
+
+def test_nb_wald_test_pvalues_are_calibrated_under_the_null():
+    Y, X, _ = _nb_counts(n_features=1000, n_de=0, seed=5)
+    res = nb_wald_test(Y, X)
+    assert 0.03 < (res["pvalue"] < 0.05).mean() < 0.08
+    assert abs(np.median(res["log2_fold_change"])) < 0.05
+
+
+def test_differential_analysis_reports_contrast(monkeypatch):
+    monkeypatch.setattr(mb, "_RESULT_CACHE", ResultCache(64 << 20))
+    Y, _, group = _nb_counts(seed=4)
+    labels = ["ctrl" if g == 0 else "case" for g in group]
+    res = MicrobiomeProcessor().differential_analysis({"counts": Y}, group=labels)
+    assert res["status"] == "success" and res["contrast"] == ["ctrl", "case"]
+    assert res["increased"] + res["decreased"] <= 33
+    # 参照水平为排序后的第一个 ("case"), 第二组中上调的特征 (偶数下标) 报告为下降
+    lfc = {r["feature"]: r["log2_fold_change"] for r in res["results"]}
+    assert all(lfc[f"ASV_{j + 1}"] < 0 for j in range(0, 30, 2))
+    assert all(lfc[f"ASV_{j + 1}"] > 0 for j in range(1, 30, 2))
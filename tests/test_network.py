@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from processors.microbiome import MicrobiomeProcessor
+from processors.network import _basis_variances, _sparcc_single, sparcc, sparcc_pvalues
+
+
+def test_basis_variances_solve_the_excluded_system():
+    rng = np.random.default_rng(0)
+    D = 9
+    t = rng.random(D) * 5 + 1
+    excluded = [(0, 3), (2, 7)]
+    M = (D - 2) * np.eye(D) + np.ones((D, D))
+    for i, j in excluded:
+        u = np.zeros(D)
+        u[[i, j]] = 1.0
+        M -= np.outer(u, u)
+    np.testing.assert_allclose(_basis_variances(t, excluded), np.maximum(np.linalg.solve(M, t), 1e-10))
+
+
+def test_sparcc_single_without_exclusion_matches_closed_form():
+    L = np.log(np.random.default_rng(1).gamma(2.0, size=(50, 6)))
+    T = np.array([[np.var(L[:, i] - L[:, j], ddof=1) for j in range(6)] for i in range(6)])
+    M = 4 * np.eye(6) + np.ones((6, 6))
+    w = np.linalg.solve(M, T.sum(axis=1))
+    expected = (w[:, None] + w[None, :] - T) / (2 * np.sqrt(np.outer(w, w)))
+    np.testing.assert_allclose(_sparcc_single(L, x_iter=0, threshold=0.1), np.clip(expected, -1, 1), atol=1e-10)
+
+
+def _compositional(n=200, D=30, rho=0.8, seed=2):
+    """对数正态基础丰度, 特征 0 与 1 相关 rho, 其余独立; 多项式抽样成计数"""
+    rng = np.random.default_rng(seed)
+    cov = np.eye(D)
+    cov[0, 1] = cov[1, 0] = rho
+    basis = np.exp(rng.multivariate_normal(np.full(D, 3.0), cov, size=n))
+    return np.array([rng.multinomial(20000, b / b.sum()) for b in basis])
+
+
+def test_sparcc_recovers_basis_correlation():
+    X = _compositional()
+    r = sparcc(X, n_iter=10)
+    iu = np.triu_indices(X.shape[1], k=1)
+    planted = (iu[0] == 0) & (iu[1] == 1)
+    assert abs(r[planted][0] - 0.8) < 0.1
+    assert np.abs(r[~planted]).max() < 0.3
+
+
+def test_sparcc_pvalues_flag_planted_pair_and_ignore_n_jobs():
+    X = _compositional(n=60, D=8)
+    res = sparcc_pvalues(X, n_bootstraps=19, n_iter=5)
+    assert res["pvalue"][0] == 1 / 20
+    assert np.median(res["pvalue"][1:]) > 0.1
+    parallel = sparcc_pvalues(X, n_bootstraps=19, n_iter=5, n_jobs=2)
+    np.testing.assert_array_equal(parallel["pvalue"], res["pvalue"])
+
+
+@pytest.mark.parametrize("n_bootstraps", [0, -1, -5])
+def test_sparcc_pvalues_reject_non_positive_bootstraps(n_bootstraps):
+    X = _compositional(n=20, D=6)
+    with pytest.raises(ValueError):
+        sparcc_pvalues(X, n_bootstraps=n_bootstraps)
+    res = MicrobiomeProcessor().network_analysis({"counts": X}, n_bootstraps=n_bootstraps)
+    assert res["status"] == "error"
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+from scipy import sparse
+
+from processors.normalize import clr, css, rarefy, sequential_hypergeometric, tss
+
+
+def _counts(seed=0, n=6, F=30):
+    rng = np.random.default_rng(seed)
+    X = rng.poisson(rng.lognormal(2, 1, (n, F))) * (rng.random((n, F)) < 0.6)
+    return sparse.csr_matrix(X)
+
+
+def test_tss_and_clr_match_hand_formulas():
+    X = _counts()
+    D = X.toarray().astype(float)
+    np.testing.assert_allclose(tss(X).toarray(), D / D.sum(axis=1, keepdims=True))
+    C = clr(X).toarray()
+    for row, c in zip(D, C):
+        nz = row > 0
+        np.testing.assert_allclose(c[nz], np.log(row[nz]) - np.log(row[nz]).mean())
+        assert np.all(c[~nz] == 0)
+
+
+def test_css_matches_metagenomeseq_definition():
+    X = _counts(1)
+    D = X.toarray().astype(float)
+    Y = css(X, quantile=0.5).toarray()
+    for row, y in zip(D, Y):
+        nz = row[row > 0]
+        factor = nz[nz <= np.quantile(nz, 0.5)].sum()
+        np.testing.assert_allclose(y, row / factor * 1000.0)
+
+
+def test_rarefy_depth_and_expectation():
+    X = _counts(2, n=3, F=12)
+    depth = int(X.sum(axis=1).min())
+    draws = np.stack([rarefy(X, depth, seed=s).toarray() for s in range(400)])
+    assert np.all(draws.sum(axis=2) == depth)
+    assert np.all(draws <= X.toarray()[None])
+    D = X.toarray()
+    expected = depth * D / D.sum(axis=1, keepdims=True)
+    np.testing.assert_allclose(draws.mean(axis=0), expected, atol=0.35 * np.sqrt(expected.max()))
+    np.testing.assert_array_equal(rarefy(X, depth, seed=7).toarray(), rarefy(X, depth, seed=7, n_jobs=2).toarray())
+    with pytest.raises(ValueError):
+        rarefy(X, depth + 10 ** 6)
+
+
+def test_sequential_hypergeometric_draws_without_replacement():
+    X = _counts(3, n=40)
+    nnz = np.diff(X.indptr)
+    units = np.argsort(-np.repeat(nnz, 2), kind="stable")
+    rows = np.repeat(np.arange(40), 2)[units]
+    total = np.asarray(X.sum(axis=1)).ravel()
+    need = np.minimum(np.tile([5, 50], 40)[units], total[rows])
+    draws = np.zeros((units.size, X.shape[1]), dtype=np.int64)
+    steps = sequential_hypergeometric(X.data, X.indptr[rows], nnz[rows], total[rows], need,
+                                      np.random.default_rng(0))
+    for m, pos, x in steps:
+        draws[np.arange(m), X.indices[pos]] = x
+    np.testing.assert_array_equal(draws.sum(axis=1), need)
+    assert np.all(draws <= X.toarray()[rows])
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+from scipy import sparse
+from scipy.spatial import procrustes
+from scipy.spatial.distance import pdist
+
+from processors.ordination import nmds, pcoa, sparse_pca
+
+
+def _points(n=60, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.standard_normal((n, 4)) * np.array([5.0, 3.0, 1.0, 0.3])
+
+
+def _same_up_to_sign(A, B, atol=1e-6):
+    signs = np.sign((A * B).sum(axis=0))
+    np.testing.assert_allclose(A, B * signs, atol=atol)
+
+
+def test_pcoa_of_euclidean_distances_is_pca():
+    X = _points()
+    Xc = X - X.mean(axis=0)
+    U, S, _ = np.linalg.svd(Xc, full_matrices=False)
+    coords, explained = pcoa(pdist(X), n_axes=3)
+    _same_up_to_sign(coords, U[:, :3] * S[:3])
+    np.testing.assert_allclose(explained, S[:3] ** 2 / (S ** 2).sum())
+
+
+def test_pcoa_randomized_path_matches_dense():
+    d = pdist(_points(n=300, seed=1))
+    dense, ev_dense = pcoa(d, n_axes=3)
+    streamed, ev_streamed = pcoa(d, n_axes=3, dense_limit=10, block_size=64)
+    _same_up_to_sign(streamed, dense)
+    np.testing.assert_allclose(ev_streamed, ev_dense)
+
+
+def test_nmds_recovers_configuration_from_monotone_dissimilarities():
+    X = _points(n=25, seed=2)[:, :2]
+    d = np.exp(pdist(X) / 4.0)
+    res = nmds(d, n_components=2, n_init=4)
+    assert res["stress"] < 0.01
+    assert procrustes(X, res["coordinates"])[2] < 0.01
+    parallel = nmds(d, n_components=2, n_init=4, n_jobs=2)
+    assert parallel["stresses"] == pytest.approx(res["stresses"])
+
+
+def test_sparse_pca_matches_dense_svd():
+    rng = np.random.default_rng(3)
+    X = sparse.random(80, 30, density=0.2, random_state=3, format="csr") + sparse.csr_matrix(
+        np.outer(rng.standard_normal(80), rng.standard_normal(30)) * 3 * (rng.random((80, 30)) < 0.5)
+    )
+    scores, components, mu, S = sparse_pca(X, 3)
+    D = X.toarray()
+    U, S_ref, Vt = np.linalg.svd(D - D.mean(axis=0), full_matrices=False)
+    np.testing.assert_allclose(mu, D.mean(axis=0))
+    np.testing.assert_allclose(S, S_ref[:3], rtol=1e-6)
+    # 随机化子空间迭代是近似解, 坐标的误差相对其尺度 (~30) 很小
+    _same_up_to_sign(scores, U[:, :3] * S_ref[:3], atol=1e-3)
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+from processors.phylo import parse_newick, random_tree, unifrac
+
+
+def _node(tree, name):
+    return tree["names"].index(name)
+
+
+def test_parse_newick_labels_lengths_and_postorder():
+    tree = parse_newick("((A:1,B_x:2)in1:0.5,'C d':3[&comment],(E,F:1.5):1)root;")
+    names, parent = tree["names"], tree["parent"]
+    assert sorted(n for n, tip in zip(names, tree["is_tip"]) if tip) == ["A", "B_x", "C d", "E", "F"]
+    assert names[-1] == "root" and parent[-1] == -1
+    assert np.all(parent[:-1] > np.arange(parent.size - 1))
+    assert parent[_node(tree, "A")] == parent[_node(tree, "B_x")] == _node(tree, "in1")
+    assert parent[_node(tree, "in1")] == parent[_node(tree, "C d")] == _node(tree, "root")
+    lengths = {n: tree["length"][i] for i, n in enumerate(names) if n}
+    assert lengths == {"A": 1.0, "B_x": 2.0, "in1": 0.5, "C d": 3.0, "E": 0.0, "F": 1.5, "root": 0.0}
+    with pytest.raises(ValueError):
+        parse_newick("((A,B);")
+
+
+def test_parse_newick_deep_tree_without_recursion():
+    depth = 5000
+    tree = parse_newick("(" * depth + "A:1" + "".join(f",T{i}:1)" for i in range(depth)) + ";")
+    assert tree["is_tip"].sum() == depth + 1 and tree["parent"].size == 2 * depth + 1
+
+
+def _brute_unifrac(X, names, tree, weighted):
+    """逐分支按定义计算: 每个非根节点的分支下各样本的相对丰度 / 是否出现"""
+    tip_of = {n: i for i, n in enumerate(tree["names"]) if tree["is_tip"][i]}
+    below = np.zeros((X.shape[0], tree["parent"].size))
+    for f, name in enumerate(names):
+        node = tip_of[name]
+        while tree["parent"][node] >= 0:
+            below[:, node] += X[:, f] / (X.sum(axis=1) if weighted else 1.0)
+            node = tree["parent"][node]
+    if not weighted:
+        below = (below > 0).astype(float)
+    b = tree["length"]
+    out = []
+    for i in range(X.shape[0]):
+        for j in range(i + 1, X.shape[0]):
+            if weighted:
+                out.append((b * np.abs(below[i] - below[j])).sum() / (b * (below[i] + below[j])).sum())
+            else:
+                out.append((b * np.abs(below[i] - below[j])).sum() / (b * np.maximum(below[i], below[j])).sum())
+    return np.array(out)
+
+
+@pytest.mark.parametrize("weighted", [False, True])
+def test_unifrac_matches_branch_definition(weighted):
+    rng = np.random.default_rng(0)
+    names = [f"OTU{j}" for j in range(25)]
+    tree = random_tree(names, seed=3)
+    X = rng.poisson(3.0, size=(12, 25)) * (rng.random((12, 25)) < 0.4)
+    X[:, 0] += 1
+    d = unifrac(X, names, tree, weighted=weighted, block_size=5)
+    np.testing.assert_allclose(d, _brute_unifrac(X.astype(float), names, tree, weighted), atol=1e-5)
+    np.testing.assert_array_equal(unifrac(X, names, tree, weighted=weighted, block_size=5, n_jobs=2), d)
+
+
+def test_unifrac_rejects_features_missing_from_tree():
+    tree = parse_newick("(A:1,B:1);")
+    with pytest.raises(ValueError):
+        unifrac(np.ones((2, 3)), ["A", "B", "C"], tree)
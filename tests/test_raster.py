@@ -0,0 +1,150 @@
+import numpy as np
+import pytest
+from matplotlib import colormaps
+from matplotlib.colors import to_rgb
+from matplotlib.figure import Figure
+
+import processors.raster as raster
+from processors.raster import _normalize, bin_points, data_extent, shade_categories, shade_values
+from processors.visualization import VisualizationProcessor, _draw_scatter, _draw_volcano
+
+
+def test_data_extent_pads_finite_range():
+    x = np.array([0.0, 10.0, np.nan, 4.0])
+    y = np.array([-2.0, 2.0, 100.0, np.inf])
+    assert data_extent(x, y, pad=0.1) == pytest.approx((-1.0, 11.0, -2.4, 2.4))
+    assert data_extent(np.array([3.0]), np.array([0.0]), pad=0.5) == pytest.approx((1.5, 4.5, -0.5, 0.5))
+    assert data_extent(np.array([np.nan]), np.array([1.0])) == (-1.0, 1.0, -1.0, 1.0)
+
+
+def _points(n=5000, seed=0):
+    """正态散点, 三个类别, 数值权重中含 NaN"""
+    rng = np.random.default_rng(seed)
+    x, y = rng.standard_normal(n), rng.standard_normal(n) * 2
+    codes = rng.integers(3, size=n)
+    weights = rng.random(n)
+    weights[::97] = np.nan
+    return x, y, codes, weights
+
+
+@pytest.mark.parametrize("chunk", [raster.BIN_CHUNK, 1000])
+def test_bin_points_matches_histogram2d(monkeypatch, chunk):
+    monkeypatch.setattr(raster, "BIN_CHUNK", chunk)
+    x, y, codes, weights = _points()
+    # 范围比数据窄, 范围外的点被忽略
+    extent, shape = (-1.5, 2.0, -3.0, 3.5), (17, 23)
+    hist = lambda keep, w=None: np.histogram2d(y[keep], x[keep], bins=shape, range=[extent[2:], extent[:2]],
+                                               weights=None if w is None else w[keep])[0]
+    everything = np.ones(x.size, dtype=bool)
+    counts, sums = bin_points(x, y, extent, shape)
+    assert counts.shape == (1, 17, 23) and sums is None
+    np.testing.assert_array_equal(counts[0], hist(everything))
+
+    counts, _ = bin_points(x, y, extent, shape, codes=codes, n_categories=3)
+    for c in range(3):
+        np.testing.assert_array_equal(counts[c], hist(codes == c))
+
+    finite = np.isfinite(weights)
+    counts, sums = bin_points(x, y, extent, shape, weights=weights)
+    np.testing.assert_array_equal(counts[0], hist(finite))
+    np.testing.assert_allclose(sums, hist(finite, weights), atol=1e-12)
+
+
+def test_normalize_eq_hist_log_and_linear():
+    total = np.array([[0, 1, 1], [2, 5, 5], [5, 0, 0]])
+    nz = total > 0
+    # 非零像素 1,1,2,5,5,5 的经验分布函数 2/6, 3/6, 6/6, 线性拉伸到 [0, 1]
+    expected = np.zeros((3, 3))
+    expected[nz] = [{1: 0.0, 2: 0.25, 5: 1.0}[v] for v in total[nz]]
+    np.testing.assert_allclose(_normalize(total, "eq_hist"), expected)
+    np.testing.assert_allclose(_normalize(total, "log")[nz], np.log1p(total[nz]) / np.log1p(5))
+    np.testing.assert_allclose(_normalize(total, "linear")[nz], total[nz] / 5)
+    assert np.all(_normalize(total, "linear")[~nz] == 0)
+    assert np.all(_normalize(np.where(nz, 3, 0), "eq_hist")[nz] == 1.0)
+    assert not _normalize(np.zeros((2, 2)), "eq_hist").any()
+    with pytest.raises(ValueError):
+        _normalize(total, "sqrt")
+
+
+def test_shade_categories_mixes_colors_by_count():
+    colors = ["#ff0000", "#0000ff"]
+    counts = np.zeros((2, 2, 2), dtype=np.int64)
+    counts[0, 0, 0], counts[1, 0, 0] = 3, 1
+    counts[1, 1, 1] = 8
+    image = shade_categories(counts, colors, how="linear", min_alpha=60)
+    mixed = (3 * np.array(to_rgb(colors[0])) + np.array(to_rgb(colors[1]))) / 4
+    np.testing.assert_array_equal(image[0, 0, :3], np.rint(mixed * 255))
+    np.testing.assert_array_equal(image[1, 1, :3], [0, 0, 255])
+    assert image[0, 0, 3] == round(60 + 195 * 4 / 8) and image[1, 1, 3] == 255
+    assert image[0, 1, 3] == 0 and image[1, 0, 3] == 0
+    single = shade_categories(counts[:1], ["#00ff00"])
+    assert np.all(single[..., :3] == [0, 255, 0]) and single[0, 0, 3] == 255
+
+
+def test_shade_values_maps_pixel_means():
+    counts = np.array([[[2, 0], [1, 4]]])
+    sums = np.array([[1.0, 0.0], [3.0, 2.0]])
+    image = shade_values(counts, sums, "viridis", 0.0, 2.0)
+    expected = colormaps["viridis"](np.array([[0.25, 0.0], [1.0, 0.25]]), bytes=True)
+    np.testing.assert_array_equal(image[..., :3], expected[..., :3])
+    assert image[0, 1, 3] == 0 and np.all(image[[0, 1, 1], [0, 0, 1], 3] == 255)
+
+
+def _raster_image(fig):
+    """图中唯一坐标轴上的栅格图像 (RGBA)"""
+    images = fig.axes[0].images
+    assert len(images) == 1
+    return np.asarray(images[0].get_array())
+
+
+def test_rasterized_scatter_draws_one_image_per_axes():
+    x, y, codes, weights = _points(20000, seed=1)
+    table = {"x": x, "y": y, "group": np.array(["a", "b", "c"])[codes], "value": weights}
+    params = {"x": "x", "y": "y", "color": "group", "size": None, "trendline": False, "rasterize": True}
+    fig = Figure(figsize=(6.0, 4.5), dpi=100)
+    info = _draw_scatter(fig, {"table": table}, params)
+    assert info == {"n_points": 20000, "rasterized": True}
+    image = _raster_image(fig)
+    # 图像与坐标轴同样大小, 非空像素数等于 bin_points 的结果
+    box = fig.axes[0].get_position()
+    shape = (int(box.height * 450), int(box.width * 600))
+    assert image.shape == shape + (4,)
+    counts, _ = bin_points(x, y, data_extent(x, y), shape, codes=codes, n_categories=3)
+    assert np.count_nonzero(image[..., 3]) == np.count_nonzero(counts.sum(axis=0))
+
+    fig = Figure(figsize=(6.0, 4.5), dpi=100)
+    _draw_scatter(fig, {"table": table}, {**params, "color": "value"})
+    assert _raster_image(fig).shape == shape + (4,)
+    assert len(fig.axes) == 2  # 色条
+
+
+def test_rasterized_volcano_keeps_labeled_points_as_vectors():
+    rng = np.random.default_rng(2)
+    lfc = rng.standard_normal(5000) * 1.5
+    p = rng.random(5000) ** 3
+    fig = Figure(figsize=(6.0, 4.5), dpi=100)
+    params = {"fc_threshold": 1.0, "pvalue_threshold": 0.05, "label_top": 7, "rasterize": True}
+    info = _draw_volcano(fig, {"log2fc": lfc, "pvalue": p}, params)
+    sig = p < 0.05
+    assert info["rasterized"] and info["n_up"] == int((sig & (lfc >= 1)).sum())
+    assert info["n_down"] == int((sig & (lfc <= -1)).sum())
+    _raster_image(fig)
+    ax = fig.axes[0]
+    assert len(ax.collections) == 1 and len(ax.collections[0].get_offsets()) == 7
+    # 没有 labels 时标注名称为原始序号 (从 1 开始), 按 p 值从小到大
+    significant = np.flatnonzero(sig & (np.abs(lfc) >= 1))
+    top = significant[np.argsort(p[significant], kind="stable")][:7]
+    assert [t.get_text() for t in ax.texts] == [str(i + 1) for i in top]
+
+
+def test_processor_rasterizes_above_threshold(tmp_path, monkeypatch):
+    monkeypatch.setattr("processors.visualization.RASTER_THRESHOLD", 1000)
+    viz = VisualizationProcessor(cache_dir=str(tmp_path))
+    coords = np.random.default_rng(3).standard_normal((3000, 2))
+    groups = np.repeat(["a", "b", "c"], 1000).tolist()
+    res = viz.umap_plot({"coordinates": coords, "groups": groups})
+    assert res["status"] == "success" and res["rasterized"] and res["n_points"] == 3000
+    small = viz.tsne_plot({"coordinates": coords[:500], "groups": groups[:500]})
+    assert small["status"] == "success" and not small["rasterized"]
+    forced = viz.tsne_plot({"coordinates": coords[:500], "groups": groups[:500]}, rasterize=True)
+    assert forced["rasterized"]
@@ -0,0 +1,114 @@
+import os
+import threading
+import time
+
+import matplotlib
+import numpy as np
+import pytest
+
+import processors.render as rd
+from processors.render import THEMES, FigureCache, content_hash, render
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return FigureCache(str(tmp_path))
+
+
+def _draw_line(fig, data, params):
+    ax = fig.add_subplot()
+    ax.plot(data["x"], data["y"])
+    return {"n": len(data["x"]), "facecolor": matplotlib.colors.to_hex(fig.get_facecolor())}
+
+
+def test_content_hash_is_stable_and_content_sensitive():
+    a = {"x": [1.0, 2.0, 3.0], "names": ["a", "b"], "nested": [[1, 2], [3, 4]]}
+    b = {"nested": [[1, 2], [3, 4]], "names": ["a", "b"], "x": [1.0, 2.0, 3.0]}
+    assert content_hash(a) == content_hash(b)
+    assert content_hash(a) != content_hash({**a, "x": [1.0, 2.0, 3.5]})
+    assert content_hash(a) != content_hash({**a, "names": ["a", "c"]})
+    assert content_hash(["1", 2]) != content_hash(["1", "2"])
+    assert content_hash([1, None]) != content_hash([1, 2])
+    assert content_hash([np.arange(3), 1]) != content_hash([np.arange(4), 1])
+
+
+def test_content_hash_of_large_lists_is_fast():
+    x = np.random.default_rng(0).random(2_000_000).tolist()
+    start = time.perf_counter()
+    key = content_hash({"x": x})
+    assert time.perf_counter() - start < 2.0
+    x[-1] += 1.0
+    assert content_hash({"x": x}) != key
+
+
+def test_render_caches_by_content_and_refreshes(cache):
+    data = {"x": [0, 1, 2], "y": [0, 1, 4]}
+    first = render("line", _draw_line, data, {}, cache=cache)
+    assert not first["cached"] and first["n"] == 3
+    again = render("line", _draw_line, {"y": [0, 1, 4], "x": [0, 1, 2]}, {}, cache=cache)
+    assert again["cached"] and again["key"] == first["key"] and again["file"] == first["file"]
+    assert render("line", _draw_line, data, {}, cache=cache, refresh=True)["cached"] is False
+    other = render("line", _draw_line, data, {}, theme="dark", cache=cache)
+    assert other["key"] != first["key"] and not other["cached"]
+    with open(first["file"], "rb") as f:
+        assert f.read(8) == b"\x89PNG\r\n\x1a\n"
+
+
+def test_themes_do_not_leak_into_global_rcparams(cache):
+    before = dict(matplotlib.rcParams)
+    out = render("line", _draw_line, {"x": [0, 1], "y": [1, 0]}, {}, theme="dark", cache=cache)
+    assert out["facecolor"] == matplotlib.colors.to_hex(THEMES["dark"]["figure.facecolor"])
+    assert dict(matplotlib.rcParams) == before
+
+
+def test_concurrent_renders_keep_their_own_theme(cache):
+    themes = ["default", "dark", "publication"] * 4
+    results = [None] * len(themes)
+
+    def draw(fig, data, params):
+        time.sleep(0.01)
+        info = _draw_line(fig, data, params)
+        return {**info, "rc": matplotlib.colors.to_hex(matplotlib.rcParams["figure.facecolor"])}
+
+    def work(i, theme):
+        data = {"x": list(range(50)), "y": [float(i)] * 50}
+        results[i] = render("line", draw, data, {}, theme=theme, cache=cache)
+
+    threads = [threading.Thread(target=work, args=(i, t)) for i, t in enumerate(themes)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for theme, out in zip(themes, results):
+        expected = matplotlib.colors.to_hex(THEMES[theme]["figure.facecolor"])
+        assert out["facecolor"] == expected and out["rc"] == expected
+
+
+def test_cache_puts_do_not_rescan_below_the_limit(tmp_path, monkeypatch):
+    cache = FigureCache(str(tmp_path), max_bytes=10_000)
+    scans = []
+    real = cache._scan
+    monkeypatch.setattr(cache, "_scan", lambda: scans.append(1) or real())
+    for i in range(20):
+        cache.put(f"{i:02d}" + "a" * 62, "png", b"x" * 100, {"i": i})
+    assert len(scans) == 1
+    # 其他进程的写入在定期扫描时计入
+    monkeypatch.setattr(rd, "SCAN_INTERVAL", 0.0)
+    cache.put("ff" + "b" * 62, "png", b"x" * 100, {})
+    assert len(scans) == 2
+
+
+def test_cache_evicts_whole_keys_oldest_first(tmp_path):
+    cache = FigureCache(str(tmp_path), max_bytes=6500)
+    old, new = "aa" + "0" * 62, "bb" + "1" * 62
+    cache.put_array(old, "z0.npy", np.zeros(200))
+    cache.put_array(old, "z1.npy", np.zeros(100))
+    cache.put(old, "json", b"{}", {})
+    for name in os.listdir(tmp_path / "aa"):
+        os.utime(tmp_path / "aa" / name, (1, 1))
+    # 最近访问过的数组使整个键保持较新
+    cache.put(new, "png", b"x" * 1000, {})
+    assert cache.load_array(old, "z0.npy") is not None
+    cache.put("cc" + "2" * 62, "png", b"x" * 3000, {})
+    assert cache.get(new, "png") is None and not os.listdir(tmp_path / "bb")
+    assert cache.get(old, "json") is not None and cache.load_array(old, "z1.npy") is not None
@@ -0,0 +1,124 @@
+import numpy as np
+import pytest
+import scipy.sparse as sp
+
+from processors.singlecell import SingleCellProcessor, _threshold_minimum
+
+
+def simulate_counts(n=2000, n_genes=400, n_types=6, rate=0.06, seed=0):
+    """泊松计数, 每个细胞类型一组标记基因; 按 rate 植入异型双细胞 (两类型平均谱, 深度加倍)"""
+    rng = np.random.default_rng(seed)
+    base = rng.gamma(0.3, 1.0, n_genes)
+    profiles = np.tile(base, (n_types, 1))
+    for t in range(n_types):
+        genes = rng.choice(n_genes, 40, replace=False)
+        profiles[t, genes] *= rng.uniform(5, 20, genes.size)
+    profiles /= profiles.sum(axis=1, keepdims=True)
+    types = rng.integers(0, n_types, n)
+    depth = rng.integers(1500, 3000, n).astype(np.float64)
+    idx = rng.choice(n, int(rate * n), replace=False)
+    partner = rng.integers(0, n, idx.size)
+    ok = types[partner] != types[idx]
+    idx, partner = idx[ok], partner[ok]
+    P = profiles[types]
+    P[idx] = 0.5 * (profiles[types[idx]] + profiles[types[partner]])
+    depth[idx] *= 2
+    truth = np.zeros(n, dtype=bool)
+    truth[idx] = True
+    return sp.csr_matrix(rng.poisson(P * depth[:, None]).astype(np.float32)), truth
+
+
+def test_threshold_minimum_finds_valley():
+    rng = np.random.default_rng(0)
+    values = np.r_[rng.normal(0.1, 0.03, 5000), rng.normal(0.7, 0.05, 500)]
+    t = _threshold_minimum(values)
+    assert 0.2 < t < 0.5
+    assert (values > t).sum() == 500
+    single_peak = np.repeat(np.arange(11.0), [1, 2, 4, 8, 16, 32, 16, 8, 4, 2, 1])
+    assert _threshold_minimum(single_peak, n_bins=11) is None
+    assert _threshold_minimum(np.zeros(10)) is None
+
+
+def test_detect_doublets_recovers_planted_doublets():
+    X, truth = simulate_counts()
+    data = {"X": X}
+    res = SingleCellProcessor().detect_doublets(data)
+    pred = res["predicted_doublets"]
+    assert res["status"] == "success"
+    assert (pred & truth).sum() >= 0.9 * truth.sum()
+    assert (pred & ~truth).sum() <= 0.01 * (~truth).sum()
+    assert set(data) == {"X"}
+    assert res["pca"].shape[0] == X.shape[0]
+
+
+def test_detect_doublets_small_input_calls_nothing():
+    X, _ = simulate_counts(n=5, n_genes=50)
+    res = SingleCellProcessor().detect_doublets({"X": X})
+    assert res["n_doublets"] == 0
+    assert res["threshold"] is None
+
+
+def test_preprocessing_does_not_mutate_input():
+    X, truth = simulate_counts(seed=1)
+    data = {"X": X}
+    res = SingleCellProcessor().preprocessing(data)
+    assert data["X"] is X and set(data) == {"X"}
+    assert res["X"].shape[0] == res["filtered_cells"] == X.shape[0] - res["doublets_removed"]
+    assert res["pca"].shape[0] == res["X"].shape[0]
+
+    small = {"X": X[:5]}
+    res = SingleCellProcessor().preprocessing(small)
+    assert res["filtered_cells"] == 5 and res["doublets_removed"] == 0
+
+
+def test_dimensionality_reduction_clamps_request_sizes(monkeypatch):
+    import processors.singlecell as sc
+    monkeypatch.setattr(sc, "MAX_EMBEDDING_CELLS", 1000)
+    proc = SingleCellProcessor()
+    emb = proc.dimensionality_reduction({"filtered_cells": 10 ** 9}, n_components=50)
+    assert emb["n_cells"] == 1000
+    assert emb["coordinates"].shape == (1000, sc.MAX_EMBEDDING_COMPONENTS)
+    assert proc.dimensionality_reduction({"filtered_cells": -5})["n_cells"] == 0
+    payload = proc.embedding_payload(emb, bins=10 ** 6)
+    assert payload["density"]["bins"] == sc.MAX_DENSITY_BINS
+
+
+def _batched_pca(n_per=300, d=10, seed=0):
+    """两个细胞类型 x 两个批次; 批次2整体平移, 类型间距离远大于批次偏移"""
+    rng = np.random.default_rng(seed)
+    types = np.repeat([0, 1, 0, 1], n_per)
+    batch = np.repeat(["a", "a", "b", "b"], n_per)
+    centers = np.zeros((2, d))
+    centers[1, 0] = 20.0
+    Z = centers[types] + rng.standard_normal((types.size, d))
+    Z[batch == "b", 1] += 6.0
+    return Z.astype(np.float32), types, batch
+
+
+def test_harmony_removes_batch_shift_within_types():
+    Z, types, batch = _batched_pca()
+    data = {"pca": Z, "batch": batch}
+    res = SingleCellProcessor().batch_correction(data, n_clusters=4, max_iter=20)
+    Zh = data["pca_harmony"]
+
+    def batch_gap(emb):
+        return max(np.linalg.norm(emb[(types == t) & (batch == "a")].mean(0) - emb[(types == t) & (batch == "b")].mean(0))
+                   for t in (0, 1))
+
+    assert res["status"] == "success"
+    assert batch_gap(Zh) < 0.25 * batch_gap(Z)
+    type_gap = np.linalg.norm(Zh[types == 0].mean(0) - Zh[types == 1].mean(0))
+    assert type_gap > 15.0
+
+
+def test_harmony_reports_convergence_on_last_iteration():
+    Z, types, batch = _batched_pca()
+    proc = SingleCellProcessor()
+    res = proc.batch_correction({"pca": Z, "batch": batch}, n_clusters=4, max_iter=50)
+    assert res["converged"]
+    n = res["iterations"]
+    exact = proc.batch_correction({"pca": Z, "batch": batch}, n_clusters=4, max_iter=n)
+    assert exact["iterations"] == n and exact["converged"]
+    if n > 2:
+        short = proc.batch_correction({"pca": Z, "batch": batch}, n_clusters=4, max_iter=n - 1)
+        assert not short["converged"]
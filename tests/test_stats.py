@@ -0,0 +1,265 @@
+import numpy as np
+import pytest
+from scipy import sparse
+from scipy.spatial import procrustes
+from scipy.spatial.distance import pdist, squareform
+from scipy.stats import false_discovery_control, pearsonr, rankdata, spearmanr
+
+from processors.stats import (
+    _circulant_index, anosim, blocked_correlation, correlation_graph, correlation_pvalues,
+    critical_correlation, mantel, modularity, modularity_communities, permanova, permutation_batch,
+    permutation_pvalues, procrustes_test, standardize_columns
+)
+
+
+def _correlated_blocks(seed=0, n=25):
+    rng = np.random.default_rng(seed)
+    A = rng.standard_normal((n, 7))
+    B = rng.standard_normal((n, 5))
+    B[:, 0] += 2 * A[:, 2]
+    A[:3, 1] = A[3, 1]
+    return A, B
+
+
+@pytest.mark.parametrize("n", [2, 3, 6, 7])
+def test_circulant_index_covers_each_pair_once(n):
+    P = np.array([np.random.default_rng(n).permutation(n)])
+    flat = _circulant_index(P, n)[0]
+    i, j = np.divmod(flat, n)
+    pairs = {tuple(sorted(t)) for t in zip(i.tolist(), j.tolist())}
+    assert len(pairs) == flat.size == n * (n - 1) // 2
+    assert all(a != b for a, b in pairs)
+
+
+def _brute_force_count(d1, d2, n, n_permutations, batch_size, seed=0):
+    """按同一组置换逐个重排方阵, 用 float64 计算 r"""
+    z1 = (d1 - d1.mean()) / np.linalg.norm(d1 - d1.mean())
+    z2 = (d2 - d2.mean()) / np.linalg.norm(d2 - d2.mean())
+    D2 = squareform(z2)
+    r_obs = z1 @ z2
+    count = 0
+    for b in range(int(np.ceil(n_permutations / batch_size))):
+        size = min(batch_size, n_permutations - b * batch_size)
+        for p in permutation_batch(seed, b, n, batch_size)[:size]:
+            count += z1 @ squareform(D2[p][:, p], checks=False) >= r_obs - 1e-6
+    return r_obs, count
+
+
+@pytest.mark.parametrize("n", [12, 15])
+def test_mantel_matches_brute_force(n):
+    rng = np.random.default_rng(n)
+    X = rng.standard_normal((n, 3))
+    d1 = pdist(X)
+    d2 = pdist(X + rng.standard_normal((n, 3)) * 2)
+    res = mantel(d1, d2, n_permutations=499, batch_size=50, early_stop=0)
+    r_obs, count = _brute_force_count(d1, d2, n, 499, 50)
+    assert res["statistic"] == pytest.approx(pearsonr(d1, d2)[0])
+    assert res["statistic"] == pytest.approx(r_obs)
+    assert res["pvalue"] == pytest.approx((count + 1) / 500)
+
+    rho = mantel(d1, d2, method="spearman", n_permutations=0)["statistic"]
+    assert rho == pytest.approx(spearmanr(d1, d2)[0])
+
+
+def test_mantel_two_sided_and_null():
+    rng = np.random.default_rng(1)
+    d1 = pdist(rng.standard_normal((30, 2)))
+    d2 = pdist(rng.standard_normal((30, 2)))
+    res = mantel(d1, d2, n_permutations=999, alternative="two-sided", early_stop=0)
+    assert res["pvalue"] > 0.05
+    strong = mantel(d1, -d1, n_permutations=199, alternative="two-sided", early_stop=0)
+    assert strong["pvalue"] == pytest.approx(1 / 200)
+
+
+@pytest.mark.parametrize("method", ["spearman", "pearson"])
+def test_blocked_correlation_matches_scipy(method):
+    A, B = _correlated_blocks()
+    res = blocked_correlation(A, B, method=method, threshold=0.0, block_size=3)
+    assert res["r"].size == res["n_tests"] == 35
+    assert np.all(np.diff(np.abs(res["r"])) <= 1e-12)
+    ref = spearmanr if method == "spearman" else pearsonr
+    exact = [ref(A[:, i], B[:, j]) for i, j in zip(res["i"], res["j"])]
+    np.testing.assert_allclose(res["r"], [e.statistic for e in exact], atol=1e-12)
+    p = np.array([e.pvalue for e in exact])
+    np.testing.assert_allclose(res["pvalue"], p, rtol=1e-9)
+    np.testing.assert_allclose(res["padj"], false_discovery_control(p), rtol=1e-9)
+
+
+def test_blocked_correlation_threshold_and_top_k_keep_strongest():
+    A, B = _correlated_blocks(1)
+    full = blocked_correlation(A, B, threshold=0.0)
+    exact_q = false_discovery_control(full["pvalue"])
+    kept = blocked_correlation(A, B, threshold=0.3, block_size=2)
+    n = kept["r"].size
+    assert 0 < n < 35 and np.all(np.abs(kept["r"]) >= 0.3)
+    np.testing.assert_allclose(kept["r"], full["r"][:n])
+    # 直方图给出的 BH 只会偏保守
+    assert np.all(kept["padj"] >= exact_q[:n] - 1e-12)
+    top = blocked_correlation(A, B, threshold=0.0, top_k=4, block_size=2)
+    np.testing.assert_allclose(top["r"], full["r"][:4])
+
+
+def test_critical_correlation_inverts_pvalues():
+    for pvalue, n in [(0.01, 30), (0.05, 8), (1e-6, 200)]:
+        r = critical_correlation(pvalue, n)
+        assert correlation_pvalues(np.array([r]), n)[0] == pytest.approx(pvalue)
+
+
+def test_permutation_pvalues_match_brute_force():
+    A, B = _correlated_blocks(3, n=20)
+    pi, pj = np.array([2, 0, 5, 2]), np.array([0, 1, 3, 4])
+    res = permutation_pvalues(A, B, pi, pj, n_permutations=230, batch_size=50, early_stop=0)
+    RA, RB = rankdata(A, axis=0), rankdata(B, axis=0)
+    for k, (i, j) in enumerate(zip(pi, pj)):
+        r_obs = pearsonr(RA[:, i], RB[:, j]).statistic
+        count = 0
+        for b in range(5):
+            size = min(50, 230 - 50 * b)
+            for p in permutation_batch(0, b, 20, 50)[:size]:
+                count += abs(pearsonr(RA[:, i], RB[p, j]).statistic) >= abs(r_obs) - 1e-9
+        assert res["r"][k] == pytest.approx(r_obs)
+        assert res["exceedances"][k] == count
+        assert res["pvalue"][k] == pytest.approx((count + 1) / 231)
+
+
+def test_permutation_pvalues_stop_early_and_ignore_n_jobs():
+    A, B = _correlated_blocks(4, n=20)
+    pi, pj = np.array([2, 1, 3]), np.array([0, 2, 4])
+    res = permutation_pvalues(A, B, pi, pj, n_permutations=2000, early_stop=10)
+    assert res["n_permutations"][0] == 2000 and res["pvalue"][0] < 0.01
+    stopped = res["n_permutations"] < 2000
+    assert stopped[1:].any() and np.all(res["exceedances"][stopped] >= 10)
+    parallel = permutation_pvalues(A, B, pi, pj, n_permutations=2000, early_stop=10, n_jobs=2)
+    np.testing.assert_array_equal(parallel["pvalue"], res["pvalue"])
+
+
+def test_permutation_blocks_respect_max_block_bytes():
+    import tracemalloc
+    rng = np.random.default_rng(6)
+    A, B = rng.standard_normal((50, 30)), rng.standard_normal((50, 200))
+    pi, pj = np.repeat(np.arange(30), 200), np.tile(np.arange(200), 30)
+    kwargs = dict(method="pearson", n_permutations=400, batch_size=200, early_stop=0)
+    full = permutation_pvalues(A, B, pi, pj, **kwargs)
+    budget = 1 << 20
+    tracemalloc.start()
+    small = permutation_pvalues(A, B, pi, pj, max_block_bytes=budget, **kwargs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    np.testing.assert_array_equal(small["exceedances"], full["exceedances"])
+    # 整批并排需 8 x 50 x 200 x 200 = 16 MB; 分块后只剩相关对级别的数组与几个预算大小的块
+    assert peak < 6 * budget
+    # 单个置换都放不下时每次只取一个置换
+    tiny = permutation_pvalues(A, B, pi[:50], pj[:50], max_block_bytes=8, **kwargs)
+    np.testing.assert_array_equal(tiny["exceedances"], full["exceedances"][:50])
+
+
+def test_correlation_graph_matches_dense_threshold():
+    Z = standardize_columns(np.random.default_rng(5).standard_normal((15, 40)))
+    A = correlation_graph(Z, 0.4, max_block_bytes=8 * 40 * 7)
+    R = np.abs(Z.T @ Z)
+    np.fill_diagonal(R, 0.0)
+    R[R < 0.4] = 0.0
+    np.testing.assert_allclose(A.toarray(), R, atol=1e-12)
+
+
+def _modularity_dense(W, labels):
+    two_m = W.sum()
+    k = W.sum(axis=1)
+    same = labels[:, None] == labels[None, :]
+    return ((W - np.outer(k, k) / two_m) * same).sum() / two_m
+
+
+def test_modularity_communities_recover_planted_cliques():
+    W = np.zeros((15, 15))
+    for block in (range(0, 6), range(6, 11), range(11, 15)):
+        idx = np.array(block)
+        W[np.ix_(idx, idx)] = 1.0
+    W[5, 6] = W[6, 5] = W[10, 11] = W[11, 10] = 0.2
+    np.fill_diagonal(W, 0.0)
+    A = sparse.csr_matrix(W)
+    labels = modularity_communities(A)
+    assert [np.unique(labels[s]).size for s in (slice(0, 6), slice(6, 11), slice(11, 15))] == [1, 1, 1]
+    assert np.unique(labels).size == 3
+    assert modularity(A, labels) == pytest.approx(_modularity_dense(W, labels))
+    other = np.arange(15) % 2
+    assert modularity(A, other) == pytest.approx(_modularity_dense(W, other))
+
+
+def test_procrustes_test_matches_scipy_and_brute_force():
+    rng = np.random.default_rng(6)
+    X = rng.standard_normal((14, 3))
+    Y = X[:, :2] @ rng.standard_normal((2, 2)) + 0.8 * rng.standard_normal((14, 2))
+    res = procrustes_test(X, Y, n_permutations=150, batch_size=40, early_stop=0)
+    Yp = np.pad(Y, ((0, 0), (0, 1)))
+    assert res["m12"] == pytest.approx(procrustes(X, Yp)[2])
+    count = 0
+    for b in range(4):
+        size = min(40, 150 - 40 * b)
+        for p in permutation_batch(0, b, 14, 40)[:size]:
+            count += procrustes(X, Yp[p])[2] <= res["m12"] + 1e-9
+    assert res["pvalue"] == pytest.approx((count + 1) / 151)
+
+
+def _pseudo_f(D2, codes):
+    """定义式: SS_total = sum d^2 / n, SS_within = sum_g sum_{i<j in g} d^2 / n_g"""
+    n, a = codes.size, codes.max() + 1
+    ss_total = np.triu(D2, 1).sum() / n
+    ss_within = sum(np.triu(D2[np.ix_(codes == g, codes == g)], 1).sum() / (codes == g).sum()
+                    for g in range(a))
+    return (ss_total - ss_within) / (a - 1) / (ss_within / (n - a)), ss_total, ss_within
+
+
+def _anosim_r_brute(d, codes):
+    n = codes.size
+    i, j = np.triu_indices(n, 1)
+    ranks = rankdata(d)
+    within = codes[i] == codes[j]
+    return (ranks[~within].mean() - ranks[within].mean()) / (d.size / 2)
+
+
+def test_permanova_and_anosim_match_brute_force():
+    rng = np.random.default_rng(7)
+    codes = np.repeat([0, 1, 2], [6, 5, 7])
+    X = rng.standard_normal((18, 3)) + 0.6 * codes[:, None]
+    d = pdist(X)
+    D2 = squareform(d) ** 2
+    res = permanova(d, codes, n_permutations=230, batch_size=50, early_stop=0)
+    F, ss_total, ss_within = _pseudo_f(D2, codes)
+    assert res["statistic"] == pytest.approx(F, rel=1e-5)
+    assert res["ss_total"] == pytest.approx(ss_total)
+    assert res["ss_residual"] == pytest.approx(ss_within, rel=1e-5)
+    assert res["r2"] == pytest.approx(1 - ss_within / ss_total, rel=1e-5)
+    R = anosim(d, codes, n_permutations=230, batch_size=50, early_stop=0)
+    assert R["statistic"] == pytest.approx(_anosim_r_brute(d, codes), abs=1e-6)
+
+    f_count = r_count = 0
+    for b in range(5):
+        size = min(50, 230 - 50 * b)
+        for p in permutation_batch(0, b, 18, 50)[:size]:
+            f_count += _pseudo_f(D2, codes[p])[0] >= F * (1 - 1e-5)
+            r_count += _anosim_r_brute(d, codes[p]) >= R["statistic"] - 1e-6
+    assert res["pvalue"] == pytest.approx((f_count + 1) / 231)
+    assert R["pvalue"] == pytest.approx((r_count + 1) / 231)
+
+
+def test_permanova_covariates_enter_the_model_first():
+    rng = np.random.default_rng(8)
+    n = 24
+    codes = np.repeat([0, 1], 12)
+    age = rng.standard_normal(n) + codes
+    d = pdist(np.column_stack([age, rng.standard_normal(n)]) + 0.1 * rng.standard_normal((n, 2)))
+    res = permanova(d, codes, covariates=age[:, None], n_permutations=0)
+    D = squareform(d)
+    J = np.eye(n) - 1.0 / n
+    G = -0.5 * J @ (D ** 2) @ J
+    hat = lambda M: M @ np.linalg.pinv(M)
+    H_cov = hat(np.column_stack([np.ones(n), age]))
+    H_full = hat(np.column_stack([np.ones(n), age, codes]))
+    ss_cov = np.trace(H_cov @ G)
+    ss_term = np.trace((H_full - H_cov) @ G)
+    assert res["ss_covariates"] == pytest.approx(ss_cov, rel=1e-5)
+    assert res["ss"] == pytest.approx(ss_term, rel=1e-4, abs=1e-6)
+    F = ss_term / ((np.trace(G) - np.trace(H_full @ G)) / (n - 3))
+    assert res["statistic"] == pytest.approx(F, rel=1e-4, abs=1e-6)
+    with pytest.raises(ValueError):
+        permanova(d, codes, covariates=codes[:, None].astype(float))
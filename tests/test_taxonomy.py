@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+
+import processors.microbiome as mb
+from processors.biom import RANKS
+from processors.microbiome import MicrobiomeProcessor, ResultCache
+from processors.taxonomy import build_hierarchy, collapse
+
+
+def _taxonomy(n=60, seed=0):
+    """随机分类路径; 同名属 g__Shared 出现在两个科下, 部分路径缺少低等级"""
+    rng = np.random.default_rng(seed)
+    paths = []
+    for j in range(n):
+        phylum = f"p__{rng.integers(3)}"
+        family = f"f__{rng.integers(4)}"
+        genus = "g__Shared" if j % 5 == 0 else f"g__{rng.integers(6)}"
+        species = f"s__{rng.integers(3)}" if j % 7 else ""
+        paths.append(["k__Bacteria", phylum, "c__X", "o__Y", family, genus, species])
+    return paths
+
+
+def test_collapse_matches_groupby_on_full_paths():
+    taxonomy = _taxonomy()
+    X = sparse.random(8, 60, density=0.4, random_state=1, format="csr") * 10
+    hierarchy = build_hierarchy(taxonomy)
+    tables = collapse(X, hierarchy, ["phylum", "genus", "species"])
+    dense = pd.DataFrame(X.toarray())
+    for level in ("phylum", "genus", "species"):
+        r = RANKS.index(level)
+        keys = [";".join(p[:r + 1]) for p in taxonomy]
+        expected = dense.T.groupby(keys).sum().T
+        names = hierarchy["names"][level]
+        assert sorted(names) == sorted(expected.columns)
+        np.testing.assert_allclose(tables[level].toarray(), expected[names].to_numpy())
+    genus = hierarchy["names"]["genus"]
+    assert len({n for n in genus if n.endswith("g__Shared")}) > 1
+
+
+def test_collapse_taxonomy_all_levels_conserve_counts(monkeypatch):
+    monkeypatch.setattr(mb, "_RESULT_CACHE", ResultCache(64 << 20))
+    X = np.random.default_rng(2).poisson(2.0, size=(5, 60))
+    data = {"counts": X, "taxonomy": _taxonomy()}
+    res = MicrobiomeProcessor().collapse_taxonomy(data, level="all")
+    assert res["status"] == "success" and res["collapsed_features"]["kingdom"] == 1
+    for level in RANKS:
+        table = res["tables"][level]["counts"]
+        np.testing.assert_allclose(np.asarray(table.sum(axis=1)).ravel(), X.sum(axis=1))
+    single = MicrobiomeProcessor().collapse_taxonomy(data, level="genus")
+    np.testing.assert_allclose(single["counts"].toarray(), res["tables"]["genus"]["counts"].toarray())
+    assert MicrobiomeProcessor().collapse_taxonomy({"counts": X}, "genus")["status"] == "error"
+    with pytest.raises(ValueError):
+        build_hierarchy([["k__Bacteria"]])
@@ -0,0 +1,67 @@
+import pytest
+
+flask = pytest.importorskip("flask")
+
+from web.app import app
+import processors.singlecell as sc
+
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+
+def test_dimred_routes_clamp_sizes(client, monkeypatch):
+    monkeypatch.setattr(sc, "MAX_EMBEDDING_CELLS", 2000)
+    import web.app as web
+    monkeypatch.setattr(web, "MAX_EMBEDDING_CELLS", 2000)
+    res = client.post("/api/singlecell/dimred", json={"filtered_cells": 10 ** 9, "bins": 10 ** 6}).get_json()
+    assert res["n_cells"] == 2000
+    assert res["density"]["bins"] == sc.MAX_DENSITY_BINS
+
+    res = client.post("/api/singlecell/dimred/points",
+                      json={"filtered_cells": 5000, "viewport": [-100, 100, -100, 100], "max_points": 0})
+    assert res.status_code == 200
+    assert int(res.headers["X-Point-Count"]) == 1
+    assert int(res.headers["X-Total-In-View"]) == 2000
+
+
+def test_permutation_routes_cap_n_permutations(client, monkeypatch):
+    import web.app as web
+    seen = {}
+
+    def fake_mantel(self, *args, **kwargs):
+        seen.update(kwargs)
+        return {"status": "success"}
+
+    monkeypatch.setattr(web.MultiOmicsProcessor, "mantel_test", fake_mantel)
+    client.post("/api/multiomics/mantel", json={"n_permutations": 10 ** 9})
+    assert seen["n_permutations"] == web.MAX_PERMUTATIONS
+
+
+def test_network_route_clamps_n_bootstraps(client, monkeypatch):
+    import web.app as web
+    seen = []
+
+    def fake_network(self, data, **kwargs):
+        seen.append(kwargs["n_bootstraps"])
+        return {"status": "success"}
+
+    monkeypatch.setattr(web.MicrobiomeProcessor, "network_analysis", fake_network)
+    client.post("/api/microbiome/network", json={"n_bootstraps": -5})
+    client.post("/api/microbiome/network", json={"n_bootstraps": 10 ** 9})
+    assert seen == [1, web.MAX_BOOTSTRAPS]
+
+
+def test_heatmap_route_clamps_max_exact(client, monkeypatch):
+    import web.app as web
+    seen = []
+
+    def fake_heatmap(self, data, **kwargs):
+        seen.append(kwargs["max_exact"])
+        return {"status": "error", "message": "stub"}
+
+    monkeypatch.setattr(web.VisualizationProcessor, "heatmap", fake_heatmap)
+    client.post("/api/viz/heatmap", json={"max_exact": 100000})
+    client.post("/api/viz/heatmap", json={"max_exact": 0})
+    assert seen == [web.MAX_EXACT_LINKAGE, 2]
@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+from scipy.spatial.distance import squareform
+
+from processors.microbiome import MicrobiomeProcessor
+from processors.wgcna import (
+    blocked_tom, linkage_memory, max_block_size, projective_blocks, rank_by_size, tom_distances, tom_linkage
+)
+
+
+def _standardized(n=20, F=12, seed=0):
+    X = np.random.default_rng(seed).standard_normal((n, F))
+    X -= X.mean(axis=0)
+    return X / np.linalg.norm(X, axis=0)
+
+
+def test_blocked_tom_matches_formula():
+    Z = _standardized()
+    A = np.abs(Z.T @ Z) ** 6
+    np.fill_diagonal(A, 0.0)
+    k = A.sum(axis=1)
+    expected = (A @ A + A) / (np.minimum.outer(k, k) + 1 - A)
+    np.fill_diagonal(expected, 1.0)
+    TOM = blocked_tom(Z, 6, max_block_bytes=4 * 12 * 5)
+    np.testing.assert_allclose(TOM, expected, rtol=1e-5, atol=1e-6)
+
+    on_disk = blocked_tom(Z, 6, max_block_bytes=4 * 12 * 5, max_memory=0)
+    np.testing.assert_allclose(on_disk, expected, rtol=1e-5, atol=1e-6)
+
+
+def test_tom_distances_are_float32_condensed():
+    TOM = blocked_tom(_standardized(), 6)
+    d = tom_distances(TOM, max_block_bytes=4 * 12 * 3)
+    assert d.dtype == np.float32
+    np.testing.assert_allclose(d, np.maximum(squareform(1.0 - TOM, checks=False), 0), rtol=1e-6)
+    assert tom_linkage(d).shape == (11, 4)
+    assert linkage_memory(20000) == 16 * 20000 * 19999 // 2
+
+
+def _planted_counts(n=60, per=40, n_modules=2, seed=0):
+    """n_modules 个模块, 每个 per 个特征共享一个潜变量"""
+    rng = np.random.default_rng(seed)
+    latent = rng.standard_normal((n, n_modules))
+    logs = np.hstack([latent[:, [m]] + 0.3 * rng.standard_normal((n, per)) for m in range(n_modules)])
+    counts = np.rint(np.exp(3 + logs)).astype(np.int64)
+    return {"counts": counts, "sample_ids": [f"S{i}" for i in range(n)]}
+
+
+def _recovered(res, per, n_modules):
+    members = [set(int(f.split("_")[1]) - 1 for f in m["features"]) for m in res["modules"]]
+    for m in range(n_modules):
+        block = set(range(m * per, (m + 1) * per))
+        assert max(len(block & found) for found in members) >= 0.9 * per
+
+
+def test_max_block_size_fits_linkage_budget():
+    for budget in (1000, 20000, 1 << 31):
+        F = max_block_size(budget)
+        assert linkage_memory(F) <= budget < linkage_memory(F + 1)
+    assert max_block_size(1 << 31) > 16000
+
+
+def test_projective_blocks_keep_modules_together():
+    rng = np.random.default_rng(1)
+    latent = rng.standard_normal((50, 6))
+    X = np.hstack([latent[:, [m]] + 0.5 * rng.standard_normal((50, 30)) for m in range(6)])
+    X -= X.mean(axis=0)
+    Z = X / np.linalg.norm(X, axis=0)
+    blocks = projective_blocks(Z, 70)
+    assert all(b.size <= 70 for b in blocks)
+    np.testing.assert_array_equal(np.sort(np.concatenate(blocks)), np.arange(180))
+    module = np.repeat(np.arange(6), 30)
+    assert sum(np.unique(module[b]).size for b in blocks) == 6
+    assert len(projective_blocks(Z, 180)) == 1
+
+
+def test_rank_by_size_numbers_largest_first():
+    labels = np.array([0, 3, 3, 1, 3, 5, 5, 0])
+    np.testing.assert_array_equal(rank_by_size(labels), [0, 1, 1, 3, 1, 2, 2, 0])
+
+
+def test_wgcna_recovers_planted_modules_and_respects_budget():
+    data = _planted_counts()
+    proc = MicrobiomeProcessor()
+    res = proc.wgcna(data, power=6, min_module_size=10)
+    assert res["status"] == "success" and res["blocks"] == [80]
+    _recovered(res, 40, 2)
+
+    small = proc.wgcna(data, power=6, min_module_size=10, max_memory=1000)
+    assert small["status"] == "error" and "max_memory" in small["message"]
+
+
+def test_wgcna_splits_features_into_blocks_within_budget(tmp_path):
+    data = _planted_counts(per=30, n_modules=3, seed=2)
+    budget = linkage_memory(70)
+    res = MicrobiomeProcessor().wgcna(data, power=6, min_module_size=10, max_memory=budget,
+                                      out_path=str(tmp_path / "tom.f32"))
+    assert res["status"] == "success"
+    assert len(res["blocks"]) > 1 and max(res["blocks"]) <= 70 and sum(res["blocks"]) == 90
+    assert len(res["tom_file"]) == len(res["blocks"])
+    _recovered(res, 30, 3)
@@ -4,7 +4,8 @@ EasyMultiProfiler Web Application - 完整整合版
 包含：原R包功能 + 新增功能
 """
 
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, Response, send_file
+from typing import Dict
 import sys
 import os
 
@@ -17,9 +18,21 @@ from processors import (
     MicrobiomeProcessor,
     VisualizationProcessor
 )
+from processors.heatmap import MAX_EXACT_LINKAGE
+from processors.render import FORMATS
+from processors.singlecell import MAX_EMBEDDING_CELLS, MAX_DENSITY_BINS
 
 app = Flask(__name__)
 
+# 网页请求的置换次数上限
+MAX_PERMUTATIONS = 9999
+# 网页请求的 SparCC 零模型数据集个数上限
+MAX_BOOTSTRAPS = 999
+
+def _int_arg(data: Dict, key: str, default: int, lo: int, hi: int) -> int:
+    """请求中的整数参数, 截断到 [lo, hi] (决定计算量与内存的参数不能由请求无限放大)"""
+    return min(max(int(data.get(key, default)), lo), hi)
+
 # 双语文本
 TEXT = {
     "zh": {
@@ -185,21 +198,80 @@ def microbiome_alpha():
 def microbiome_beta():
     proc = MicrobiomeProcessor()
     data = request.json or {}
-    result = proc.beta_diversity(data)
+    result = proc.beta_diversity(
+        data,
+        method=data.get('method', 'bray_curtis'),
+        ordination=data.get('ordination', 'pcoa')
+    )
+    return jsonify(result)
+
+@app.route('/api/microbiome/permanova', methods=['POST'])
+def microbiome_permanova():
+    proc = MicrobiomeProcessor()
+    data = request.json or {}
+    result = proc.group_test(
+        data,
+        data.get('group'),
+        method=data.get('method', 'bray_curtis'),
+        test='permanova',
+        covariates=data.get('covariates'),
+        n_permutations=_int_arg(data, 'n_permutations', 9999, 0, MAX_PERMUTATIONS)
+    )
+    return jsonify(result)
+
+@app.route('/api/microbiome/anosim', methods=['POST'])
+def microbiome_anosim():
+    proc = MicrobiomeProcessor()
+    data = request.json or {}
+    result = proc.group_test(
+        data,
+        data.get('group'),
+        method=data.get('method', 'bray_curtis'),
+        test='anosim',
+        n_permutations=_int_arg(data, 'n_permutations', 9999, 0, MAX_PERMUTATIONS)
+    )
     return jsonify(result)
 
 @app.route('/api/microbiome/diff', methods=['POST'])
 def microbiome_diff():
     proc = MicrobiomeProcessor()
     data = request.json or {}
-    result = proc.differential_analysis(data, data.get('group', []))
+    result = proc.differential_analysis(data, data.get('group'), method=data.get('method', 'DESeq2'))
     return jsonify(result)
 
 @app.route('/api/microbiome/network', methods=['POST'])
 def microbiome_network():
     proc = MicrobiomeProcessor()
     data = request.json or {}
-    result = proc.network_analysis(data)
+    result = proc.network_analysis(
+        data,
+        method=data.get('method', 'SparCC'),
+        n_bootstraps=_int_arg(data, 'n_bootstraps', 100, 1, MAX_BOOTSTRAPS)
+    )
+    return jsonify(result)
+
+@app.route('/api/microbiome/cluster', methods=['POST'])
+def microbiome_cluster():
+    proc = MicrobiomeProcessor()
+    data = request.json or {}
+    result = proc.clustering(
+        data,
+        n_clusters=int(data.get('n_clusters', 4)),
+        distance=data.get('distance', 'bray_curtis'),
+        linkage_method=data.get('linkage', 'average')
+    )
+    return jsonify(result)
+
+@app.route('/api/microbiome/marker', methods=['POST'])
+def microbiome_marker():
+    proc = MicrobiomeProcessor()
+    data = request.json or {}
+    result = proc.marker_analysis(
+        data,
+        data.get('group'),
+        method=data.get('method', 'lefse'),
+        level=data.get('level', 'all')
+    )
     return jsonify(result)
 
 @app.route('/api/microbiome/wgcna', methods=['POST'])
@@ -252,9 +324,40 @@ def chipseq_motif():
 def singlecell_dimred():
     proc = SingleCellProcessor()
     data = request.json or {}
-    result = proc.dimensionality_reduction(data, 'UMAP')
+    data['filtered_cells'] = _int_arg(data, 'filtered_cells', 4500, 0, MAX_EMBEDDING_CELLS)
+    embedding = proc.dimensionality_reduction(data, data.get('method', 'UMAP'))
+    result = proc.embedding_payload(
+        embedding,
+        bins=_int_arg(data, 'bins', 256, 1, MAX_DENSITY_BINS),
+        max_points=_int_arg(data, 'max_points', 50000, 1, 200000),
+        quantize=bool(data.get('quantize', False))
+    )
     return jsonify(result)
 
+@app.route('/api/singlecell/dimred/points', methods=['POST'])
+def singlecell_dimred_points():
+    """视窗内的点, 以二进制返回 (xy交错), 元信息放在响应头"""
+    proc = SingleCellProcessor()
+    data = request.json or {}
+    data['filtered_cells'] = _int_arg(data, 'filtered_cells', 4500, 0, MAX_EMBEDDING_CELLS)
+    embedding = proc.dimensionality_reduction(data, data.get('method', 'UMAP'))
+    viewport = data.get('viewport')
+    if not viewport or len(viewport) != 4:
+        return jsonify({"status": "error", "message": "viewport must be [x0, x1, y0, y1]"}), 400
+    result = proc.viewport_points(
+        embedding,
+        viewport,
+        max_points=_int_arg(data, 'max_points', 200000, 1, 1_000_000),
+        quantize=bool(data.get('quantize', False))
+    )
+    response = Response(result["buffer"].tobytes(), mimetype='application/octet-stream')
+    response.headers['X-Point-Count'] = str(result["count"])
+    response.headers['X-Total-In-View'] = str(result["total_in_view"])
+    response.headers['X-Point-Dtype'] = result["dtype"]
+    response.headers['X-Point-Offset'] = ','.join(str(v) for v in result["offset"])
+    response.headers['X-Point-Scale'] = ','.join(str(v) for v in result["scale"])
+    return response
+
 @app.route('/api/singlecell/cluster', methods=['POST'])
 def singlecell_cluster():
     proc = SingleCellProcessor()
@@ -284,28 +387,115 @@ def multiomics_joint():
     result = proc.joint_analysis({}, {}, {})
     return jsonify(result)
 
+@app.route('/api/multiomics/mantel', methods=['POST'])
+def multiomics_mantel():
+    proc = MultiOmicsProcessor()
+    data = request.json or {}
+    result = proc.mantel_test(
+        data.get('rnaseq', {}),
+        data.get('microbiome', {}),
+        method=data.get('method', 'pearson'),
+        n_permutations=_int_arg(data, 'n_permutations', 9999, 0, MAX_PERMUTATIONS)
+    )
+    return jsonify(result)
+
+@app.route('/api/multiomics/procrustes', methods=['POST'])
+def multiomics_procrustes():
+    proc = MultiOmicsProcessor()
+    data = request.json or {}
+    result = proc.procrustes_analysis(
+        data.get('rnaseq', {}),
+        data.get('microbiome', {}),
+        n_permutations=_int_arg(data, 'n_permutations', 9999, 0, MAX_PERMUTATIONS)
+    )
+    return jsonify(result)
+
 # ==================== 可视化 API ====================
 
+def _figure_result(result: Dict) -> Dict:
+    """给成功的绘图结果加上图像的访问地址 (不暴露服务器上的缓存路径)"""
+    if result.get("status") == "success":
+        result = {k: v for k, v in result.items() if k != "file"}
+        result["url"] = f"/api/viz/figure/{result['key']}.{result['format']}"
+        if result.get("tiles"):
+            tiles = result["tiles"]
+            result["tiles"] = {
+                **tiles,
+                "info_url": f"/api/viz/heatmap/tiles/{tiles['key']}",
+                "url_template": f"/api/viz/heatmap/tile/{tiles['key']}/{{z}}/{{x}}/{{y}}.png"
+            }
+    return result
+
+def _valid_key(key: str) -> bool:
+    return len(key) == 64 and all(c in '0123456789abcdef' for c in key)
+
+@app.route('/api/viz/figure/<key>.<fmt>', methods=['GET'])
+def viz_figure(key, fmt):
+    """按内容键返回缓存的图像; 键由内容决定, 浏览器可以永久缓存"""
+    if fmt not in FORMATS or not _valid_key(key):
+        return jsonify({"status": "error", "message": "invalid figure key"}), 404
+    path = VisualizationProcessor().cache.path(key, fmt)
+    if not os.path.exists(path):
+        return jsonify({"status": "error", "message": "figure not found"}), 404
+    response = send_file(path, mimetype='image/png' if fmt == 'png' else 'image/svg+xml', etag=key)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
 @app.route('/api/viz/heatmap', methods=['POST'])
 def viz_heatmap():
     proc = VisualizationProcessor()
     data = request.json or {}
-    result = proc.heatmap(data)
-    return jsonify(result)
+    result = proc.heatmap(
+        data,
+        method=data.get('method', 'ward.D2'),
+        distance=data.get('distance', 'bray'),
+        scale=data.get('scale', 'row'),
+        max_exact=_int_arg(data, 'max_exact', 4000, 2, MAX_EXACT_LINKAGE),
+        theme=data.get('theme', 'default'),
+        format=data.get('format', 'png')
+    )
+    return jsonify(_figure_result(result))
+
+@app.route('/api/viz/heatmap/tiles/<key>', methods=['GET'])
+def viz_heatmap_tiles(key):
+    """热图瓦片金字塔的说明 (各级形状, 颜色范围, 排序后的行列名称)"""
+    if not _valid_key(key):
+        return jsonify({"status": "error", "message": "invalid tile key"}), 404
+    result = VisualizationProcessor().heatmap_tiles_info(key)
+    return jsonify(result), (200 if result["status"] == "success" else 404)
+
+@app.route('/api/viz/heatmap/tile/<key>/<int:z>/<int:x>/<int:y>.png', methods=['GET'])
+def viz_heatmap_tile(key, z, x, y):
+    """热图的一个 256x256 瓦片; 内容由键与坐标决定, 浏览器可以永久缓存"""
+    if not _valid_key(key):
+        return jsonify({"status": "error", "message": "invalid tile key"}), 404
+    result = VisualizationProcessor().heatmap_tile(key, z, x, y)
+    if result["status"] != "success":
+        return jsonify(result), 404
+    response = send_file(result["file"], mimetype='image/png', etag=result["key"])
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
 
 @app.route('/api/viz/volcano', methods=['POST'])
 def viz_volcano():
     proc = VisualizationProcessor()
     data = request.json or {}
-    result = proc.volcano(data)
-    return jsonify(result)
+    result = proc.volcano(
+        data,
+        fc_threshold=float(data.get('fc_threshold', 1.0)),
+        pvalue_threshold=float(data.get('pvalue_threshold', 0.05)),
+        rasterize=data.get('rasterize'),
+        theme=data.get('theme', 'default'),
+        format=data.get('format', 'png')
+    )
+    return jsonify(_figure_result(result))
 
 @app.route('/api/viz/pca', methods=['POST'])
 def viz_pca():
     proc = VisualizationProcessor()
     data = request.json or {}
-    result = proc.pca_plot(data)
-    return jsonify(result)
+    result = proc.pca_plot(data, theme=data.get('theme', 'default'), format=data.get('format', 'png'))
+    return jsonify(_figure_result(result))
 
 if __name__ == '__main__':
     print("""